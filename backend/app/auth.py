@@ -1,17 +1,26 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, NamedTuple, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from app.database import get_db
 from app import models, schemas
+from app.services import phone_numbers
 import os
+import threading
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))
+# Caché del usuario autenticado: cuánto vive cada entrada (también acota lo que tarda otro proceso en
+# ver un cambio, porque la invalidación solo es local) y cuántas entradas como máximo (LRU).
+PRINCIPAL_CACHE_TTL = float(os.getenv("AUTH_PRINCIPAL_CACHE_TTL", "300"))
+PRINCIPAL_CACHE_MAX = max(1, int(os.getenv("AUTH_PRINCIPAL_CACHE_MAX", "10000")))
 
 # Usar pbkdf2_sha256 en lugar de bcrypt para evitar límite de 72 bytes
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
@@ -37,6 +46,92 @@ def get_password_hash(password: str) -> str:
     # pbkdf2_sha256 no tiene límite de longitud como bcrypt
     return pwd_context.hash(password)
 
+class Principal(NamedTuple):
+    """
+    Usuario autenticado que reciben los routers (inmutable, no es un objeto ORM: el caché vive entre
+    sesiones). Para modificar al usuario o leer otras columnas usar get_current_db_user.
+    """
+    id: int
+    email: str
+    name: str
+    family_id: Optional[int]
+    is_family_admin: bool
+    is_active: bool
+
+    @classmethod
+    def from_user(cls, user: models.User) -> "Principal":
+        return cls(user.id, user.email, user.name, user.family_id, bool(user.is_family_admin), user.is_active is not False)
+
+
+class _PrincipalCache:
+    """Caché TTL + LRU: ("uid", id) o ("email", email) de tokens viejos -> Principal."""
+
+    def __init__(self, maxsize: int = PRINCIPAL_CACHE_MAX):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Tuple[str, object], Tuple[float, Principal]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, object]) -> Optional[Principal]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Tuple[str, object], principal: Principal) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + PRINCIPAL_CACHE_TTL, principal)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[int] = None, email: Optional[str] = None) -> None:
+        """Olvida al usuario (por id y por email) o todo si no se indica ninguno."""
+        with self._lock:
+            if user_id is None and email is None:
+                self._data.clear()
+                return
+            emails = {email} if email else set()
+            entry = self._data.pop(("uid", user_id), None)
+            if entry is not None:
+                emails.add(entry[1].email)
+            for e in emails:
+                self._data.pop(("email", e), None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+principal_cache = _PrincipalCache()
+_PENDING_INVALIDATIONS = "auth_principal_invalidate"
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _user_changed(mapper, connection, target) -> None:
+    # Ya (para este proceso) y otra vez al confirmar: una petición concurrente pudo recargar el valor viejo.
+    # También el remitente de WhatsApp en caché (familia, activo o borrado; el cambio de teléfono ya lo olvida).
+    principal_cache.invalidate(target.id, target.email)
+    phone_numbers.invalidate(target.phone)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(_PENDING_INVALIDATIONS, set()).add((target.id, target.email, target.phone))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session: Session) -> None:
+    for user_id, email, phone in session.info.pop(_PENDING_INVALIDATIONS, ()):
+        principal_cache.invalidate(user_id, email)
+        phone_numbers.invalidate(phone)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     # Usar datetime.now() en lugar de utcnow() para mejor compatibilidad
@@ -49,6 +144,16 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_user_token(user: models.User, expires_delta: Optional[timedelta] = None) -> str:
+    """
+    Token con el id del usuario (`uid`) y `sub`=email (compatibilidad con clientes). Familia y permisos no
+    van en el token: get_current_user los lee del usuario (caché o BD) para que un cambio aplique de inmediato.
+    """
+    return create_access_token(
+        data={"sub": user.email, "uid": user.id},
+        expires_delta=expires_delta,
+    )
+
 def authenticate_user(db: Session, email: str, password: str):
     try:
         user = db.query(models.User).filter(models.User.email == email).first()
@@ -78,7 +183,12 @@ def authenticate_user(db: Session, email: str, password: str):
         print(traceback.format_exc())
         return False
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
+    """
+    Usuario del token sin consultar la BD en cada petición: el Principal sale del caché (invalidado al
+    actualizar/borrar el usuario); solo si no está se lee una vez por llave primaria (o por email si
+    el token es de antes de incluir `uid`).
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -86,13 +196,34 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = payload.get("uid")
         email: str = payload.get("sub")
-        if email is None:
+        if user_id is None and email is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(models.User).filter(models.User.email == email).first()
-    if user is None:
+    key = ("uid", user_id) if user_id is not None else ("email", email)
+    principal = principal_cache.get(key)
+    if principal is None:
+        if user_id is not None:
+            user = db.get(models.User, user_id)
+        else:
+            user = db.query(models.User).filter(models.User.email == email).first()
+        if user is None:
+            raise credentials_exception
+        principal = Principal.from_user(user)
+        principal_cache.put(key, principal)
+    if not principal.is_active:
         raise credentials_exception
-    return user
+    return principal
 
+def get_current_db_user(principal: Principal = Depends(get_current_user), db: Session = Depends(get_db)) -> models.User:
+    """El usuario autenticado como objeto ORM de la sesión (para endpoints que lo modifican o leen más columnas)."""
+    user = db.get(models.User, principal.id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
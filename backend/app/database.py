@@ -1,7 +1,9 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,17 +11,82 @@ load_dotenv()
 # Soporte para SQLite y PostgreSQL
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./domus_plus.db")
 
+# Pool de conexiones (por engine: el síncrono y el async tienen cada uno el suyo)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+
+def _async_url(url: str) -> str:
+    """URL con driver async: aiosqlite para SQLite, asyncpg para PostgreSQL."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith("postgresql:") or url.startswith("postgresql+psycopg2:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+
+def _pool_options(url: str) -> dict:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    # SQLite en memoria usa un pool de una sola conexión (no acepta tamaño ni overflow)
+    if ":memory:" not in url and "mode=memory" not in url:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+
 # Configuración especial para SQLite
 if DATABASE_URL.startswith("sqlite"):
     engine = create_engine(
         DATABASE_URL,
-        connect_args={"check_same_thread": False}  # Necesario para SQLite
+        connect_args={"check_same_thread": False},  # Necesario para SQLite
+        **_pool_options(DATABASE_URL)
     )
 else:
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(DATABASE_URL, **_pool_options(DATABASE_URL))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Engine async para los endpoints `async def` y los workers: las esperas a la BD ceden el event loop en
+# lugar de congelar todas las peticiones del worker. Se crea al primer uso, no al importar: un despliegue
+# con PostgreSQL sin asyncpg arranca igual y solo falla (con un mensaje claro) la primera ruta async.
+# expire_on_commit=False porque en async no hay carga perezosa de atributos después del commit.
+_async_engine: Optional[AsyncEngine] = None
+_async_sessionmaker: Optional[async_sessionmaker] = None
+
+
+def get_async_engine() -> AsyncEngine:
+    global _async_engine, _async_sessionmaker
+    if _async_engine is None:
+        try:
+            _async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_options(ASYNC_DATABASE_URL))
+        except ImportError as e:
+            raise RuntimeError(
+                f"Falta el driver async para {ASYNC_DATABASE_URL.split(':', 1)[0]} "
+                f"(PostgreSQL: pip install asyncpg; SQLite: pip install aiosqlite): {e}"
+            ) from e
+        _async_sessionmaker = async_sessionmaker(
+            _async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+    return _async_engine
+
+
+def AsyncSessionLocal() -> AsyncSession:
+    """Sesión async nueva (como SessionLocal() para la síncrona); crea el engine async si hace falta."""
+    get_async_engine()
+    return _async_sessionmaker()
+
+
+async def dispose_async_engine() -> None:
+    """Cierra las conexiones del pool async (si llegó a crearse)."""
+    if _async_engine is not None:
+        await _async_engine.dispose()
+
 Base = declarative_base()
 
 def get_db():
@@ -29,3 +96,11 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """
+    Sesión async para endpoints `async def`. El código ORM síncrono ya existente (servicios que reciben
+    Session) se reutiliza con `await db.run_sync(fn, ...)`: corre igual, pero cada consulta espera al
+    driver async sin bloquear el event loop.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
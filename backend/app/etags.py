@@ -0,0 +1,86 @@
+"""
+GET condicionales (ETag / If-None-Match) a partir de la versión de datos de la familia.
+
+El ETag es fuerte y se deriva de (endpoint, familia, versión de family_data_versions, parámetros[,
+usuario], día): mientras nada de la familia se escriba, la misma consulta produce el mismo JSON y el
+mismo ETag. Si el cliente manda ese ETag en If-None-Match se contesta 304 sin ejecutar el endpoint (ni
+consultas, ni armado, ni serialización); solo cuesta leer la versión por llave primaria.
+
+Se usa como decorador debajo de @router.get (y encima de @response_cache.cached si lo hay). Agrega
+Request y Response a la firma que ve FastAPI para leer el encabezado y poner el ETag en la respuesta.
+Usuarios sin familia no tienen versión: el endpoint se ejecuta normal, sin ETag.
+"""
+import functools
+import hashlib
+import inspect
+import json
+from datetime import date
+from typing import Any, Dict, Optional
+
+from fastapi import Request, Response
+
+from app.services import family_versions
+
+_CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(endpoint: str, family_id: int, version: int, params: Dict[str, Any],
+              user_id: Optional[int] = None) -> str:
+    raw = json.dumps(
+        [endpoint, family_id, version, user_id, date.today().isoformat(), params], sort_keys=True, default=str
+    )
+    return '"' + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110): lista separada por comas, W/ opcional, o *."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def conditional(endpoint: str, per_user: bool = False):
+    """
+    Decorador para GET con `db` y `current_user`. Los demás parámetros del endpoint entran en el ETag;
+    per_user=True para listados que dependen de quién pregunta y no solo de su familia.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        extra = [
+            inspect.Parameter("etag_request", inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+            inspect.Parameter("etag_response", inspect.Parameter.KEYWORD_ONLY, annotation=Response),
+        ]
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            request: Request = kwargs.pop("etag_request")
+            response: Response = kwargs.pop("etag_response")
+            db = kwargs.get("db")
+            current_user = kwargs.get("current_user")
+            family_id = getattr(current_user, "family_id", None)
+            if db is None or family_id is None:
+                return fn(*args, **kwargs)
+            params = {k: v for k, v in kwargs.items() if k not in ("db", "current_user")}
+            etag = make_etag(
+                endpoint, family_id, family_versions.current(db, family_id), params,
+                current_user.id if per_user else None,
+            )
+            headers = {"ETag": etag, "Cache-Control": _CACHE_CONTROL, "Vary": "Authorization"}
+            if matches(request.headers.get("if-none-match"), etag):
+                return Response(status_code=304, headers=headers)
+            result = fn(*args, **kwargs)
+            response.headers.update(headers)
+            return result
+
+        # FastAPI lee __signature__ (no sigue __wrapped__ si existe)
+        wrapper.__signature__ = signature.replace(parameters=[*signature.parameters.values(), *extra])
+        return wrapper
+    return decorator
@@ -1,10 +1,12 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException
 import os
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-from app.database import engine, Base
+from app.database import engine, dispose_async_engine, Base
 from app.routers import users, families, transactions
+from app import auth
 
 # Presupuestos (budgets) - puede fallar por ForwardRef en schemas
 try:
@@ -26,16 +28,52 @@ except ImportError:
 # Crear tablas
 Base.metadata.create_all(bind=engine)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Monitor del event loop (lag y, con LOOP_MONITOR_DEBUG=1, pila de callbacks que lo bloquean)
+    from app.services import loop_monitor
+    await loop_monitor.start()
+    # Cola de procesamiento de recibos en segundo plano (solo si el router de recibos está activo)
+    receipt_jobs = None
+    whatsapp_inbox = None
+    if WHATSAPP_AVAILABLE and not DISABLE_WHATSAPP:
+        from app.services import receipt_jobs
+        await receipt_jobs.start()
+        # Bandeja de mensajes de WhatsApp: el webhook solo encola, los workers procesan y encolan la
+        # respuesta en la bandeja de salida (que también arranca aquí)
+        from app.services import whatsapp_inbox
+        await whatsapp_inbox.start()
+        from app.services import receipt_images
+        receipt_images.warmup()
+    yield
+    if whatsapp_inbox is not None:
+        await whatsapp_inbox.stop()
+        # Después de la bandeja de entrada: sus últimas respuestas ya quedaron encoladas
+        from app.services import whatsapp_outbox
+        await whatsapp_outbox.stop()
+    if receipt_jobs is not None:
+        await receipt_jobs.stop()
+        # Cerrar los clientes OpenAI compartidos (pool de conexiones keep-alive)
+        from app.services import receipt_processor
+        await receipt_processor.aclose_clients()
+        # Cerrar el pool de procesos de imágenes
+        from app.services import receipt_images
+        receipt_images.shutdown()
+    # Cerrar las conexiones del pool async
+    await dispose_async_engine()
+    await loop_monitor.stop()
+
 app = FastAPI(
     title="DOMUS+ API",
     description="Sistema de Presupuesto Anual Doméstico",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Static files: uploads (imágenes de recibos, etc.)
 try:
     backend_dir = Path(__file__).resolve().parent.parent  # .../backend
-    uploads_dir = backend_dir / "uploads"
+    uploads_dir = Path(os.getenv("UPLOADS_DIR") or backend_dir / "uploads")
     uploads_dir.mkdir(parents=True, exist_ok=True)
     app.mount("/uploads", StaticFiles(directory=str(uploads_dir)), name="uploads")
 except Exception as e:
@@ -61,6 +99,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],  # El frontend guarda el ETag para mandar If-None-Match
 )
 
 # Routers
@@ -77,6 +116,13 @@ else:
     print("⚠️  Router 'budgets' no incluido (import falló). Revisa schemas.py para ForwardRefs.")
 app.include_router(transactions.router, prefix="/api/transactions", tags=["transactions"])
 
+# Router de sincronización incremental (cliente móvil)
+try:
+    from app.routers import sync
+    app.include_router(sync.router, prefix="/api/sync", tags=["sync"])
+except ImportError as e:
+    print(f"⚠️  Sync router no disponible: {e}")
+
 # Router de presupuestos personales
 try:
     from app.routers import personal_budgets
@@ -154,3 +200,27 @@ async def root():
 async def health():
     return {"status": "ok"}
 
+def require_metrics_access(current_user: auth.Principal = Depends(auth.get_current_user)) -> auth.Principal:
+    """Las métricas son del proceso completo (trazas del event loop, rutas del caché): solo administradores."""
+    if not current_user.is_family_admin:
+        raise HTTPException(status_code=403, detail="Solo los administradores pueden ver métricas")
+    return current_user
+
+@app.get("/api/metrics/openai", dependencies=[Depends(require_metrics_access)])
+async def openai_metrics():
+    """Gobernador de OpenAI: profundidad de cola y espera por carril, cubetas RPM/TPM."""
+    from app.services import openai_governor
+    return openai_governor.metrics()
+
+@app.get("/api/metrics/event-loop", dependencies=[Depends(require_metrics_access)])
+async def event_loop_metrics():
+    """Lag del event loop (p50/p90/p99/máx de las muestras recientes) y bloqueos por encima del umbral."""
+    from app.services import loop_monitor
+    return loop_monitor.metrics()
+
+@app.get("/api/metrics/response-cache", dependencies=[Depends(require_metrics_access)])
+def response_cache_metrics():
+    """Caché de respuestas por familia: aciertos, fallos y hit ratio por endpoint, y tamaño del backend."""
+    from app.services import response_cache
+    return response_cache.stats()
+
@@ -1,7 +1,9 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Enum as SQLEnum, JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Enum as SQLEnum, JSON, Index, UniqueConstraint
+from sqlalchemy.orm import relationship, validates
 from sqlalchemy.sql import func
 from app.database import Base
+from app.services import phone_numbers, spending_rollups  # spending_rollups registra los eventos que mantienen monthly_spending
+from app.services import family_versions  # registra los eventos que suben la versión de datos de cada familia
 import enum
 
 class TransactionStatus(str, enum.Enum):
@@ -128,6 +130,8 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True, nullable=False)
     phone = Column(String, unique=True, index=True, nullable=False)  # WhatsApp number
+    phone_e164 = Column(String, index=True, nullable=True)  # Número canónico (+52XXXXXXXXXX), se llena al asignar phone
+    phone_last10 = Column(String(10), index=True, nullable=True)  # Últimos 10 dígitos (búsqueda del remitente de WhatsApp)
     name = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
     is_active = Column(Boolean, default=True)
@@ -141,6 +145,14 @@ class User(Base):
     transactions = relationship("Transaction", back_populates="user")
     receipts = relationship("Receipt", back_populates="user")
 
+    @validates("phone")
+    def _fill_phone_keys(self, key, value):
+        # Mantener las llaves normalizadas en sync con phone y olvidar el remitente en caché
+        phone_numbers.invalidate(self.phone, value)
+        self.phone_e164 = phone_numbers.normalize_phone(value)
+        self.phone_last10 = phone_numbers.phone_last10(value)
+        return value
+
 class Family(Base):
     __tablename__ = "families"
     
@@ -271,6 +283,109 @@ class Transaction(Base):
     
     user = relationship("User", back_populates="transactions")
 
+    __table_args__ = (
+        Index("ix_transactions_user_date", "user_id", "date"),  # Últimos movimientos de un usuario
+    )
+
+class MonthlySpending(Base):
+    """
+    Agregado mensual de transacciones por (usuario, año, mes, categoría, subcategoría), con la familia
+    del usuario. Se actualiza en la misma transacción que cada alta/cambio/baja de Transaction
+    (app/services/spending_rollups.py); rebuild_rollups.py lo recalcula completo.
+    Categoría/subcategoría guardan el nombre del enum como en transactions ("" si no hay) y las
+    personalizadas su id (0 si no hay), para que la llave única no tenga NULLs.
+    """
+    __tablename__ = "monthly_spending"
+
+    id = Column(Integer, primary_key=True, index=True)
+    family_id = Column(Integer, ForeignKey("families.id"), nullable=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    category = Column(String(60), nullable=False, default="")
+    subcategory = Column(String(80), nullable=False, default="")
+    custom_category_id = Column(Integer, nullable=False, default=0)
+    custom_subcategory_id = Column(Integer, nullable=False, default=0)
+    expense_total = Column(Float, nullable=False, default=0.0)
+    income_total = Column(Float, nullable=False, default=0.0)
+    expense_count = Column(Integer, nullable=False, default=0)
+    income_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint(
+            "user_id", "year", "month", "category", "subcategory", "custom_category_id", "custom_subcategory_id",
+            name="uq_monthly_spending_key",
+        ),
+        Index("ix_monthly_spending_family_period", "family_id", "year", "month"),
+    )
+
+class BudgetRollup(Base):
+    """
+    Agregado mensual de transacciones por (presupuesto familiar, usuario, año, mes), con la familia del
+    presupuesto. Lo mantiene app/services/spending_rollups.py en la misma transacción que cada
+    alta/cambio/baja de Transaction con family_budget_id (junto con user_budgets.spent_amount);
+    rebuild_rollups.py lo recalcula completo.
+    """
+    __tablename__ = "budget_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    family_budget_id = Column(Integer, ForeignKey("family_budgets.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    family_id = Column(Integer, ForeignKey("families.id"), nullable=True)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    expense_total = Column(Float, nullable=False, default=0.0)
+    income_total = Column(Float, nullable=False, default=0.0)
+    expense_count = Column(Integer, nullable=False, default=0)
+    income_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("family_budget_id", "user_id", "year", "month", name="uq_budget_rollups_key"),
+        Index("ix_budget_rollups_user_period", "user_id", "year", "month"),
+        Index("ix_budget_rollups_family_period", "family_id", "year", "month"),
+    )
+
+class FamilyDataVersion(Base):
+    """
+    Versión de los datos de una familia: sube en la misma transacción que cualquier escritura a sus
+    presupuestos, asignaciones, transacciones, recibos, categorías personalizadas o miembros
+    (app/services/family_versions.py). La usan la caché de respuestas, los ETag y, como secuencia de
+    cambios, la sincronización incremental (sync_changes).
+    """
+    __tablename__ = "family_data_versions"
+
+    family_id = Column(Integer, ForeignKey("families.id"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class SyncChange(Base):
+    """
+    Último cambio de cada entidad sincronizable de una familia (transacciones, recibos y sus conceptos,
+    presupuestos, asignaciones, categorías y subcategorías personalizadas): una fila por (familia,
+    entidad, id) con la secuencia de family_data_versions en la que cambió, si fue borrada (tombstone) y,
+    en lo que es de un solo miembro, quiénes han sido sus dueños.
+    Lo mantiene app/services/sync_log.py en la misma transacción que la escritura; GET /api/sync lo lee.
+    """
+    __tablename__ = "sync_changes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    family_id = Column(Integer, ForeignKey("families.id"), nullable=False)
+    entity = Column(String(32), nullable=False)  # transactions, receipts, receipt_items, ...
+    entity_id = Column(Integer, nullable=False)
+    seq = Column(Integer, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    # Transacciones, recibos y conceptos: usuarios que han sido dueños (",3,7,"); el feed de cada
+    # miembro solo incluye lo suyo y lo que dejó de serlo (reasignado o borrado)
+    user_ids = Column(String, nullable=True)
+    changed_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("family_id", "entity", "entity_id", name="uq_sync_changes_entity"),
+        Index("ix_sync_changes_family_seq", "family_id", "seq"),
+    )
+
 class Receipt(Base):
     __tablename__ = "receipts"
     
@@ -324,6 +439,135 @@ class ReceiptItem(Base):
     receipt = relationship("Receipt", back_populates="items")
     assigned_transaction = relationship("Transaction", foreign_keys=[assigned_transaction_id])
 
+class ReceiptJobStatus(str, enum.Enum):
+    QUEUED = "queued"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+class ReceiptJob(Base):
+    """
+    Trabajo de procesamiento de recibos en segundo plano (cola persistente).
+    Las imágenes se guardan en disco (uploads/receipt_jobs/<id>/) y aquí solo su ruta.
+    """
+    __tablename__ = "receipt_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)  # Usuario que subió el recibo
+    assigned_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # Usuario al que se asigna el recibo
+    status = Column(String(20), default=ReceiptJobStatus.QUEUED.value, nullable=False, index=True)
+    mode = Column(String(20), default="precise", nullable=True)
+    files = Column(JSON, nullable=True)  # [{"path": ..., "filename": ..., "content_type": ...}]
+    base_url = Column(String, nullable=True)  # Para construir image_url del recibo
+    progress = Column(JSON, nullable=True)  # Avance por parte: {"parts_total", "parts_done", "parts": [...]}
+    result = Column(JSON, nullable=True)  # parts_status / totals_status del pipeline
+    receipt_id = Column(Integer, ForeignKey("receipts.id"), nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    
+    receipt = relationship("Receipt", foreign_keys=[receipt_id])
+
+class ReceiptTile(Base):
+    """
+    Resultado de extracción por parte (tile) de un recibo: permite re-extraer solo las partes dudosas
+    (fallidas, no legibles o con cantidad × precio ≠ total) y volver a combinar sin repetir todo el recibo.
+    La imagen de la parte se guarda en disco (uploads/receipt_tiles/<receipt_id>/) y aquí solo su ruta.
+    """
+    __tablename__ = "receipt_tiles"
+
+    id = Column(Integer, primary_key=True, index=True)
+    receipt_id = Column(Integer, ForeignKey("receipts.id"), nullable=False, index=True)
+    kind = Column(String(20), default="items", nullable=False)  # items | totals (recorte del pie)
+    file_index = Column(Integer, default=1, nullable=False)  # Imagen subida (1..n)
+    part_index = Column(Integer, default=1, nullable=False)  # Parte dentro de la imagen (0 = pie)
+    image_path = Column(String, nullable=True)
+    image_format = Column(String(10), nullable=True)
+    top = Column(Integer, nullable=True)  # Offsets en pixeles dentro de la imagen redimensionada
+    bottom = Column(Integer, nullable=True)
+    mode = Column(String(20), nullable=True)  # Modo con el que se extrajo (fast/precise/text)
+    method = Column(String(30), nullable=True)  # structured | transcribe | transcribe_fallback | reextract
+    ok = Column(Boolean, default=False, nullable=False)
+    skipped = Column(Boolean, default=False, nullable=False)  # Omitida por cierre anticipado (items ya cuadraban)
+    attempts = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)  # Respuesta RAW del modelo (JSON de items/totales o texto transcrito)
+    items = Column(JSON, nullable=True)  # Renglones normalizados de la parte (None = falló o vino vacía)
+    issues = Column(JSON, nullable=True)  # Motivos de inconsistencia detectados
+    reextract_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    receipt = relationship("Receipt", foreign_keys=[receipt_id])
+
+class WhatsAppMessageStatus(str, enum.Enum):
+    RECEIVED = "received"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+class WhatsAppMessage(Base):
+    """
+    Mensaje entrante de WhatsApp (Twilio). El webhook lo guarda y responde de inmediato con TwiML vacío;
+    un worker en segundo plano lo procesa y deja la respuesta en la bandeja de salida (whatsapp_outbox).
+    Los comandos de texto se guardan ya contestados. MessageSid es único: un reintento nunca crea otro registro.
+    """
+    __tablename__ = "whatsapp_messages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_sid = Column(String, nullable=False, unique=True, index=True)  # MessageSid de Twilio (idempotencia)
+    phone = Column(String, nullable=False)  # Número normalizado del remitente (+52...)
+    from_number = Column(String, nullable=True)  # Número tal cual lo envió Twilio (para responder)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
+    body = Column(Text, nullable=True)
+    media = Column(JSON, nullable=True)  # [{"url": ..., "content_type": ...}] (MediaUrl0..3)
+    status = Column(String(20), default=WhatsAppMessageStatus.RECEIVED.value, nullable=False, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    receipt_id = Column(Integer, ForeignKey("receipts.id"), nullable=True)
+    reply = Column(Text, nullable=True)  # Respuesta enviada (o que se intentó enviar) al usuario
+    reply_sent = Column(Boolean, default=False, nullable=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    user = relationship("User", foreign_keys=[user_id])
+    receipt = relationship("Receipt", foreign_keys=[receipt_id])
+
+class WhatsAppOutboundStatus(str, enum.Enum):
+    QUEUED = "queued"
+    SENDING = "sending"
+    SENT = "sent"  # Aceptado por Twilio (la entrega real llega en delivery_status)
+    FAILED = "failed"
+
+class WhatsAppOutbound(Base):
+    """
+    Mensaje de salida de WhatsApp. Quien necesita avisar algo solo inserta aquí; el worker de
+    whatsapp_outbox lo envía respetando el ritmo de Twilio, reintenta con backoff y guarda el estado
+    de entrega que Twilio reporta en el status callback.
+    """
+    __tablename__ = "whatsapp_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    to_number = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    kind = Column(String(30), nullable=False, default="reply")  # reply, alert, digest...
+    dedup_key = Column(String, nullable=True, unique=True, index=True)  # Evita encolar dos veces el mismo aviso
+    message_sid = Column(String, nullable=True, index=True)  # MessageSid del mensaje entrante que se contesta
+    status = Column(String(20), default=WhatsAppOutboundStatus.QUEUED.value, nullable=False, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    twilio_sid = Column(String, nullable=True, index=True)  # SID del mensaje enviado (para el status callback)
+    delivery_status = Column(String(20), nullable=True)  # queued/sent/delivered/read/undelivered/failed (Twilio)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
 class ActivityLog(Base):
     __tablename__ = "activity_logs"
     
@@ -22,7 +22,7 @@ def get_activity_logs(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene los logs de actividad del sistema.
@@ -73,7 +73,7 @@ def get_activity_logs(
 def get_activity_stats(
     days: int = Query(30, ge=1, le=365),
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene estadísticas de actividad del sistema.
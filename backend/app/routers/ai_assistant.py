@@ -27,7 +27,7 @@ class AnalysisRequest(BaseModel):
 def chat_with_assistant(
     chat_message: ChatMessage,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Chatea con el asistente de IA.
@@ -126,7 +126,7 @@ def chat_with_assistant(
 def analyze_budget(
     request: AnalysisRequest,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Analiza la situación del presupuesto y proporciona insights.
@@ -213,7 +213,7 @@ def suggest_category(
     description: str,
     amount: float,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Sugiere una categoría y subcategoría para una transacción.
@@ -248,7 +248,7 @@ def detect_anomalies(
     budget_id: Optional[int] = None,
     limit: int = 50,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Detecta anomalías en los gastos (gastos inusuales, patrones sospechosos).
@@ -311,7 +311,7 @@ def predict_expenses(
     months_ahead: int = 3,
     budget_id: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Predice gastos futuros basado en patrones históricos.
@@ -368,7 +368,7 @@ def generate_report(
     period: str = "mensual",
     budget_id: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Genera un reporte narrativo inteligente sobre la situación financiera.
@@ -441,7 +441,7 @@ def generate_report(
 @router.post("/optimize-budget")
 def optimize_budget(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Sugiere optimizaciones en la asignación de presupuesto basado en gastos reales.
@@ -1,17 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 from app.database import get_db
-from app import models, schemas, auth
-from app.services import activity_logger
+from app import models, schemas, auth, etags
+from app.services import activity_logger, response_cache, spending_rollups
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 from sqlalchemy.orm import joinedload
 
 router = APIRouter()
 
 @router.post("/family", response_model=schemas.FamilyBudgetResponse)
-def create_family_budget(budget: schemas.FamilyBudgetCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def create_family_budget(budget: schemas.FamilyBudgetCreate, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     try:
         # Verificar que el usuario pertenezca a una familia
         if not current_user.family_id:
@@ -162,7 +161,9 @@ def create_family_budget(budget: schemas.FamilyBudgetCreate, db: Session = Depen
         raise HTTPException(status_code=500, detail=f"Error al crear presupuesto familiar: {str(e)}")
 
 @router.get("/family", response_model=List[schemas.FamilyBudgetResponse])
-def get_family_budgets(year: Optional[int] = None, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+@etags.conditional("budgets.family")
+@response_cache.cached("budgets.family", response_model=List[schemas.FamilyBudgetResponse])
+def get_family_budgets(year: Optional[int] = None, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     if not current_user.family_id:
         raise HTTPException(status_code=400, detail="Usuario no pertenece a una familia")
     
@@ -176,43 +177,15 @@ def get_family_budgets(year: Optional[int] = None, db: Session = Depends(get_db)
         
         budgets = query.all()
         
-        # Optimización: Obtener todos los income_amounts en una sola consulta agregada
-        if budgets:
-            budget_ids = [b.id for b in budgets]
-            user_budget_ids = []
-            for budget in budgets:
-                if budget.user_allocations:
-                    for user_budget in budget.user_allocations:
-                        user_budget_ids.append((budget.id, user_budget.user_id))
-            
-            # Consulta agregada única para todos los income_amounts
-            income_totals = {}
-            if user_budget_ids:
-                # Crear una consulta que agrupe por family_budget_id y user_id
-                income_results = db.query(
-                    models.Transaction.family_budget_id,
-                    models.Transaction.user_id,
-                    func.sum(models.Transaction.amount).label('total_income')
-                ).filter(
-                    models.Transaction.family_budget_id.in_(budget_ids),
-                    models.Transaction.transaction_type == models.TransactionType.INCOME.value
-                ).group_by(
-                    models.Transaction.family_budget_id,
-                    models.Transaction.user_id
-                ).all()
-                
-                # Crear diccionario para acceso rápido: (budget_id, user_id) -> total_income
-                for result in income_results:
-                    key = (result.family_budget_id, result.user_id)
-                    income_totals[key] = float(result.total_income) if result.total_income else 0.0
+        # Ingresos por (presupuesto, usuario) desde budget_rollups en una sola consulta agregada
+        totals = spending_rollups.budget_totals(db, [b.id for b in budgets], by_user=True)
         
         # Calcular available_amount para cada UserBudget usando los datos pre-calculados
         for budget in budgets:
             if budget.user_allocations:
                 for user_budget in budget.user_allocations:
-                    # Obtener income_amount del diccionario pre-calculado
                     key = (budget.id, user_budget.user_id)
-                    income_amount = income_totals.get(key, 0.0)
+                    income_amount = totals.get(key, {}).get("income", 0.0)
                     
                     # Calcular available_amount
                     user_budget.available_amount = user_budget.allocated_amount + income_amount - (user_budget.spent_amount or 0.0)
@@ -227,7 +200,7 @@ def get_family_budgets(year: Optional[int] = None, db: Session = Depends(get_db)
         raise HTTPException(status_code=500, detail=error_detail)
 
 @router.post("/user", response_model=schemas.UserBudgetResponse)
-def create_user_budget(budget: schemas.UserBudgetCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def create_user_budget(budget: schemas.UserBudgetCreate, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     try:
         # Verificar que el presupuesto familiar exista
         family_budget = db.query(models.FamilyBudget).filter(models.FamilyBudget.id == budget.family_budget_id).first()
@@ -282,7 +255,8 @@ def create_user_budget(budget: schemas.UserBudgetCreate, db: Session = Depends(g
         raise HTTPException(status_code=500, detail=f"Error al crear presupuesto de usuario: {str(e)}")
 
 @router.get("/user", response_model=List[schemas.UserBudgetResponse])
-def get_user_budgets(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+@etags.conditional("budgets.user", per_user=True)
+def get_user_budgets(db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     budgets = db.query(models.UserBudget).options(
         joinedload(models.UserBudget.family_budget),
         joinedload(models.UserBudget.user)
@@ -301,7 +275,7 @@ def get_user_budgets(db: Session = Depends(get_db), current_user: models.User =
 def distribute_budget(
     budget_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Distribuye un presupuesto familiar entre todos los miembros de la familia.
@@ -371,7 +345,7 @@ def update_family_budget(
     budget_id: int,
     budget: schemas.FamilyBudgetCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza un presupuesto familiar existente.
@@ -462,10 +436,12 @@ def update_family_budget(
         raise HTTPException(status_code=500, detail=f"Error al actualizar presupuesto: {str(e)}")
 
 @router.get("/global-summary")
+@etags.conditional("budgets.global_summary")
+@response_cache.cached("budgets.global_summary")
 def get_global_budget_summary(
     year: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Devuelve un resumen del presupuesto global que incluye:
@@ -553,11 +529,45 @@ def get_global_budget_summary(
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=error_detail)
 
+# Meses en español y en inglés (llaves de monthly_amounts, como vienen del Excel)
+MESES_ES = [
+    'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
+    'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'
+]
+MESES_EN = [
+    'JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY', 'JUNE',
+    'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER', 'NOVEMBER', 'DECEMBER'
+]
+
+
+def _planned_months(budget: models.FamilyBudget) -> List[float]:
+    """Presupuesto de cada mes (enero a diciembre): monthly_amounts si hay, si no el total entre 12."""
+    monthly_amounts_dict = None
+    if budget.monthly_amounts:
+        # SQLite puede guardar JSON como string, necesitamos parsearlo
+        if isinstance(budget.monthly_amounts, str):
+            import json
+            try:
+                monthly_amounts_dict = json.loads(budget.monthly_amounts)
+            except:
+                monthly_amounts_dict = None
+        elif isinstance(budget.monthly_amounts, dict):
+            monthly_amounts_dict = budget.monthly_amounts
+    
+    if not monthly_amounts_dict:
+        return [budget.total_amount / 12.0] * 12
+    by_month = {str(mes_en).upper(): float(monto or 0) for mes_en, monto in monthly_amounts_dict.items()}
+    # Meses faltantes en 0
+    return [by_month.get(mes_en, 0.0) for mes_en in MESES_EN]
+
+
 @router.get("/annual-matrix")
+@etags.conditional("budgets.annual_matrix")
+@response_cache.cached("budgets.annual_matrix")
 def get_annual_budget_matrix(
     year: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Devuelve el presupuesto anual en formato de matriz (tabla pivot).
@@ -580,18 +590,7 @@ def get_annual_budget_matrix(
             models.FamilyBudget.subcategory
         ).all()
         
-        # Meses en español
-        meses_es = [
-            'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
-            'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'
-        ]
-        
-        # Mapeo de meses en inglés (del Excel) a español
-        meses_en = [
-            'JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY', 'JUNE',
-            'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER', 'NOVEMBER', 'DECEMBER'
-        ]
-        mes_mapping = dict(zip(meses_en, meses_es))
+        meses_es = MESES_ES
         
         # Construir la matriz
         matrix = []
@@ -607,36 +606,10 @@ def get_annual_budget_matrix(
                 'meses': {}
             }
             
-            # Usar montos mensuales reales si están disponibles, sino dividir el total entre 12
-            monthly_amounts_dict = None
-            if budget.monthly_amounts:
-                # SQLite puede guardar JSON como string, necesitamos parsearlo
-                if isinstance(budget.monthly_amounts, str):
-                    import json
-                    try:
-                        monthly_amounts_dict = json.loads(budget.monthly_amounts)
-                    except:
-                        monthly_amounts_dict = None
-                elif isinstance(budget.monthly_amounts, dict):
-                    monthly_amounts_dict = budget.monthly_amounts
-            
-            if monthly_amounts_dict and len(monthly_amounts_dict) > 0:
-                # Hay montos mensuales reales del Excel
-                for mes_en, monto in monthly_amounts_dict.items():
-                    mes_es = mes_mapping.get(mes_en.upper(), None)
-                    if mes_es:
-                        row['meses'][mes_es] = round(float(monto), 2)
-                        totales_mensuales[mes_es] += float(monto)
-                # Rellenar meses faltantes con 0
-                for mes_es in meses_es:
-                    if mes_es not in row['meses']:
-                        row['meses'][mes_es] = 0.0
-            else:
-                # No hay montos mensuales o solo hay un mes, dividir el total entre 12
-                monto_mensual = budget.total_amount / 12.0
-                for mes_es in meses_es:
-                    row['meses'][mes_es] = round(monto_mensual, 2)
-                    totales_mensuales[mes_es] += monto_mensual
+            # Montos mensuales reales si están disponibles, sino el total entre 12
+            for mes_es, monto in zip(meses_es, _planned_months(budget)):
+                row['meses'][mes_es] = round(monto, 2)
+                totales_mensuales[mes_es] += monto
             
             # Total anual para este concepto
             row['total_anual'] = round(budget.total_amount, 2)
@@ -667,11 +640,164 @@ def get_annual_budget_matrix(
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=error_detail)
 
+@router.get("/budget-vs-actual")
+@etags.conditional("budgets.budget_vs_actual")
+@response_cache.cached("budgets.budget_vs_actual")
+def get_budget_vs_actual_matrix(
+    year: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user)
+):
+    """
+    Matriz anual presupuesto vs. real. Cada fila es un concepto (categoría-subcategoría) y cada mes trae
+    lo presupuestado, lo gastado (egresos), los ingresos y la diferencia. Lo real sale del agregado
+    mensual (monthly_spending) en una sola consulta por índice; los conceptos con movimientos pero sin
+    presupuesto se agregan al final con sin_presupuesto=True.
+    """
+    if not current_user.family_id:
+        raise HTTPException(status_code=400, detail="Usuario no pertenece a una familia")
+    
+    try:
+        if not year:
+            year = datetime.now().year
+        
+        budgets = db.query(models.FamilyBudget).filter(
+            models.FamilyBudget.family_id == current_user.family_id,
+            models.FamilyBudget.year == year
+        ).order_by(
+            models.FamilyBudget.category,
+            models.FamilyBudget.subcategory
+        ).all()
+        actual = spending_rollups.year_totals(db, year, family_id=current_user.family_id)
+        
+        # Nombres de categorías/subcategorías personalizadas que aparecen en la matriz
+        custom_category_ids = {b.custom_category_id for b in budgets if b.custom_category_id}
+        custom_category_ids |= {r['custom_category_id'] for r in actual if r['custom_category_id']}
+        custom_subcategory_ids = {b.custom_subcategory_id for b in budgets if b.custom_subcategory_id}
+        custom_subcategory_ids |= {r['custom_subcategory_id'] for r in actual if r['custom_subcategory_id']}
+        custom_names = {}
+        if custom_category_ids:
+            custom_names.update(
+                (('category', c.id), c.name) for c in db.query(models.CustomCategory).filter(
+                    models.CustomCategory.id.in_(custom_category_ids)
+                ).all()
+            )
+        if custom_subcategory_ids:
+            custom_names.update(
+                (('subcategory', s.id), s.name) for s in db.query(models.CustomSubcategory).filter(
+                    models.CustomSubcategory.id.in_(custom_subcategory_ids)
+                ).all()
+            )
+        
+        def enum_label(name, enum_cls):
+            return enum_cls[name].value if name in enum_cls.__members__ else (name or '')
+        
+        def new_row(key, category, subcategory, custom_category_id, custom_subcategory_id, budgeted):
+            if key[0] == 'custom':
+                categoria = custom_names.get(('category', custom_category_id), '')
+                subcategoria = custom_names.get(('subcategory', custom_subcategory_id), '')
+            else:
+                categoria = enum_label(category, models.Category) or 'Sin categoría'
+                subcategoria = enum_label(subcategory, models.Subcategory)
+            return {
+                'concepto': f"{categoria} - {subcategoria}" if subcategoria else categoria,
+                'categoria': categoria,
+                'subcategoria': subcategoria,
+                'custom_category_id': custom_category_id,
+                'custom_subcategory_id': custom_subcategory_id,
+                'sin_presupuesto': not budgeted,
+                'presupuestado': [0.0] * 12,
+                'real': [0.0] * 12,
+                'ingresos': [0.0] * 12,
+            }
+        
+        # Conceptos presupuestados (varias cuentas del mismo concepto se suman en una fila). Las cuentas
+        # con categoría personalizada se identifican por ella; las demás por categoría y subcategoría.
+        rows = {}
+        for budget in budgets:
+            category = budget.category.name if budget.category else ''
+            subcategory = budget.subcategory.name if budget.subcategory else ''
+            if budget.custom_category_id:
+                key = ('custom', budget.custom_category_id, budget.custom_subcategory_id or 0)
+            else:
+                key = ('enum', category, subcategory)
+            if key not in rows:
+                rows[key] = new_row(key, category, subcategory, budget.custom_category_id,
+                                    budget.custom_subcategory_id, True)
+            for i, monto in enumerate(_planned_months(budget)):
+                rows[key]['presupuestado'][i] += monto
+        
+        # Lo real de cada mes va al concepto presupuestado que le corresponde (primero por categoría
+        # personalizada, luego por categoría y subcategoría); si no hay, a una fila sin presupuesto
+        unbudgeted = {}
+        for r in actual:
+            candidates = []
+            if r['custom_category_id']:
+                candidates.append(('custom', r['custom_category_id'], r['custom_subcategory_id'] or 0))
+            candidates.append(('enum', r['category'], r['subcategory']))
+            key = next((k for k in candidates if k in rows), None)
+            if key is None:
+                key = candidates[0]
+                if key not in unbudgeted:
+                    unbudgeted[key] = new_row(key, r['category'], r['subcategory'], r['custom_category_id'],
+                                              r['custom_subcategory_id'], False)
+                row = unbudgeted[key]
+            else:
+                row = rows[key]
+            row['real'][r['month'] - 1] += r['expense']
+            row['ingresos'][r['month'] - 1] += r['income']
+        
+        def render(row):
+            meses = {}
+            for i, mes in enumerate(MESES_ES):
+                meses[mes] = {
+                    'presupuestado': round(row['presupuestado'][i], 2),
+                    'real': round(row['real'][i], 2),
+                    'ingresos': round(row['ingresos'][i], 2),
+                    'diferencia': round(row['presupuestado'][i] - row['real'][i], 2),
+                }
+            total_presupuestado = sum(row['presupuestado'])
+            total_real = sum(row['real'])
+            rendered = {k: v for k, v in row.items() if k not in ('presupuestado', 'real', 'ingresos')}
+            rendered.update(
+                meses=meses,
+                total_presupuestado=round(total_presupuestado, 2),
+                total_real=round(total_real, 2),
+                total_ingresos=round(sum(row['ingresos']), 2),
+                diferencia=round(total_presupuestado - total_real, 2),
+                porcentaje_ejercido=round(total_real / total_presupuestado * 100, 1) if total_presupuestado > 0 else None,
+            )
+            return rendered
+        
+        ordered = list(rows.values()) + sorted(unbudgeted.values(), key=lambda row: sum(row['real']), reverse=True)
+        totals = new_row(('total',), '', '', None, None, True)
+        for row in ordered:
+            for field in ('presupuestado', 'real', 'ingresos'):
+                totals[field] = [a + b for a, b in zip(totals[field], row[field])]
+        totals_row = render(totals)
+        totals_row.update(concepto='TOTAL', categoria='', subcategoria='', sin_presupuesto=False)
+        
+        return {
+            'year': year,
+            'meses': MESES_ES,
+            'matrix': [render(row) for row in ordered] + [totals_row],
+            'total_conceptos': len(ordered),
+            'conceptos_sin_presupuesto': len(unbudgeted)
+        }
+    except Exception as e:
+        import traceback
+        error_detail = f"Error al obtener matriz presupuesto vs. real: {str(e)}"
+        print(error_detail)
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=error_detail)
+
 @router.get("/summary")
+@etags.conditional("budgets.summary")
+@response_cache.cached("budgets.summary")
 def get_budget_summary(
     year: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene un concentrado completo del presupuesto anual con todas las cuentas.
@@ -693,6 +819,25 @@ def get_budget_summary(
             models.FamilyBudget.year == year
         ).all()
         
+        # Totales de todas las cuentas desde budget_rollups (una consulta) y sus movimientos en otra
+        budget_ids = [b.id for b in budgets]
+        totals = spending_rollups.budget_totals(db, budget_ids)
+        movements_by_budget = {}
+        if budget_ids:
+            transactions = db.query(models.Transaction).filter(
+                models.Transaction.family_budget_id.in_(budget_ids)
+            ).order_by(models.Transaction.date).all()
+            for transaction in transactions:
+                movements_by_budget.setdefault(transaction.family_budget_id, []).append({
+                    'id': transaction.id,
+                    'date': transaction.date.isoformat() if transaction.date else None,
+                    'amount': transaction.amount,
+                    'type': transaction.transaction_type,
+                    'merchant_or_beneficiary': transaction.merchant_or_beneficiary,
+                    'concept': transaction.concept,
+                    'status': transaction.status.value if transaction.status else None
+                })
+        
         accounts = []
         for budget in budgets:
             # Obtener contribuyentes
@@ -709,30 +854,11 @@ def get_budget_summary(
                         'percentage': percentage
                     })
             
-            # Obtener transacciones relacionadas (movimientos)
-            transactions = db.query(models.Transaction).filter(
-                models.Transaction.family_budget_id == budget.id
-            ).all()
-            
-            # Calcular montos pagados y restantes
-            total_paid = 0.0
-            total_income = 0.0
-            movements = []
-            for transaction in transactions:
-                if transaction.transaction_type == models.TransactionType.EXPENSE.value:
-                    total_paid += transaction.amount
-                elif transaction.transaction_type == models.TransactionType.INCOME.value:
-                    total_income += transaction.amount
-                
-                movements.append({
-                    'id': transaction.id,
-                    'date': transaction.date.isoformat() if transaction.date else None,
-                    'amount': transaction.amount,
-                    'type': transaction.transaction_type,
-                    'merchant_or_beneficiary': transaction.merchant_or_beneficiary,
-                    'concept': transaction.concept,
-                    'status': transaction.status.value if transaction.status else None
-                })
+            # Montos pagados e ingresos del agregado; movimientos ya agrupados por cuenta
+            budget_totals = totals.get(budget.id, {})
+            total_paid = budget_totals.get("expense", 0.0)
+            total_income = budget_totals.get("income", 0.0)
+            movements = movements_by_budget.get(budget.id, [])
             
             # Calcular monto restante
             remaining_amount = budget.total_amount - total_paid + total_income
@@ -767,7 +893,6 @@ def get_budget_summary(
             # Verificar si está vencido
             is_overdue = False
             if budget.due_date:
-                from datetime import datetime, timezone
                 now = datetime.now(timezone.utc)
                 if isinstance(budget.due_date, datetime):
                     due_date_utc = budget.due_date
@@ -819,7 +944,7 @@ def update_account_display_names(
     account_id: int,
     display_names: dict,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza los nombres de visualización personalizados para una cuenta (categoría/subcategoría).
@@ -908,7 +1033,7 @@ def update_budget_account(
     account_id: int,
     updates: dict,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza campos editables de una cuenta del presupuesto.
@@ -7,6 +7,7 @@ from sqlalchemy import and_
 from typing import List, Optional
 from app.database import get_db
 from app import models, schemas, auth
+from app.services import response_cache
 
 router = APIRouter()
 
@@ -14,7 +15,7 @@ router = APIRouter()
 def create_custom_category(
     category: schemas.CustomCategoryCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Crea una nueva categoría personalizada con sus subcategorías.
@@ -65,10 +66,11 @@ def create_custom_category(
     return db_category
 
 @router.get("/", response_model=List[schemas.CustomCategoryResponse])
+@response_cache.cached("custom_categories.list", response_model=List[schemas.CustomCategoryResponse])
 def get_custom_categories(
     include_inactive: bool = False,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene todas las categorías personalizadas de la familia del usuario.
@@ -100,7 +102,7 @@ def get_custom_categories(
 def get_custom_category(
     category_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene una categoría personalizada específica.
@@ -129,7 +131,7 @@ def update_custom_category(
     category_id: int,
     category_update: schemas.CustomCategoryUpdate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza una categoría personalizada.
@@ -183,7 +185,7 @@ def update_custom_category(
 def delete_custom_category(
     category_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Elimina (desactiva) una categoría personalizada.
@@ -228,7 +230,7 @@ def create_subcategory(
     category_id: int,
     subcategory: schemas.CustomSubcategoryCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Crea una nueva subcategoría para una categoría personalizada.
@@ -272,7 +274,7 @@ def update_subcategory(
     subcategory_id: int,
     subcategory_update: schemas.CustomSubcategoryBase,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza una subcategoría personalizada.
@@ -316,7 +318,7 @@ def update_subcategory(
 def delete_subcategory(
     subcategory_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Elimina (desactiva) una subcategoría personalizada.
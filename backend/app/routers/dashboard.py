@@ -1,11 +1,11 @@
 """Estadísticas del dashboard para usuario autenticado (backend)."""
-from datetime import datetime, timedelta
+from datetime import datetime
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 
 from app.database import get_db
 from app import models, auth
+from app.services import spending_rollups
 
 router = APIRouter()
 
@@ -13,15 +13,12 @@ router = APIRouter()
 @router.get("/stats")
 def get_dashboard_stats(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user),
+    current_user: auth.Principal = Depends(auth.get_current_user),
 ):
     """Devuelve estadísticas para el dashboard: presupuesto mensual, gastado, restante, recibos pendientes, transacciones recientes."""
     now = datetime.now()
     year = now.year
     month = now.month
-    first_day = datetime(year, month, 1).date()
-    next_month = datetime(year, month, 1) + timedelta(days=32)
-    last_day = (next_month.replace(day=1) - timedelta(days=1)).date()
 
     total_budget_month = 0.0
     if current_user.family_id:
@@ -35,14 +32,8 @@ def get_dashboard_stats(
         year_total = sum(b.total_amount or 0 for b in budgets)
         total_budget_month = year_total / 12.0
 
-    # Gastado este mes (egresos del usuario)
-    spent_result = db.query(func.coalesce(func.sum(models.Transaction.amount), 0)).filter(
-        models.Transaction.user_id == current_user.id,
-        models.Transaction.transaction_type == models.TransactionType.EXPENSE.value,
-        models.Transaction.date >= first_day,
-        models.Transaction.date <= last_day,
-    ).scalar()
-    spent_month = float(spent_result or 0)
+    # Gastado este mes (egresos del usuario, con o sin presupuesto) desde el agregado mensual
+    spent_month = spending_rollups.month_totals(db, year, month, user_id=current_user.id)["expense"]
 
     remaining_month = max(0.0, total_budget_month - spent_month)
 
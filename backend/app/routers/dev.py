@@ -9,7 +9,7 @@ import random
 router = APIRouter()
 
 @router.post("/load-test-data")
-def load_test_data(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def load_test_data(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_db_user)):
     """
     Carga datos de prueba completos para testing profesional.
     Crea usuarios, familia, presupuestos y transacciones.
@@ -250,7 +250,6 @@ def load_test_data(db: Session = Depends(get_db), current_user: models.User = De
             
             # Buscar el presupuesto correspondiente
             family_budget = None
-            user_budget = None
             for budget in created_budgets:
                 # Comparar usando el valor del enum, no el objeto directamente
                 budget_category = str(budget.category.value) if hasattr(budget.category, 'value') else str(budget.category)
@@ -258,10 +257,6 @@ def load_test_data(db: Session = Depends(get_db), current_user: models.User = De
                 
                 if budget_category == template["category"] and budget_subcategory == template["subcategory"]:
                     family_budget = budget
-                    user_budget = db.query(models.UserBudget).filter(
-                        models.UserBudget.user_id == user.id,
-                        models.UserBudget.family_budget_id == budget.id
-                    ).first()
                     break
             
             # Convertir categoría y subcategoría a enums
@@ -287,11 +282,7 @@ def load_test_data(db: Session = Depends(get_db), current_user: models.User = De
             )
             db.add(transaction)
             transactions_data.append(transaction)
-            
-            # Actualizar el presupuesto gastado si hay user_budget
-            if user_budget:
-                user_budget.spent_amount = round(user_budget.spent_amount + amount, 2)
-                db.add(user_budget)
+            # spent_amount del presupuesto se actualiza al hacer flush (spending_rollups)
         
         db.commit()
         
@@ -326,7 +317,7 @@ def load_test_data(db: Session = Depends(get_db), current_user: models.User = De
         raise HTTPException(status_code=500, detail=f"Error al cargar datos de prueba: {str(e)}")
 
 @router.post("/clear-test-data")
-def clear_test_data(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def clear_test_data(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_db_user)):
     """
     Limpia todos los datos de prueba del sistema.
     Elimina transacciones, presupuestos de usuario, presupuestos familiares y usuarios de prueba.
@@ -436,7 +427,7 @@ def clear_test_data(db: Session = Depends(get_db), current_user: models.User = D
         raise HTTPException(status_code=500, detail=f"Error al limpiar datos de prueba: {str(e)}")
 
 @router.post("/delete-all-transactions")
-def delete_all_transactions(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def delete_all_transactions(db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     """
     Elimina ABSOLUTAMENTE TODAS las transacciones de la base de datos.
     Sin importar a qué usuario pertenezcan o si están en una familia.
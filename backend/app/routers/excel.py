@@ -11,7 +11,7 @@ router = APIRouter()
 @router.post("/read")
 async def read_excel_file(
     file: UploadFile = File(...),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Lee un archivo Excel y devuelve su contenido en formato JSON.
@@ -104,7 +104,7 @@ async def preview_excel_file(
     file: UploadFile = File(...),
     sheet_name: str = None,
     rows: int = 10,
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Vista previa de un archivo Excel.
@@ -1,10 +1,12 @@
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import get_db
+from app.database import get_async_db, get_db
 from app import models, schemas, auth
 from app.models import Category, Subcategory, BudgetType, DistributionMethod
 from datetime import datetime
 import pandas as pd
+import asyncio
 import io
 
 router = APIRouter()
@@ -574,16 +576,200 @@ def map_excel_category_to_system(excel_category, excel_subcategory=None):
     
     return system_category, system_subcategory
 
+def _load_budgets_sheet(contents: bytes, file_ext: str) -> list:
+    """Abre el Excel y lee la hoja de presupuestos (pandas; se llama en un hilo para no bloquear el event loop)."""
+    engine = 'openpyxl' if file_ext in ['.xlsx', '.xlsm'] else 'xlrd'
+    
+    try:
+        excel_file = pd.ExcelFile(io.BytesIO(contents), engine=engine)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error al abrir el archivo Excel: {str(e)}. Verifica que el archivo no esté corrupto o protegido con contraseña."
+        )
+    
+    # Verificar que existe la hoja
+    if 'Input Categories Budget' not in excel_file.sheet_names:
+        available_sheets = ', '.join(excel_file.sheet_names[:5])
+        raise HTTPException(
+            status_code=400,
+            detail=f"No se encontró la hoja 'Input Categories Budget' en el Excel. Hojas disponibles: {available_sheets}{'...' if len(excel_file.sheet_names) > 5 else ''}"
+        )
+    
+    # Parsear presupuestos
+    try:
+        excel_budgets = parse_excel_budgets(excel_file)
+    except ValueError as ve:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error al parsear presupuestos del Excel: {str(ve)}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error inesperado al leer presupuestos: {str(e)}"
+        )
+    
+    if not excel_budgets:
+        raise HTTPException(
+            status_code=400,
+            detail="No se encontraron presupuestos en el Excel. Verifica que la hoja 'Input Categories Budget' tenga datos de presupuestos."
+        )
+    return excel_budgets
+
+def _import_budgets(db: Session, family_id: int, year: int, excel_budgets: list) -> dict:
+    """
+    Reemplaza los presupuestos del año de la familia por los del Excel (se llama con run_sync desde el
+    endpoint async: las consultas esperan al driver sin bloquear el event loop).
+    """
+    family = db.query(models.Family).filter(models.Family.id == family_id).first()
+    if not family:
+        raise HTTPException(status_code=404, detail="Familia no encontrada")
+    
+    # Eliminar presupuestos existentes del año
+    existing_budgets = db.query(models.FamilyBudget).filter(
+        models.FamilyBudget.family_id == family.id,
+        models.FamilyBudget.year == year
+    ).all()
+    
+    for existing_budget in existing_budgets:
+        user_budgets = db.query(models.UserBudget).filter(
+            models.UserBudget.family_budget_id == existing_budget.id
+        ).all()
+        for user_budget in user_budgets:
+            db.delete(user_budget)
+        db.delete(existing_budget)
+    db.flush()
+    
+    # Obtener todos los usuarios de la familia
+    family_users = db.query(models.User).filter(
+        models.User.family_id == family.id
+    ).all()
+    
+    if not family_users:
+        raise HTTPException(
+            status_code=400,
+            detail="No hay usuarios en la familia. Crea los usuarios primero con /api/family-setup/create-family-members"
+        )
+    
+    # Crear presupuestos
+    created_budgets = []
+    skipped_budgets = []
+    errors = []
+    
+    for excel_budget in excel_budgets:
+        try:
+            # Mapear categorías
+            system_category, system_subcategory = map_excel_category_to_system(
+                excel_budget['category'],
+                excel_budget.get('subcategory')
+            )
+            
+            if not system_category:
+                skipped_budgets.append({
+                    'excel_category': excel_budget['category'],
+                    'excel_subcategory': excel_budget.get('subcategory'),
+                    'reason': 'Categoría no reconocida'
+                })
+                continue
+            
+            if not system_subcategory:
+                # Si no hay subcategoría, usar la categoría como subcategoría
+                # Si no hay subcategoría, usar una subcategoría por defecto según la categoría
+                try:
+                    if system_category == Category.SERVICIOS_BASICOS:
+                        system_subcategory = Subcategory.ELECTRICIDAD_CFE
+                    elif system_category == Category.MERCADO:
+                        system_subcategory = Subcategory.MERCADO_GENERAL
+                    elif system_category == Category.TRANSPORTE:
+                        system_subcategory = Subcategory.GASOLINA
+                    elif system_category == Category.EDUCACION:
+                        system_subcategory = Subcategory.COLEGIATURAS
+                    elif system_category == Category.SALUD:
+                        system_subcategory = Subcategory.SEGURO_MEDICO
+                    elif system_category == Category.VIDA_SOCIAL:
+                        system_subcategory = Subcategory.SALIDAS_FAMILIARES
+                    else:
+                        system_subcategory = Subcategory.OTROS
+                except:
+                    system_subcategory = Subcategory.OTROS
+            
+            # Convertir subcategoría a string
+            subcategory_str = system_subcategory.value if isinstance(system_subcategory, Subcategory) else str(system_subcategory)
+            
+            # Convertir montos mensuales del Excel a formato JSON
+            monthly_amounts_json = None
+            if 'monthly_amounts' in excel_budget and excel_budget['monthly_amounts']:
+                monthly_amounts_json = excel_budget['monthly_amounts']
+            
+            # Crear presupuesto familiar
+            family_budget = models.FamilyBudget(
+                family_id=family.id,
+                category=system_category.value,
+                subcategory=subcategory_str,
+                year=year,
+                total_amount=excel_budget['total_amount'],
+                monthly_amounts=monthly_amounts_json,  # Guardar montos mensuales
+                budget_type=BudgetType.SHARED.value,  # Por defecto compartido
+                distribution_method=DistributionMethod.EQUAL.value,  # Distribución equitativa
+                auto_distribute=True
+            )
+            db.add(family_budget)
+            db.flush()
+            
+            # Distribuir entre usuarios
+            amount_per_user = excel_budget['total_amount'] / len(family_users)
+            
+            for user in family_users:
+                user_budget = models.UserBudget(
+                    user_id=user.id,
+                    family_budget_id=family_budget.id,
+                    allocated_amount=round(amount_per_user, 2),
+                    spent_amount=0.0
+                )
+                db.add(user_budget)
+            
+            created_budgets.append({
+                'category': system_category.value,
+                'subcategory': subcategory_str,
+                'total_amount': excel_budget['total_amount'],
+                'users_assigned': len(family_users)
+            })
+        
+        except Exception as e:
+            errors.append({
+                'excel_category': excel_budget.get('category'),
+                'excel_subcategory': excel_budget.get('subcategory'),
+                'error': str(e)
+            })
+            continue
+    
+    db.commit()
+    
+    return {
+        "message": "Presupuestos importados exitosamente",
+        "summary": {
+            "created": len(created_budgets),
+            "skipped": len(skipped_budgets),
+            "errors": len(errors),
+            "year": year,
+            "budgets": created_budgets,
+            "skipped": skipped_budgets,
+            "errors": errors
+        }
+    }
+
 @router.post("/import-budgets")
 async def import_budgets_from_excel(
     file: UploadFile = File(...),
     year: int = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Importa presupuestos desde un archivo Excel.
     Lee la hoja 'Input Categories Budget' y crea los presupuestos familiares.
+    El Excel se lee en un hilo y las escrituras usan la sesión async (no bloquean el event loop).
     """
     try:
         # Verificar permisos
@@ -599,10 +785,6 @@ async def import_budgets_from_excel(
                 detail="Solo el administrador de la familia puede importar presupuestos."
             )
         
-        family = db.query(models.Family).filter(models.Family.id == current_user.family_id).first()
-        if not family:
-            raise HTTPException(status_code=404, detail="Familia no encontrada")
-        
         # Año para los presupuestos
         if not year:
             year = datetime.now().year
@@ -629,121 +811,262 @@ async def import_budgets_from_excel(
         if len(contents) == 0:
             raise HTTPException(status_code=400, detail="El archivo está vacío")
         
-        engine = 'openpyxl' if file_ext in ['.xlsx', '.xlsm'] else 'xlrd'
+        excel_budgets = await asyncio.to_thread(_load_budgets_sheet, contents, file_ext)
         
+        return await db.run_sync(_import_budgets, current_user.family_id, year, excel_budgets)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al importar presupuestos: {str(e)}"
+        )
+
+def _load_setup_workbook(contents: bytes, file_ext: str) -> dict:
+    """
+    Abre el Excel y lee presupuestos y transacciones (pandas; se llama en un hilo para no bloquear el
+    event loop). Un error al leer la hoja opcional de transacciones se regresa en lugar de lanzarse.
+    """
+    engine = 'openpyxl' if file_ext in ['.xlsx', '.xlsm'] else 'xlrd'
+    
+    try:
+        excel_file = pd.ExcelFile(io.BytesIO(contents), engine=engine)
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error al abrir el archivo Excel: {str(e)}\n\nDetalles técnicos: {error_details[:500]}\n\nVerifica que:\n- El archivo no esté corrupto\n- El archivo no esté protegido con contraseña\n- El archivo sea un Excel válido (.xlsx, .xlsm, .xls)"
+        )
+    
+    if 'Input Categories Budget' not in excel_file.sheet_names:
+        available_sheets = ', '.join(excel_file.sheet_names[:5])
+        raise HTTPException(
+            status_code=400,
+            detail=f"No se encontró la hoja 'Input Categories Budget' en el Excel.\n\nHojas disponibles: {available_sheets}{'...' if len(excel_file.sheet_names) > 5 else ''}\n\nTotal de hojas: {len(excel_file.sheet_names)}"
+        )
+    
+    try:
+        excel_budgets = parse_excel_budgets(excel_file)
+    except ValueError as ve:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error al parsear presupuestos del Excel: {str(ve)}\n\nVerifica que la hoja 'Input Categories Budget' tenga el formato correcto con meses (JANUARY, FEBRUARY, etc.) y categorías."
+        )
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error inesperado al leer presupuestos: {str(e)}\n\nDetalles: {error_details[:500]}"
+        )
+    
+    if not excel_budgets:
+        raise HTTPException(
+            status_code=400,
+            detail="No se encontraron presupuestos en el Excel.\n\nVerifica que:\n- La hoja 'Input Categories Budget' tenga datos\n- Los presupuestos tengan montos mayores a cero\n- Los meses estén en inglés (JANUARY, FEBRUARY, etc.)"
+        )
+    
+    excel_transactions = None
+    has_transactions = 'Input Transactions' in excel_file.sheet_names
+    if has_transactions:
         try:
-            excel_file = pd.ExcelFile(io.BytesIO(contents), engine=engine)
+            excel_transactions = parse_excel_transactions(excel_file)
         except Exception as e:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error al abrir el archivo Excel: {str(e)}. Verifica que el archivo no esté corrupto o protegido con contraseña."
-            )
-        
-        # Verificar que existe la hoja
-        if 'Input Categories Budget' not in excel_file.sheet_names:
-            available_sheets = ', '.join(excel_file.sheet_names[:5])
-            raise HTTPException(
-                status_code=400,
-                detail=f"No se encontró la hoja 'Input Categories Budget' en el Excel. Hojas disponibles: {available_sheets}{'...' if len(excel_file.sheet_names) > 5 else ''}"
-            )
+            excel_transactions = e
+    return {"budgets": excel_budgets, "transactions": excel_transactions, "has_transactions": has_transactions}
+
+def _setup_from_excel(db: Session, current_user: auth.Principal, year: int, workbook: dict) -> dict:
+    """
+    Pasos de BD de /setup-from-excel (se llama con run_sync desde el endpoint async: las consultas
+    esperan al driver sin bloquear el event loop). El Excel ya viene leído en `workbook`.
+    """
+    family = db.query(models.Family).filter(models.Family.id == current_user.family_id).first()
+    if not family:
+        raise HTTPException(status_code=404, detail="Familia no encontrada")
+    
+    # Año para los presupuestos
+    if not year:
+        year = datetime.now().year
+    
+    results = {
+        "cleared": {},
+        "users_created": {},
+        "budgets_imported": {}
+    }
+    
+    # PASO 1: Limpiar TODOS los datos
+    # Eliminar ABSOLUTAMENTE TODAS las transacciones (método más agresivo)
+    try:
+        # Obtener todos los usuarios de la familia primero
+        all_family_users = db.query(models.User).filter(
+            models.User.family_id == family.id
+        ).all()
+        all_family_user_ids = [u.id for u in all_family_users]
         
-        # Parsear presupuestos
-        try:
-            excel_budgets = parse_excel_budgets(excel_file)
-        except ValueError as ve:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error al parsear presupuestos del Excel: {str(ve)}"
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error inesperado al leer presupuestos: {str(e)}"
-            )
+        # Contar antes
+        total_transactions_before = db.query(models.Transaction).count()
         
-        if not excel_budgets:
-            raise HTTPException(
-                status_code=400,
-                detail="No se encontraron presupuestos en el Excel. Verifica que la hoja 'Input Categories Budget' tenga datos de presupuestos."
-            )
+        # Eliminar TODAS las transacciones sin importar a qué usuario pertenezcan
+        deleted_transactions = db.query(models.Transaction).delete(synchronize_session=False)
         
-        # Eliminar presupuestos existentes del año
-        existing_budgets = db.query(models.FamilyBudget).filter(
-            models.FamilyBudget.family_id == family.id,
-            models.FamilyBudget.year == year
-        ).all()
+        print(f"✅ Eliminadas {deleted_transactions} transacciones de un total de {total_transactions_before}")
         
-        for existing_budget in existing_budgets:
-            user_budgets = db.query(models.UserBudget).filter(
-                models.UserBudget.family_budget_id == existing_budget.id
-            ).all()
-            for user_budget in user_budgets:
-                db.delete(user_budget)
-            db.delete(existing_budget)
-        db.flush()
+        # Eliminar TODOS los user_budgets de la familia
+        if all_family_user_ids:
+            deleted_user_budgets = db.query(models.UserBudget).filter(
+                models.UserBudget.user_id.in_(all_family_user_ids)
+            ).delete(synchronize_session=False)
+        else:
+            deleted_user_budgets = 0
         
-        # Obtener todos los usuarios de la familia
-        family_users = db.query(models.User).filter(
-            models.User.family_id == family.id
-        ).all()
+        # Eliminar TODOS los presupuestos familiares
+        deleted_family_budgets = db.query(models.FamilyBudget).filter(
+            models.FamilyBudget.family_id == family.id
+        ).delete(synchronize_session=False)
         
-        if not family_users:
-            raise HTTPException(
-                status_code=400,
-                detail="No hay usuarios en la familia. Crea los usuarios primero con /api/family-setup/create-family-members"
-            )
+        # Eliminar usuarios (excepto el actual)
+        users_to_delete = [u for u in all_family_users if u.id != current_user.id]
+        for user in users_to_delete:
+            user.family_id = None
+            db.delete(user)
         
-        # Crear presupuestos
-        created_budgets = []
-        skipped_budgets = []
-        errors = []
+        db.flush()
         
-        for excel_budget in excel_budgets:
-            try:
-                # Mapear categorías
-                system_category, system_subcategory = map_excel_category_to_system(
-                    excel_budget['category'],
-                    excel_budget.get('subcategory')
-                )
-                
-                if not system_category:
-                    skipped_budgets.append({
-                        'excel_category': excel_budget['category'],
-                        'excel_subcategory': excel_budget.get('subcategory'),
-                        'reason': 'Categoría no reconocida'
-                    })
-                    continue
-                
-                if not system_subcategory:
-                    # Si no hay subcategoría, usar la categoría como subcategoría
-                    # Si no hay subcategoría, usar una subcategoría por defecto según la categoría
-                    try:
-                        if system_category == Category.SERVICIOS_BASICOS:
-                            system_subcategory = Subcategory.ELECTRICIDAD_CFE
-                        elif system_category == Category.MERCADO:
-                            system_subcategory = Subcategory.MERCADO_GENERAL
-                        elif system_category == Category.TRANSPORTE:
-                            system_subcategory = Subcategory.GASOLINA
-                        elif system_category == Category.EDUCACION:
-                            system_subcategory = Subcategory.COLEGIATURAS
-                        elif system_category == Category.SALUD:
-                            system_subcategory = Subcategory.SEGURO_MEDICO
-                        elif system_category == Category.VIDA_SOCIAL:
-                            system_subcategory = Subcategory.SALIDAS_FAMILIARES
-                        else:
-                            system_subcategory = Subcategory.OTROS
-                    except:
+        results["cleared"] = {
+            "transactions": deleted_transactions,
+            "user_budgets": deleted_user_budgets,
+            "family_budgets": deleted_family_budgets,
+            "users": len(users_to_delete)
+        }
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al limpiar datos: {str(e)}")
+    
+    # PASO 2: Crear usuarios de la familia
+    from app.routers.family_setup import FAMILY_MEMBERS
+    from app import auth
+    
+    DEFAULT_PASSWORD = "domus123"
+    created_users = []
+    
+    for member_data in FAMILY_MEMBERS:
+        existing_user = db.query(models.User).filter(
+            models.User.email == member_data["email"]
+        ).first()
+        
+        if not existing_user:
+            password_to_hash = DEFAULT_PASSWORD
+            if len(password_to_hash.encode('utf-8')) > 72:
+                password_to_hash = password_to_hash.encode('utf-8')[:72].decode('utf-8', errors='ignore')
+            
+            hashed_password = auth.get_password_hash(password_to_hash)
+            
+            # Asignar teléfono por defecto si no se proporciona (el campo es NOT NULL y UNIQUE)
+            # Generar un teléfono único basado en el email
+            if member_data.get("phone"):
+                phone_value = member_data["phone"]
+            else:
+                # Generar teléfono único: usar hash del email para asegurar unicidad
+                import hashlib
+                email_hash = hashlib.md5(member_data["email"].encode()).hexdigest()[:8]
+                phone_value = f"+52555{email_hash}"
+            
+            new_user = models.User(
+                name=member_data["name"],
+                email=member_data["email"],
+                phone=phone_value,
+                hashed_password=hashed_password,
+                family_id=family.id,
+                is_active=True,
+                is_family_admin=False
+            )
+            db.add(new_user)
+            created_users.append(new_user)
+    
+    db.flush()
+    results["users_created"] = {
+        "created": len(created_users),
+        "password": DEFAULT_PASSWORD
+    }
+    
+    # PASO 3: Importar presupuestos del Excel (ya leídos por _load_setup_workbook)
+    excel_budgets = workbook["budgets"]
+    
+    # Obtener todos los usuarios de la familia (incluyendo los recién creados)
+    family_users = db.query(models.User).filter(
+        models.User.family_id == family.id
+    ).all()
+    
+    created_budgets = []
+    skipped_budgets = []
+    
+    for excel_budget in excel_budgets:
+        try:
+            # Ignorar presupuestos donde la categoría es "EXPENSES" (es el Type, no la categoría)
+            if excel_budget['category'] and excel_budget['category'].upper() in ['EXPENSES', 'EXPENSE', 'INCOME']:
+                print(f"⚠️ Ignorando presupuesto con Type como categoría: '{excel_budget['category']}'")
+                skipped_budgets.append({
+                    'excel_category': excel_budget['category'],
+                    'excel_subcategory': excel_budget.get('subcategory'),
+                    'reason': 'Type (EXPENSES/INCOME) usado como categoría'
+                })
+                continue
+            
+            system_category, system_subcategory = map_excel_category_to_system(
+                excel_budget['category'],
+                excel_budget.get('subcategory')
+            )
+            
+            print(f"🔍 Mapeo: Excel '{excel_budget['category']}' -> Sistema: {system_category.value if system_category else 'None'}, Subcat: {system_subcategory.value if system_subcategory else 'None'}")
+            
+            if not system_category:
+                print(f"⚠️ Categoría no reconocida: '{excel_budget['category']}' (subcategoría: '{excel_budget.get('subcategory')}')")
+                skipped_budgets.append({
+                    'excel_category': excel_budget['category'],
+                    'excel_subcategory': excel_budget.get('subcategory'),
+                    'reason': 'Categoría no reconocida'
+                })
+                continue
+            
+            if not system_subcategory:
+                # Si no hay subcategoría, usar una subcategoría por defecto según la categoría
+                try:
+                    if system_category == Category.SERVICIOS_BASICOS:
+                        system_subcategory = Subcategory.ELECTRICIDAD_CFE
+                    elif system_category == Category.MERCADO:
+                        system_subcategory = Subcategory.MERCADO_GENERAL
+                    elif system_category == Category.TRANSPORTE:
+                        system_subcategory = Subcategory.GASOLINA
+                    elif system_category == Category.EDUCACION:
+                        system_subcategory = Subcategory.COLEGIATURAS
+                    elif system_category == Category.SALUD:
+                        system_subcategory = Subcategory.SEGURO_MEDICO
+                    elif system_category == Category.VIDA_SOCIAL:
+                        system_subcategory = Subcategory.SALIDAS_FAMILIARES
+                    else:
                         system_subcategory = Subcategory.OTROS
-                
-                # Convertir subcategoría a string
-                subcategory_str = system_subcategory.value if isinstance(system_subcategory, Subcategory) else str(system_subcategory)
-                
+                except:
+                    system_subcategory = Subcategory.OTROS
+            
+            # Asegurar que system_subcategory sea un enum Subcategory válido
+            if not isinstance(system_subcategory, Subcategory):
+                try:
+                    system_subcategory = Subcategory(system_subcategory)
+                except:
+                    system_subcategory = Subcategory.OTROS
+            
+            subcategory_str = system_subcategory.value
+            
+            try:
                 # Convertir montos mensuales del Excel a formato JSON
+                # El Excel tiene meses en inglés (JANUARY, FEBRUARY, etc.)
                 monthly_amounts_json = None
                 if 'monthly_amounts' in excel_budget and excel_budget['monthly_amounts']:
                     monthly_amounts_json = excel_budget['monthly_amounts']
                 
-                # Crear presupuesto familiar
                 family_budget = models.FamilyBudget(
                     family_id=family.id,
                     category=system_category.value,
@@ -751,71 +1074,227 @@ async def import_budgets_from_excel(
                     year=year,
                     total_amount=excel_budget['total_amount'],
                     monthly_amounts=monthly_amounts_json,  # Guardar montos mensuales
-                    budget_type=BudgetType.SHARED.value,  # Por defecto compartido
-                    distribution_method=DistributionMethod.EQUAL.value,  # Distribución equitativa
+                    budget_type=BudgetType.SHARED.value,
+                    distribution_method=DistributionMethod.EQUAL.value,
                     auto_distribute=True
                 )
                 db.add(family_budget)
                 db.flush()
-                
-                # Distribuir entre usuarios
-                amount_per_user = excel_budget['total_amount'] / len(family_users)
-                
-                for user in family_users:
-                    user_budget = models.UserBudget(
-                        user_id=user.id,
-                        family_budget_id=family_budget.id,
-                        allocated_amount=round(amount_per_user, 2),
-                        spent_amount=0.0,
-                        income_amount=0.0
-                    )
-                    db.add(user_budget)
-                
-                created_budgets.append({
-                    'category': system_category.value,
-                    'subcategory': subcategory_str,
-                    'total_amount': excel_budget['total_amount'],
-                    'users_assigned': len(family_users)
-                })
-            
+                print(f"✅ Presupuesto creado: {system_category.value} - {subcategory_str}: ${excel_budget['total_amount']:,.2f}")
             except Exception as e:
-                errors.append({
-                    'excel_category': excel_budget.get('category'),
+                print(f"❌ Error al crear presupuesto {excel_budget['category']} - {excel_budget.get('subcategory')}: {str(e)}")
+                skipped_budgets.append({
+                    'excel_category': excel_budget['category'],
                     'excel_subcategory': excel_budget.get('subcategory'),
                     'error': str(e)
                 })
                 continue
+            
+            amount_per_user = excel_budget['total_amount'] / len(family_users)
+            
+            for user in family_users:
+                user_budget = models.UserBudget(
+                    user_id=user.id,
+                    family_budget_id=family_budget.id,
+                    allocated_amount=round(amount_per_user, 2),
+                    spent_amount=0.0
+                )
+                db.add(user_budget)
+            
+            created_budgets.append({
+                'category': system_category.value,
+                'subcategory': subcategory_str,
+                'total_amount': excel_budget['total_amount']
+            })
         
-        db.commit()
+        except Exception as e:
+            skipped_budgets.append({
+                'excel_category': excel_budget.get('category'),
+                'error': str(e)
+            })
+            continue
+    
+    print(f"📊 Resumen de presupuestos: {len(created_budgets)} creados, {len(skipped_budgets)} saltados")
+    if len(skipped_budgets) > 0:
+        print(f"⚠️ Primeros 10 presupuestos saltados:")
+        for skip in skipped_budgets[:10]:
+            print(f"   - {skip.get('excel_category', 'N/A')} / {skip.get('excel_subcategory', 'N/A')}: {skip.get('reason', skip.get('error', 'N/A'))}")
+    
+    results["budgets_imported"] = {
+        "created": len(created_budgets),
+        "skipped": len(skipped_budgets),
+        "year": year,
+        "skipped_details": skipped_budgets[:20]  # Primeros 20 para debugging
+    }
+    
+    # PASO 4: Importar transacciones del Excel (si existe la hoja)
+    transactions_imported = 0
+    transactions_errors = []
+    
+    if workbook["has_transactions"]:
+        try:
+            excel_transactions = workbook["transactions"]
+            if isinstance(excel_transactions, Exception):
+                # La hoja no se pudo leer: se reporta igual que los demás errores de transacciones
+                raise excel_transactions
+            print(f"📊 Transacciones encontradas en Excel: {len(excel_transactions)}")
+            
+            # Obtener todos los usuarios de la familia
+            family_users = db.query(models.User).filter(
+                models.User.family_id == family.id
+            ).all()
+            
+            if not family_users:
+                print("⚠️ No hay usuarios en la familia para asignar transacciones")
+            else:
+                # Importar transacciones
+                for excel_trans in excel_transactions:
+                    try:
+                        # Mapear categorías
+                        system_category, system_subcategory = map_excel_category_to_system(
+                            excel_trans['category'],
+                            excel_trans.get('subcategory')
+                        )
+                        
+                        if not system_category:
+                            transactions_errors.append({
+                                'date': str(excel_trans['date']),
+                                'amount': excel_trans['amount'],
+                                'error': f"Categoría no reconocida: {excel_trans['category']}"
+                            })
+                            continue
+                        
+                        # Determinar tipo de transacción
+                        if excel_trans['type'] in ['INCOME']:
+                            transaction_type = models.TransactionType.INCOME.value
+                        else:
+                            transaction_type = models.TransactionType.EXPENSE.value
+                        
+                        # Asignar a un usuario (por ahora al primero, luego se puede mejorar)
+                        assigned_user = family_users[0]
+                        
+                        # Asegurar que system_subcategory sea válido antes de buscar presupuesto
+                        if not system_subcategory or not isinstance(system_subcategory, Subcategory):
+                            try:
+                                if system_category == Category.SERVICIOS_BASICOS:
+                                    system_subcategory = Subcategory.ELECTRICIDAD_CFE
+                                elif system_category == Category.MERCADO:
+                                    system_subcategory = Subcategory.MERCADO_GENERAL
+                                elif system_category == Category.TRANSPORTE:
+                                    system_subcategory = Subcategory.GASOLINA
+                                elif system_category == Category.EDUCACION:
+                                    system_subcategory = Subcategory.COLEGIATURAS
+                                elif system_category == Category.SALUD:
+                                    system_subcategory = Subcategory.SEGURO_MEDICO
+                                elif system_category == Category.VIDA_SOCIAL:
+                                    system_subcategory = Subcategory.SALIDAS_FAMILIARES
+                                else:
+                                    system_subcategory = Subcategory.OTROS
+                            except:
+                                system_subcategory = Subcategory.OTROS
+                        
+                        # Buscar presupuesto relacionado usando valores de los enums
+                        family_budget = None
+                        if system_subcategory:
+                            family_budget = db.query(models.FamilyBudget).filter(
+                                models.FamilyBudget.family_id == family.id,
+                                models.FamilyBudget.category == system_category.value,
+                                models.FamilyBudget.subcategory == system_subcategory.value,
+                                models.FamilyBudget.year == excel_trans['date'].year
+                            ).first()
+                        
+                        # Asegurar que system_subcategory sea válido
+                        if not system_subcategory:
+                            # Usar una subcategoría por defecto según la categoría
+                            try:
+                                if system_category == Category.SERVICIOS_BASICOS:
+                                    system_subcategory = Subcategory.ELECTRICIDAD_CFE
+                                elif system_category == Category.MERCADO:
+                                    system_subcategory = Subcategory.MERCADO_GENERAL
+                                elif system_category == Category.TRANSPORTE:
+                                    system_subcategory = Subcategory.GASOLINA
+                                elif system_category == Category.EDUCACION:
+                                    system_subcategory = Subcategory.COLEGIATURAS
+                                elif system_category == Category.SALUD:
+                                    system_subcategory = Subcategory.SEGURO_MEDICO
+                                elif system_category == Category.VIDA_SOCIAL:
+                                    system_subcategory = Subcategory.SALIDAS_FAMILIARES
+                                else:
+                                    system_subcategory = Subcategory.OTROS
+                            except:
+                                system_subcategory = Subcategory.OTROS
+                        
+                        # Asegurar que sea un enum Subcategory
+                        if not isinstance(system_subcategory, Subcategory):
+                            try:
+                                system_subcategory = Subcategory(system_subcategory)
+                            except:
+                                system_subcategory = Subcategory.OTROS
+                        
+                        # Crear transacción
+                        transaction = models.Transaction(
+                            user_id=assigned_user.id,
+                            family_budget_id=family_budget.id if family_budget else None,
+                            date=excel_trans['date'],
+                            amount=excel_trans['amount'],
+                            transaction_type=transaction_type,
+                            currency="MXN",
+                            merchant_or_beneficiary=excel_trans.get('description', '')[:100],
+                            category=system_category,
+                            subcategory=system_subcategory,
+                            concept=excel_trans.get('description', '')[:200],
+                            status=models.TransactionStatus.PROCESSED
+                        )
+                        db.add(transaction)
+                        transactions_imported += 1
+                        # El presupuesto gastado (spent_amount, budget_rollups) se actualiza al hacer flush
+                    
+                    except Exception as e:
+                        transactions_errors.append({
+                            'date': str(excel_trans.get('date', 'N/A')),
+                            'amount': excel_trans.get('amount', 0),
+                            'error': str(e)
+                        })
+                        continue
+                
+                db.flush()
+                print(f"✅ Transacciones importadas: {transactions_imported}")
         
-        return {
-            "message": "Presupuestos importados exitosamente",
-            "summary": {
-                "created": len(created_budgets),
-                "skipped": len(skipped_budgets),
-                "errors": len(errors),
-                "year": year,
-                "budgets": created_budgets,
-                "skipped": skipped_budgets,
-                "errors": errors
-            }
-        }
+        except Exception as e:
+            print(f"⚠️ Error al importar transacciones: {str(e)}")
+            transactions_errors.append({
+                'error': f"Error general: {str(e)}"
+            })
+    else:
+        print("ℹ️ No se encontró la hoja 'Input Transactions' en el Excel")
     
-    except HTTPException:
-        raise
+    results["transactions_imported"] = {
+        "imported": transactions_imported,
+        "errors": len(transactions_errors),
+        "error_details": transactions_errors[:10]  # Primeros 10 errores
+    }
+    
+    # Hacer commit de todos los cambios
+    try:
+        db.commit()
+        print(f"✅ Commit exitoso: {len(created_budgets)} presupuestos y {transactions_imported} transacciones guardados")
     except Exception as e:
         db.rollback()
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error al importar presupuestos: {str(e)}"
-        )
+        print(f"❌ Error al hacer commit: {str(e)}")
+        raise
+    
+    return {
+        "message": "Sistema configurado completamente desde Excel",
+        "summary": results,
+        "note": "Solo los datos del Excel están ahora en el sistema"
+    }
 
 @router.post("/setup-from-excel")
 async def setup_from_excel(
     file: UploadFile = File(...),
     year: int = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Configuración completa desde Excel:
@@ -824,6 +1303,7 @@ async def setup_from_excel(
     3. Importa presupuestos del Excel
     
     Solo deja los datos del Excel en el sistema.
+    El Excel se lee y valida (en un hilo) antes de borrar nada; los pasos de BD usan la sesión async.
     """
     try:
         # Verificar permisos
@@ -839,116 +1319,6 @@ async def setup_from_excel(
                 detail="Solo el administrador de la familia puede configurar desde Excel."
             )
         
-        family = db.query(models.Family).filter(models.Family.id == current_user.family_id).first()
-        if not family:
-            raise HTTPException(status_code=404, detail="Familia no encontrada")
-        
-        # Año para los presupuestos
-        if not year:
-            year = datetime.now().year
-        
-        results = {
-            "cleared": {},
-            "users_created": {},
-            "budgets_imported": {}
-        }
-        
-        # PASO 1: Limpiar TODOS los datos
-        # Eliminar ABSOLUTAMENTE TODAS las transacciones (método más agresivo)
-        try:
-            # Obtener todos los usuarios de la familia primero
-            all_family_users = db.query(models.User).filter(
-                models.User.family_id == family.id
-            ).all()
-            all_family_user_ids = [u.id for u in all_family_users]
-            
-            # Contar antes
-            total_transactions_before = db.query(models.Transaction).count()
-            
-            # Eliminar TODAS las transacciones sin importar a qué usuario pertenezcan
-            deleted_transactions = db.query(models.Transaction).delete(synchronize_session=False)
-            
-            print(f"✅ Eliminadas {deleted_transactions} transacciones de un total de {total_transactions_before}")
-            
-            # Eliminar TODOS los user_budgets de la familia
-            if all_family_user_ids:
-                deleted_user_budgets = db.query(models.UserBudget).filter(
-                    models.UserBudget.user_id.in_(all_family_user_ids)
-                ).delete(synchronize_session=False)
-            else:
-                deleted_user_budgets = 0
-            
-            # Eliminar TODOS los presupuestos familiares
-            deleted_family_budgets = db.query(models.FamilyBudget).filter(
-                models.FamilyBudget.family_id == family.id
-            ).delete(synchronize_session=False)
-            
-            # Eliminar usuarios (excepto el actual)
-            users_to_delete = [u for u in all_family_users if u.id != current_user.id]
-            for user in users_to_delete:
-                user.family_id = None
-                db.delete(user)
-            
-            db.flush()
-            
-            results["cleared"] = {
-                "transactions": deleted_transactions,
-                "user_budgets": deleted_user_budgets,
-                "family_budgets": deleted_family_budgets,
-                "users": len(users_to_delete)
-            }
-        except Exception as e:
-            db.rollback()
-            raise HTTPException(status_code=500, detail=f"Error al limpiar datos: {str(e)}")
-        
-        # PASO 2: Crear usuarios de la familia
-        from app.routers.family_setup import FAMILY_MEMBERS
-        from app import auth
-        
-        DEFAULT_PASSWORD = "domus123"
-        created_users = []
-        
-        for member_data in FAMILY_MEMBERS:
-            existing_user = db.query(models.User).filter(
-                models.User.email == member_data["email"]
-            ).first()
-            
-            if not existing_user:
-                password_to_hash = DEFAULT_PASSWORD
-                if len(password_to_hash.encode('utf-8')) > 72:
-                    password_to_hash = password_to_hash.encode('utf-8')[:72].decode('utf-8', errors='ignore')
-                
-                hashed_password = auth.get_password_hash(password_to_hash)
-                
-                # Asignar teléfono por defecto si no se proporciona (el campo es NOT NULL y UNIQUE)
-                # Generar un teléfono único basado en el email
-                if member_data.get("phone"):
-                    phone_value = member_data["phone"]
-                else:
-                    # Generar teléfono único: usar hash del email para asegurar unicidad
-                    import hashlib
-                    email_hash = hashlib.md5(member_data["email"].encode()).hexdigest()[:8]
-                    phone_value = f"+52555{email_hash}"
-                
-                new_user = models.User(
-                    name=member_data["name"],
-                    email=member_data["email"],
-                    phone=phone_value,
-                    hashed_password=hashed_password,
-                    family_id=family.id,
-                    is_active=True,
-                    is_family_admin=False
-                )
-                db.add(new_user)
-                created_users.append(new_user)
-        
-        db.flush()
-        results["users_created"] = {
-            "created": len(created_users),
-            "password": DEFAULT_PASSWORD
-        }
-        
-        # PASO 3: Importar presupuestos del Excel
         valid_extensions = ['.xlsx', '.xlsm', '.xls']
         file_ext = None
         for ext in valid_extensions:
@@ -966,355 +1336,14 @@ async def setup_from_excel(
         if len(contents) == 0:
             raise HTTPException(status_code=400, detail="El archivo está vacío")
         
-        engine = 'openpyxl' if file_ext in ['.xlsx', '.xlsm'] else 'xlrd'
-        
-        try:
-            excel_file = pd.ExcelFile(io.BytesIO(contents), engine=engine)
-        except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error al abrir el archivo Excel: {str(e)}\n\nDetalles técnicos: {error_details[:500]}\n\nVerifica que:\n- El archivo no esté corrupto\n- El archivo no esté protegido con contraseña\n- El archivo sea un Excel válido (.xlsx, .xlsm, .xls)"
-            )
-        
-        if 'Input Categories Budget' not in excel_file.sheet_names:
-            available_sheets = ', '.join(excel_file.sheet_names[:5])
-            raise HTTPException(
-                status_code=400,
-                detail=f"No se encontró la hoja 'Input Categories Budget' en el Excel.\n\nHojas disponibles: {available_sheets}{'...' if len(excel_file.sheet_names) > 5 else ''}\n\nTotal de hojas: {len(excel_file.sheet_names)}"
-            )
-        
-        try:
-            excel_budgets = parse_excel_budgets(excel_file)
-        except ValueError as ve:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error al parsear presupuestos del Excel: {str(ve)}\n\nVerifica que la hoja 'Input Categories Budget' tenga el formato correcto con meses (JANUARY, FEBRUARY, etc.) y categorías."
-            )
-        except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error inesperado al leer presupuestos: {str(e)}\n\nDetalles: {error_details[:500]}"
-            )
-        
-        if not excel_budgets:
-            raise HTTPException(
-                status_code=400,
-                detail="No se encontraron presupuestos en el Excel.\n\nVerifica que:\n- La hoja 'Input Categories Budget' tenga datos\n- Los presupuestos tengan montos mayores a cero\n- Los meses estén en inglés (JANUARY, FEBRUARY, etc.)"
-            )
-        
-        # Obtener todos los usuarios de la familia (incluyendo los recién creados)
-        family_users = db.query(models.User).filter(
-            models.User.family_id == family.id
-        ).all()
-        
-        created_budgets = []
-        skipped_budgets = []
-        
-        for excel_budget in excel_budgets:
-            try:
-                # Ignorar presupuestos donde la categoría es "EXPENSES" (es el Type, no la categoría)
-                if excel_budget['category'] and excel_budget['category'].upper() in ['EXPENSES', 'EXPENSE', 'INCOME']:
-                    print(f"⚠️ Ignorando presupuesto con Type como categoría: '{excel_budget['category']}'")
-                    skipped_budgets.append({
-                        'excel_category': excel_budget['category'],
-                        'excel_subcategory': excel_budget.get('subcategory'),
-                        'reason': 'Type (EXPENSES/INCOME) usado como categoría'
-                    })
-                    continue
-                
-                system_category, system_subcategory = map_excel_category_to_system(
-                    excel_budget['category'],
-                    excel_budget.get('subcategory')
-                )
-                
-                print(f"🔍 Mapeo: Excel '{excel_budget['category']}' -> Sistema: {system_category.value if system_category else 'None'}, Subcat: {system_subcategory.value if system_subcategory else 'None'}")
-                
-                if not system_category:
-                    print(f"⚠️ Categoría no reconocida: '{excel_budget['category']}' (subcategoría: '{excel_budget.get('subcategory')}')")
-                    skipped_budgets.append({
-                        'excel_category': excel_budget['category'],
-                        'excel_subcategory': excel_budget.get('subcategory'),
-                        'reason': 'Categoría no reconocida'
-                    })
-                    continue
-                
-                if not system_subcategory:
-                    # Si no hay subcategoría, usar una subcategoría por defecto según la categoría
-                    try:
-                        if system_category == Category.SERVICIOS_BASICOS:
-                            system_subcategory = Subcategory.ELECTRICIDAD_CFE
-                        elif system_category == Category.MERCADO:
-                            system_subcategory = Subcategory.MERCADO_GENERAL
-                        elif system_category == Category.TRANSPORTE:
-                            system_subcategory = Subcategory.GASOLINA
-                        elif system_category == Category.EDUCACION:
-                            system_subcategory = Subcategory.COLEGIATURAS
-                        elif system_category == Category.SALUD:
-                            system_subcategory = Subcategory.SEGURO_MEDICO
-                        elif system_category == Category.VIDA_SOCIAL:
-                            system_subcategory = Subcategory.SALIDAS_FAMILIARES
-                        else:
-                            system_subcategory = Subcategory.OTROS
-                    except:
-                        system_subcategory = Subcategory.OTROS
-                
-                # Asegurar que system_subcategory sea un enum Subcategory válido
-                if not isinstance(system_subcategory, Subcategory):
-                    try:
-                        system_subcategory = Subcategory(system_subcategory)
-                    except:
-                        system_subcategory = Subcategory.OTROS
-                
-                subcategory_str = system_subcategory.value
-                
-                try:
-                    # Convertir montos mensuales del Excel a formato JSON
-                    # El Excel tiene meses en inglés (JANUARY, FEBRUARY, etc.)
-                    monthly_amounts_json = None
-                    if 'monthly_amounts' in excel_budget and excel_budget['monthly_amounts']:
-                        monthly_amounts_json = excel_budget['monthly_amounts']
-                    
-                    family_budget = models.FamilyBudget(
-                        family_id=family.id,
-                        category=system_category.value,
-                        subcategory=subcategory_str,
-                        year=year,
-                        total_amount=excel_budget['total_amount'],
-                        monthly_amounts=monthly_amounts_json,  # Guardar montos mensuales
-                        budget_type=BudgetType.SHARED.value,
-                        distribution_method=DistributionMethod.EQUAL.value,
-                        auto_distribute=True
-                    )
-                    db.add(family_budget)
-                    db.flush()
-                    print(f"✅ Presupuesto creado: {system_category.value} - {subcategory_str}: ${excel_budget['total_amount']:,.2f}")
-                except Exception as e:
-                    print(f"❌ Error al crear presupuesto {excel_budget['category']} - {excel_budget.get('subcategory')}: {str(e)}")
-                    skipped_budgets.append({
-                        'excel_category': excel_budget['category'],
-                        'excel_subcategory': excel_budget.get('subcategory'),
-                        'error': str(e)
-                    })
-                    continue
-                
-                amount_per_user = excel_budget['total_amount'] / len(family_users)
-                
-                for user in family_users:
-                    user_budget = models.UserBudget(
-                        user_id=user.id,
-                        family_budget_id=family_budget.id,
-                        allocated_amount=round(amount_per_user, 2),
-                        spent_amount=0.0,
-                        income_amount=0.0
-                    )
-                    db.add(user_budget)
-                
-                created_budgets.append({
-                    'category': system_category.value,
-                    'subcategory': subcategory_str,
-                    'total_amount': excel_budget['total_amount']
-                })
-            
-            except Exception as e:
-                skipped_budgets.append({
-                    'excel_category': excel_budget.get('category'),
-                    'error': str(e)
-                })
-                continue
-        
-        print(f"📊 Resumen de presupuestos: {len(created_budgets)} creados, {len(skipped_budgets)} saltados")
-        if len(skipped_budgets) > 0:
-            print(f"⚠️ Primeros 10 presupuestos saltados:")
-            for skip in skipped_budgets[:10]:
-                print(f"   - {skip.get('excel_category', 'N/A')} / {skip.get('excel_subcategory', 'N/A')}: {skip.get('reason', skip.get('error', 'N/A'))}")
-        
-        results["budgets_imported"] = {
-            "created": len(created_budgets),
-            "skipped": len(skipped_budgets),
-            "year": year,
-            "skipped_details": skipped_budgets[:20]  # Primeros 20 para debugging
-        }
-        
-        # PASO 4: Importar transacciones del Excel (si existe la hoja)
-        transactions_imported = 0
-        transactions_errors = []
-        
-        if 'Input Transactions' in excel_file.sheet_names:
-            try:
-                excel_transactions = parse_excel_transactions(excel_file)
-                print(f"📊 Transacciones encontradas en Excel: {len(excel_transactions)}")
-                
-                # Obtener todos los usuarios de la familia
-                family_users = db.query(models.User).filter(
-                    models.User.family_id == family.id
-                ).all()
-                
-                if not family_users:
-                    print("⚠️ No hay usuarios en la familia para asignar transacciones")
-                else:
-                    # Importar transacciones
-                    for excel_trans in excel_transactions:
-                        try:
-                            # Mapear categorías
-                            system_category, system_subcategory = map_excel_category_to_system(
-                                excel_trans['category'],
-                                excel_trans.get('subcategory')
-                            )
-                            
-                            if not system_category:
-                                transactions_errors.append({
-                                    'date': str(excel_trans['date']),
-                                    'amount': excel_trans['amount'],
-                                    'error': f"Categoría no reconocida: {excel_trans['category']}"
-                                })
-                                continue
-                            
-                            # Determinar tipo de transacción
-                            if excel_trans['type'] in ['INCOME']:
-                                transaction_type = models.TransactionType.INCOME.value
-                            else:
-                                transaction_type = models.TransactionType.EXPENSE.value
-                            
-                            # Asignar a un usuario (por ahora al primero, luego se puede mejorar)
-                            assigned_user = family_users[0]
-                            
-                            # Asegurar que system_subcategory sea válido antes de buscar presupuesto
-                            if not system_subcategory or not isinstance(system_subcategory, Subcategory):
-                                try:
-                                    if system_category == Category.SERVICIOS_BASICOS:
-                                        system_subcategory = Subcategory.ELECTRICIDAD_CFE
-                                    elif system_category == Category.MERCADO:
-                                        system_subcategory = Subcategory.MERCADO_GENERAL
-                                    elif system_category == Category.TRANSPORTE:
-                                        system_subcategory = Subcategory.GASOLINA
-                                    elif system_category == Category.EDUCACION:
-                                        system_subcategory = Subcategory.COLEGIATURAS
-                                    elif system_category == Category.SALUD:
-                                        system_subcategory = Subcategory.SEGURO_MEDICO
-                                    elif system_category == Category.VIDA_SOCIAL:
-                                        system_subcategory = Subcategory.SALIDAS_FAMILIARES
-                                    else:
-                                        system_subcategory = Subcategory.OTROS
-                                except:
-                                    system_subcategory = Subcategory.OTROS
-                            
-                            # Buscar presupuesto relacionado usando valores de los enums
-                            family_budget = None
-                            if system_subcategory:
-                                family_budget = db.query(models.FamilyBudget).filter(
-                                    models.FamilyBudget.family_id == family.id,
-                                    models.FamilyBudget.category == system_category.value,
-                                    models.FamilyBudget.subcategory == system_subcategory.value,
-                                    models.FamilyBudget.year == excel_trans['date'].year
-                                ).first()
-                            
-                            # Asegurar que system_subcategory sea válido
-                            if not system_subcategory:
-                                # Usar una subcategoría por defecto según la categoría
-                                try:
-                                    if system_category == Category.SERVICIOS_BASICOS:
-                                        system_subcategory = Subcategory.ELECTRICIDAD_CFE
-                                    elif system_category == Category.MERCADO:
-                                        system_subcategory = Subcategory.MERCADO_GENERAL
-                                    elif system_category == Category.TRANSPORTE:
-                                        system_subcategory = Subcategory.GASOLINA
-                                    elif system_category == Category.EDUCACION:
-                                        system_subcategory = Subcategory.COLEGIATURAS
-                                    elif system_category == Category.SALUD:
-                                        system_subcategory = Subcategory.SEGURO_MEDICO
-                                    elif system_category == Category.VIDA_SOCIAL:
-                                        system_subcategory = Subcategory.SALIDAS_FAMILIARES
-                                    else:
-                                        system_subcategory = Subcategory.OTROS
-                                except:
-                                    system_subcategory = Subcategory.OTROS
-                            
-                            # Asegurar que sea un enum Subcategory
-                            if not isinstance(system_subcategory, Subcategory):
-                                try:
-                                    system_subcategory = Subcategory(system_subcategory)
-                                except:
-                                    system_subcategory = Subcategory.OTROS
-                            
-                            # Crear transacción
-                            transaction = models.Transaction(
-                                user_id=assigned_user.id,
-                                family_budget_id=family_budget.id if family_budget else None,
-                                date=excel_trans['date'],
-                                amount=excel_trans['amount'],
-                                transaction_type=transaction_type,
-                                currency="MXN",
-                                merchant_or_beneficiary=excel_trans.get('description', '')[:100],
-                                category=system_category,
-                                subcategory=system_subcategory,
-                                concept=excel_trans.get('description', '')[:200],
-                                status=models.TransactionStatus.PROCESSED
-                            )
-                            db.add(transaction)
-                            transactions_imported += 1
-                            
-                            # Actualizar presupuesto gastado si hay family_budget
-                            if family_budget:
-                                user_budget = db.query(models.UserBudget).filter(
-                                    models.UserBudget.user_id == assigned_user.id,
-                                    models.UserBudget.family_budget_id == family_budget.id
-                                ).first()
-                                
-                                if user_budget:
-                                    if transaction_type == models.TransactionType.INCOME.value:
-                                        user_budget.income_amount += excel_trans['amount']
-                                    else:
-                                        user_budget.spent_amount += excel_trans['amount']
-                                    db.add(user_budget)
-                        
-                        except Exception as e:
-                            transactions_errors.append({
-                                'date': str(excel_trans.get('date', 'N/A')),
-                                'amount': excel_trans.get('amount', 0),
-                                'error': str(e)
-                            })
-                            continue
-                    
-                    db.flush()
-                    print(f"✅ Transacciones importadas: {transactions_imported}")
-            
-            except Exception as e:
-                print(f"⚠️ Error al importar transacciones: {str(e)}")
-                transactions_errors.append({
-                    'error': f"Error general: {str(e)}"
-                })
-        else:
-            print("ℹ️ No se encontró la hoja 'Input Transactions' en el Excel")
-        
-        results["transactions_imported"] = {
-            "imported": transactions_imported,
-            "errors": len(transactions_errors),
-            "error_details": transactions_errors[:10]  # Primeros 10 errores
-        }
+        workbook = await asyncio.to_thread(_load_setup_workbook, contents, file_ext)
         
-        # Hacer commit de todos los cambios
-        try:
-            db.commit()
-            print(f"✅ Commit exitoso: {len(created_budgets)} presupuestos y {transactions_imported} transacciones guardados")
-        except Exception as e:
-            db.rollback()
-            print(f"❌ Error al hacer commit: {str(e)}")
-            raise
-        
-        return {
-            "message": "Sistema configurado completamente desde Excel",
-            "summary": results,
-            "note": "Solo los datos del Excel están ahora en el sistema"
-        }
+        return await db.run_sync(_setup_from_excel, current_user, year, workbook)
     
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         import traceback
         error_trace = traceback.format_exc()
         raise HTTPException(
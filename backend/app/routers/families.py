@@ -7,7 +7,7 @@ from typing import List
 router = APIRouter()
 
 @router.post("/", response_model=schemas.FamilyResponse)
-def create_family(family: schemas.FamilyCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def create_family(family: schemas.FamilyCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_db_user)):
     try:
         # Validar que el nombre no esté vacío
         if not family.name or not family.name.strip():
@@ -39,7 +39,7 @@ def create_family(family: schemas.FamilyCreate, db: Session = Depends(get_db), c
         raise HTTPException(status_code=500, detail=f"Error al crear familia: {str(e)}")
 
 @router.get("/{family_id}", response_model=schemas.FamilyResponse)
-def get_family(family_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def get_family(family_id: int, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     family = db.query(models.Family).filter(models.Family.id == family_id).first()
     if not family:
         raise HTTPException(status_code=404, detail="Familia no encontrada")
@@ -51,7 +51,7 @@ def get_family(family_id: int, db: Session = Depends(get_db), current_user: mode
     return family
 
 @router.get("/{family_id}/members", response_model=List[schemas.UserResponse])
-def get_family_members(family_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def get_family_members(family_id: int, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     """Obtiene todos los miembros de una familia"""
     family = db.query(models.Family).filter(models.Family.id == family_id).first()
     if not family:
@@ -65,7 +65,7 @@ def get_family_members(family_id: int, db: Session = Depends(get_db), current_us
     return members
 
 @router.post("/{family_id}/members/{user_id}")
-def add_member_to_family(family_id: int, user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def add_member_to_family(family_id: int, user_id: int, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     try:
         family = db.query(models.Family).filter(models.Family.id == family_id).first()
         if not family:
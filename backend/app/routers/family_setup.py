@@ -24,7 +24,7 @@ TEST_USER_EMAILS = ["maria.gonzalez@test.com", "carlos.rodriguez@test.com"]
 @router.post("/create-family-members")
 def create_family_members(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Crea usuarios para todos los integrantes de la familia según el Excel.
@@ -181,7 +181,7 @@ def create_family_members(
 @router.post("/delete-test-users")
 def delete_test_users(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Elimina específicamente los usuarios de prueba: María González y Carlos Rodríguez.
@@ -248,7 +248,7 @@ def delete_test_users(
 @router.post("/clear-all-data")
 def clear_all_data(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Elimina TODOS los datos del sistema: transacciones, presupuestos y usuarios (excepto el usuario actual).
@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, func
+from sqlalchemy import or_, and_
 from app.database import get_db
-from app import models, schemas, auth
-from app.services import activity_logger
+from app import models, schemas, auth, etags
+from app.services import activity_logger, response_cache, spending_rollups
 from typing import List, Optional
 from datetime import datetime
 
@@ -26,7 +26,7 @@ def is_individual_category(category: str, subcategory: str) -> bool:
 @router.get("/categories")
 def get_individual_categories(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene las categorías y subcategorías disponibles para presupuestos personales.
@@ -43,7 +43,7 @@ def get_individual_categories(
 def create_personal_budget(
     budget: schemas.FamilyBudgetCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Crea un presupuesto personal para el usuario actual.
@@ -107,14 +107,8 @@ def create_personal_budget(
         db.refresh(db_budget)
         db.refresh(user_budget)
         
-        # Calcular income_amount desde transacciones (si existe)
+        # Presupuesto recién creado: todavía no tiene movimientos
         income_amount = 0.0
-        transactions = db.query(models.Transaction).filter(
-            models.Transaction.family_budget_id == db_budget.id,
-            models.Transaction.user_id == current_user.id,
-            models.Transaction.transaction_type == models.TransactionType.INCOME.value
-        ).all()
-        income_amount = sum(t.amount for t in transactions)
         
         # Calcular available_amount
         available_amount = user_budget.allocated_amount + income_amount - (user_budget.spent_amount or 0.0)
@@ -185,10 +179,12 @@ def create_personal_budget(
         raise HTTPException(status_code=500, detail=error_detail)
 
 @router.get("/", response_model=List[schemas.FamilyBudgetResponse])
+@etags.conditional("personal_budgets.list", per_user=True)
+@response_cache.cached("personal_budgets.list", response_model=List[schemas.FamilyBudgetResponse], per_user=True)
 def get_personal_budgets(
     year: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene todos los presupuestos asignados al usuario actual.
@@ -239,30 +235,15 @@ def get_personal_budgets(
         ).all()
         user_budgets_dict = {ub.family_budget_id: ub for ub in user_budgets}
     
-    # Obtener todos los income_amounts en una sola consulta agregada
-    income_totals = {}
-    if budget_ids:
-        income_results = db.query(
-            models.Transaction.family_budget_id,
-            func.sum(models.Transaction.amount).label('total_income')
-        ).filter(
-            models.Transaction.family_budget_id.in_(budget_ids),
-            models.Transaction.user_id == current_user.id,
-            models.Transaction.transaction_type == models.TransactionType.INCOME.value
-        ).group_by(
-            models.Transaction.family_budget_id
-        ).all()
-        
-        income_totals = {result.family_budget_id: float(result.total_income) if result.total_income else 0.0 
-                        for result in income_results}
+    # Ingresos del usuario por presupuesto desde budget_rollups en una sola consulta agregada
+    totals = spending_rollups.budget_totals(db, budget_ids, user_id=current_user.id)
     
     # Asignar user_allocations y calcular available_amount
     for budget in budgets:
         user_budget = user_budgets_dict.get(budget.id)
         
         if user_budget:
-            # Obtener income_amount del diccionario pre-calculado
-            income_amount = income_totals.get(budget.id, 0.0)
+            income_amount = totals.get(budget.id, {}).get("income", 0.0)
             
             # Calcular available_amount
             user_budget.available_amount = user_budget.allocated_amount + income_amount - (user_budget.spent_amount or 0.0)
@@ -276,10 +257,11 @@ def get_personal_budgets(
     return budgets
 
 @router.get("/{budget_id}", response_model=schemas.FamilyBudgetResponse)
+@etags.conditional("personal_budgets.detail", per_user=True)
 def get_personal_budget(
     budget_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Obtiene un presupuesto personal específico.
@@ -305,7 +287,7 @@ def update_personal_budget(
     budget_id: int,
     budget_update: schemas.FamilyBudgetUpdate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza un presupuesto personal.
@@ -378,7 +360,7 @@ def update_personal_budget(
 def delete_personal_budget(
     budget_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Elimina un presupuesto personal.
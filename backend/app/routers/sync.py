@@ -0,0 +1,99 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session, noload
+from app.database import get_db
+from app import models, schemas, auth
+from app.services import family_versions, spending_rollups, sync_log
+from typing import Any, Dict, List
+
+router = APIRouter()
+
+# Por entidad: (esquema de respuesta, campos anidados que no se mandan; el cliente los une por id)
+_PAYLOADS = {
+    "transactions": (schemas.TransactionResponse, {"user"}),
+    "receipts": (schemas.ReceiptResponse, {"items", "user"}),
+    "receipt_items": (schemas.ReceiptItemResponse, set()),
+    "family_budgets": (
+        schemas.FamilyBudgetResponse, {"user_allocations", "target_user", "custom_category", "custom_subcategory"},
+    ),
+    "user_budgets": (schemas.UserBudgetResponse, {"user"}),
+    "custom_categories": (schemas.CustomCategoryResponse, {"subcategories"}),
+    "custom_subcategories": (schemas.CustomSubcategoryResponse, set()),
+}
+
+
+def _visible(db: Session, entity: str, current_user: auth.Principal):
+    """Entidades de ese tipo que el usuario ve, con el mismo criterio que sus listados."""
+    family_id = current_user.family_id
+    if entity == "transactions":
+        return db.query(models.Transaction).filter(models.Transaction.user_id == current_user.id)
+    if entity == "receipts":
+        return db.query(models.Receipt).filter(models.Receipt.user_id == current_user.id)
+    if entity == "receipt_items":
+        own_receipts = db.query(models.Receipt.id).filter(models.Receipt.user_id == current_user.id)
+        return db.query(models.ReceiptItem).filter(models.ReceiptItem.receipt_id.in_(own_receipts))
+    if entity == "family_budgets":
+        return db.query(models.FamilyBudget).filter(models.FamilyBudget.family_id == family_id)
+    if entity == "user_budgets":
+        family_budgets = db.query(models.FamilyBudget.id).filter(models.FamilyBudget.family_id == family_id)
+        return db.query(models.UserBudget).filter(models.UserBudget.family_budget_id.in_(family_budgets))
+    if entity == "custom_categories":
+        return db.query(models.CustomCategory).filter(models.CustomCategory.family_id == family_id)
+    family_categories = db.query(models.CustomCategory.id).filter(models.CustomCategory.family_id == family_id)
+    return db.query(models.CustomSubcategory).filter(models.CustomSubcategory.custom_category_id.in_(family_categories))
+
+
+def _payloads(db: Session, entity: str, rows: list) -> List[Dict[str, Any]]:
+    schema, nested = _PAYLOADS[entity]
+    if entity == "user_budgets" and rows:
+        # Ingresos por (presupuesto, usuario) desde budget_rollups, igual que en presupuestos personales
+        totals = spending_rollups.budget_totals(db, {ub.family_budget_id for ub in rows}, by_user=True)
+        for user_budget in rows:
+            income_amount = totals.get((user_budget.family_budget_id, user_budget.user_id), {}).get("income", 0.0)
+            user_budget.income_amount = income_amount
+            user_budget.available_amount = user_budget.allocated_amount + income_amount - (user_budget.spent_amount or 0.0)
+    return [schema.model_validate(row, from_attributes=True).model_dump(mode="json", exclude=nested) for row in rows]
+
+
+@router.get("", response_model=schemas.SyncResponse)
+def sync(
+    since: int = Query(0, ge=0),  # `cursor` de la respuesta anterior; 0 = descarga completa
+    limit: int = Query(500, ge=1, le=5000),  # Cambios por página (aprox.; un mismo commit nunca se parte)
+    db: Session = Depends(get_db),
+    current_user: auth.Principal = Depends(auth.get_current_user)
+):
+    """
+    Sincronización incremental para el cliente móvil: solo las transacciones, recibos, conceptos de
+    recibo, presupuestos, asignaciones y categorías personalizadas que se crearon, cambiaron o borraron
+    después de `since` (sync_changes), en páginas. Sin `since`, o con uno mayor a la secuencia actual
+    de la familia (base restaurada, otra familia), regresa todo con full=true y sin tombstones.
+    """
+    if not current_user.family_id:
+        raise HTTPException(status_code=400, detail="Usuario no pertenece a una familia")
+
+    version = family_versions.current(db, current_user.family_id)
+    full = since == 0 or since > version
+    # De transacciones, recibos y conceptos solo lo que el usuario tiene o tuvo (user_ids)
+    changed, cursor, has_more = sync_log.changes_since(
+        db, current_user.family_id, 0 if full else since, limit, include_deleted=not full, user_id=current_user.id
+    )
+    if not has_more:
+        # Lo de secuencias <= version ya quedó en esta respuesta (se escribe en la misma transacción)
+        cursor = max(cursor, version)
+
+    changes: Dict[str, List[Dict[str, Any]]] = {}
+    deleted: Dict[str, List[int]] = {}
+    for entity, ids in changed.items():
+        model = getattr(models, sync_log.ENTITIES[entity])
+        rows = []
+        if ids["upserts"]:
+            rows = _visible(db, entity, current_user).filter(
+                model.id.in_(ids["upserts"])
+            ).options(noload("*")).order_by(model.id).all()
+        if rows:
+            changes[entity] = _payloads(db, entity, rows)
+        # Lo que cambió pero el usuario ya no ve (p. ej. una transacción suya reasignada a otro miembro) se borra en el cliente
+        gone = ids["deleted"] + sorted(set(ids["upserts"]) - {row.id for row in rows})
+        if gone and not full:
+            deleted[entity] = gone
+
+    return {"cursor": cursor, "has_more": has_more, "full": full, "changes": changes, "deleted": deleted}
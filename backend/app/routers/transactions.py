@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from app.database import get_db
-from app import models, schemas, auth
+from app import models, schemas, auth, etags
 from app.services import activity_logger
 from typing import List, Optional
 from datetime import datetime
@@ -10,7 +10,7 @@ from sqlalchemy import or_
 router = APIRouter()
 
 @router.post("/", response_model=schemas.TransactionResponse)
-def create_transaction(transaction: schemas.TransactionCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def create_transaction(transaction: schemas.TransactionCreate, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     try:
         # Validar que el monto sea positivo y razonable
         if transaction.amount <= 0:
@@ -49,23 +49,7 @@ def create_transaction(transaction: schemas.TransactionCreate, db: Session = Dep
         )
         db.add(db_transaction)
         
-        # Actualizar el presupuesto del usuario si hay family_budget_id
-        if transaction.family_budget_id:
-            user_budget = db.query(models.UserBudget).filter(
-                models.UserBudget.user_id == current_user.id,
-                models.UserBudget.family_budget_id == transaction.family_budget_id
-            ).first()
-            
-            if user_budget:
-                transaction_type_value = transaction.transaction_type.value if isinstance(transaction.transaction_type, models.TransactionType) else transaction.transaction_type
-                if transaction_type_value == models.TransactionType.INCOME.value:
-                    # Ingreso: aumenta el income_amount (y por tanto el available_amount)
-                    user_budget.income_amount += transaction.amount
-                else:
-                    # Egreso: aumenta el spent_amount (disminuye el available_amount)
-                    user_budget.spent_amount += transaction.amount
-                db.add(user_budget)
-        
+        # user_budgets.spent_amount y budget_rollups se actualizan al hacer flush (spending_rollups)
         db.commit()
         db.refresh(db_transaction)
         
@@ -100,6 +84,7 @@ def create_transaction(transaction: schemas.TransactionCreate, db: Session = Dep
         raise HTTPException(status_code=500, detail=f"Error al crear transacción: {str(e)}")
 
 @router.get("/", response_model=List[schemas.TransactionResponse])
+@etags.conditional("transactions.list", per_user=True)
 def get_transactions(
     category: Optional[models.Category] = Query(None),
     transaction_type: Optional[models.TransactionType] = Query(None),  # Filtro por tipo
@@ -108,7 +93,7 @@ def get_transactions(
     limit: Optional[int] = Query(100, ge=1, le=1000),  # Límite de resultados
     offset: Optional[int] = Query(0, ge=0),  # Offset para paginación
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     query = db.query(models.Transaction).filter(models.Transaction.user_id == current_user.id)
     
@@ -128,7 +113,8 @@ def get_transactions(
     return transactions
 
 @router.get("/{transaction_id}", response_model=schemas.TransactionResponse)
-def get_transaction(transaction_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+@etags.conditional("transactions.detail", per_user=True)
+def get_transaction(transaction_id: int, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     transaction = db.query(models.Transaction).filter(
         models.Transaction.id == transaction_id,
         models.Transaction.user_id == current_user.id
@@ -144,7 +130,7 @@ def update_transaction(
     transaction_id: int,
     updates: dict,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Actualiza una transacción existente.
@@ -159,11 +145,6 @@ def update_transaction(
         if not transaction:
             raise HTTPException(status_code=404, detail="Transacción no encontrada")
         
-        # Guardar valores antiguos para actualizar presupuestos
-        old_amount = transaction.amount
-        old_type = transaction.transaction_type
-        old_budget_id = transaction.family_budget_id
-        
         # Actualizar campos permitidos
         if 'amount' in updates:
             new_amount = float(updates['amount'])
@@ -205,36 +186,7 @@ def update_transaction(
                     raise HTTPException(status_code=403, detail="No tienes acceso a este presupuesto")
             transaction.family_budget_id = new_budget_id
         
-        # Revertir cambios en el presupuesto antiguo
-        if old_budget_id:
-            old_user_budget = db.query(models.UserBudget).filter(
-                models.UserBudget.user_id == current_user.id,
-                models.UserBudget.family_budget_id == old_budget_id
-            ).first()
-            
-            if old_user_budget:
-                if old_type == models.TransactionType.INCOME.value:
-                    old_user_budget.income_amount -= old_amount
-                else:
-                    old_user_budget.spent_amount -= old_amount
-                db.add(old_user_budget)
-        
-        # Aplicar cambios en el presupuesto nuevo (o actualizado)
-        new_budget_id = transaction.family_budget_id
-        if new_budget_id:
-            new_user_budget = db.query(models.UserBudget).filter(
-                models.UserBudget.user_id == transaction.user_id,
-                models.UserBudget.family_budget_id == new_budget_id
-            ).first()
-            
-            if new_user_budget:
-                transaction_type_value = transaction.transaction_type
-                if transaction_type_value == models.TransactionType.INCOME.value:
-                    new_user_budget.income_amount += transaction.amount
-                else:
-                    new_user_budget.spent_amount += transaction.amount
-                db.add(new_user_budget)
-        
+        # El presupuesto anterior y el nuevo se ajustan al hacer flush (spending_rollups)
         db.commit()
         db.refresh(transaction)
         
@@ -1,7 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from app.database import get_db
 from app import models, schemas, auth
+from app.services import phone_numbers
 from datetime import timedelta
 from pydantic import BaseModel
 from typing import Optional
@@ -32,8 +34,12 @@ def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         if db_user:
             raise HTTPException(status_code=400, detail="Email ya registrado")
         
-        # Verificar si el teléfono ya existe
-        db_user = db.query(models.User).filter(models.User.phone == user.phone).first()
+        # Verificar si el teléfono ya existe (también escrito en otro formato: sin +52, con "1" extra, etc.)
+        phone_filter = models.User.phone == user.phone
+        phone_e164 = phone_numbers.normalize_phone(user.phone)
+        if phone_e164:
+            phone_filter = or_(phone_filter, models.User.phone_e164 == phone_e164)
+        db_user = db.query(models.User).filter(phone_filter).first()
         if db_user:
             raise HTTPException(status_code=400, detail="Teléfono ya registrado")
         
@@ -105,9 +111,7 @@ def login_user(user_credentials: LoginRequest, db: Session = Depends(get_db)):
             )
         
         access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = auth.create_access_token(
-            data={"sub": user.email}, expires_delta=access_token_expires
-        )
+        access_token = auth.create_user_token(user, expires_delta=access_token_expires)
         
         print(f"✅ Token generado exitosamente para: {user.email}")
         return {"access_token": access_token, "token_type": "bearer"}
@@ -123,13 +127,13 @@ def login_user(user_credentials: LoginRequest, db: Session = Depends(get_db)):
         )
 
 @router.get("/me", response_model=schemas.UserResponse)
-def get_current_user_info(current_user: models.User = Depends(auth.get_current_user)):
+def get_current_user_info(current_user: models.User = Depends(auth.get_current_db_user)):
     return current_user
 
 @router.post("/verify-password")
 def verify_password(
     request: PasswordVerifyRequest,
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: models.User = Depends(auth.get_current_db_user)
 ):
     """
     Verifica la contraseña del usuario actual.
@@ -147,7 +151,7 @@ def verify_password(
         return {"valid": False}
 
 @router.get("/{user_id}", response_model=schemas.UserResponse)
-def get_user(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_user)):
+def get_user(user_id: int, db: Session = Depends(get_db), current_user: auth.Principal = Depends(auth.get_current_user)):
     # Solo permitir ver el propio perfil o usuarios de la misma familia
     if user_id != current_user.id:
         if not current_user.family_id:
@@ -173,7 +177,7 @@ class CreateUserRequest(BaseModel):
 def create_user_by_admin(
     user_data: CreateUserRequest,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: auth.Principal = Depends(auth.get_current_user)
 ):
     """
     Crea un nuevo usuario. Solo los administradores de familia pueden usar este endpoint.
@@ -229,7 +233,11 @@ def create_user_by_admin(
                     status_code=400,
                     detail="Email ya registrado"
                 )
-            existing_user = db.query(models.User).filter(models.User.phone == user_data.phone.strip()).first()
+            phone_filter = models.User.phone == user_data.phone.strip()
+            phone_e164 = phone_numbers.normalize_phone(user_data.phone)
+            if phone_e164:
+                phone_filter = or_(phone_filter, models.User.phone_e164 == phone_e164)
+            existing_user = db.query(models.User).filter(phone_filter).first()
             if existing_user:
                 raise HTTPException(
                     status_code=400,
@@ -303,6 +303,26 @@ class ReceiptResponse(ReceiptBase):
     class Config:
         from_attributes = True
 
+class ReceiptJobResponse(BaseModel):
+    job_id: int
+    status: str  # queued, processing, done, failed
+    mode: Optional[str] = None
+    progress: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    queue_position: Optional[int] = None
+    receipt_id: Optional[int] = None
+    receipt: Optional[ReceiptResponse] = None
+    parts_status: Optional[List[Dict[str, Any]]] = None
+    totals_status: Optional[List[Dict[str, Any]]] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+class ReceiptReextractRequest(BaseModel):
+    file: int = 1  # Imagen del recibo (cuando se subieron varias)
+    parts: Optional[List[int]] = None  # Partes a re-extraer; si es None, solo las inconsistentes
+
 class ReceiptAssignRequest(BaseModel):
     transaction_id: Optional[int] = None  # Si es None, se crea una nueva transacción
     items: Optional[List[Dict[str, Any]]] = None  # Lista de items con transaction_id asignado
@@ -341,3 +361,11 @@ class ActivityLogResponse(ActivityLogBase):
     
     class Config:
         from_attributes = True
+
+# Sincronización incremental
+class SyncResponse(BaseModel):
+    cursor: int  # Secuencia hasta la que llega esta respuesta; mandarla como `since` en la siguiente
+    has_more: bool  # Quedan cambios después de `cursor`: pedir de nuevo de inmediato
+    full: bool  # Respuesta completa (sin `since` o con uno que no es de esta familia): reemplazar lo local
+    changes: Dict[str, List[Dict[str, Any]]]  # Entidades nuevas o cambiadas, planas (sin anidados), por tipo
+    deleted: Dict[str, List[int]]  # Ids borrados o que el usuario ya no ve, por tipo
@@ -6,15 +6,32 @@ import os
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 
+from app.services import llm_transport, openai_governor
+
 try:
     from openai import OpenAI
     OPENAI_AVAILABLE = True
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY")) if os.getenv("OPENAI_API_KEY") else None
+    # En replay (LLM_TRANSPORT=replay) no se usa la red: basta un cliente con llave de relleno.
+    _api_key = os.getenv("OPENAI_API_KEY") or ("replay" if llm_transport.offline() else None)
+    client = OpenAI(api_key=_api_key) if _api_key else None
 except ImportError:
     OPENAI_AVAILABLE = False
     OpenAI = None
     client = None
 
+
+def _chat(**request_payload):
+    """
+    Llamada al chat de OpenAI en el carril "analytics" del gobernador global
+    (cede el paso a recibos web y WhatsApp cuando hay saturación).
+    """
+    est = openai_governor.estimate_tokens(request_payload)
+    with openai_governor.slot(est, openai_governor.LANE_ANALYTICS) as ticket:
+        response = llm_transport.create(client, **request_payload)
+        ticket.record(response)
+        return response
+
+
 # Contexto del sistema para el asistente
 SYSTEM_CONTEXT = """Eres un asistente financiero inteligente para el sistema DOMUS+, un sistema de gestión de presupuesto familiar.
 
@@ -119,7 +136,7 @@ def get_ai_response(
         messages.append({"role": "user", "content": user_message})
         
         # Llamar a GPT
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",  # Modelo más económico para chat
             messages=messages,
             temperature=0.7,
@@ -169,7 +186,7 @@ Proporciona:
 
 Responde en español, de forma clara y concisa."""
         
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": SYSTEM_CONTEXT},
@@ -220,7 +237,7 @@ Responde SOLO con un JSON válido en este formato:
     "reason": "breve explicación"
 }}"""
 
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Eres un asistente que ayuda a categorizar transacciones financieras. Responde SOLO con JSON válido."},
@@ -311,7 +328,7 @@ Responde SOLO con un JSON válido:
     "recommendations": ["recomendación 1", "recomendación 2"]
 }}"""
 
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Eres un analista financiero experto que detecta anomalías y patrones en gastos. Responde SOLO con JSON válido."},
@@ -399,7 +416,7 @@ Responde SOLO con un JSON válido:
     "seasonal_factors": ["factor estacional 1", "factor estacional 2"]
 }}"""
 
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Eres un analista financiero que predice gastos futuros basado en patrones históricos. Responde SOLO con JSON válido."},
@@ -470,7 +487,7 @@ Genera un reporte narrativo que incluya:
 
 El reporte debe ser profesional, claro y útil para la toma de decisiones."""
 
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": SYSTEM_CONTEXT + "\n\nEres un analista financiero profesional que genera reportes narrativos claros y accionables."},
@@ -539,7 +556,7 @@ Responde SOLO con un JSON válido:
     "total_redistribution": 0.00
 }}"""
 
-        response = client.chat.completions.create(
+        response = _chat(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Eres un consultor financiero experto en optimización de presupuestos. Responde SOLO con JSON válido."},
@@ -0,0 +1,178 @@
+"""
+Caché de extracciones de recibos direccionada por contenido.
+
+La llave es SHA-256 de los bytes de la imagen (parte/pie) + versión del prompt +
+modelo + nivel de detalle. Si el mismo recibo llega dos veces (reintento web, o la
+misma foto por WhatsApp) no se vuelve a pagar la llamada a OpenAI.
+Se guarda en un archivo SQLite local (compartido entre workers) con evicción LRU
+por tamaño total. Las versiones async del extractor llaman get/put en un hilo (to_thread).
+"""
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+CACHE_ENABLED = str(os.getenv("RECEIPT_CACHE_ENABLED", "1")).strip().lower() not in ("0", "false", "no")
+CACHE_PATH = os.getenv("RECEIPT_CACHE_PATH") or str(Path(__file__).resolve().parents[2] / "receipt_cache.db")
+CACHE_MAX_BYTES = int(float(os.getenv("RECEIPT_CACHE_MAX_MB", "200")) * 1024 * 1024)
+EVICT_BATCH = max(1, int(os.getenv("RECEIPT_CACHE_EVICT_BATCH", "200")))
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+# Contadores del proceso (los de la tabla `entries` acumulan por llave entre reinicios)
+_stats: Dict[str, float] = {
+    "hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0,
+    "tokens_saved": 0,
+    "seconds_saved": 0.0,
+}
+
+
+def prompt_version(prompt: str) -> str:
+    """Versión corta del prompt: cambia sola cuando se edita el texto."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def make_key(kind: str, image_base64: str, prompt_ver: str, model: str, image_detail: Optional[str], max_tokens: int) -> str:
+    try:
+        image_bytes = base64.b64decode(image_base64)
+    except Exception:
+        image_bytes = image_base64.encode("utf-8")
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    return f"{kind}:{digest}:{prompt_ver}:{model}:{image_detail or ''}:{max_tokens}"
+
+
+def _get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        Path(CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(CACHE_PATH, check_same_thread=False, timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                elapsed REAL NOT NULL DEFAULT 0,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_last_access ON entries (last_access)")
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def get(key: str) -> Optional[Dict[str, Any]]:
+    """Devuelve el resultado cacheado (marcado con _meta.cache = "hit") o None."""
+    if not CACHE_ENABLED:
+        return None
+    try:
+        with _lock:
+            conn = _get_conn()
+            row = conn.execute("SELECT value, elapsed, tokens FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                _stats["misses"] += 1
+                return None
+            conn.execute(
+                "UPDATE entries SET hits = hits + 1, last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            conn.commit()
+            _stats["hits"] += 1
+            _stats["seconds_saved"] += float(row[1] or 0.0)
+            _stats["tokens_saved"] += int(row[2] or 0)
+        data = json.loads(row[0])
+        meta = data.get("_meta") if isinstance(data.get("_meta"), dict) else {}
+        data["_meta"] = dict(meta, cache="hit")
+        return data
+    except Exception as e:
+        print(f"⚠️ Caché de recibos no disponible (get): {e}")
+        return None
+
+
+def put(key: str, kind: str, data: Dict[str, Any], elapsed: float = 0.0, tokens: int = 0) -> None:
+    if not CACHE_ENABLED:
+        return
+    try:
+        value = json.dumps(data, ensure_ascii=False)
+        now = time.time()
+        with _lock:
+            conn = _get_conn()
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO entries (key, kind, value, size, elapsed, tokens, hits, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)
+                """,
+                (key, kind, value, len(value.encode("utf-8")), float(elapsed or 0.0), int(tokens or 0), now, now),
+            )
+            _stats["stores"] += 1
+            _evict(conn)
+            conn.commit()
+    except Exception as e:
+        print(f"⚠️ Caché de recibos no disponible (put): {e}")
+
+
+def _evict(conn: sqlite3.Connection) -> None:
+    """
+    Evicción LRU: al pasar el límite, borrar lo menos usado hasta quedar en ~90%. Se leen solo lotes de
+    EVICT_BATCH llaves (índice por last_access), no la tabla completa.
+    """
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0] or 0
+    if total <= CACHE_MAX_BYTES:
+        return
+    target = int(CACHE_MAX_BYTES * 0.9)
+    while total > target:
+        rows = conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_access ASC LIMIT ?", (EVICT_BATCH,)
+        ).fetchall()
+        if not rows:
+            break
+        to_delete = []
+        for key, size in rows:
+            if total <= target:
+                break
+            to_delete.append((key,))
+            total -= size or 0
+        conn.executemany("DELETE FROM entries WHERE key = ?", to_delete)
+        _stats["evictions"] += len(to_delete)
+
+
+def stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = dict(_stats)
+    lookups = out["hits"] + out["misses"]
+    out["hit_ratio"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+    out["seconds_saved"] = round(out["seconds_saved"], 2)
+    out["enabled"] = CACHE_ENABLED
+    out["max_bytes"] = CACHE_MAX_BYTES
+    if CACHE_ENABLED:
+        try:
+            with _lock:
+                row = _get_conn().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), "
+                    "COALESCE(SUM(hits * tokens), 0), COALESCE(SUM(hits * elapsed), 0) FROM entries"
+                ).fetchone()
+            out["entries"] = row[0]
+            out["size_bytes"] = row[1]
+            # Acumulado histórico (sobrevive reinicios) de las llaves aún en caché
+            out["total_hits"] = row[2]
+            out["total_tokens_saved"] = row[3]
+            out["total_seconds_saved"] = round(row[4] or 0.0, 2)
+        except Exception as e:
+            out["error"] = str(e)
+    return out
@@ -0,0 +1,235 @@
+"""
+Versión de los datos de cada familia (tabla family_data_versions).
+
+Un contador por familia que sube en la MISMA transacción que cualquier escritura a sus presupuestos,
+asignaciones, transacciones, recibos, categorías personalizadas, miembros o a la familia misma. Quien arma una
+respuesta a partir de esos datos puede guardarla junto con la versión con la que la armó: mientras la
+versión no cambie, la respuesta sigue siendo válida (caché de respuestas, ETag). Vive en la base de
+datos, así que todos los workers ven la misma versión. Es también la secuencia de cambios de la
+sincronización incremental: cada entidad cambiada queda en sync_changes con la versión nueva (sync_log).
+
+Se mantiene con eventos de la sesión de SQLAlchemy:
+- before_flush: de lo que se va a borrar se leen sus referencias en la BD mientras todavía existen
+  (al borrar un recibo con sus conceptos, después ya no hay recibo por el cual llegar a la familia).
+- after_flush: cada objeto nuevo, cambiado o borrado se resuelve a su familia (directo, o por su
+  usuario, presupuesto, recibo o categoría personalizada, con los valores actuales y los anteriores).
+- do_orm_execute: los borrados/actualizaciones masivos (query(...).delete()/update()) no pasan por el
+  flush; antes de ejecutarlos se buscan, con su mismo WHERE, las filas que tocan y sus familias.
+
+No importa app.models a nivel de módulo (models importa este módulo para registrar los eventos).
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session
+
+from app.services import sync_log
+from app.services.sync_log import Change
+
+# Columna que lleva de cada modelo a su familia: ("family", col) es la familia directa; ("user", col),
+# ("budget", col), ("receipt", col) y ("custom_category", col) se resuelven con una consulta (_lookup).
+_FAMILY_REFS = {
+    "Family": [("family", "id")],
+    "FamilyBudget": [("family", "family_id")],
+    "CustomCategory": [("family", "family_id")],
+    "User": [("family", "family_id")],
+    "UserBudget": [("budget", "family_budget_id"), ("user", "user_id")],
+    "Transaction": [("user", "user_id"), ("budget", "family_budget_id")],
+    "CustomSubcategory": [("custom_category", "custom_category_id")],
+    "Receipt": [("user", "user_id")],
+    "ReceiptItem": [("receipt", "receipt_id")],
+}
+_DELETED_KEY = "family_versions_deleted"
+
+# (modelo, id, {tipo de referencia: {ids}}, borrado): un cambio antes de saber sus familias
+Pending = Tuple[str, Optional[int], Dict[str, Set[int]], bool]
+
+
+def _tracked(obj) -> bool:
+    return type(obj).__name__ in _FAMILY_REFS and type(obj).__module__ == "app.models"
+
+
+def _values(obj, column: str) -> Set[int]:
+    """Valor actual y, si cambió en este flush, el anterior (mover algo de familia cambia las dos)."""
+    history = sa_inspect(obj).attrs[column].history
+    return {v for v in (*history.added, *history.unchanged, *history.deleted) if v is not None}
+
+
+def _lookup(connection, refs: Dict[str, Set[int]]) -> Dict[str, Dict[int, int]]:
+    """Familia de cada id referenciado: {"user": {...}, "budget": {...}, ...} -> {"user": {id: family_id}, ...}."""
+    from app import models
+    users = models.User.__table__
+    receipts = models.Receipt.__table__
+    budgets = models.FamilyBudget.__table__
+    categories = models.CustomCategory.__table__
+    out: Dict[str, Dict[int, int]] = {"family": {f: f for f in refs.get("family", ())}}
+    lookups = (
+        ("user", users.c.id, users.c.family_id, users),
+        ("budget", budgets.c.id, budgets.c.family_id, budgets),
+        ("custom_category", categories.c.id, categories.c.family_id, categories),
+        ("receipt", receipts.c.id, users.c.family_id, receipts.join(users, users.c.id == receipts.c.user_id)),
+    )
+    for kind, id_column, family_column, from_ in lookups:
+        ids = refs.get(kind)
+        if ids:
+            out[kind] = dict(connection.execute(
+                select(id_column, family_column).select_from(from_).where(id_column.in_(ids))
+            ).all())
+    if refs.get("receipt"):
+        # Dueño de cada recibo: los conceptos se sincronizan solo a quien ve el recibo
+        out["receipt_owner"] = dict(connection.execute(
+            select(receipts.c.id, receipts.c.user_id).where(receipts.c.id.in_(refs["receipt"]))
+        ).all())
+    return out
+
+
+def _resolve(connection, pending: List[Pending]) -> List[Change]:
+    """Agrega a cada cambio sus familias, con una consulta por tipo de referencia para todos juntos."""
+    refs: Dict[str, Set[int]] = defaultdict(set)
+    for _, _, obj_refs, _ in pending:
+        for kind, ids in obj_refs.items():
+            refs[kind].update(ids)
+    found = _lookup(connection, refs)
+    changes = []
+    for model, entity_id, obj_refs, deleted in pending:
+        families = {found.get(kind, {}).get(v) for kind, ids in obj_refs.items() for v in ids}
+        if obj_refs.get("receipt") and "user" not in obj_refs:
+            owners = {found.get("receipt_owner", {}).get(r) for r in obj_refs["receipt"]}
+            obj_refs = dict(obj_refs, user={u for u in owners if u is not None})
+        changes.append((model, entity_id, obj_refs, {f for f in families if f is not None}, deleted))
+    return changes
+
+
+def _rows(connection, model: str, table, where, deleted: bool) -> List[Pending]:
+    """Filas de `table` que cumplen `where`, con sus referencias como están hoy en la BD."""
+    spec = _FAMILY_REFS[model]
+    query = select(table.c.id, *[table.c[column] for _, column in spec])
+    if where is not None:
+        query = query.where(where)
+    return [
+        (model, row[0], {kind: {row[i + 1]} - {None} for i, (kind, _) in enumerate(spec)}, deleted)
+        for row in connection.execute(query).all()
+    ]
+
+
+def bump(connection, family_ids: Iterable[int]) -> Dict[int, int]:
+    """Sube en 1 la versión de cada familia (upsert atómico ante escrituras concurrentes); regresa las nuevas."""
+    from app import models
+    table = models.FamilyDataVersion.__table__
+    dialect = connection.dialect.name
+    family_ids = sorted(set(family_ids))
+    for family_id in family_ids:
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            stmt = dialect_insert(table).values(family_id=family_id, version=1)
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=["family_id"],
+                set_={"version": table.c.version + 1, "updated_at": func.now()},
+            ))
+            continue
+        result = connection.execute(
+            update(table).where(table.c.family_id == family_id).values(version=table.c.version + 1)
+        )
+        if not result.rowcount:
+            connection.execute(insert(table).values(family_id=family_id, version=1))
+    if not family_ids:
+        return {}
+    return dict(connection.execute(
+        select(table.c.family_id, table.c.version).where(table.c.family_id.in_(family_ids))
+    ).all())
+
+
+def _apply(connection, changes: List[Change]) -> None:
+    """Sube la versión de las familias afectadas y deja las entidades en sync_changes con esa versión."""
+    changes = changes + sync_log.derived(connection, changes)
+    families = {f for _, _, _, obj_families, _ in changes for f in obj_families}
+    if families:
+        sync_log.record(connection, changes, bump(connection, families))
+
+
+@event.listens_for(Session, "before_flush")
+def _capture_deleted(session: Session, flush_context, instances) -> None:
+    by_model: Dict[type, List[int]] = defaultdict(list)
+    for obj in session.deleted:
+        identity = sa_inspect(obj).identity
+        if _tracked(obj) and identity:
+            by_model[type(obj)].append(identity[0])
+    if not by_model:
+        return
+    connection = session.connection()
+    captured = session.info.setdefault(_DELETED_KEY, {})
+    for model, ids in by_model.items():
+        table = model.__table__
+        for change in _resolve(connection, _rows(connection, model.__name__, table, table.c.id.in_(ids), True)):
+            captured[(change[0], change[1])] = change
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_after_flush(session: Session, flush_context) -> None:
+    captured: Dict[Tuple[str, int], Change] = session.info.pop(_DELETED_KEY, None) or {}
+    objects = [o for o in list(session.new) + list(session.dirty) + list(session.deleted) if _tracked(o)]
+    if not objects:
+        return
+    pending: List[Pending] = []
+    changes: List[Change] = []
+    for obj in objects:
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        model = type(obj).__name__
+        deleted = obj in session.deleted
+        # Los nuevos todavía no tienen identity en after_flush, pero su id ya está asignado
+        identity = sa_inspect(obj).identity
+        entity_id = identity[0] if identity else obj.id
+        if deleted and (model, entity_id) in captured:
+            changes.append(captured[(model, entity_id)])
+            continue
+        refs = {kind: _values(obj, column) for kind, column in _FAMILY_REFS[model]}
+        pending.append((model, entity_id, refs, deleted))
+    connection = session.connection()
+    _apply(connection, changes + _resolve(connection, pending))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session) -> None:
+    session.info.pop(_DELETED_KEY, None)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _bump_on_bulk_write(orm_execute_state) -> None:
+    """query(...).delete()/update() y delete()/update() ORM: filas afectadas y sus familias, antes de ejecutar."""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_.__name__ not in _FAMILY_REFS or mapper.class_.__module__ != "app.models":
+        return
+    model = mapper.class_.__name__
+    table = mapper.local_table
+    connection = orm_execute_state.session.connection()
+    pending = _rows(connection, model, table, orm_execute_state.statement.whereclause, orm_execute_state.is_delete)
+    if orm_execute_state.is_delete:
+        _apply(connection, _resolve(connection, pending))
+        return None
+    # Una actualización puede mover filas de familia o de presupuesto: referencias de antes y de después
+    result = orm_execute_state.invoke_statement()
+    refs = {entity_id: obj_refs for _, entity_id, obj_refs, _ in pending}
+    if refs:
+        for _, entity_id, obj_refs, _ in _rows(connection, model, table, table.c.id.in_(list(refs)), False):
+            for kind, ids in obj_refs.items():
+                refs[entity_id].setdefault(kind, set()).update(ids)
+        _apply(connection, _resolve(connection, [(model, i, r, False) for i, r in refs.items()]))
+    return result
+
+
+def current(db: Session, family_id: Optional[int]) -> int:
+    """Versión actual de los datos de la familia (0 si nunca se ha escrito nada)."""
+    if family_id is None:
+        return 0
+    from app import models
+    table = models.FamilyDataVersion.__table__
+    version = db.execute(select(table.c.version).where(table.c.family_id == family_id)).scalar()
+    return int(version or 0)
@@ -0,0 +1,325 @@
+"""
+Transporte intercambiable para las llamadas al LLM (OpenAI chat.completions).
+
+LLM_TRANSPORT:
+  - "live" (default): llama a OpenAI.
+  - "record": llama a OpenAI y guarda cada respuesta en disco (LLM_CASSETTE_DIR).
+  - "replay": no usa red; responde con lo grabado (llave = hash del request completo) con
+    latencia simulada (LLM_REPLAY_LATENCY_MS: "800" o rango "400-1500") y errores inyectados
+    (LLM_REPLAY_ERROR_RATE: 0..1, LLM_REPLAY_ERROR_KIND: timeout | rate_limit | server | mixed).
+
+Sirve para medir cambios del pipeline de recibos sin gastar ni depender de red
+(ver benchmark_pipeline_recibos.py). Lleva contadores globales y, opcionalmente,
+por tarea (`track()`), para saber llamadas y bytes enviados por recibo.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+MODES = ("live", "record", "replay")
+ERROR_KINDS = ("timeout", "rate_limit", "server")
+
+_config: Dict[str, Any] = {}
+_lock = threading.Lock()
+_rng = random.Random()
+_stats: Dict[str, Any] = {}
+_tracker: ContextVar[Optional[Dict[str, Any]]] = ContextVar("llm_tracker", default=None)
+
+
+class InjectedError(Exception):
+    """Error simulado en modo replay (mismo texto que devolvería la API)."""
+
+
+def _parse_latency(value: Any) -> Tuple[float, float]:
+    text = str(value or "0").strip()
+    if "-" in text:
+        low, high = text.split("-", 1)
+        return max(0.0, float(low)), max(0.0, float(high))
+    ms = max(0.0, float(text))
+    return ms, ms
+
+
+def configure(
+    mode: Optional[str] = None,
+    cassette_dir: Optional[str] = None,
+    latency_ms: Optional[str] = None,
+    error_rate: Optional[float] = None,
+    error_kind: Optional[str] = None,
+    seed: Optional[int] = None,
+) -> None:
+    """(Re)configura el transporte; los valores no indicados se toman de las variables de entorno."""
+    mode = (mode or os.getenv("LLM_TRANSPORT") or "live").strip().lower()
+    if mode not in MODES:
+        print(f"⚠️ LLM_TRANSPORT desconocido ({mode}); se usa live")
+        mode = "live"
+    latency = latency_ms if latency_ms is not None else os.getenv("LLM_REPLAY_LATENCY_MS", "0")
+    default_dir = Path(__file__).resolve().parents[2] / "llm_cassettes"
+    with _lock:
+        _config.update(
+            mode=mode,
+            cassette_dir=Path(cassette_dir or os.getenv("LLM_CASSETTE_DIR") or default_dir),
+            latency_ms=_parse_latency(latency),
+            error_rate=min(1.0, max(0.0, float(error_rate if error_rate is not None else os.getenv("LLM_REPLAY_ERROR_RATE", "0")))),
+            error_kind=(error_kind or os.getenv("LLM_REPLAY_ERROR_KIND") or "timeout").strip().lower(),
+        )
+        seed_value = seed if seed is not None else os.getenv("LLM_REPLAY_SEED")
+        if seed_value is not None:
+            _rng.seed(int(seed_value))
+
+
+def mode() -> str:
+    return _config["mode"]
+
+
+def offline() -> bool:
+    """En replay no hace falta API key ni red."""
+    return _config["mode"] == "replay"
+
+
+def request_key(request_payload: Dict[str, Any]) -> str:
+    """Llave estable del request completo (modelo, prompt, imagen, parámetros)."""
+    canonical = json.dumps(request_payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _cassette_path(key: str) -> Path:
+    return _config["cassette_dir"] / key[:2] / f"{key}.json"
+
+
+def _request_summary(request_payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Resumen legible del request para la grabación (sin el base64 de la imagen)."""
+    images = []
+    prompt_chars = 0
+    for msg in request_payload.get("messages") or []:
+        content = msg.get("content")
+        if isinstance(content, str):
+            prompt_chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                prompt_chars += len(part.get("text") or "")
+            elif part.get("type") == "image_url":
+                url = str((part.get("image_url") or {}).get("url") or "")
+                images.append({
+                    "sha256": hashlib.sha256(url.encode("utf-8")).hexdigest(),
+                    "chars": len(url),
+                    "detail": (part.get("image_url") or {}).get("detail"),
+                })
+    return {
+        "model": request_payload.get("model"),
+        "max_tokens": request_payload.get("max_tokens"),
+        "response_format": request_payload.get("response_format"),
+        "prompt_chars": prompt_chars,
+        "images": images,
+    }
+
+
+def _dump_response(response) -> Dict[str, Any]:
+    if hasattr(response, "model_dump"):
+        return response.model_dump()
+    if hasattr(response, "to_dict"):
+        return response.to_dict()
+    return json.loads(json.dumps(response, default=lambda o: getattr(o, "__dict__", str(o))))
+
+
+class _Obj:
+    """Vista por atributos de un dict (respuesta grabada sin el SDK de OpenAI)."""
+
+    def __init__(self, data: Dict[str, Any]):
+        for k, v in data.items():
+            setattr(self, k, _wrap(v))
+
+
+def _wrap(value):
+    if isinstance(value, dict):
+        return _Obj(value)
+    if isinstance(value, list):
+        return [_wrap(v) for v in value]
+    return value
+
+
+def _load_response(data: Dict[str, Any]):
+    try:
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate(data)
+    except Exception:
+        return _Obj(data)
+
+
+# --- contadores ---
+
+def _empty_stats() -> Dict[str, Any]:
+    return {
+        "calls": 0,
+        "errors": 0,
+        "injected_errors": 0,
+        "replay_misses": 0,
+        "recorded": 0,
+        "bytes_sent": 0,
+        "bytes_received": 0,
+        "tokens": 0,
+        "latency_s": 0.0,
+    }
+
+
+def reset_stats() -> None:
+    with _lock:
+        _stats.clear()
+        _stats.update(_empty_stats())
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        out = dict(_stats)
+    out["mode"] = _config["mode"]
+    out["latency_s"] = round(out["latency_s"], 3)
+    return out
+
+
+@contextmanager
+def track():
+    """Cuenta las llamadas hechas dentro del bloque (se hereda en tareas asyncio e hilos de to_thread)."""
+    counters = _empty_stats()
+    token = _tracker.set(counters)
+    try:
+        yield counters
+    finally:
+        _tracker.reset(token)
+
+
+def _count(**deltas) -> None:
+    tracked = _tracker.get()
+    with _lock:
+        for target in (_stats, tracked):
+            if target is None:
+                continue
+            for k, v in deltas.items():
+                target[k] = target.get(k, 0) + v
+
+
+def _response_tokens(response) -> int:
+    return int(getattr(getattr(response, "usage", None), "total_tokens", None) or 0)
+
+
+# --- replay ---
+
+def _replay_plan(request_payload: Dict[str, Any]) -> Tuple[str, float, Optional[str]]:
+    """(llave, segundos de latencia, tipo de error a inyectar o None)."""
+    key = request_key(request_payload)
+    low, high = _config["latency_ms"]
+    with _lock:
+        delay = _rng.uniform(low, high) / 1000.0
+        inject = _rng.random() < _config["error_rate"]
+        kind = _config["error_kind"]
+        if inject and kind not in ERROR_KINDS:
+            kind = _rng.choice(ERROR_KINDS)
+    return key, delay, (kind if inject else None)
+
+
+def _injected(kind: str) -> InjectedError:
+    if kind == "rate_limit":
+        return InjectedError("Error code: 429 - Rate limit reached for requests (inyectado)")
+    if kind == "server":
+        return InjectedError("Error code: 500 - The server had an error while processing your request (inyectado)")
+    return InjectedError("Request timed out. (inyectado)")
+
+
+def _replay_response(key: str, sent: int):
+    path = _cassette_path(key)
+    if not path.exists():
+        _count(calls=1, errors=1, replay_misses=1, bytes_sent=sent)
+        raise LookupError(f"Sin grabación para la solicitud {key[:12]} (LLM_TRANSPORT=replay, {_config['cassette_dir']})")
+    raw = path.read_text(encoding="utf-8")
+    response = _load_response(json.loads(raw)["response"])
+    _count(calls=1, bytes_sent=sent, bytes_received=len(raw), tokens=_response_tokens(response))
+    return response
+
+
+def _record(request_payload: Dict[str, Any], response, elapsed: float) -> None:
+    try:
+        key = request_key(request_payload)
+        path = _cassette_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        doc = {
+            "key": key,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "elapsed_s": round(elapsed, 3),
+            "request": _request_summary(request_payload),
+            "response": _dump_response(response),
+        }
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(doc, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+        _count(recorded=1)
+    except Exception as e:
+        print(f"⚠️ No se pudo grabar la respuesta del LLM: {e}")
+
+
+def _payload_bytes(request_payload: Dict[str, Any]) -> int:
+    return len(json.dumps(request_payload, ensure_ascii=False).encode("utf-8"))
+
+
+# --- API ---
+
+def create(client, **request_payload):
+    """Equivalente a `client.chat.completions.create(**request_payload)` según el modo configurado."""
+    sent = _payload_bytes(request_payload)
+    started = time.monotonic()
+    if offline():
+        key, delay, error_kind = _replay_plan(request_payload)
+        if delay:
+            time.sleep(delay)
+        _count(latency_s=time.monotonic() - started)
+        if error_kind:
+            _count(calls=1, errors=1, injected_errors=1, bytes_sent=sent)
+            raise _injected(error_kind)
+        return _replay_response(key, sent)
+
+    try:
+        response = client.chat.completions.create(**request_payload)
+    except Exception:
+        _count(calls=1, errors=1, bytes_sent=sent, latency_s=time.monotonic() - started)
+        raise
+    elapsed = time.monotonic() - started
+    _count(calls=1, bytes_sent=sent, tokens=_response_tokens(response), latency_s=elapsed)
+    if _config["mode"] == "record":
+        _record(request_payload, response, elapsed)
+    return response
+
+
+async def acreate(client, **request_payload):
+    """Versión async de `create` (la latencia simulada no bloquea el event loop)."""
+    sent = _payload_bytes(request_payload)
+    started = time.monotonic()
+    if offline():
+        key, delay, error_kind = _replay_plan(request_payload)
+        if delay:
+            await asyncio.sleep(delay)
+        _count(latency_s=time.monotonic() - started)
+        if error_kind:
+            _count(calls=1, errors=1, injected_errors=1, bytes_sent=sent)
+            raise _injected(error_kind)
+        return await asyncio.to_thread(_replay_response, key, sent)
+
+    try:
+        response = await client.chat.completions.create(**request_payload)
+    except Exception:
+        _count(calls=1, errors=1, bytes_sent=sent, latency_s=time.monotonic() - started)
+        raise
+    elapsed = time.monotonic() - started
+    _count(calls=1, bytes_sent=sent, tokens=_response_tokens(response), latency_s=elapsed)
+    if _config["mode"] == "record":
+        await asyncio.to_thread(_record, request_payload, response, elapsed)
+    return response
+
+
+configure()
+reset_stats()
@@ -0,0 +1,194 @@
+"""
+Monitor del event loop: mide continuamente su retraso (lag) y, en modo debug, reporta la pila de
+cualquier callback que lo bloquee más de un umbral.
+
+Una tarea asyncio duerme LOOP_MONITOR_INTERVAL_MS y mide cuánto de más tardó en despertar: ese
+retraso es el tiempo que el loop estuvo ocupado en otra cosa (consultas síncronas, Pillow, Twilio...)
+y que todas las peticiones concurrentes tuvieron que esperar. Las muestras recientes dan los
+percentiles de GET /api/metrics/event-loop.
+
+Con LOOP_MONITOR_DEBUG=1 un hilo vigía revisa el último latido de esa tarea: si el loop lleva más de
+LOOP_BLOCK_THRESHOLD_MS sin latir, toma la pila del hilo del loop (sys._current_frames) MIENTRAS sigue
+bloqueado, la imprime y señala la línea de la app responsable (p. ej. una consulta síncrona dentro de
+un endpoint async). Se reporta una vez por bloqueo; al liberarse se anota cuánto duró.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+LOOP_MONITOR_ENABLED = str(os.getenv("LOOP_MONITOR_ENABLED", "1")).strip().lower() not in ("0", "false", "no")
+LOOP_MONITOR_DEBUG = str(os.getenv("LOOP_MONITOR_DEBUG", "0")).strip().lower() in ("1", "true", "yes")
+LOOP_MONITOR_INTERVAL = max(0.01, float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100")) / 1000.0)
+# Muestras que se conservan para los percentiles (3000 a 100 ms ≈ últimos 5 minutos)
+LOOP_MONITOR_SAMPLES = max(10, int(os.getenv("LOOP_MONITOR_SAMPLES", "3000")))
+LOOP_BLOCK_THRESHOLD = max(0.01, float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "200")) / 1000.0)
+LOOP_BLOCK_REPORTS = max(1, int(os.getenv("LOOP_BLOCK_REPORTS", "20")))
+_STACK_LIMIT = 40
+
+_APP_DIR = str(Path(__file__).resolve().parents[1])
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def _culprit(stack: traceback.StackSummary) -> Optional[str]:
+    """Frame más interno que pertenece a la app (la línea nuestra que está bloqueando)."""
+    for fs in reversed(stack):
+        if fs.filename.startswith(_APP_DIR) and fs.filename != __file__:
+            return f"{os.path.relpath(fs.filename, os.path.dirname(_APP_DIR))}:{fs.lineno} en {fs.name}"
+    return None
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        interval: float = LOOP_MONITOR_INTERVAL,
+        threshold: float = LOOP_BLOCK_THRESHOLD,
+        debug: bool = LOOP_MONITOR_DEBUG,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self._samples: deque = deque(maxlen=LOOP_MONITOR_SAMPLES)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0  # time.monotonic() del último latido de la tarea
+        self._reported_beat: Optional[float] = None
+        self._open_report: Optional[Dict[str, Any]] = None
+        self.blocked = 0  # muestras con lag >= umbral
+        self.max_lag = 0.0
+        self.reports: deque = deque(maxlen=LOOP_BLOCK_REPORTS)
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.started or not LOOP_MONITOR_ENABLED:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        if self.debug:
+            self._stop_event.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+            self._watchdog.start()
+        print(
+            f"⏱️ Monitor del event loop iniciado (cada {self.interval * 1000:.0f} ms, "
+            f"umbral {self.threshold * 1000:.0f} ms{', pilas de bloqueos activadas' if self.debug else ''})"
+        )
+
+    async def stop(self) -> None:
+        self._stop_event.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=1)
+            self._watchdog = None
+
+    async def _run(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            self._record(max(0.0, now - before - self.interval))
+
+    def _record(self, lag: float) -> None:
+        with self._lock:
+            self._samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.blocked += 1
+            report, self._open_report = self._open_report, None
+        if report is not None:
+            # El vigía ya imprimió la pila; aquí se sabe cuánto duró el bloqueo completo
+            report["blocked_ms"] = round(lag * 1000, 1)
+            print(f"🐢 Event loop liberado tras {report['blocked_ms']:.0f} ms ({report['culprit'] or 'sin frame de la app'})")
+
+    def _watch(self) -> None:
+        """Hilo vigía (solo en debug): captura la pila del loop mientras está bloqueado."""
+        poll = min(self.threshold / 4, 0.05)
+        while not self._stop_event.wait(poll):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or self._reported_beat == beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=_STACK_LIMIT)
+            del frame
+            self._reported_beat = beat
+            report = {
+                "at": datetime.now(timezone.utc).isoformat(),
+                "stalled_ms": round(stalled * 1000, 1),
+                "blocked_ms": None,
+                "culprit": _culprit(stack),
+                "stack": stack.format(),
+            }
+            with self._lock:
+                self.reports.append(report)
+                self._open_report = report
+            print(
+                f"🐢 Event loop bloqueado {report['stalled_ms']:.0f} ms (umbral {self.threshold * 1000:.0f} ms)"
+                f" en {report['culprit'] or 'código fuera de la app'}. Pila:\n" + "".join(report["stack"])
+            )
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples)
+            reports = [dict(r) for r in self.reports]
+            blocked = self.blocked
+            max_lag = self.max_lag
+        ordered = sorted(samples)
+        ms = lambda v: round(v * 1000, 2)
+        return {
+            "enabled": LOOP_MONITOR_ENABLED,
+            "running": self.started,
+            "debug": self.debug,
+            "interval_ms": ms(self.interval),
+            "threshold_ms": ms(self.threshold),
+            "samples": len(samples),
+            "lag_ms": {
+                "last": ms(samples[-1]) if samples else 0.0,
+                "avg": ms(sum(samples) / len(samples)) if samples else 0.0,
+                "p50": ms(_percentile(ordered, 0.50)),
+                "p90": ms(_percentile(ordered, 0.90)),
+                "p99": ms(_percentile(ordered, 0.99)),
+                "max": ms(ordered[-1]) if ordered else 0.0,
+            },
+            "max_lag_ms": ms(max_lag),
+            "blocked": blocked,
+            "blocked_reports": reports,
+        }
+
+
+loop_monitor = LoopMonitor()
+
+
+async def start() -> None:
+    await loop_monitor.start()
+
+
+async def stop() -> None:
+    await loop_monitor.stop()
+
+
+def metrics() -> Dict[str, Any]:
+    return loop_monitor.metrics()
@@ -0,0 +1,293 @@
+"""
+Gobernador global de llamadas a OpenAI (todo el proceso).
+
+Todas las llamadas (partes de recibos, recibos por WhatsApp y el asistente IA) piden un
+turno antes de llamar a la API. El turno se concede respetando:
+  - cubeta de solicitudes por minuto (OPENAI_RPM),
+  - cubeta de tokens por minuto (OPENAI_TPM; se estima antes y se ajusta con `usage` real),
+  - máximo de llamadas simultáneas (OPENAI_MAX_CONCURRENCY),
+  - carriles con prioridad estricta: web (subidas interactivas) > whatsapp > analytics (asistente IA).
+
+Funciona para código sync (routers `def` en el threadpool) y async (pipeline de recibos):
+un hilo despachador concede los turnos en orden de prioridad.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+LANE_WEB = "web"
+LANE_WHATSAPP = "whatsapp"
+LANE_ANALYTICS = "analytics"
+LANES = (LANE_WEB, LANE_WHATSAPP, LANE_ANALYTICS)  # en orden de prioridad
+
+GOVERNOR_ENABLED = str(os.getenv("OPENAI_GOVERNOR_ENABLED", "1")).strip().lower() not in ("0", "false", "no")
+OPENAI_RPM = max(1.0, float(os.getenv("OPENAI_RPM", "500")))
+OPENAI_TPM = max(1000.0, float(os.getenv("OPENAI_TPM", "200000")))
+OPENAI_MAX_CONCURRENCY = max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")))
+
+# Carril de la tarea actual (se hereda en tareas asyncio y asyncio.to_thread)
+_current_lane: ContextVar[str] = ContextVar("openai_lane", default=LANE_WEB)
+
+
+def current_lane() -> str:
+    return _current_lane.get()
+
+
+@contextmanager
+def lane(name: str):
+    """Ejecuta el bloque en el carril `name` (p. ej. el webhook de WhatsApp)."""
+    token = _current_lane.set(name if name in LANES else LANE_WEB)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def estimate_tokens(request_payload: Dict[str, Any], image_tokens: int = 0) -> int:
+    """Estimación burda previa a la llamada: ~4 caracteres por token + max_tokens de salida + imagen."""
+    chars = 0
+    for msg in request_payload.get("messages") or []:
+        content = msg.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "text":
+                    chars += len(part.get("text") or "")
+    return int(chars / 4) + int(request_payload.get("max_tokens") or 0) + int(image_tokens)
+
+
+class _Bucket:
+    """Cubeta que se rellena a `per_minute` unidades por minuto (capacidad = un minuto)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Segundos hasta tener `amount` disponible (0 si ya alcanza)."""
+        missing = amount - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+
+class Ticket:
+    """Turno concedido. `record(response)` ajusta la cubeta de tokens con el uso real."""
+
+    def __init__(self, lane_name: str, est_tokens: int):
+        self.lane = lane_name
+        self.est_tokens = est_tokens
+        self.actual_tokens: Optional[int] = None
+        self.enqueued = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self.released = False
+        # Espera sync (threading.Event) o async (future en su loop)
+        self._event: Optional[threading.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._future: Optional[asyncio.Future] = None
+
+    def record(self, response) -> None:
+        total = getattr(getattr(response, "usage", None), "total_tokens", None)
+        if total is not None:
+            self.actual_tokens = int(total)
+
+    def _wake(self) -> None:
+        if self._event is not None:
+            self._event.set()
+        elif self._loop is not None and self._future is not None:
+            def _done(fut=self._future):
+                if not fut.done():
+                    fut.set_result(True)
+            try:
+                self._loop.call_soon_threadsafe(_done)
+            except RuntimeError:
+                pass  # loop cerrado
+
+
+class OpenAIGovernor:
+    def __init__(self, rpm: float = OPENAI_RPM, tpm: float = OPENAI_TPM, max_concurrency: int = OPENAI_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._requests = _Bucket(rpm)
+        self._tokens = _Bucket(tpm)
+        self._cond = threading.Condition()
+        self._queues: Dict[str, deque] = {name: deque() for name in LANES}
+        self._in_flight = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stats: Dict[str, Dict[str, Any]] = {
+            name: {"granted": 0, "in_flight": 0, "wait_total": 0.0, "wait_max": 0.0, "waits": deque(maxlen=500)}
+            for name in LANES
+        }
+        self._throttled = 0  # veces que el primero en la fila tuvo que esperar por las cubetas
+
+    # --- despachador ---
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="openai-governor", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        with self._cond:
+            while True:
+                delay = self._dispatch_locked()
+                self._cond.wait(timeout=delay)
+
+    def _dispatch_locked(self) -> Optional[float]:
+        """Concede turnos en orden de prioridad. Regresa cuántos segundos esperar (None = hasta aviso)."""
+        now = time.monotonic()
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        while True:
+            ticket = None
+            for name in LANES:
+                if self._queues[name]:
+                    ticket = self._queues[name][0]
+                    break
+            if ticket is None:
+                return None
+            if self._in_flight >= self.max_concurrency:
+                return None  # se despierta en release()
+            est = min(ticket.est_tokens, self._tokens.capacity)
+            delay = max(self._requests.wait_for(1), self._tokens.wait_for(est))
+            if delay > 0:
+                # Prioridad estricta: los carriles de menor prioridad no se adelantan.
+                self._throttled += 1
+                return delay
+            self._queues[ticket.lane].popleft()
+            self._requests.level -= 1
+            self._tokens.level -= est
+            self._in_flight += 1
+            ticket.granted_at = now
+            waited = now - ticket.enqueued
+            st = self._stats[ticket.lane]
+            st["granted"] += 1
+            st["in_flight"] += 1
+            st["wait_total"] += waited
+            st["wait_max"] = max(st["wait_max"], waited)
+            st["waits"].append(waited)
+            ticket._wake()
+
+    def _enqueue(self, ticket: Ticket) -> None:
+        with self._cond:
+            self._ensure_thread()
+            self._queues[ticket.lane].append(ticket)
+            self._cond.notify_all()
+
+    # --- API ---
+
+    def acquire(self, lane_name: str, est_tokens: int) -> Ticket:
+        ticket = Ticket(lane_name if lane_name in LANES else LANE_WEB, max(1, int(est_tokens)))
+        ticket._event = threading.Event()
+        self._enqueue(ticket)
+        ticket._event.wait()
+        return ticket
+
+    async def aacquire(self, lane_name: str, est_tokens: int) -> Ticket:
+        ticket = Ticket(lane_name if lane_name in LANES else LANE_WEB, max(1, int(est_tokens)))
+        ticket._loop = asyncio.get_running_loop()
+        ticket._future = ticket._loop.create_future()
+        self._enqueue(ticket)
+        try:
+            await ticket._future
+        except asyncio.CancelledError:
+            # Cancelado (timeout de la parte/recibo): salir de la fila o devolver el turno si ya se concedió.
+            with self._cond:
+                if ticket.granted_at is None:
+                    try:
+                        self._queues[ticket.lane].remove(ticket)
+                    except ValueError:
+                        pass
+                    self._cond.notify_all()
+                    raise
+            self.release(ticket, refund=True)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket, refund: bool = False) -> None:
+        with self._cond:
+            if ticket.released or ticket.granted_at is None:
+                return
+            ticket.released = True
+            self._in_flight -= 1
+            self._stats[ticket.lane]["in_flight"] -= 1
+            est = min(ticket.est_tokens, self._tokens.capacity)
+            if refund:
+                self._tokens.level = min(self._tokens.capacity, self._tokens.level + est)
+            elif ticket.actual_tokens is not None:
+                # Ajustar la estimación con el uso real (puede quedar en deuda si se subestimó).
+                self._tokens.level = min(self._tokens.capacity, self._tokens.level + est - ticket.actual_tokens)
+            self._cond.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            lanes = {}
+            for name in LANES:
+                st = self._stats[name]
+                waits = sorted(st["waits"])
+                queue = self._queues[name]
+                lanes[name] = {
+                    "queue_depth": len(queue),
+                    "oldest_wait_s": round(now - queue[0].enqueued, 3) if queue else 0.0,
+                    "in_flight": st["in_flight"],
+                    "granted": st["granted"],
+                    "wait_avg_s": round(st["wait_total"] / st["granted"], 3) if st["granted"] else 0.0,
+                    "wait_p95_s": round(waits[int(len(waits) * 0.95)] if len(waits) > 1 else (waits[0] if waits else 0.0), 3),
+                    "wait_max_s": round(st["wait_max"], 3),
+                }
+            return {
+                "enabled": GOVERNOR_ENABLED,
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "requests_available": round(self._requests.level, 1),
+                "requests_per_minute": self._requests.capacity,
+                "tokens_available": int(self._tokens.level),
+                "tokens_per_minute": int(self._tokens.capacity),
+                "throttled": self._throttled,
+                "lanes": lanes,
+            }
+
+
+governor = OpenAIGovernor()
+
+
+@contextmanager
+def slot(est_tokens: int, lane_name: Optional[str] = None):
+    """Turno sync: `with slot(est) as t: resp = client...; t.record(resp)`."""
+    if not GOVERNOR_ENABLED:
+        yield Ticket(lane_name or current_lane(), est_tokens)
+        return
+    ticket = governor.acquire(lane_name or current_lane(), est_tokens)
+    try:
+        yield ticket
+    finally:
+        governor.release(ticket)
+
+
+@asynccontextmanager
+async def aslot(est_tokens: int, lane_name: Optional[str] = None):
+    """Turno async (no bloquea el event loop mientras espera)."""
+    if not GOVERNOR_ENABLED:
+        yield Ticket(lane_name or current_lane(), est_tokens)
+        return
+    ticket = await governor.aacquire(lane_name or current_lane(), est_tokens)
+    try:
+        yield ticket
+    finally:
+        governor.release(ticket)
+
+
+def metrics() -> Dict[str, Any]:
+    return governor.metrics()
@@ -0,0 +1,138 @@
+"""
+Teléfonos normalizados para identificar al remitente de WhatsApp.
+
+Cada usuario guarda su número canónico en E.164 (`users.phone_e164`) y los últimos 10 dígitos
+(`users.phone_last10`), ambos con índice; `models.User` los llena al asignar `phone` (registro,
+altas por familia/Excel y cualquier actualización) y migrate_add_phone_e164.py rellena los existentes.
+Así el webhook resuelve al remitente con una sola consulta por índice en lugar de probar varios
+formatos y un LIKE '%dígitos' que recorre toda la tabla. Un caché TTL en memoria evita incluso esa
+consulta para remitentes frecuentes.
+"""
+import os
+import re
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+SENDER_CACHE_TTL = float(os.getenv("WHATSAPP_SENDER_CACHE_TTL", "300"))
+# Números no registrados se recuerdan menos tiempo (y se olvidan al registrarse ese número).
+SENDER_CACHE_MISS_TTL = float(os.getenv("WHATSAPP_SENDER_CACHE_MISS_TTL", "30"))
+SENDER_CACHE_MAX = max(1, int(os.getenv("WHATSAPP_SENDER_CACHE_MAX", "5000")))
+
+
+def normalize_phone(raw: Optional[str]) -> Optional[str]:
+    """
+    Número canónico E.164 (+52XXXXXXXXXX). Acepta "whatsapp:+52...", espacios, guiones y paréntesis.
+    Reglas de México: 10 dígitos sin lada -> +52; Twilio a veces agrega un "1" después de +52
+    (+521XXXXXXXXXX) y se elimina. Regresa None si no parece un teléfono.
+    """
+    if not raw:
+        return None
+    s = str(raw).strip()
+    if s.lower().startswith("whatsapp:"):
+        s = s[len("whatsapp:"):].strip()
+    digits = re.sub(r"\D", "", s)
+    if len(digits) < 7:
+        return None
+    if len(digits) == 10 and not s.startswith("+"):
+        digits = "52" + digits
+    elif len(digits) == 13 and digits.startswith("521"):
+        digits = "52" + digits[3:]
+    return "+" + digits
+
+
+def phone_last10(raw: Optional[str]) -> Optional[str]:
+    """Últimos 10 dígitos del número (sin lada del país); llave para encontrarlo con otra lada."""
+    e164 = normalize_phone(raw)
+    if not e164:
+        return None
+    return e164[1:][-10:]
+
+
+class PhoneSender(NamedTuple):
+    """Datos del usuario que necesita el webhook (no un objeto ORM: el caché vive entre sesiones)."""
+    id: int
+    name: str
+    email: str
+    family_id: Optional[int]
+    phone: str
+
+
+class _SenderCache:
+    """Caché TTL acotado: e164 -> PhoneSender (o None si el número no está registrado)."""
+
+    def __init__(self, maxsize: int = SENDER_CACHE_MAX):
+        self.maxsize = maxsize
+        self._data: Dict[str, Tuple[float, Optional[PhoneSender]]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Tuple[bool, Optional[PhoneSender]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key: str, value: Optional[PhoneSender]) -> None:
+        ttl = SENDER_CACHE_TTL if value is not None else SENDER_CACHE_MISS_TTL
+        with self._lock:
+            if len(self._data) >= self.maxsize and key not in self._data:
+                # Primero lo expirado; si no alcanza, lo más viejo (orden de inserción).
+                now = time.monotonic()
+                for k in [k for k, (exp, _v) in self._data.items() if exp < now]:
+                    del self._data[k]
+                while len(self._data) >= self.maxsize:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, *phones: Optional[str]) -> None:
+        """Olvida los números indicados (por últimos 10 dígitos) o todo si no se indica ninguno."""
+        with self._lock:
+            if not phones:
+                self._data.clear()
+                return
+            keys = {phone_last10(p) for p in phones if p}
+            for k in [k for k in self._data if k[1:][-10:] in keys]:
+                del self._data[k]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+sender_cache = _SenderCache()
+
+
+def invalidate(*phones: Optional[str]) -> None:
+    sender_cache.invalidate(*phones)
+
+
+def find_user(db, raw_phone: Optional[str]) -> Optional[PhoneSender]:
+    """
+    Usuario activo dueño del número (o None). Una consulta por índice sobre `phone_last10`; si hay varios
+    con los mismos 10 dígitos (otra lada), gana el que coincide exacto en E.164. Al cambiar o borrar un
+    usuario, auth olvida su número en el caché.
+    """
+    from app import models
+
+    e164 = normalize_phone(raw_phone)
+    if not e164:
+        return None
+    found, sender = sender_cache.get(e164)
+    if found:
+        return sender
+
+    candidates = db.query(
+        models.User.id, models.User.name, models.User.email, models.User.family_id, models.User.phone_e164
+    ).filter(
+        models.User.phone_last10 == e164[1:][-10:], models.User.is_active == True
+    ).order_by(models.User.id).all()
+    row = next((c for c in candidates if c.phone_e164 == e164), candidates[0] if candidates else None)
+    sender = PhoneSender(row.id, row.name, row.email, row.family_id, row.phone_e164) if row else None
+    sender_cache.put(e164, sender)
+    return sender
@@ -0,0 +1,513 @@
+"""
+Preparación de imágenes de recibos (CPU): normalización, división en partes, recorte del pie y base64.
+
+Todo el trabajo de Pillow (decode, resize LANCZOS, encode JPEG) corre en un
+ProcessPoolExecutor acotado para no bloquear el event loop. Cada imagen se
+decodifica una sola vez (con orientación EXIF y transparencias sobre blanco) y
+esa misma imagen alimenta la versión normalizada, la división y el recorte.
+"""
+import asyncio
+import base64
+import io
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# 0 = sin procesos (se usa un hilo; útil en desarrollo o entornos sin fork/spawn)
+IMAGE_WORKERS = max(0, int(os.getenv("RECEIPT_IMAGE_WORKERS", str(min(2, os.cpu_count() or 1)))))
+IMAGE_MP_START = os.getenv("RECEIPT_IMAGE_MP_START", "spawn")
+
+# División en partes: "gaps" (cortes en renglones en blanco) o "fixed" (cortes fijos con solapamiento)
+SPLIT_STRATEGY = os.getenv("RECEIPT_SPLIT_STRATEGY", "gaps").strip().lower()
+FIXED_OVERLAP = 260  # solapamiento del esquema fijo para no perder renglones
+FIXED_CUT_PENALTY = 170  # "tokens" que cuesta un corte con solape (renglones duplicados que luego hay que deduplicar)
+GAP_OVERLAP = 8  # margen máximo de cada parte dentro del hueco en blanco (no duplica renglones)
+MIN_GAP_PX = int(os.getenv("RECEIPT_SPLIT_MIN_GAP_PX", "3"))
+INK_DELTA = 40  # un pixel es tinta si es 40 niveles más oscuro que su vecindad
+BLANK_INK = 0.004  # fracción de tinta que siempre cuenta como renglón en blanco
+BLANK_RATIO = float(os.getenv("RECEIPT_SPLIT_BLANK_RATIO", "0.25"))  # o hasta 25% de la tinta mediana por renglón
+# Imagen normalizada (parte única e imagen guardada del recibo): el ancho máximo que se le manda al modelo.
+NORMALIZED_MAX_WIDTH = int(os.getenv("RECEIPT_IMAGE_MAX_WIDTH", "1700"))
+NORMALIZED_QUALITY = int(os.getenv("RECEIPT_IMAGE_QUALITY", "90"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_slots: Optional[asyncio.Semaphore] = None
+
+
+def _ms(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000.0, 1)
+
+
+def _encode_jpeg(img, quality: int) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+def _decode(image_bytes: bytes):
+    """Decodifica una vez: orientación EXIF (fotos de teléfono) y RGB/L (transparencias sobre blanco)."""
+    img = Image.open(io.BytesIO(image_bytes))
+    img.load()
+    if ImageOps is not None:
+        img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    return img
+
+
+def _resize_max_width(img, max_width: int):
+    width, height = img.size
+    if max_width and width > max_width:
+        ratio = max_width / width
+        img = img.resize((int(width * ratio), int(height * ratio)), Image.Resampling.LANCZOS)
+    return img
+
+
+def _num_parts(height: int, aggressive: bool) -> tuple:
+    """(número de partes, ancho máximo) según la altura original; 1 parte = no dividir."""
+    # Más partes = menos alucinación/menos truncamiento
+    if aggressive:
+        thresholds = ((9000, 8), (7000, 7), (5500, 6), (4200, 5), (3000, 4), (2000, 3), (1200, 2))
+        max_width = 1700
+    else:
+        thresholds = ((9000, 7), (7000, 6), (5200, 5), (3600, 4), (2500, 3), (1700, 2))
+        max_width = 1400
+    for min_height, parts in thresholds:
+        if height > min_height:
+            return parts, max_width
+    return 1, max_width
+
+
+def _fixed_tiles(height: int, num_parts: int, overlap: int = FIXED_OVERLAP) -> List[Tuple[int, int]]:
+    """Cortes fijos cada height // num_parts con solapamiento (esquema original)."""
+    step = height // num_parts
+    tiles = []
+    for i in range(num_parts):
+        top = max(0, i * step - overlap if i > 0 else 0)
+        bottom = height if i == num_parts - 1 else min(height, (i + 1) * step + overlap)
+        tiles.append((top, bottom))
+    return tiles
+
+
+def ink_profile(img) -> List[float]:
+    """
+    Fracción de "tinta" (0..1) por renglón de pixeles, solo con Pillow.
+    - Se limita a las columnas del papel (las más claras) para ignorar la mesa/fondo alrededor del ticket.
+    - Umbral local: tinta = pixel más oscuro que su vecindad (BoxBlur) por más de INK_DELTA,
+      así las sombras y arrugas del papel no cuentan como texto.
+    - Un resize a 1 columna (BOX) promedia cada renglón.
+    """
+    from PIL import ImageChops, ImageFilter
+
+    height = img.size[1]
+    gray = img.convert("L")
+    # El perfil no necesita resolución horizontal.
+    if gray.width > 400:
+        gray = gray.resize((400, height), Image.Resampling.BOX)
+
+    columns = list(gray.resize((gray.width, 1), Image.Resampling.BOX).tobytes())
+    brightest = max(columns) or 1
+    paper = [x for x, v in enumerate(columns) if v >= brightest * 0.85]
+    if paper and paper[-1] - paper[0] > gray.width * 0.2:
+        gray = gray.crop((paper[0], 0, paper[-1] + 1, height))
+
+    background = gray.filter(ImageFilter.BoxBlur(12))
+    ink = ImageChops.subtract(background, gray).point(lambda v: 255 if v > INK_DELTA else 0)
+    column = ink.resize((1, height), Image.Resampling.BOX)
+    return [v / 255.0 for v in column.tobytes()]
+
+
+def blank_level(profile: List[float]) -> float:
+    """Tinta máxima para considerar un renglón como hueco entre líneas."""
+    median = sorted(profile)[len(profile) // 2] if profile else 0.0
+    return max(BLANK_INK, median * BLANK_RATIO)
+
+
+def _blank_runs(profile: List[float], min_gap: int) -> List[Tuple[int, int]]:
+    """
+    Rangos [inicio, fin) de renglones "en blanco" (valles entre líneas impresas) de al menos `min_gap` px.
+    En fotos el ticket suele estar un poco inclinado/arrugado y casi nunca hay un renglón 100% limpio,
+    así que el umbral es relativo a la tinta típica del recibo (mediana).
+    """
+    if not profile:
+        return []
+    # Suavizar 3 renglones para que un pixel suelto no parta un hueco
+    smooth = [
+        (profile[max(0, y - 1)] + profile[y] + profile[min(len(profile) - 1, y + 1)]) / 3.0
+        for y in range(len(profile))
+    ]
+    level = blank_level(profile)
+
+    runs = []
+    start = None
+    for y, value in enumerate(smooth):
+        if value <= level:
+            if start is None:
+                start = y
+        elif start is not None:
+            if y - start >= min_gap:
+                runs.append((start, y))
+            start = None
+    if start is not None and len(smooth) - start >= min_gap:
+        runs.append((start, len(smooth)))
+    return runs
+
+
+def vision_tokens(width: int, height: int) -> int:
+    """Tokens estimados de una imagen con detail=high (escala a 2048, lado corto a 768, bloques de 512)."""
+    scale = min(1.0, 2048 / max(width, height, 1))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / max(1.0, min(width, height)))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def _plan_cuts(
+    width: int,
+    height: int,
+    runs: List[Tuple[int, int]],
+    num_parts: int,
+    max_tile: Optional[int],
+    allow_fixed: bool,
+) -> Optional[List[Tuple[int, int, bool]]]:
+    """
+    Elige los cortes (y, solapamiento, es_hueco) para `num_parts` partes.
+    Entre los huecos candidatos cerca de cada corte ideal se elige la combinación con menos tokens
+    de visión estimados (a igual costo, la más pareja). Sin hueco cercano: corte fijo si `allow_fixed`.
+    `max_tile` limita la altura de cada parte. None si no hay combinación válida.
+    """
+    step = height / num_parts
+    window = step * 0.45
+
+    candidates: List[List[Tuple[int, int, bool]]] = []
+    for i in range(1, num_parts):
+        ideal = i * step
+        # El borde de cada parte queda dentro del hueco (no rebana renglones vecinos).
+        opts = [
+            ((start + end) // 2, min(GAP_OVERLAP, (end - start) // 2), True)
+            for start, end in runs
+            if abs((start + end) // 2 - ideal) <= window
+        ]
+        if allow_fixed:
+            # El corte fijo siempre es opción (penalizado en el costo por los renglones duplicados).
+            opts.append((int(ideal), FIXED_OVERLAP, False))
+        if not opts:
+            return None
+        candidates.append(opts)
+
+    def tile_cost(prev: Tuple[int, int, bool], cut: Tuple[int, int, bool]) -> Optional[float]:
+        if cut[0] - prev[0] < step * 0.5:
+            return None
+        top = max(0, prev[0] - prev[1])
+        bottom = min(height, cut[0] + cut[1])
+        if max_tile and bottom - top > max_tile:
+            return None
+        # Desempate: desviación respecto a partes parejas (una parte completa de desviación ~ 50 tokens)
+        cost = vision_tokens(width, bottom - top) + 50.0 * abs((cut[0] - prev[0]) - step) / step
+        if not cut[2]:
+            cost += FIXED_CUT_PENALTY
+        return cost
+
+    # Programación dinámica sobre los cortes (pocos cortes y pocos candidatos por corte)
+    layer = [(0.0, [(0, 0, True)])]
+    for opts in candidates + [[(height, 0, True)]]:
+        next_layer = []
+        for cut in opts:
+            best = None
+            for cost, path in layer:
+                c = tile_cost(path[-1], cut)
+                if c is not None and (best is None or cost + c < best[0]):
+                    best = (cost + c, path + [cut])
+            if best is not None:
+                next_layer.append(best)
+        if not next_layer:
+            return None
+        layer = next_layer
+    return min(layer, key=lambda x: x[0])[1]
+
+
+def _gap_tiles(img, num_parts: int) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    Cortes en huecos entre renglones.
+    Como ya no hace falta solapamiento, primero se intenta con menos partes: las necesarias para que
+    ninguna mida más que una parte del esquema fijo (con sus 2 x 260 px de solape), todas cortadas en
+    huecos. Si no se puede, se usan las mismas partes que el esquema fijo y cada corte sin hueco
+    cercano cae al corte fijo (con solapamiento).
+    Regresa (tiles, número de cortes que sí cayeron en un hueco).
+    """
+    width, height = img.size
+    runs = _blank_runs(ink_profile(img), MIN_GAP_PX)
+
+    max_tile = height // num_parts + 2 * FIXED_OVERLAP
+    fewer_parts = max(2, math.ceil(height / max_tile))
+    path = None
+    if fewer_parts < num_parts:
+        path = _plan_cuts(width, height, runs, fewer_parts, max_tile, allow_fixed=False)
+    if path is None:
+        path = _plan_cuts(width, height, runs, num_parts, None, allow_fixed=True)
+    if path is None:
+        raise ValueError("sin combinación de cortes válida")
+
+    tiles = []
+    for prev, cut in zip(path, path[1:]):
+        tiles.append((max(0, prev[0] - prev[1]), min(height, cut[0] + cut[1])))
+    return tiles, sum(1 for c in path[1:-1] if c[2])
+
+
+def split_image_parts(img, image_bytes: bytes, aggressive: bool = False, strategy: str = SPLIT_STRATEGY) -> Tuple[List[bytes], Dict[str, Any]]:
+    """
+    Divide una imagen ya decodificada en partes JPEG (o regresa el original si es corta).
+    strategy="gaps": corta en renglones en blanco (perfil de tinta), con poco o nada de solapamiento.
+    strategy="fixed": cortes fijos con 260 px de solapamiento.
+    Regresa (partes, info) donde info trae la estrategia usada y los offsets (top, bottom) de cada parte.
+    """
+    width, height = img.size
+    num_parts, max_width = _num_parts(height, aggressive)
+    if num_parts <= 1:
+        return [image_bytes], {"strategy": "none", "tiles": [(0, height)], "width": width, "gap_cuts": 0}
+
+    # Redimensionar ancho máximo (evitar bajar demasiado resolución en recibos medianos)
+    img = _resize_max_width(img, max_width)
+    width, height = img.size
+
+    tiles = None
+    gap_cuts = 0
+    used = "fixed"
+    if strategy == "gaps":
+        try:
+            tiles, gap_cuts = _gap_tiles(img, num_parts)
+            used = "gaps" if gap_cuts == len(tiles) - 1 else ("mixed" if gap_cuts else "fixed")
+        except Exception:
+            tiles = None
+    if not tiles:
+        tiles = _fixed_tiles(height, num_parts)
+
+    parts = [_encode_jpeg(img.crop((0, top, width, bottom)), quality=92) for top, bottom in tiles]
+    return parts, {"strategy": used, "tiles": tiles, "width": width, "gap_cuts": gap_cuts}
+
+
+def crop_image_bottom(img, crop_height: int = 1700, max_width: int = 1700) -> bytes:
+    """Recorte JPEG del PIE del recibo (donde suele estar el TOTAL) a partir de una imagen decodificada."""
+    img = _resize_max_width(img, max_width)
+    width, height = img.size
+    h = min(crop_height, height)
+    top = max(0, height - h)
+    return _encode_jpeg(img.crop((0, top, width, height)), quality=95)
+
+
+def prepare_receipt_image(
+    image_bytes: bytes,
+    image_format: str,
+    aggressive: bool,
+    crop_height: int,
+    crop_max_width: int = 1700,
+) -> Dict[str, Any]:
+    """
+    Decodifica una vez y produce la imagen normalizada, partes + recorte del pie ya en base64.
+    Corre dentro del pool de procesos (debe ser una función de módulo, serializable).
+    Si Pillow no está disponible o la imagen no se puede leer, usa la imagen original tal cual.
+    """
+    t_start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    parts_bytes: List[bytes] = [image_bytes]
+    split_info: Dict[str, Any] = {"strategy": "none", "tiles": [], "gap_cuts": 0}
+    totals_bytes = image_bytes
+    totals_format = image_format
+
+    # Imagen normalizada: la que se guarda como imagen del recibo (y la parte única si no se divide)
+    normalized_bytes = image_bytes
+    normalized_format = image_format
+
+    img = None
+    if Image is not None:
+        t0 = time.perf_counter()
+        try:
+            img = _decode(image_bytes)
+        except Exception:
+            img = None
+        timings["decode_ms"] = _ms(t0)
+
+    if img is not None:
+        t0 = time.perf_counter()
+        try:
+            # Misma imagen decodificada: resize al ancho del modelo + un solo JPEG. Sustituye al original
+            # si se redujo o pesa menos (fotos de 8-12 MB); una captura chica se queda como llegó.
+            normalized = _resize_max_width(img, NORMALIZED_MAX_WIDTH)
+            candidate = _encode_jpeg(normalized, quality=NORMALIZED_QUALITY)
+            if normalized.size != img.size or len(candidate) < len(image_bytes):
+                normalized_bytes, normalized_format = candidate, "jpeg"
+        except Exception:
+            pass
+        timings["normalize_ms"] = _ms(t0)
+
+        t0 = time.perf_counter()
+        try:
+            parts_bytes, split_info = split_image_parts(img, normalized_bytes, aggressive=aggressive)
+        except Exception:
+            parts_bytes = [normalized_bytes]
+        timings["split_ms"] = _ms(t0)
+
+        t0 = time.perf_counter()
+        try:
+            totals_bytes = crop_image_bottom(img, crop_height=crop_height, max_width=crop_max_width)
+            totals_format = "jpeg"
+        except Exception:
+            totals_bytes = image_bytes
+        timings["crop_ms"] = _ms(t0)
+
+    t0 = time.perf_counter()
+    parts_base64 = [base64.b64encode(p).decode("utf-8") for p in parts_bytes]
+    totals_base64 = base64.b64encode(totals_bytes).decode("utf-8")
+    timings["base64_ms"] = _ms(t0)
+    timings["total_ms"] = _ms(t_start)
+
+    sent_bytes = sum(len(p) for p in parts_bytes) + len(totals_bytes)
+    return {
+        # Si se dividió con PIL, las partes son JPEG; la parte única es la imagen normalizada.
+        "parts_base64": parts_base64,
+        "part_format": "jpeg" if len(parts_bytes) > 1 else normalized_format,
+        "totals_base64": totals_base64,
+        "totals_format": totals_format,
+        "parts_bytes": sum(len(p) for p in parts_bytes),
+        "totals_bytes": len(totals_bytes),
+        "normalized_bytes": normalized_bytes if normalized_bytes is not image_bytes else None,
+        "normalized_format": normalized_format,
+        "bytes": {
+            "original": len(image_bytes),
+            "sent": sent_bytes,
+            "stored": len(normalized_bytes),
+            "saved": max(0, len(image_bytes) - sent_bytes),
+        },
+        "split": split_info,
+        "timings": timings,
+    }
+
+
+def split_tile(image_bytes: bytes, pieces: int = 2, min_height: int = 600) -> List[str]:
+    """
+    Divide una parte ya enviada en `pieces` sub-partes (base64 JPEG) para re-extraerla con más detalle:
+    cada sub-parte llega al modelo con más pixeles por renglón que la parte completa.
+    Corta en huecos en blanco; si no hay, cortes fijos con solape corto. Partes bajas se regresan tal cual.
+    """
+    original = [base64.b64encode(image_bytes).decode("utf-8")]
+    if Image is None or pieces <= 1:
+        return original
+    try:
+        img = _decode(image_bytes)
+    except Exception:
+        return original
+    width, height = img.size
+    if height < min_height:
+        return original
+    try:
+        tiles, _gap_cuts = _gap_tiles(img, pieces)
+    except Exception:
+        tiles = _fixed_tiles(height, pieces, overlap=min(FIXED_OVERLAP, height // 6))
+    return [
+        base64.b64encode(_encode_jpeg(img.crop((0, top, width, bottom)), quality=92)).decode("utf-8")
+        for top, bottom in tiles
+    ]
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if IMAGE_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                mp_context=multiprocessing.get_context(IMAGE_MP_START),
+            )
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _get_slots() -> asyncio.Semaphore:
+    # Acotar trabajos en vuelo: no acumular imágenes decodificadas en memoria si llegan muchos recibos.
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(max(1, IMAGE_WORKERS) * 2)
+    return _slots
+
+
+async def aprepare_receipt_image(
+    image_bytes: bytes,
+    image_format: str,
+    *,
+    aggressive: bool,
+    crop_height: int,
+    crop_max_width: int = 1700,
+) -> Dict[str, Any]:
+    """Ejecuta `prepare_receipt_image` fuera del event loop (pool de procesos o hilo)."""
+    args = (image_bytes, image_format, aggressive, crop_height, crop_max_width)
+    t_wait = time.perf_counter()
+    async with _get_slots():
+        queue_ms = _ms(t_wait)
+        t0 = time.perf_counter()
+        out = await _run_offloop(prepare_receipt_image, *args)
+        out["timings"]["queue_ms"] = queue_ms
+        out["timings"]["roundtrip_ms"] = _ms(t0)
+    return out
+
+
+async def asplit_tile(image_bytes: bytes, pieces: int = 2) -> List[str]:
+    """Ejecuta `split_tile` fuera del event loop."""
+    async with _get_slots():
+        return await _run_offloop(split_tile, image_bytes, pieces)
+
+
+async def _run_offloop(fn, *args):
+    pool = _get_pool()
+    try:
+        if pool is None:
+            return await asyncio.to_thread(fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # Un worker murió (p. ej. OOM con una imagen enorme): recrear el pool y resolver en un hilo.
+        print("⚠️ Pool de imágenes roto; se recrea y se procesa en hilo")
+        _reset_pool()
+        return await asyncio.to_thread(fn, *args)
+
+
+def _warm() -> bool:
+    return Image is not None
+
+
+def warmup() -> None:
+    """Arranca los procesos del pool al iniciar el servidor (spawn + import de Pillow tarda ~1-3 s)."""
+    pool = _get_pool()
+    if pool is None:
+        return
+    for _ in range(IMAGE_WORKERS):
+        pool.submit(_warm)
+
+
+def shutdown() -> None:
+    global _slots
+    _reset_pool()
+    _slots = None
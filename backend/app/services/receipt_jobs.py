@@ -0,0 +1,395 @@
+"""
+Cola persistente de trabajos de procesamiento de recibos.
+
+POST /api/receipts/process guarda las imágenes en disco, crea un registro en
+`receipt_jobs` y responde 202 con el id del trabajo. Un pool de workers (tareas
+asyncio del mismo proceso) toma los trabajos, ejecuta el pipeline de extracción
+y deja el avance/resultado en la tabla. Si la cola está saturada se rechaza con
+503 (cola llena) o 429 (demasiados trabajos del mismo usuario) + Retry-After.
+"""
+import asyncio
+import math
+import os
+import shutil
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.database import AsyncSessionLocal
+from app.services import receipt_pipeline
+
+JOB_WORKERS = max(1, int(os.getenv("RECEIPT_JOB_WORKERS", "2")))
+JOB_QUEUE_MAX = max(1, int(os.getenv("RECEIPT_JOB_QUEUE_MAX", "20")))
+JOB_MAX_PER_USER = max(1, int(os.getenv("RECEIPT_JOB_MAX_PER_USER", "3")))
+# Cada cuánto se revisa la tabla: latido de los trabajos en curso, trabajos abandonados y trabajos en
+# "queued" que no caben en la cola en memoria. También se revisa en cuanto la cola se vacía.
+JOB_RESCAN_SECONDS = max(1.0, float(os.getenv("RECEIPT_JOB_RESCAN_SECONDS", "30")))
+# Trabajos en "processing" sin latido por más de este tiempo se consideran abandonados (proceso caído).
+JOB_STALE_SECONDS = max(JOB_RESCAN_SECONDS * 3, float(os.getenv("RECEIPT_JOB_STALE_SECONDS", "180")))
+
+JOBS_DIR = Path(os.getenv("UPLOADS_DIR") or Path(__file__).resolve().parents[2] / "uploads") / "receipt_jobs"
+
+_ACTIVE_STATUSES = (models.ReceiptJobStatus.QUEUED.value, models.ReceiptJobStatus.PROCESSING.value)
+
+
+def _write_uploads(job_dir: Path, uploads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Guarda las imágenes del trabajo en disco (en un hilo: no bloquea el event loop)."""
+    job_dir.mkdir(parents=True, exist_ok=True)
+    files: List[Dict[str, Any]] = []
+    for idx, upload in enumerate(uploads, start=1):
+        path = job_dir / f"{idx}.bin"
+        path.write_bytes(upload["data"])
+        files.append({
+            "path": str(path),
+            "filename": upload.get("filename"),
+            "content_type": upload.get("content_type"),
+        })
+    return files
+
+
+class QueueFullError(Exception):
+    """La cola no acepta más trabajos por ahora (el router lo convierte en 429/503 + Retry-After)."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class ReceiptJobQueue:
+    def __init__(self, workers: int = JOB_WORKERS, maxsize: int = JOB_QUEUE_MAX, max_per_user: int = JOB_MAX_PER_USER):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_per_user = max_per_user
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending: List[int] = []  # orden de la cola (para queue_position)
+        self._in_flight: set = set()
+        self._durations: deque = deque(maxlen=50)
+        self._rescan_now: Optional[asyncio.Event] = None
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks) and not all(t.done() for t in self._tasks)
+
+    async def start(self) -> None:
+        if self.started:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._pending = []
+        self._rescan_now = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(1, self.workers + 1)]
+        self._tasks.append(asyncio.create_task(self._rescan_loop()))
+        print(f"🧾 Cola de recibos iniciada ({self.workers} workers, máx. {self.maxsize} en cola)")
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._pending = []
+        self._rescan_now = None
+
+    def retry_after(self) -> int:
+        """Estimación (segundos) de cuándo se libera un lugar en la cola."""
+        avg = (sum(self._durations) / len(self._durations)) if self._durations else 60.0
+        backlog = len(self._pending) + len(self._in_flight)
+        waves = max(1, math.ceil(backlog / max(1, self.workers)))
+        return int(min(600, max(5, avg * waves)))
+
+    def queue_position(self, job_id: int) -> Optional[int]:
+        try:
+            return self._pending.index(job_id) + 1
+        except ValueError:
+            return None
+
+    async def submit(
+        self,
+        db: AsyncSession,
+        *,
+        user_id: int,
+        assigned_user_id: int,
+        mode: str,
+        uploads: List[Dict[str, Any]],
+        base_url: str,
+    ) -> models.ReceiptJob:
+        await self.start()
+
+        # Backpressure: cola global llena -> 503; demasiados trabajos del usuario -> 429.
+        if len(self._pending) >= self.maxsize:
+            raise QueueFullError(
+                503,
+                "El procesamiento de recibos está saturado. Intenta de nuevo en unos momentos.",
+                self.retry_after(),
+            )
+        user_active = await db.scalar(select(func.count(models.ReceiptJob.id)).where(
+            models.ReceiptJob.user_id == user_id,
+            models.ReceiptJob.status.in_(_ACTIVE_STATUSES),
+        ))
+        if user_active >= self.max_per_user:
+            raise QueueFullError(
+                429,
+                f"Ya tienes {user_active} recibos en proceso. Espera a que terminen antes de subir más.",
+                self.retry_after(),
+            )
+
+        job = models.ReceiptJob(
+            user_id=user_id,
+            assigned_user_id=assigned_user_id,
+            status=models.ReceiptJobStatus.QUEUED.value,
+            mode=mode,
+            base_url=base_url,
+            progress={"stage": "queued"},
+            attempts=0,
+        )
+        db.add(job)
+        await db.flush()
+
+        job_dir = JOBS_DIR / str(job.id)
+        try:
+            job.files = await asyncio.to_thread(_write_uploads, job_dir, uploads)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+
+        await db.refresh(job)
+        self._enqueue(job.id)
+        return job
+
+    def _enqueue(self, job_id: int) -> bool:
+        """Pone el trabajo en la cola en memoria; si no cabe se queda en "queued" y lo toma una revisión posterior."""
+        if job_id in self._pending or job_id in self._in_flight:
+            return False
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            return False
+        self._pending.append(job_id)
+        return True
+
+    async def _rescan_loop(self) -> None:
+        while True:
+            await self._recover()
+            try:
+                await asyncio.wait_for(self._rescan_now.wait(), timeout=JOB_RESCAN_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._rescan_now.clear()
+
+    async def _recover(self) -> None:
+        """
+        Revisión periódica de la tabla: renueva el latido (updated_at) de los trabajos que corren aquí,
+        regresa a "queued" los de procesos caídos y rellena la cola en memoria con los que esperan en la BD.
+        """
+        try:
+            async with AsyncSessionLocal() as db:
+                if self._in_flight:
+                    await db.execute(
+                        update(models.ReceiptJob)
+                        .where(models.ReceiptJob.id.in_(list(self._in_flight)))
+                        .values(updated_at=func.now())
+                        .execution_options(synchronize_session=False)
+                    )
+                stale_before = _now() - timedelta(seconds=JOB_STALE_SECONDS)
+                stale = [
+                    models.ReceiptJob.status == models.ReceiptJobStatus.PROCESSING.value,
+                    or_(
+                        models.ReceiptJob.updated_at < stale_before,
+                        and_(models.ReceiptJob.updated_at.is_(None), models.ReceiptJob.started_at < stale_before),
+                    ),
+                ]
+                if self._in_flight:
+                    stale.append(models.ReceiptJob.id.not_in(list(self._in_flight)))
+                reclaimed = (await db.execute(
+                    update(models.ReceiptJob).where(*stale)
+                    .values(status=models.ReceiptJobStatus.QUEUED.value)
+                    .execution_options(synchronize_session=False)
+                )).rowcount
+                await db.commit()
+                if reclaimed:
+                    print(f"🔁 {reclaimed} trabajos de recibos abandonados regresaron a la cola")
+
+                free = self.maxsize - self._queue.qsize()
+                if free <= 0:
+                    return
+                skip = list(self._in_flight) + list(self._pending)
+                query = select(models.ReceiptJob.id).where(
+                    models.ReceiptJob.status == models.ReceiptJobStatus.QUEUED.value
+                )
+                if skip:
+                    query = query.where(models.ReceiptJob.id.not_in(skip))
+                rows = (await db.execute(query.order_by(models.ReceiptJob.id).limit(free))).scalars().all()
+            enqueued = sum(1 for job_id in rows if self._enqueue(job_id))
+            if enqueued:
+                print(f"🔁 {enqueued} trabajos de recibos reencolados")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ No se pudieron recuperar trabajos de recibos: {e}")
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            job_id = await self._queue.get()
+            # En vuelo antes de salir de _pending: una revisión en medio no lo vuelve a encolar
+            self._in_flight.add(job_id)
+            if job_id in self._pending:
+                self._pending.remove(job_id)
+            try:
+                await self._run_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                import traceback
+                print(f"❌ Worker {n}: error inesperado en trabajo {job_id}: {e}")
+                print(traceback.format_exc())
+            finally:
+                self._in_flight.discard(job_id)
+                self._queue.task_done()
+                if self._queue.empty() and self._rescan_now is not None:
+                    # La cola en memoria se vació: traer lo que siga esperando en la BD
+                    self._rescan_now.set()
+
+    async def _run_job(self, job_id: int) -> None:
+        # Todo con la sesión async: ni el reclamo, ni el avance, ni el guardado del recibo bloquean el event loop.
+        async with AsyncSessionLocal() as db:
+            # Reclamar el trabajo de forma atómica (otro proceso pudo haberlo tomado).
+            claimed = (await db.execute(
+                update(models.ReceiptJob)
+                .where(
+                    models.ReceiptJob.id == job_id,
+                    models.ReceiptJob.status == models.ReceiptJobStatus.QUEUED.value,
+                )
+                .values(
+                    status=models.ReceiptJobStatus.PROCESSING.value,
+                    started_at=_now(),
+                    attempts=models.ReceiptJob.attempts + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            await db.commit()
+            if not claimed:
+                return
+
+            job = await db.get(models.ReceiptJob, job_id)
+            started = time.monotonic()
+            progress_writer = _ProgressWriter(job_id, job.progress)
+
+            values: Dict[str, Any]
+            try:
+                out = await receipt_pipeline.run_receipt_job(db, job, on_progress=progress_writer.set)
+                await progress_writer.drain()
+                values = {
+                    "status": models.ReceiptJobStatus.DONE.value,
+                    "receipt_id": out.get("receipt_id"),
+                    "result": {
+                        "message": out.get("message"),
+                        "parts_status": out.get("parts_status"),
+                        "totals_status": out.get("totals_status"),
+                    },
+                    "progress": dict(progress_writer.latest or {}, stage="done"),
+                }
+            except asyncio.CancelledError:
+                # Apagado del servidor: devolver el trabajo a la cola para el siguiente arranque.
+                progress_writer.cancel()
+                await db.rollback()
+                await db.execute(
+                    update(models.ReceiptJob).where(models.ReceiptJob.id == job_id)
+                    .values(status=models.ReceiptJobStatus.QUEUED.value)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                raise
+            except Exception as e:
+                await db.rollback()
+                await progress_writer.drain()
+                error = str(e)[:2000]
+                values = {
+                    "status": models.ReceiptJobStatus.FAILED.value,
+                    "error": error,
+                    "progress": dict(progress_writer.latest or {}, stage="failed"),
+                }
+                print(f"❌ Trabajo de recibo {job_id} falló: {error[:240]}")
+
+            values["finished_at"] = _now()
+            await db.execute(
+                update(models.ReceiptJob).where(models.ReceiptJob.id == job_id).values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            self._durations.append(time.monotonic() - started)
+            await asyncio.to_thread(shutil.rmtree, JOBS_DIR / str(job_id), True)
+
+
+class _ProgressWriter:
+    """
+    Guarda el avance del pipeline (callback síncrono) en su propia sesión async, en segundo plano:
+    si llegan varios avances mientras se escribe uno, solo se guarda el último.
+    """
+
+    def __init__(self, job_id: int, progress: Optional[Dict[str, Any]]):
+        self.job_id = job_id
+        self.latest = progress
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def set(self, progress: Dict[str, Any]) -> None:
+        self.latest = progress
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self._dirty:
+            self._dirty = False
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(
+                        update(models.ReceiptJob).where(models.ReceiptJob.id == self.job_id)
+                        .values(progress=self.latest)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar el avance del trabajo {self.job_id}: {e}")
+
+    async def drain(self) -> None:
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+job_queue = ReceiptJobQueue()
+
+
+async def start() -> None:
+    await job_queue.start()
+
+
+async def stop() -> None:
+    await job_queue.stop()
+
+
+async def submit(db: AsyncSession, **kwargs) -> models.ReceiptJob:
+    return await job_queue.submit(db, **kwargs)
+
+
+def queue_position(job_id: int) -> Optional[int]:
+    return job_queue.queue_position(job_id)
@@ -0,0 +1,1955 @@
+"""
+Pipeline de extracción de recibos (RAW): partes en paralelo + pie de totales, combinación de
+renglones por solape, cuadre contra el total declarado, re-extracción de partes dudosas y guardado.
+
+Lo usan POST /api/receipts/process (directo o por la cola `receipt_jobs`) y los recibos que llegan
+por WhatsApp (`whatsapp_inbox`). No depende de FastAPI: los errores se reportan con
+ReceiptPipelineError (status_code + detail) y cada entrada los traduce a su manera.
+"""
+from app import models, schemas
+from app.services import receipt_processor, receipt_images
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+import base64
+import json
+from typing import List, Optional, Tuple, Dict, Any, Callable, Union
+import math
+import re
+from difflib import SequenceMatcher
+from pathlib import Path
+import os
+
+
+class ReceiptPipelineError(Exception):
+    """Error del pipeline con el código HTTP sugerido (el router lo convierte en HTTPException)."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+# Carpeta de archivos subidos (servida en /uploads); UPLOADS_DIR permite apuntarla fuera del repo (p. ej. benchmarks).
+UPLOADS_DIR = Path(os.getenv("UPLOADS_DIR") or Path(__file__).resolve().parents[2] / "uploads")
+
+def _parse_float_safe(value) -> float:
+    try:
+        if value is None:
+            return 0.0
+        import re
+        s = str(value).strip()
+        if not s:
+            return 0.0
+        negative = False
+        # Algunos tickets marcan negativos con signo al final (ej. "0.57-")
+        if s.endswith("-") and not s.startswith("-"):
+            negative = True
+            s = s[:-1].strip()
+        # También soportar negativos con paréntesis "(123.45)"
+        if s.startswith("(") and s.endswith(")"):
+            negative = True
+            s = s[1:-1].strip()
+        # Extraer el último número del string (maneja "518.00 MXN", "$3,185.00", etc.)
+        matches = re.findall(r"-?\d+(?:[.,]\d+)?", s)
+        if not matches:
+            return 0.0
+        num = matches[-1]
+        if num.startswith("-"):
+            negative = True
+            num = num[1:]
+        # Normalizar separadores:
+        # - Si hay punto y coma, la coma suele ser separador de miles
+        if "," in num and "." in num:
+            num = num.replace(",", "")
+        # - Si solo hay coma, decidir si es decimal (1-2 dígitos) o miles (3 dígitos)
+        elif "," in num and "." not in num:
+            parts = num.split(",")
+            if len(parts) == 2 and len(parts[1]) in (1, 2):
+                num = f"{parts[0]}.{parts[1]}"
+            else:
+                num = "".join(parts)
+        val = float(num)
+        return -val if negative else val
+    except Exception:
+        return 0.0
+
+
+def _normalize_for_match(text: str) -> str:
+    s = (text or "").upper().strip()
+    s = re.sub(r"\s+", " ", s)
+    # mantener letras/números/espacios para similitud
+    s = re.sub(r"[^A-Z0-9 ]+", "", s)
+    return s
+
+
+def _similarity(a: str, b: str) -> float:
+    if not a or not b:
+        return 0.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+# Alto mínimo (px, imagen redimensionada) de un renglón impreso: si dos partes se solapan menos que esto
+# (cortes en huecos en blanco), no comparten renglones y no hay nada que deduplicar.
+MIN_ROW_PX = 18
+
+
+def _align_key(item: Dict[str, Any]) -> Tuple[str, Optional[int]]:
+    """Llave de alineación: texto normalizado compacto + monto en centavos (None si no es legible)."""
+    text = _normalize_for_match(str(item.get("raw_line") or "")).replace(" ", "")
+    total_raw = str(item.get("total_raw") or "")
+    cents = round(_parse_float_safe(total_raw) * 100) if re.search(r"\d", total_raw) else None
+    return text, cents
+
+
+def _overlap_lengths(tail_keys: List[Any], head_keys: List[Any], max_len: int) -> List[int]:
+    """
+    Longitudes j (1..max_len) en que los últimos j renglones de `tail` y los primeros j de `head`
+    tienen el mismo multiconjunto de llaves. Una sola pasada O(max_len): se lleva la diferencia de
+    conteos por llave y cuántas llaves no cuadran. Respeta repeticiones (3 x "LECHE 1L" solo
+    empareja con 3) y tolera que el modelo reordene renglones dentro del solape.
+    """
+    diff: Dict[Any, int] = {}
+    unmatched = 0
+    out: List[int] = []
+    for j in range(1, max_len + 1):
+        for key, delta in ((tail_keys[-j], 1), (head_keys[j - 1], -1)):
+            before = diff.get(key, 0)
+            after = before + delta
+            diff[key] = after
+            if before == 0:
+                unmatched += 1
+            elif after == 0:
+                unmatched -= 1
+        if unmatched == 0:
+            out.append(j)
+    return out
+
+
+def _texts_agree(tail_items: List[Dict[str, Any]], head_items: List[Dict[str, Any]], keys: Tuple[List[Any], List[Any]]) -> bool:
+    """Verifica un solape encontrado solo por monto: los renglones emparejados deben parecerse en texto."""
+    pending: Dict[Any, List[Dict[str, Any]]] = {}
+    for key, it in zip(keys[0], tail_items):
+        pending.setdefault(key, []).append(it)
+    for key, it in zip(keys[1], head_items):
+        other = pending[key].pop(0)
+        a_line = _normalize_for_match(str(it.get("raw_line") or ""))
+        b_line = _normalize_for_match(str(other.get("raw_line") or ""))
+        if a_line and b_line and _similarity(a_line, b_line) < 0.75:
+            return False
+    return True
+
+
+def _tolerant_prefix_matches(
+    tail_keys: List[Tuple[str, Optional[int]]],
+    head_keys: List[Tuple[str, Optional[int]]],
+    max_misses: int = 2,
+    max_shift: Optional[int] = None,
+) -> List[Tuple[int, int]]:
+    """
+    Parejas (índice en head, índice en tail) de renglones repetidos, tolerando variaciones OCR:
+    mismo texto compacto, o mismo monto (o monto ilegible) con texto parecido (>= 0.75).
+    Cada renglón de `tail` absorbe a lo mucho uno. Se recorre `head` desde el inicio y se detiene tras
+    `max_misses` renglones sin pareja: el solape es un prefijo de `head`, un producto repetido más
+    adelante no se toca. Con `max_shift` (tail y head ya alineados) solo se emparejan posiciones
+    cercanas, prefiriendo la más cercana. Con cubetas por texto y monto el costo es ~lineal.
+    """
+    by_text: Dict[str, List[int]] = {}
+    by_cents: Dict[Optional[int], List[int]] = {}
+    for idx, (text, cents) in enumerate(tail_keys):
+        by_text.setdefault(text, []).append(idx)
+        by_cents.setdefault(cents, []).append(idx)
+    used = [False] * len(tail_keys)
+
+    def _take(candidates, pos: int, text: str, fuzzy: bool) -> Optional[int]:
+        best = None
+        for idx in candidates:
+            if used[idx] or (max_shift is not None and abs(idx - pos) > max_shift):
+                continue
+            if fuzzy and _similarity(text, tail_keys[idx][0]) < 0.75:
+                continue
+            if max_shift is None:
+                best = idx
+                break
+            if best is None or abs(idx - pos) < abs(best - pos):
+                best = idx
+        if best is not None:
+            used[best] = True
+        return best
+
+    pairs: List[Tuple[int, int]] = []
+    misses = 0
+    for idx_head, (text, cents) in enumerate(head_keys):
+        found = None
+        if text:
+            found = _take(by_text.get(text, []), idx_head, text, False)
+            if found is None and cents is not None:
+                found = _take(by_cents.get(cents, []), idx_head, text, True)
+                if found is None:
+                    found = _take(by_cents.get(None, []), idx_head, text, True)
+            elif found is None:
+                # Monto ilegible: contra cualquier renglón aún libre (acotado al tamaño de la ventana)
+                if max_shift is None:
+                    nearby = range(len(tail_keys))
+                else:
+                    nearby = range(max(0, idx_head - max_shift), min(len(tail_keys), idx_head + max_shift + 1))
+                found = _take(nearby, idx_head, text, True)
+        if found is not None:
+            pairs.append((idx_head, found))
+        else:
+            misses += 1
+            if misses > max_misses:
+                break
+    return pairs
+
+
+def _expected_overlap_rows(
+    prev_items: List[Dict[str, Any]],
+    prev_offset: Optional[Tuple[int, int, int]],
+    items: List[Dict[str, Any]],
+    offset: Optional[Tuple[int, int, int]],
+) -> Optional[float]:
+    """Renglones que deberían repetirse entre dos partes según sus offsets en pixeles (None = sin offsets)."""
+    if not prev_offset or not offset or None in prev_offset or None in offset:
+        return None
+    prev_file, prev_top, prev_bottom = prev_offset
+    file_index, top, bottom = offset
+    if prev_file != file_index:
+        return 0.0
+    overlap_px = prev_bottom - top
+    if overlap_px < MIN_ROW_PX:
+        return 0.0
+    # Densidad de renglones por pixel (la mayor de las dos partes: encabezados/pies no traen items)
+    density = max(len(prev_items) / max(1, prev_bottom - prev_top), len(items) / max(1, bottom - top))
+    return overlap_px * density
+
+
+def _boundary_overlap(
+    tail: List[Dict[str, Any]],
+    head: List[Dict[str, Any]],
+    expected: Optional[float],
+    window: int,
+) -> Tuple[int, List[int]]:
+    """
+    Renglones de `head` que repiten el final de `tail`: (j, índices extra).
+    j = largo del solape alineado (se quitan head[:j]); los índices extra vienen del respaldo tolerante
+    (variaciones OCR que no alinean por llave) y también se quitan.
+    Con `expected` (renglones de solape según los pixeles) solo se aceptan alineaciones cercanas a él.
+    """
+    if expected is not None:
+        window = min(window, max(2, math.ceil(expected * 2) + 2))
+    max_len = min(len(tail), len(head), window)
+    if max_len <= 0:
+        return 0, []
+
+    # Margen sobre el esperado: renglones cortados en el borde de cada parte y densidad estimada
+    # (encabezado/pie del recibo diluyen los renglones por pixel)
+    slack = None if expected is None else max(2.0, expected * 0.25)
+
+    def _plausible(lengths: List[int]) -> List[int]:
+        if expected is None:
+            return lengths
+        return [j for j in lengths if abs(j - expected) <= slack]
+
+    tail_keys = [_align_key(it) for it in tail[-max_len:]]
+    head_keys = [_align_key(it) for it in head[:max_len]]
+
+    def _score(j: int) -> Optional[Tuple[int, int, float]]:
+        """(renglones sin pareja, desplazamiento de las parejas, distancia al esperado) del solape j; None si no alcanza."""
+        pairs = _tolerant_prefix_matches(tail_keys[-j:], head_keys[:j], max_misses=j, max_shift=2)
+        if len(pairs) < j - max(1, j // 5):
+            return None
+        return (len(pairs) - j, -sum(abs(h - t) for h, t in pairs), -abs(j - expected))
+
+    def _pick(lengths: List[int]) -> int:
+        if expected is None:
+            return max(lengths)
+        if len(lengths) == 1:
+            return lengths[0]
+        # Con productos repetidos un largo corrido por uno también cuadra como multiconjunto,
+        # pero con las parejas desplazadas: gana el de parejas más cercanas en posición
+        return max(lengths, key=lambda j: _score(j) or (-j, 0, 0.0))
+
+    # 1) Texto + monto exactos
+    lengths = _plausible(_overlap_lengths(tail_keys, head_keys, max_len))
+    if lengths:
+        return _pick(lengths), []
+
+    # 2) Solo monto (texto con variaciones OCR), verificando que el texto se parezca
+    loose_tail = [cents if cents is not None else text for text, cents in tail_keys]
+    loose_head = [cents if cents is not None else text for text, cents in head_keys]
+    lengths = [
+        j for j in _plausible(_overlap_lengths(loose_tail, loose_head, max_len))
+        if _texts_agree(tail[-j:], head[:j], (loose_tail[-j:], loose_head[:j]))
+    ]
+    if lengths:
+        return _pick(lengths), []
+
+    # 3) Respaldo tolerante (montos ilegibles, renglones mal leídos).
+    if expected == 0:
+        return 0, []
+    if expected is not None:
+        # Con pixeles: probar los largos plausibles; gana el que deje menos renglones sin pareja
+        best: Optional[Tuple[Tuple[int, int, float], int]] = None
+        for j in range(max(1, math.floor(expected - slack)), min(max_len, math.ceil(expected + slack)) + 1):
+            score = _score(j)
+            if score is not None and (best is None or score > best[0]):
+                best = (score, j)
+        return (best[1], []) if best else (0, [])
+    # Sin pixeles: quitar los duplicados del inicio de `head` que encuentren pareja en el final de `tail`
+    return 0, [h for h, _t in _tolerant_prefix_matches(tail_keys, head_keys)]
+
+
+def _merge_items_with_overlap_dedup(
+    parts_items: List[List[Dict[str, Any]]],
+    tail_window: int = 60,
+    boundary_window: int = 45,
+    offsets: Optional[List[Optional[Tuple[int, int, int]]]] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Une items de múltiples partes quitando los renglones repetidos por el solapamiento.
+    Alinea el final de la parte anterior con el inicio de la siguiente por texto normalizado + monto
+    (tiempo lineal en la ventana, respeta productos repetidos y leves reordenamientos del modelo).
+    `offsets` (opcional, uno por parte): (imagen, top, bottom) en pixeles; con ellos se sabe cuántos
+    renglones se solapan de verdad y las partes cortadas en huecos en blanco no se deduplican.
+    """
+    merged: List[Dict[str, Any]] = []
+    removed = 0
+    prev_items: List[Dict[str, Any]] = []
+    prev_offset: Optional[Tuple[int, int, int]] = None
+
+    for idx_part, part_items in enumerate(parts_items):
+        offset = offsets[idx_part] if offsets and idx_part < len(offsets) else None
+        if not part_items:
+            continue
+        if not merged:
+            merged.extend(part_items)
+            prev_items, prev_offset = part_items, offset
+            continue
+
+        expected = _expected_overlap_rows(prev_items, prev_offset, part_items, offset)
+        if expected == 0:
+            merged.extend(part_items)
+        else:
+            tail = merged[-tail_window:] if len(merged) > tail_window else merged
+            overlap, extra = _boundary_overlap(tail, part_items, expected, boundary_window)
+            skip = set(extra)
+            kept = [it for i, it in enumerate(part_items) if i >= overlap and i not in skip]
+            removed += len(part_items) - len(kept)
+            merged.extend(kept)
+        prev_items, prev_offset = part_items, offset
+
+    return merged, removed
+
+
+def _interleave_placeholders_evenly(
+    items: List[Dict[str, Any]],
+    placeholders: List[Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """
+    Inserta placeholders de manera uniforme dentro de `items` sin reordenar los items existentes.
+    Esto es un "best effort" para mantener el orden cuando sabemos que faltan renglones
+    pero no sabemos exactamente sus posiciones.
+    """
+    if not placeholders:
+        return items
+    if not items:
+        return list(placeholders)
+
+    m = len(items)
+    n = len(placeholders)
+    # Cantidad de items originales que deben ir antes de cada placeholder (0..m)
+    insert_after = [int(i * m / (n + 1)) for i in range(1, n + 1)]
+
+    out: List[Dict[str, Any]] = []
+    p = 0
+    count = 0  # items originales ya agregados
+
+    while p < n and insert_after[p] == 0:
+        out.append(placeholders[p])
+        p += 1
+
+    for it in items:
+        out.append(it)
+        count += 1
+        while p < n and insert_after[p] == count:
+            out.append(placeholders[p])
+            p += 1
+
+    while p < n:
+        out.append(placeholders[p])
+        p += 1
+
+    return out
+
+
+def _extract_number_candidates(text: str) -> List[float]:
+    """
+    Extrae TODOS los números del texto (incluye separadores de miles/decimales).
+    Ej: "TOTAL 1,234.56" -> [1234.56]
+    """
+    if not text:
+        return []
+    tokens = re.findall(r"-?\d[\d.,]*\d", str(text))
+    out: List[float] = []
+    for tok in tokens:
+        try:
+            s = tok.strip()
+            if "," in s and "." in s:
+                s = s.replace(",", "")
+            elif "," in s and "." not in s:
+                parts = s.split(",")
+                if len(parts) == 2 and len(parts[1]) in (1, 2):
+                    s = f"{parts[0]}.{parts[1]}"
+                else:
+                    s = "".join(parts)
+            out.append(float(s))
+        except Exception:
+            continue
+    # unique (mantener orden)
+    seen = set()
+    uniq: List[float] = []
+    for v in out:
+        key = round(v, 4)
+        if key in seen:
+            continue
+        seen.add(key)
+        uniq.append(v)
+    return uniq
+
+
+_CURRENCY_AMOUNT_RE = re.compile(r"-?\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2})(?!\d)")
+_NON_ITEM_LINE_KWS = (
+    "SUBTOTAL",
+    "TOTAL",
+    "IVA",
+    "IEPS",
+    "CAMBIO",
+    "PAGO",
+    "EFECTIVO",
+    "TARJ",
+    "TARJETA",
+    "AUTORIZ",
+    "APROB",
+    "ARTICUL",
+    "CUENTA",
+    "CLIENTE",
+    "RFC",
+    "FOLIO",
+    "TICKET",
+    "CAJA",
+    "TRANSACC",
+    "FECHA",
+    "HORA",
+    "PROMOC",
+    "DESCU",
+    "CANCEL",
+    "GRACIAS",
+    "BIENVEN",
+    "VENTA ",
+    "A PAGAR",
+    "IMPORTE",
+    "AHORRO",
+    "PUNTOS",
+)
+
+
+def _has_trailing_negative_marker(text: str) -> bool:
+    if not text:
+        return False
+    s = str(text).strip()
+    # e.g. "... 85.90-" or "(85.90)"
+    if s.endswith("-"):
+        return True
+    if s.startswith("(") and s.endswith(")"):
+        return True
+    return False
+
+
+def _apply_negative_marker_if_needed(raw_line: str, value_raw: str) -> str:
+    """
+    Si el renglón parece marcar negativo con '-' al final, pero value_raw no lo trae,
+    lo aplicamos (ej. raw_line "... 85.90-" + total_raw "85.90" => "85.90-").
+    """
+    if not raw_line or not value_raw:
+        return value_raw
+    rl = str(raw_line).strip()
+    vr = str(value_raw).strip()
+    if not vr or vr.lower() == "no legible":
+        return value_raw
+    if _has_trailing_negative_marker(rl) and not _has_trailing_negative_marker(vr) and not vr.startswith("-"):
+        # Solo si el número aparece cerca del final para evitar falsos positivos.
+        pos = rl.rfind(vr)
+        if pos != -1 and pos >= max(0, len(rl) - len(vr) - 6):
+            return vr + "-"
+    return value_raw
+
+
+def _structured_line_type(raw_line: str) -> str:
+    up = (raw_line or "").upper()
+    if "CANCEL" in up or "CANCELADA" in up:
+        return "cancellation"
+    if "CAMB. PRECIO" in up or "CAMBIO PRECIO" in up or up.startswith("PRECIO:") or "PRECIO:" in up:
+        return "price_change"
+    if "DESCU" in up or "PROMOC" in up or "AHORRO" in up:
+        return "discount"
+    return "item"
+
+
+def _ensure_negative_if_adjustment_line(line_type: str, value_raw: str) -> str:
+    """
+    Para renglones que típicamente son ajustes (descuentos/cancelaciones/cambio de precio),
+    forzar signo negativo si no viene explícito (sin afectar 'no legible').
+    """
+    if line_type not in ("cancellation", "price_change", "discount"):
+        return value_raw
+    if not value_raw:
+        return value_raw
+    vr = str(value_raw).strip()
+    if not vr or vr.lower() == "no legible":
+        return value_raw
+    if vr.startswith("-") or _has_trailing_negative_marker(vr):
+        return value_raw
+    return vr + "-"
+
+
+def _extract_last_currency_amount_raw(line: str) -> str:
+    if not line:
+        return ""
+    matches = _CURRENCY_AMOUNT_RE.findall(str(line))
+    if not matches:
+        return ""
+    raw = matches[-1]
+    s = str(line).strip()
+    # Preservar signo negativo al final (ej. "0.57-")
+    if s.endswith("-") and not raw.endswith("-"):
+        # Si el número aparece cerca del final, asumir que el "-" aplica al monto.
+        pos = s.rfind(raw)
+        if pos != -1 and pos >= len(s) - len(raw) - 3:
+            raw = raw + "-"
+    return raw
+
+
+def _should_skip_transcribed_line(line: str) -> bool:
+    up = (line or "").upper().strip()
+    if not up:
+        return True
+    if up == "NO LEGIBLE":
+        return False
+    if re.fullmatch(r"[*\-_=\s]+", up or ""):
+        return True
+    # Si el renglón tiene un monto tipo moneda, normalmente es un item (excepto totales/subtotales/impuestos).
+    has_amount = bool(_CURRENCY_AMOUNT_RE.findall(str(line)))
+    for kw in _NON_ITEM_LINE_KWS:
+        if kw in up:
+            # No descartar cancelaciones si traen monto (impactan el total).
+            if has_amount and ("CANCEL" in kw):
+                return False
+            return True
+    return False
+
+
+def _pick_declared_total(receipt_raws: List[Dict[str, Any]], sum_items: float, max_item: float) -> Tuple[float, Optional[str]]:
+    """
+    Selecciona el total declarado más probable usando todos los `amount_raw` disponibles.
+    Preferencia:
+    - `amount_raw` con keywords de TOTAL (si viniera con etiqueta)
+    - valores que no sean menores que el item más caro
+    - valores más cercanos a la suma de items (dedupeado)
+    """
+    best_total = 0.0
+    best_score: Optional[float] = None
+    best_source: Optional[str] = None
+
+    for idx, raw in enumerate(receipt_raws, start=1):
+        amount_text = str(raw.get("amount_raw") or "").strip()
+        declared_cents = raw.get("declared_total_cents")
+        has_kw = False
+        if amount_text:
+            up = amount_text.upper()
+            has_kw = any(k in up for k in ("TOTAL", "A PAGAR", "IMPORTE"))
+
+        candidates: List[float] = []
+        if isinstance(declared_cents, int) and declared_cents > 0:
+            candidates.append(declared_cents / 100.0)
+        if amount_text:
+            candidates.extend(_extract_number_candidates(amount_text))
+
+        for c in candidates:
+            if c <= 0:
+                continue
+            if max_item > 0 and c + 0.01 < max_item:
+                continue
+
+            diff = abs(c - sum_items) if sum_items > 0 else 0.0
+            score = diff
+
+            # Bonus si venía etiquetado como TOTAL
+            if has_kw:
+                score *= 0.6
+
+            # Penalizar enteros puros (a veces son folios/tickets)
+            if abs(c - round(c)) < 1e-9:
+                score *= 1.1
+
+            if best_score is None or score < best_score:
+                best_score = score
+                best_total = c
+                best_source = f"part_{idx}"
+
+    return best_total, best_source
+
+
+def _pick_declared_total_v2(
+    receipt_raws: List[Dict[str, Any]],
+    totals_raws: List[Dict[str, Any]],
+    sum_items: float,
+    max_item: float,
+) -> Tuple[float, Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Selección de total con preferencia por extracción dedicada del PIE (totales_raws).
+    - Prioriza total_line_raw con keyword "TOTAL".
+    - Usa consistencia subtotal+impuestos como verificación secundaria (si está disponible).
+    - Solo usa cercanía a suma de items como tie-breaker de baja importancia.
+    """
+    best_total = 0.0
+    best_score: Optional[float] = None
+    best_source: Optional[str] = None
+    best_raw: Optional[Dict[str, Any]] = None
+
+    # 1) Preferir el extractor dedicado de totales
+    for idx, raw in enumerate(totals_raws or [], start=1):
+        amount_text = str(raw.get("amount_raw") or "").strip()
+        total_line = str(raw.get("total_line_raw") or "")
+        up = total_line.upper()
+        has_kw = any(k in up for k in ("TOTAL", "A PAGAR", "IMPORTE"))
+
+        candidates: List[float] = []
+        declared_cents = raw.get("declared_total_cents")
+        if isinstance(declared_cents, int) and declared_cents > 0:
+            candidates.append(declared_cents / 100.0)
+        if amount_text:
+            candidates.extend(_extract_number_candidates(amount_text))
+
+        subtotal = _parse_float_safe(raw.get("subtotal_raw"))
+        tax_total = 0.0
+        try:
+            for t in (raw.get("taxes") or []):
+                tax_total += _parse_float_safe(t.get("amount_raw"))
+        except Exception:
+            tax_total = 0.0
+        expected = (subtotal + tax_total) if (subtotal > 0 and tax_total > 0) else None
+
+        for c in candidates:
+            if c <= 0:
+                continue
+            if max_item > 0 and c + 0.01 < max_item:
+                continue
+
+            # Scoring: menor = mejor
+            score = 0.0
+            if has_kw:
+                score -= 100.0
+            if expected is not None and expected > 0:
+                score += abs(c - expected)
+
+            # Penalizar enteros puros (a veces son folios/tickets)
+            if abs(c - round(c)) < 1e-9:
+                score += 1.0
+
+            # Tie-breaker leve por cercanía a suma de items
+            if sum_items > 0:
+                score += abs(c - sum_items) * 0.01
+
+            if best_score is None or score < best_score:
+                best_score = score
+                best_total = c
+                best_source = f"totals_part_{idx}"
+                best_raw = raw
+
+    if best_total > 0:
+        return best_total, best_source, best_raw
+
+    # 2) Fallback al método anterior (por partes de items)
+    fallback_total, fallback_source = _pick_declared_total(receipt_raws, sum_items=sum_items, max_item=max_item)
+    return fallback_total, fallback_source, None
+
+
+def _items_from_transcription(text: str) -> List[Dict[str, Any]]:
+    """Convierte el texto transcrito de una parte en renglones (items RAW)."""
+    lines = [ln.strip() for ln in (text or "").splitlines() if ln and ln.strip()]
+    part_items: List[Dict[str, Any]] = []
+    for ln in lines:
+        if _should_skip_transcribed_line(ln):
+            continue
+        up = ln.upper().strip()
+        total_raw = _extract_last_currency_amount_raw(ln)
+        if not total_raw:
+            # Mantener orden: si parece item pero no tiene monto, marcar monto como no legible.
+            has_letter = bool(re.search(r"[A-Z]", up))
+            has_digit = bool(re.search(r"\d", up))
+            if up == "NO LEGIBLE":
+                total_raw = "no legible"
+            elif has_letter and has_digit:
+                total_raw = "no legible"
+            else:
+                continue
+        line_type = _structured_line_type(ln)
+        cleaned_total = _apply_negative_marker_if_needed(ln, total_raw)
+        cleaned_total = _ensure_negative_if_adjustment_line(line_type, cleaned_total)
+        part_items.append({
+            "raw_line": ln,
+            "quantity_raw": "",
+            "unit_price_raw": "",
+            "total_raw": cleaned_total,
+            "_line_type": line_type,
+        })
+    return part_items
+
+
+def _items_from_structured(receipt_raw: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Normaliza los items JSON de una parte (negativos, total faltante, ajustes)."""
+    part_items: List[Dict[str, Any]] = []
+    for item in (receipt_raw.get("items") or []):
+        raw_line = str(item.get("raw_line", "") or "")
+        quantity_raw = str(item.get("quantity_raw", "") or "")
+        unit_price_raw = str(item.get("unit_price_raw", "") or "")
+        total_raw = str(item.get("total_raw", "") or "")
+
+        line_type = _structured_line_type(raw_line)
+
+        # Preservar negativos marcados al final del renglón (ej. "85.90-")
+        total_raw = _apply_negative_marker_if_needed(raw_line, total_raw)
+        unit_price_raw = _apply_negative_marker_if_needed(raw_line, unit_price_raw)
+        quantity_raw = _apply_negative_marker_if_needed(raw_line, quantity_raw)
+
+        # Si el modelo omitió total_raw, intentar extraerlo del raw_line (sin inventar).
+        if not total_raw and raw_line:
+            extracted = _extract_last_currency_amount_raw(raw_line)
+            if extracted:
+                total_raw = _apply_negative_marker_if_needed(raw_line, extracted)
+
+        total_raw = _ensure_negative_if_adjustment_line(line_type, total_raw)
+
+        part_items.append({
+            "raw_line": raw_line,
+            "quantity_raw": quantity_raw,
+            "unit_price_raw": unit_price_raw,
+            "total_raw": total_raw,
+            "_line_type": line_type,
+        })
+    return part_items
+
+
+def _part_result_items(pr: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Items de un resultado de parte ya terminado (None si la parte falló o vino vacía)."""
+    if not pr.get("ok"):
+        return None
+    result = pr.get("result")
+    if not isinstance(result, dict):
+        return None
+    if str(pr.get("method") or "").startswith("transcribe"):
+        text = str(result.get("text") or "").strip()
+        return _items_from_transcription(text) if text else None
+    if "items" not in result:
+        return None
+    return _items_from_structured(result)
+
+
+# --- Partes guardadas y re-extracción selectiva ---
+
+def _qty_price_mismatch(item: Dict[str, Any]) -> bool:
+    """¿El renglón trae cantidad, precio unitario y total legibles pero cantidad × precio ≠ total?"""
+    raws = [str(item.get(k) or "").strip() for k in ("quantity_raw", "unit_price_raw", "total_raw")]
+    if not all(re.search(r"\d", r) for r in raws):
+        return False
+    quantity, unit_price, total = (abs(_parse_float_safe(r)) for r in raws)
+    if quantity <= 0 or unit_price <= 0 or total <= 0:
+        return False
+    return abs(quantity * unit_price - total) > max(0.02, total * 0.01)
+
+
+def _tile_issues(tile: Dict[str, Any]) -> List[str]:
+    """Motivos por los que una parte guardada parece inconsistente (lista vacía = parte confiable)."""
+    if tile.get("skipped"):
+        return []
+    if not tile.get("ok"):
+        return ["failed"]
+    if tile.get("kind") == "totals":
+        return []
+    items = tile.get("items")
+    if items is None:
+        return ["empty"]
+    issues: List[str] = []
+    illegible = sum(1 for it in items if str(it.get("total_raw") or "").strip().lower() == "no legible")
+    if illegible:
+        issues.append(f"no_legible:{illegible}")
+    mismatches = sum(1 for it in items if _qty_price_mismatch(it))
+    if mismatches:
+        issues.append(f"qty_x_price:{mismatches}")
+    return issues
+
+
+def _issues_score(issues: List[str]) -> int:
+    """Peso de las inconsistencias: cada renglón dudoso cuenta 1; una parte fallida/vacía, 100."""
+    score = 0
+    for issue in issues:
+        _name, _sep, count = issue.partition(":")
+        score += int(count) if count.isdigit() else 100
+    return score
+
+
+def _tile_record(
+    kind: str,
+    file_index: int,
+    part_index: int,
+    pr: Dict[str, Any],
+    image_base64: Optional[str],
+    image_format: str,
+    bounds: Tuple[Optional[int], Optional[int]],
+    mode: str,
+) -> Dict[str, Any]:
+    """Resultado de una parte (o del pie de totales) tal como se guarda en receipt_tiles."""
+    result = pr.get("result") if isinstance(pr.get("result"), dict) else None
+    tile = {
+        "id": None,
+        "kind": kind,
+        "file": file_index,
+        "part": part_index,
+        "b64": image_base64,
+        "path": None,
+        "format": image_format,
+        "top": bounds[0],
+        "bottom": bounds[1],
+        "mode": mode,
+        "method": pr.get("method") or ("totals" if kind == "totals" else "structured"),
+        "ok": bool(pr.get("ok")) and result is not None,
+        "skipped": bool(pr.get("skipped")),
+        "attempts": pr.get("attempts"),
+        "error": pr.get("error"),
+        "result": result,
+        "items": _part_result_items(pr) if kind == "items" else None,
+        "reextracts": 0,
+    }
+    tile["issues"] = _tile_issues(tile)
+    return tile
+
+
+def _tile_sort_key(tile: Dict[str, Any]) -> Tuple[int, int]:
+    return int(tile.get("file") or 0), int(tile.get("part") or 0)
+
+
+def _parts_items_from_tiles(
+    tiles: List[Dict[str, Any]],
+) -> Tuple[List[List[Dict[str, Any]]], List[Optional[Tuple[int, int, int]]]]:
+    """
+    Renglones por parte (en orden) reconstruidos desde las partes guardadas, con placeholder para las
+    fallidas, y los offsets (imagen, top, bottom) de cada parte para la alineación del solape.
+    """
+    allow_placeholder = any(t.get("ok") for t in tiles)
+    all_parts_items: List[List[Dict[str, Any]]] = []
+    offsets: List[Optional[Tuple[int, int, int]]] = []
+    for tile in sorted((t for t in tiles if t.get("kind") == "items"), key=_tile_sort_key):
+        if tile.get("skipped"):
+            continue
+        if tile.get("ok") and tile.get("items") is not None:
+            all_parts_items.append([dict(it) for it in tile["items"]])
+        elif allow_placeholder:
+            all_parts_items.append([{
+                "raw_line": f"no legible (parte {tile.get('part')} no se pudo extraer)",
+                "quantity_raw": "",
+                "unit_price_raw": "",
+                "total_raw": "no legible",
+                "_system_placeholder": True,
+            }])
+        else:
+            continue
+        has_bounds = tile.get("top") is not None and tile.get("bottom") is not None
+        offsets.append((tile.get("file"), tile["top"], tile["bottom"]) if has_bounds else None)
+    return all_parts_items, offsets
+
+
+def _raws_from_tiles(tiles: List[Dict[str, Any]]) -> Tuple[List[dict], List[dict]]:
+    """(receipt_raws, totals_raws) con la misma forma que arma el pipeline."""
+    receipt_raws: List[dict] = []
+    totals_raws: List[dict] = []
+    for tile in sorted(tiles, key=_tile_sort_key):
+        result = tile.get("result")
+        if not tile.get("ok") or not isinstance(result, dict):
+            continue
+        if tile.get("kind") == "totals":
+            totals_raws.append(result)
+        elif str(tile.get("method") or "").startswith("transcribe"):
+            receipt_raws.append({
+                "mode": "transcribe",
+                "method": tile.get("method"),
+                "attempts": tile.get("attempts"),
+                "part": tile.get("part"),
+                "text": str(result.get("text") or "")[:20000],
+                "_meta": result.get("_meta"),
+            })
+        elif "items" in result:
+            receipt_raws.append(result)
+    return receipt_raws, totals_raws
+
+
+def _status_from_tiles(tiles: List[Dict[str, Any]]) -> Tuple[List[dict], List[dict]]:
+    """(parts_status, totals_status) a partir de las partes guardadas."""
+    parts_status: List[dict] = []
+    totals_status: List[dict] = []
+    for tile in sorted(tiles, key=_tile_sort_key):
+        if tile.get("kind") == "totals":
+            if tile.get("ok"):
+                totals_status.append({"ok": True, "amount_raw": (tile.get("result") or {}).get("amount_raw")})
+            else:
+                totals_status.append({"ok": False, "error": tile.get("error")})
+                if tile.get("skipped"):
+                    totals_status[-1]["skipped"] = True
+            continue
+        ok = bool(tile.get("ok")) and tile.get("items") is not None
+        entry = {
+            "file": tile.get("file"),
+            "part": tile.get("part"),
+            "ok": ok,
+            "items": len(tile.get("items") or []),
+            "method": tile.get("method"),
+            "attempts": tile.get("attempts"),
+            "issues": tile.get("issues") or [],
+            "reextracts": tile.get("reextracts") or 0,
+        }
+        if not ok:
+            entry["error"] = tile.get("error") or "Empty items result"
+        if tile.get("skipped"):
+            entry["skipped"] = True
+        parts_status.append(entry)
+    return parts_status, totals_status
+
+
+def _tiles_dir(receipt_id: int) -> Path:
+    return UPLOADS_DIR / "receipt_tiles" / str(receipt_id)
+
+
+def _tile_from_row(row: models.ReceiptTile) -> Dict[str, Any]:
+    tile = {
+        "id": row.id,
+        "kind": row.kind,
+        "file": row.file_index,
+        "part": row.part_index,
+        "b64": None,
+        "path": row.image_path,
+        "format": row.image_format or "jpeg",
+        "top": row.top,
+        "bottom": row.bottom,
+        "mode": row.mode,
+        "method": row.method,
+        "ok": bool(row.ok),
+        "skipped": bool(row.skipped),
+        "attempts": row.attempts,
+        "error": row.error,
+        "result": row.result,
+        "items": row.items,
+        "reextracts": row.reextract_count or 0,
+    }
+    tile["issues"] = _tile_issues(tile)
+    return tile
+
+
+def _load_tile_base64(tile: Dict[str, Any]) -> Optional[str]:
+    if tile.get("b64"):
+        return tile["b64"]
+    path = tile.get("path")
+    if path and Path(path).exists():
+        return base64.b64encode(Path(path).read_bytes()).decode("utf-8")
+    return None
+
+
+def _save_tiles(db: Session, receipt_id: int, tiles: List[Dict[str, Any]]) -> None:
+    """Guarda/actualiza las partes del recibo: imagen en disco (una vez) + resultado en receipt_tiles."""
+    keep_images = str(os.getenv("RECEIPT_KEEP_TILES", "1")).strip().lower() not in ("0", "false", "no")
+    saved: List[Tuple[Dict[str, Any], models.ReceiptTile]] = []
+    for tile in tiles:
+        if keep_images and tile.get("b64") and not tile.get("path"):
+            try:
+                tiles_dir = _tiles_dir(receipt_id)
+                tiles_dir.mkdir(parents=True, exist_ok=True)
+                ext = "jpg" if tile.get("format") == "jpeg" else (tile.get("format") or "jpg")
+                file_path = tiles_dir / f"{tile['kind']}_f{tile['file']}_p{tile['part']}.{ext}"
+                file_path.write_bytes(base64.b64decode(tile["b64"]))
+                tile["path"] = str(file_path)
+            except Exception as e:
+                # Sin imagen la parte no se podrá re-extraer, pero no bloquea el guardado.
+                print(f"⚠️ No se pudo guardar la imagen de la parte {tile.get('part')}: {e}")
+
+        row = db.get(models.ReceiptTile, tile["id"]) if tile.get("id") else None
+        if row is None:
+            row = models.ReceiptTile(
+                receipt_id=receipt_id,
+                kind=tile["kind"],
+                file_index=tile["file"],
+                part_index=tile["part"],
+            )
+            db.add(row)
+        row.image_path = tile.get("path")
+        row.image_format = tile.get("format")
+        row.top = tile.get("top")
+        row.bottom = tile.get("bottom")
+        row.mode = tile.get("mode")
+        row.method = tile.get("method")
+        row.ok = bool(tile.get("ok"))
+        row.skipped = bool(tile.get("skipped"))
+        row.attempts = tile.get("attempts")
+        row.error = str(tile.get("error"))[:2000] if tile.get("error") else None
+        row.result = tile.get("result")
+        row.items = tile.get("items")
+        row.issues = tile.get("issues") or []
+        row.reextract_count = int(tile.get("reextracts") or 0)
+        saved.append((tile, row))
+    db.flush()
+    for tile, row in saved:
+        tile["id"] = row.id
+
+
+def _merge_and_reconcile(
+    all_parts_items: List[List[Dict[str, Any]]],
+    receipt_raws: List[dict],
+    totals_raws: List[dict],
+    offsets: Optional[List[Optional[Tuple[int, int, int]]]] = None,
+) -> Dict[str, Any]:
+    """
+    Combina los renglones de todas las partes, elige el total declarado y, si no cuadra,
+    agrega placeholders (conteo de artículos) y un renglón de ajuste.
+    """
+    combined_items, dedup_removed = _merge_items_with_overlap_dedup(all_parts_items, offsets=offsets)
+    sum_items_before = sum(_parse_float_safe(it.get("total_raw")) for it in combined_items)
+    max_item = max((_parse_float_safe(it.get("total_raw")) for it in combined_items), default=0.0)
+    declared_total, total_source, chosen_totals_raw = _pick_declared_total_v2(
+        receipt_raws=receipt_raws,
+        totals_raws=totals_raws,
+        sum_items=sum_items_before,
+        max_item=max_item,
+    )
+    chosen_amount = declared_total if declared_total > 0 else sum_items_before
+
+    expected_items_count: Optional[int] = None
+    try:
+        if isinstance(chosen_totals_raw, dict) and isinstance(chosen_totals_raw.get("items_count"), int):
+            expected_items_count = int(chosen_totals_raw.get("items_count"))
+    except Exception:
+        expected_items_count = None
+
+    extracted_items_count = len(combined_items)
+    missing_items_count = (expected_items_count - extracted_items_count) if isinstance(expected_items_count, int) else None
+
+    diff_before = (declared_total - sum_items_before) if declared_total > 0 else None
+    reconcile_threshold = float(os.getenv("RECEIPT_RECONCILE_THRESHOLD", "0.5"))
+    combined_items_final: List[Dict[str, Any]] = list(combined_items)
+    placeholders_added: int = 0
+    adjustment_added: Optional[float] = None
+    sum_items_after = sum_items_before
+
+    # Si el recibo declara un # de artículos, insertar placeholders para conservar el conteo (sin inventar montos).
+    if isinstance(missing_items_count, int) and missing_items_count > 0:
+        placeholders_added = missing_items_count
+        placeholders: List[Dict[str, Any]] = []
+        for i in range(missing_items_count):
+            placeholders.append({
+                "raw_line": "no legible",
+                "quantity_raw": "",
+                "unit_price_raw": "",
+                "total_raw": "no legible",
+                "_system_placeholder": True,
+                "_line_type": "placeholder",
+                "_placeholder_idx": i + 1,
+                "_placeholder_total": missing_items_count,
+            })
+        combined_items_final = _interleave_placeholders_evenly(combined_items_final, placeholders)
+
+    # Reconciliar para que el total "cuadre" sin inventar items.
+    # - Si falta monto (diff > 0): es muy probable que haya renglones no legibles/omitidos.
+    # - Si sobra monto (diff < 0): normalmente hay promociones/descuentos/cancelaciones no desglosadas como items.
+    needs_reconcile = declared_total > 0 and diff_before is not None and abs(diff_before) >= reconcile_threshold
+    if needs_reconcile:
+        adjustment_added = round(diff_before, 2)
+        if diff_before > 0:
+            if isinstance(missing_items_count, int) and missing_items_count > 0:
+                label = f"NO LEGIBLE (FALTAN {missing_items_count} RENGLONES) — DIFERENCIA PARA CUADRAR TOTAL"
+            else:
+                label = "NO LEGIBLE (DIFERENCIA PARA CUADRAR TOTAL)"
+        else:
+            label = "PROMOCIONES/DESCUENTOS/CANCELACIONES (NO DESGLOSADOS) — AJUSTE PARA CUADRAR TOTAL"
+        combined_items_final.append({
+            "raw_line": label,
+            "quantity_raw": "",
+            "unit_price_raw": "",
+            "total_raw": f"{diff_before:.2f}",
+            "_system_adjustment": True,
+        })
+        sum_items_after = sum_items_before + diff_before
+
+    return {
+        "combined_items": combined_items,
+        "combined_items_final": combined_items_final,
+        "dedup_removed": dedup_removed,
+        "placeholders_added": placeholders_added,
+        "chosen_amount": chosen_amount,
+        "chosen_totals_raw": chosen_totals_raw,
+        "needs_reconcile": needs_reconcile,
+        "arith": {
+            "declared_total": declared_total,
+            "sum_items": sum_items_before,
+            "diff_total_minus_items": diff_before,
+            "adjustment_added": adjustment_added,
+            "sum_items_after_adjustment": sum_items_after,
+            "max_item": max_item,
+            "total_source": total_source,
+            "expected_items_count": expected_items_count,
+            "extracted_items_count": extracted_items_count,
+            "missing_items_count": missing_items_count,
+            "placeholders_added": placeholders_added,
+        },
+    }
+
+
+def _receipt_item_rows(receipt_id: int, combined_items_final: List[Dict[str, Any]]) -> List[models.ReceiptItem]:
+    """Renglones combinados -> ReceiptItem (con notas RAW por renglón)."""
+    rows: List[models.ReceiptItem] = []
+    for idx, item in enumerate(combined_items_final, start=1):
+        raw_line = str(item.get("raw_line") or "").strip()
+        if not raw_line:
+            raw_line = "no legible"
+        quantity_raw = str(item.get("quantity_raw") or "").strip()
+        unit_price_raw = str(item.get("unit_price_raw") or "").strip()
+        total_raw = str(item.get("total_raw") or "").strip()
+
+        is_adjustment = bool(item.get("_system_adjustment"))
+        is_placeholder = bool(item.get("_system_placeholder"))
+        amount_val = _parse_float_safe(total_raw)
+        quantity_val = _parse_float_safe(quantity_raw) if quantity_raw and quantity_raw.lower() != "no legible" else None
+        unit_price_val = _parse_float_safe(unit_price_raw) if unit_price_raw and unit_price_raw.lower() != "no legible" else None
+
+        item_notes = {
+            "line_number": idx,
+            "raw_line": raw_line,
+            "quantity_raw": quantity_raw,
+            "unit_price_raw": unit_price_raw,
+            "total_raw": total_raw,
+            # Considerar legible si hay dígitos (incluye "0.00"); "no legible" no trae números.
+            "amount_legible": bool(re.search(r"\d", total_raw)) if total_raw else False,
+            "is_adjustment": is_adjustment,
+            "derived_amount": is_adjustment,
+            "is_placeholder": is_placeholder,
+            "line_type": str(item.get("_line_type") or "").strip()
+            or ("adjustment" if is_adjustment else ("placeholder" if is_placeholder else "item")),
+            "placeholder_idx": int(item.get("_placeholder_idx")) if is_placeholder and item.get("_placeholder_idx") else None,
+            "placeholder_total": int(item.get("_placeholder_total")) if is_placeholder and item.get("_placeholder_total") else None,
+        }
+        rows.append(models.ReceiptItem(
+            receipt_id=receipt_id,
+            description=raw_line,
+            amount=amount_val,
+            quantity=quantity_val,
+            unit_price=unit_price_val,
+            unit_of_measure=None,
+            category=None,
+            subcategory=None,
+            notes=json.dumps(item_notes, ensure_ascii=False),
+        ))
+    return rows
+
+
+async def _reextract_tiles(targets: List[Dict[str, Any]], timeout: float, prefer_new: bool = False) -> Dict[str, Any]:
+    """
+    Re-extrae solo las partes indicadas con más detalle: modo preciso, detail "high" y cada parte
+    dividida en sub-partes (más pixeles por renglón). Una parte se reemplaza solo si el resultado
+    nuevo tiene menos inconsistencias (o las mismas, con `prefer_new`, cuando el usuario la pidió).
+    Actualiza los dicts de `targets` en su lugar.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + max(1.0, timeout)
+    pieces = max(1, int(os.getenv("RECEIPT_REEXTRACT_PIECES", "2")))
+    sem = asyncio.Semaphore(max(1, min(8, int(os.getenv("RECEIPT_REEXTRACT_CONCURRENCY", "2")))))
+    calls = 0
+
+    async def _call(fn, *args, **kwargs):
+        budget = deadline - loop.time()
+        if budget <= 0:
+            raise asyncio.TimeoutError()
+
+        async def _guarded():
+            nonlocal calls
+            async with sem:
+                calls += 1
+                return await fn(*args, **kwargs)
+
+        return await asyncio.wait_for(_guarded(), timeout=budget)
+
+    async def _one(tile: Dict[str, Any]) -> Dict[str, Any]:
+        before = _tile_issues(tile)
+        entry: Dict[str, Any] = {
+            "file": tile.get("file"),
+            "part": tile.get("part"),
+            "kind": tile.get("kind"),
+            "issues_before": before,
+            "accepted": False,
+        }
+        t0 = loop.time()
+        try:
+            image_base64 = _load_tile_base64(tile)
+            if not image_base64:
+                raise ValueError("Imagen de la parte no disponible")
+            if tile.get("kind") == "totals":
+                # use_cache=False: la misma imagen con los mismos parámetros daría la misma lectura desde el caché
+                res = await _call(
+                    receipt_processor.aprocess_receipt_totals_image, image_base64, tile.get("format") or "jpeg", "precise",
+                    use_cache=False,
+                )
+                if not isinstance(res, dict):
+                    raise ValueError("Empty totals result")
+                candidate = {"result": res, "items": None}
+                entry["pieces"] = 1
+            else:
+                sub_parts = await receipt_images.asplit_tile(base64.b64decode(image_base64), pieces)
+                sub_format = "jpeg" if len(sub_parts) > 1 else (tile.get("format") or "jpeg")
+                results = await asyncio.gather(*[
+                    _call(
+                        receipt_processor.aprocess_receipt_items_image, b64, sub_format, "precise",
+                        image_detail="high", use_cache=False,
+                    )
+                    for b64 in sub_parts
+                ])
+                raw_items: List[Dict[str, Any]] = []
+                pieces_items: List[List[Dict[str, Any]]] = []
+                for res in results:
+                    if not isinstance(res, dict) or "items" not in res:
+                        raise ValueError("Empty items result")
+                    raw_items.extend(res.get("items") or [])
+                    pieces_items.append(_items_from_structured(res))
+                merged, _removed = _merge_items_with_overlap_dedup(pieces_items)
+                result = dict(results[0], items=raw_items)
+                result["_meta"] = dict(results[0].get("_meta") or {}, reextract_pieces=len(sub_parts))
+                candidate = {"result": result, "items": merged}
+                entry["pieces"] = len(sub_parts)
+
+            after = _tile_issues(dict(tile, ok=True, skipped=False, **candidate))
+            entry["issues_after"] = after
+            score_before, score_after = _issues_score(before), _issues_score(after)
+            if not tile.get("ok") or tile.get("skipped") or score_after < score_before or (prefer_new and score_after == score_before):
+                tile.update(candidate)
+                tile.update(ok=True, skipped=False, method="reextract", mode="precise", error=None, issues=after)
+                entry["accepted"] = True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            entry["error"] = "Request timed out." if isinstance(e, asyncio.TimeoutError) else str(e)[:240]
+        tile["reextracts"] = int(tile.get("reextracts") or 0) + 1
+        entry["elapsed_s"] = round(loop.time() - t0, 2)
+        return entry
+
+    entries = await asyncio.gather(*[_one(t) for t in targets])
+    accepted = sum(1 for e in entries if e.get("accepted"))
+    elapsed = round(loop.time() - started, 2)
+    print(f"🔁 Re-extracción: {accepted}/{len(entries)} partes mejoradas en {elapsed}s ({calls} llamadas)")
+    return {
+        "tiles": entries,
+        "calls": calls,
+        "improved": accepted > 0,
+        "elapsed_s": elapsed,
+    }
+
+
+def _detect_image_format(content_type: Optional[str], image_bytes: bytes) -> str:
+    image_format = "jpeg"
+    if content_type:
+        ct = content_type.lower()
+        if "png" in ct:
+            image_format = "png"
+        elif "gif" in ct:
+            image_format = "gif"
+        elif "webp" in ct:
+            image_format = "webp"
+        elif "jpg" in ct or "jpeg" in ct:
+            image_format = "jpeg"
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        image_format = "png"
+    elif image_bytes.startswith(b"\xff\xd8\xff"):
+        image_format = "jpeg"
+    elif image_bytes.startswith(b"GIF87a") or image_bytes.startswith(b"GIF89a"):
+        image_format = "gif"
+    elif image_bytes.startswith(b"RIFF") and b"WEBP" in image_bytes[:12]:
+        image_format = "webp"
+    return image_format
+
+
+async def run_receipt_pipeline(
+    db: Union[Session, AsyncSession],
+    uploads: List[Dict[str, Any]],
+    mode: Optional[str],
+    assigned_user_id: int,
+    base_url: str,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    receipt_fields: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Pipeline completo de extracción RAW (partes en paralelo + pie de totales) y guardado del recibo.
+    `uploads` es una lista de {"filename", "content_type", "data"} ya validada; todas las imágenes son
+    del mismo recibo y se preparan y extraen a la vez (los renglones se combinan en orden de imagen).
+    `on_progress` (opcional) recibe el estado por parte conforme avanza (usado por la cola de trabajos).
+    `receipt_fields` (opcional) son columnas extra del recibo (p. ej. whatsapp_message_id).
+    `db` (Session o AsyncSession, como la de los workers de la cola) solo se usa al guardar el recibo.
+    Lanza ReceiptPipelineError si no se pudo extraer nada.
+    """
+    import asyncio
+    import json
+
+    progress: Dict[str, Any] = {
+        "stage": "extracting",
+        "files_total": len(uploads),
+        "file_index": 0,
+        "parts_total": 0,
+        "parts_done": 0,
+        "parts": [],
+        "totals_done": 0,
+    }
+
+    def _notify():
+        if on_progress is None:
+            return
+        try:
+            on_progress(dict(progress, parts=list(progress["parts"])))
+        except Exception as e:
+            print(f"⚠️ Error reportando progreso de recibo: {e}")
+    receipt_raws: List[dict] = []
+    totals_raws: List[dict] = []
+    first_date = None
+    first_time = None
+    first_currency = None
+    first_merchant = None
+    parts_status: List[dict] = []
+    totals_status: List[dict] = []
+    all_parts_items: List[List[Dict[str, Any]]] = []
+    items_before_dedup = 0
+    image_timings: List[Dict[str, Any]] = []
+    # Resultado por parte (se guarda en receipt_tiles para re-extraer solo las partes dudosas)
+    tile_records: List[Dict[str, Any]] = []
+
+    # Guardar la imagen original (primera) para visualizar en "Registros de Usuario"
+    saved_image_bytes: Optional[bytes] = None
+    saved_image_ext: Optional[str] = None
+
+    # Plazo único para todo el recibo (todas las imágenes, partes, fallbacks y totales).
+    # Cada llamada recibe lo que quede del plazo; al agotarse se cancela lo pendiente y se guarda con placeholders.
+    mode_norm = (mode or "precise").strip().lower()
+    deadline_budget = float(os.getenv(
+        "RECEIPT_DEADLINE_FAST" if mode_norm == "fast" else "RECEIPT_DEADLINE_PRECISE",
+        "90" if mode_norm == "fast" else "240",
+    ))
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    deadline = started_at + deadline_budget
+    # Parte del plazo restante que puede usar el intento principal de una parte (el resto queda para el fallback).
+    primary_share = min(1.0, max(0.1, float(os.getenv("RECEIPT_PRIMARY_SHARE", "0.65"))))
+    early_complete_enabled = str(os.getenv("RECEIPT_EARLY_COMPLETE", "1")).strip().lower() not in ("0", "false", "no")
+    early_tolerance = float(os.getenv("RECEIPT_EARLY_COMPLETE_TOLERANCE", "0.01"))
+    deadline_hit = False
+    early_completed = False
+
+    def _remaining() -> float:
+        return deadline - loop.time()
+
+    part_timeout = float(os.getenv(
+        "RECEIPT_PART_TIMEOUT_FAST" if mode_norm == "fast" else "RECEIPT_PART_TIMEOUT_PRECISE",
+        "120" if mode_norm == "fast" else "300"
+    ))
+
+    totals_timeout = float(os.getenv(
+        "RECEIPT_TOTAL_TIMEOUT_FAST" if mode_norm == "fast" else "RECEIPT_TOTAL_TIMEOUT_PRECISE",
+        "60" if mode_norm == "fast" else "120"
+    ))
+
+    use_transcribe_mode = mode_norm in ("text", "transcribe", "texto")
+    fallback_transcribe = str(os.getenv("RECEIPT_FALLBACK_TRANSCRIBE_ON_ERROR", "1")).strip().lower() not in ("0", "false", "no")
+
+    # Evitar rate limits/errores por demasiadas llamadas concurrentes (especialmente en modo Preciso).
+    # El límite es por imagen; el gobernador de OpenAI acota el total del proceso.
+    part_concurrency = int(os.getenv(
+        "RECEIPT_PART_CONCURRENCY_FAST" if mode_norm == "fast" else "RECEIPT_PART_CONCURRENCY_PRECISE",
+        "4" if mode_norm == "fast" else "2",
+    ))
+    part_concurrency = max(1, min(8, part_concurrency))
+    transcribe_timeout = float(os.getenv("RECEIPT_TRANSCRIBE_TIMEOUT", "180"))
+
+    # Decodificar una sola vez y dividir/recortar/base64 fuera del event loop (pool de procesos),
+    # todas las imágenes a la vez.
+    image_formats = [_detect_image_format(u.get("content_type"), u["data"]) for u in uploads]
+    prepared_all = await asyncio.gather(*[
+        receipt_images.aprepare_receipt_image(
+            upload["data"],
+            image_format,
+            aggressive=(mode_norm in ("precise", "text", "transcribe", "texto")),
+            # Recorte del PIE del recibo para extraer el TOTAL con mayor precisión
+            crop_height=1900 if mode_norm in ("precise", "text", "transcribe", "texto") else 1500,
+            crop_max_width=1700,
+        )
+        for upload, image_format in zip(uploads, image_formats)
+    ])
+
+    files: List[Dict[str, Any]] = []
+    for file_index, (upload, image_format, prepared) in enumerate(zip(uploads, image_formats, prepared_all), start=1):
+        image_timings.append(dict(
+            prepared["timings"],
+            file=file_index,
+            parts=len(prepared["parts_base64"]),
+            split=prepared["split"].get("strategy"),
+            tiles=prepared["split"].get("tiles"),
+            bytes=prepared["bytes"],
+        ))
+        t = prepared["timings"]
+        b = prepared["bytes"]
+        print(
+            f"🖼️ Imagen {file_index}: {len(prepared['parts_base64'])} partes en {t.get('roundtrip_ms')} ms "
+            f"(decode {t.get('decode_ms')}, normalizar {t.get('normalize_ms')}, split {t.get('split_ms')}, pie {t.get('crop_ms')}, base64 {t.get('base64_ms')}, espera {t.get('queue_ms')}) | "
+            f"{b['original'] / 1024:.0f} KB originales -> {b['sent'] / 1024:.0f} KB al modelo, {b['saved'] / 1024:.0f} KB ahorrados"
+        )
+
+        # Guardar la primera imagen ya normalizada (no la foto original de varios MB)
+        if saved_image_bytes is None:
+            if prepared.get("normalized_bytes"):
+                saved_image_bytes = prepared["normalized_bytes"]
+                saved_image_ext = "jpg"
+            else:
+                saved_image_bytes = upload["data"]
+                saved_image_ext = "jpg" if image_format == "jpeg" else image_format
+
+        part_jobs: List[Tuple[int, str]] = list(enumerate(prepared["parts_base64"], start=1))
+        # (top, bottom) en pixeles de cada parte, para alinear los solapes al combinar
+        split_bounds = prepared["split"].get("tiles") or []
+        if len(split_bounds) != len(part_jobs):
+            split_bounds = [(None, None)] * len(part_jobs)
+        files.append({
+            "file": file_index,
+            "part_jobs": part_jobs,
+            "split_bounds": split_bounds,
+            "part_format": prepared["part_format"],
+            "totals_format": prepared["totals_format"],
+            "totals_base64": prepared["totals_base64"],
+        })
+        progress["parts_total"] += len(part_jobs)
+
+    progress["file_index"] = len(files)
+    _notify()
+
+    async def _call_part(sem: asyncio.Semaphore, fn, *args, timeout: float):
+        # Llamada async nativa sobre el cliente compartido: el timeout cancela la petición HTTP en curso.
+        # El tiempo en espera del semáforo también cuenta contra el plazo del recibo.
+        budget = min(timeout, _remaining())
+        if budget <= 0:
+            raise asyncio.TimeoutError()
+
+        async def _guarded():
+            async with sem:
+                return await fn(*args)
+
+        return await asyncio.wait_for(_guarded(), timeout=budget)
+
+    async def _run_totals(f: Dict[str, Any]):
+        try:
+            res = await _call_part(
+                f["sem"],
+                receipt_processor.aprocess_receipt_totals_image,
+                f["totals_base64"],
+                f["totals_format"],
+                mode,
+                timeout=totals_timeout,
+            )
+            return {"ok": True, "result": res}
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                return {"ok": False, "error": "Totals request timed out."}
+            return {"ok": False, "error": str(e)}
+
+    async def _run_part(f: Dict[str, Any], idx: int, b64: str):
+        attempts = 0
+        method = "transcribe" if use_transcribe_mode else "structured"
+        primary_fn = receipt_processor.atranscribe_receipt_image if use_transcribe_mode else receipt_processor.aprocess_receipt_items_image
+        last_err: Optional[BaseException] = None
+
+        try:
+            attempts += 1
+            primary_timeout = part_timeout
+            if (not use_transcribe_mode) and fallback_transcribe:
+                primary_timeout = min(part_timeout, max(1.0, _remaining() * primary_share))
+            res = await _call_part(f["sem"], primary_fn, b64, f["part_format"], mode, timeout=primary_timeout)
+            return {"part": idx, "ok": True, "method": method, "attempts": attempts, "result": res}
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            last_err = e
+
+        # Fallback automático: si el JSON estructurado falla, intentar transcripción de texto para NO perder la parte.
+        if (not use_transcribe_mode) and fallback_transcribe:
+            try:
+                attempts += 1
+                res = await _call_part(
+                    f["sem"],
+                    receipt_processor.atranscribe_receipt_image,
+                    b64,
+                    f["part_format"],
+                    mode,
+                    timeout=min(part_timeout, transcribe_timeout),
+                )
+                return {
+                    "part": idx,
+                    "ok": True,
+                    "method": "transcribe_fallback",
+                    "attempts": attempts,
+                    "fallback_error": (str(last_err)[:220] if last_err else None),
+                    "result": res,
+                }
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e2:
+                last_err = e2
+
+        if isinstance(last_err, asyncio.TimeoutError):
+            err = "Request timed out."
+        else:
+            err = str(last_err) if last_err else "Unknown error"
+
+        return {"part": idx, "ok": False, "method": method, "attempts": attempts, "error": err}
+
+    async def _tracked_part(f: Dict[str, Any], idx: int, b64: str):
+        out = await _run_part(f, idx, b64)
+        progress["parts_done"] += 1
+        progress["parts"].append({
+            "file": f["file"],
+            "part": idx,
+            "ok": bool(out.get("ok")),
+            "method": out.get("method"),
+            "attempts": out.get("attempts"),
+        })
+        _notify()
+        return out
+
+    async def _tracked_totals(f: Dict[str, Any]):
+        out = await _run_totals(f)
+        progress["totals_done"] += 1
+        _notify()
+        return out
+
+    # Procesar partes y pies de TODAS las imágenes EN PARALELO para reducir tiempo total (wall-clock).
+    for f in files:
+        f["sem"] = asyncio.Semaphore(part_concurrency)
+        f["totals_task"] = asyncio.create_task(_tracked_totals(f))
+        f["part_tasks"] = [asyncio.create_task(_tracked_part(f, idx_part, part_base64)) for idx_part, part_base64 in f["part_jobs"]]
+    part_tasks = [t for f in files for t in f["part_tasks"]]
+    totals_tasks = [f["totals_task"] for f in files]
+
+    def _finished(task: asyncio.Task) -> bool:
+        return task.done() and not task.cancelled() and task.exception() is None
+
+    def _items_match_declared_total() -> bool:
+        """¿Los items ya extraídos (partes terminadas de todas las imágenes) suman el total declarado del pie?"""
+        totals_done = [
+            t.result()["result"] for t in totals_tasks
+            if _finished(t) and t.result().get("ok") and isinstance(t.result().get("result"), dict)
+        ]
+        if not totals_done:
+            return False
+        parts_items: List[List[Dict[str, Any]]] = []
+        offsets: List[Optional[Tuple[int, int, int]]] = []
+        raws: List[dict] = []
+        for f in files:
+            done_parts = [t.result() for t in f["part_tasks"] if _finished(t)]
+            # Una imagen sin ninguna parte terminada dejaría fuera un tramo entero del recibo.
+            if not done_parts:
+                return False
+            for pr in sorted(done_parts, key=lambda x: int(x.get("part") or 0)):
+                items = _part_result_items(pr)
+                if items:
+                    parts_items.append(items)
+                    idx_part = int(pr.get("part") or 0)
+                    bounds = f["split_bounds"]
+                    top, bottom = bounds[idx_part - 1] if 1 <= idx_part <= len(bounds) else (None, None)
+                    offsets.append((f["file"], top, bottom))
+                    if not str(pr.get("method") or "").startswith("transcribe"):
+                        raws.append(pr["result"])
+        if not parts_items:
+            return False
+        merged, _removed = _merge_items_with_overlap_dedup(parts_items, offsets=offsets)
+        sum_items = sum(_parse_float_safe(it.get("total_raw")) for it in merged)
+        max_item = max((_parse_float_safe(it.get("total_raw")) for it in merged), default=0.0)
+        declared, _source, _raw = _pick_declared_total_v2(
+            receipt_raws=raws,
+            totals_raws=totals_done,
+            sum_items=sum_items,
+            max_item=max_item,
+        )
+        return declared > 0 and abs(declared - sum_items) <= early_tolerance + 1e-6
+
+    # Esperar hasta que todo termine, se agote el plazo o los items ya cuadren con el total.
+    pending = set(part_tasks) | set(totals_tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=max(0.0, _remaining()), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            deadline_hit = True
+            break
+        if (
+            early_complete_enabled
+            and any(t in pending for t in part_tasks)
+            and _items_match_declared_total()
+        ):
+            early_completed = True
+            break
+    for t in pending:
+        t.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        print(
+            f"⏱️ Recibo: {len(pending)} llamadas canceladas "
+            + ("(los items ya suman el total declarado)" if early_completed else f"(plazo de {deadline_budget:.0f}s agotado)")
+        )
+
+    # Combinar resultados en orden de imagen y de parte
+    for f in files:
+        file_index = f["file"]
+        part_jobs = f["part_jobs"]
+        part_results = []
+        for (idx_part, _b64), task in zip(part_jobs, f["part_tasks"]):
+            if _finished(task):
+                part_results.append(task.result())
+                continue
+            # Parte cancelada: por plazo -> placeholder (como una parte fallida); por cierre anticipado -> se omite.
+            pr = {
+                "part": idx_part,
+                "ok": False,
+                "method": "transcribe" if use_transcribe_mode else "structured",
+                "attempts": None,
+                "error": "Skipped: items already match declared total" if early_completed else "Receipt deadline exceeded",
+                "skipped": early_completed,
+            }
+            part_results.append(pr)
+            progress["parts_done"] += 1
+            progress["parts"].append({"file": file_index, "part": idx_part, "ok": False, "method": pr["method"], "attempts": None})
+        totals_task = f["totals_task"]
+        if _finished(totals_task):
+            totals_out = totals_task.result()
+        else:
+            # Igual que las partes: por cierre anticipado se omite (no es una lectura fallida del total)
+            totals_out = {
+                "ok": False,
+                "error": "Skipped: items already match declared total" if early_completed else "Receipt deadline exceeded",
+                "skipped": early_completed,
+            }
+
+        for (idx_part, part_base64), pr in zip(part_jobs, part_results):
+            bounds = tuple(f["split_bounds"][idx_part - 1])
+            tile_records.append(_tile_record("items", file_index, idx_part, pr, part_base64, f["part_format"], bounds, mode_norm))
+        tile_records.append(_tile_record("totals", file_index, 0, totals_out, f["totals_base64"], f["totals_format"], (None, None), mode_norm))
+
+        # Procesar resultado de totales
+        if not totals_out.get("ok"):
+            totals_status.append({"ok": False, "error": totals_out.get("error")})
+            if totals_out.get("skipped"):
+                totals_status[-1]["skipped"] = True
+        else:
+            totals_raw = totals_out.get("result")
+            if totals_raw and isinstance(totals_raw, dict):
+                totals_status.append({"ok": True, "amount_raw": totals_raw.get("amount_raw")})
+                totals_raws.append(totals_raw)
+                # Completar currency si llega aquí
+                if first_currency is None and totals_raw.get("currency"):
+                    first_currency = totals_raw.get("currency")
+            else:
+                totals_status.append({"ok": False, "error": "Empty totals result"})
+
+        allow_placeholder = bool(totals_out.get("ok")) or any(bool(p.get("ok")) for p in (part_results or []))
+
+        for pr in (part_results or []):
+            idx_part = int(pr.get("part") or 0)
+            ok = bool(pr.get("ok"))
+            method = str(pr.get("method") or "")
+            attempts = pr.get("attempts")
+
+            if pr.get("skipped"):
+                # Cancelada porque los items ya cuadraban con el total: sin placeholder.
+                parts_status.append({"part": idx_part, "ok": False, "items": 0, "error": pr.get("error"), "method": method, "attempts": attempts, "skipped": True})
+                continue
+
+            if not ok:
+                err = pr.get("error") or "Unknown error"
+                parts_status.append({"part": idx_part, "ok": False, "items": 0, "error": err, "method": method, "attempts": attempts})
+
+                # Mantener el orden: insertar placeholder para partes fallidas si al menos hubo señal útil (totales u otra parte OK)
+                if allow_placeholder:
+                    placeholder = {
+                        "raw_line": f"no legible (parte {idx_part} no se pudo extraer)",
+                        "quantity_raw": "",
+                        "unit_price_raw": "",
+                        "total_raw": "no legible",
+                        "_system_placeholder": True,
+                    }
+                    items_before_dedup += 1
+                    all_parts_items.append([placeholder])
+                continue
+
+            result = pr.get("result")
+
+            # Si el resultado viene de transcripción (modo texto o fallback), convertir texto a items.
+            if method.startswith("transcribe"):
+                payload = result if isinstance(result, dict) else {}
+                text = str(payload.get("text") or "").strip()
+                if not text:
+                    parts_status.append({"part": idx_part, "ok": False, "items": 0, "error": "Empty transcription", "method": method, "attempts": attempts})
+                    if allow_placeholder:
+                        placeholder = {
+                            "raw_line": f"no legible (parte {idx_part} sin texto)",
+                            "quantity_raw": "",
+                            "unit_price_raw": "",
+                            "total_raw": "no legible",
+                            "_system_placeholder": True,
+                        }
+                        items_before_dedup += 1
+                        all_parts_items.append([placeholder])
+                    continue
+
+                part_items = _items_from_transcription(text)
+
+                parts_status.append({"part": idx_part, "ok": True, "items": len(part_items), "method": method, "attempts": attempts, "fallback_error": pr.get("fallback_error"), "cache": (payload.get("_meta") or {}).get("cache")})
+                receipt_raws.append({
+                    "mode": "transcribe",
+                    "method": method,
+                    "attempts": attempts,
+                    "fallback_error": pr.get("fallback_error"),
+                    "part": idx_part,
+                    "text": text[:20000],
+                    "_meta": payload.get("_meta"),
+                })
+                items_before_dedup += len(part_items)
+                all_parts_items.append(part_items)
+                continue
+
+            # Structured JSON normal
+            receipt_raw = result
+            if not receipt_raw or "items" not in receipt_raw:
+                parts_status.append({"part": idx_part, "ok": False, "items": 0, "error": "Empty items result", "method": method or "structured", "attempts": attempts})
+                if allow_placeholder:
+                    placeholder = {
+                        "raw_line": f"no legible (parte {idx_part} sin items)",
+                        "quantity_raw": "",
+                        "unit_price_raw": "",
+                        "total_raw": "no legible",
+                        "_system_placeholder": True,
+                    }
+                    items_before_dedup += 1
+                    all_parts_items.append([placeholder])
+                continue
+
+            parts_status.append({"part": idx_part, "ok": True, "items": len(receipt_raw.get("items") or []), "method": method or "structured", "attempts": attempts, "cache": (receipt_raw.get("_meta") or {}).get("cache")})
+            receipt_raws.append(receipt_raw)
+
+            if first_date is None and receipt_raw.get("date"):
+                first_date = receipt_raw.get("date")
+            if first_time is None and receipt_raw.get("time"):
+                first_time = receipt_raw.get("time")
+            if first_currency is None and receipt_raw.get("currency"):
+                first_currency = receipt_raw.get("currency")
+            if first_merchant is None and receipt_raw.get("merchant_or_beneficiary"):
+                first_merchant = receipt_raw.get("merchant_or_beneficiary")
+
+            part_items = _items_from_structured(receipt_raw)
+            items_before_dedup += len(part_items)
+            all_parts_items.append(part_items)
+
+    if pending:
+        _notify()
+
+    if not receipt_raws and items_before_dedup == 0:
+        # Incluir una pista del motivo real (timeout, rate limit, imagen inválida, JSON, etc.)
+        try:
+            errors = [ps.get("error") for ps in parts_status if ps.get("error")]
+            # Tomar el primer error no vacío (y truncarlo).
+            hint = ""
+            for e in errors:
+                if not e:
+                    continue
+                hint = re.sub(r"\s+", " ", str(e)).strip()
+                break
+            if hint:
+                hint = hint[:240]
+                print(f"❌ Receipt extraction failed. Hint: {hint}")
+            else:
+                print("❌ Receipt extraction failed. No hint available.")
+        except Exception:
+            hint = ""
+
+        # Si el error ya es explícito (ej. OpenAI cuota), no confundir con “foto más clara”.
+        if hint.startswith("OpenAI:"):
+            raise ReceiptPipelineError(500, f"No se pudo extraer información. {hint}")
+
+        # Si al menos pudimos leer el TOTAL desde el pie, crear recibo con placeholder para corrección manual.
+        has_totals = any(
+            isinstance(t, dict) and isinstance(t.get("declared_total_cents"), int) and (t.get("declared_total_cents") or 0) > 0
+            for t in (totals_raws or [])
+        )
+        if has_totals:
+            print("⚠️ No se pudieron extraer items, pero sí se detectaron totales. Se creará recibo con placeholder.")
+        else:
+            raise ReceiptPipelineError(
+                500,
+                "No se pudo extraer información del recibo. Intenta una foto más clara o cambia el modo (Rápido/Preciso)."
+                + (f" Detalle: {hint}" if hint else ""),
+            )
+
+        # Nota: se continúa para crear el recibo con ajuste (abajo).
+
+    progress["stage"] = "saving"
+    _notify()
+
+    # Crear un solo recibo combinando todos los renglones (desde las partes, con sus offsets en pixeles)
+    merge_parts_items, merge_offsets = _parts_items_from_tiles(tile_records)
+    outcome = _merge_and_reconcile(merge_parts_items, receipt_raws, totals_raws, merge_offsets)
+
+    # Pasada automática: si no cuadra con el total, re-extraer con más detalle SOLO las partes inconsistentes
+    # (fallidas, no legibles o con cantidad × precio ≠ total) mientras quede plazo, y volver a combinar.
+    reextract_passes: List[Dict[str, Any]] = []
+    auto_reextract = str(os.getenv("RECEIPT_AUTO_REEXTRACT", "1")).strip().lower() not in ("0", "false", "no")
+    if auto_reextract and outcome["needs_reconcile"]:
+        targets = [t for t in tile_records if t.get("issues")]
+        item_tiles = sum(1 for t in tile_records if t["kind"] == "items")
+        max_share = float(os.getenv("RECEIPT_AUTO_REEXTRACT_MAX_SHARE", "0.5"))
+        min_seconds = float(os.getenv("RECEIPT_REEXTRACT_MIN_SECONDS", "20"))
+        budget = _remaining()
+        if targets and len(targets) <= max(1, int(item_tiles * max_share)) and budget >= min_seconds:
+            progress["stage"] = "reextracting"
+            _notify()
+            reextract_meta = await _reextract_tiles(targets, timeout=budget)
+            reextract_passes.append(dict(reextract_meta, trigger="auto"))
+            if reextract_meta["improved"]:
+                receipt_raws, totals_raws = _raws_from_tiles(tile_records)
+                merge_parts_items, merge_offsets = _parts_items_from_tiles(tile_records)
+                items_before_dedup = sum(len(p) for p in merge_parts_items)
+                parts_status, totals_status = _status_from_tiles(tile_records)
+                outcome = _merge_and_reconcile(merge_parts_items, receipt_raws, totals_raws, merge_offsets)
+            progress["stage"] = "saving"
+            _notify()
+
+    combined_items = outcome["combined_items"]
+    combined_items_final = outcome["combined_items_final"]
+    chosen_amount = outcome["chosen_amount"]
+    chosen_totals_raw = outcome["chosen_totals_raw"]
+    arith_meta = outcome["arith"]
+
+    merge_meta = {
+        "parts": len(merge_parts_items),
+        "items_before_dedup": items_before_dedup,
+        "items_after_dedup": len(combined_items),
+        "items_after_adjustment": len(combined_items_final),
+        "dedup_removed": outcome["dedup_removed"],
+        "mode": (mode or "precise"),
+        "placeholders_added": outcome["placeholders_added"],
+        "image_prep": image_timings,
+        "deadline_s": deadline_budget,
+        "deadline_hit": deadline_hit,
+        "early_complete": early_completed,
+        "elapsed_s": round(loop.time() - started_at, 2),
+    }
+    def _persist(db: Session) -> Dict[str, Any]:
+        db_receipt = models.Receipt(
+            user_id=assigned_user_id,
+            date=first_date,
+            time=first_time,
+            amount=chosen_amount,
+            currency=first_currency or "MXN",
+            merchant_or_beneficiary=first_merchant,
+            status="pending",
+            notes=json.dumps(
+                {
+                    "raw_receipts": receipt_raws,
+                    "totals": chosen_totals_raw,
+                    "totals_candidates": totals_raws,
+                    "parts_status": parts_status,
+                    "totals_status": totals_status,
+                    "merge": merge_meta,
+                    "arith": arith_meta,
+                    "reextract": reextract_passes,
+                },
+                ensure_ascii=False,
+            ),
+        )
+        for column, value in (receipt_fields or {}).items():
+            setattr(db_receipt, column, value)
+        db.add(db_receipt)
+        db.flush()
+        _save_tiles(db, db_receipt.id, tile_records)
+
+        # Persistir imagen del recibo y exponer URL
+        try:
+            if saved_image_bytes and saved_image_ext:
+                upload_dir = UPLOADS_DIR / "receipts"
+                upload_dir.mkdir(parents=True, exist_ok=True)
+                filename = f"receipt_{db_receipt.id}.{saved_image_ext}"
+                file_path = upload_dir / filename
+                file_path.write_bytes(saved_image_bytes)
+                db_receipt.image_url = f"{base_url.rstrip('/')}/uploads/receipts/{filename}"
+                db.add(db_receipt)
+        except Exception:
+            # Si falla guardar imagen, no bloquear el flujo de extracción.
+            pass
+
+        # Guardar los renglones combinados
+        for receipt_item in _receipt_item_rows(db_receipt.id, combined_items_final):
+            db.add(receipt_item)
+
+        db.commit()
+        db.refresh(db_receipt)
+        db_receipt.items = db.query(models.ReceiptItem).filter(
+            models.ReceiptItem.receipt_id == db_receipt.id
+        ).all()
+
+        return {
+            "message": "Recibo combinado procesado y guardado exitosamente (RAW)",
+            "receipt": schemas.ReceiptResponse.model_validate(db_receipt),
+            "receipt_id": db_receipt.id,
+            "parts_status": parts_status,
+            "totals_status": totals_status,
+        }
+
+    if isinstance(db, AsyncSession):
+        # Sesión async (POST /api/receipts/process con sync=true): el guardado corre con run_sync y
+        # sus consultas esperan al driver sin bloquear el event loop
+        return await db.run_sync(_persist)
+    return _persist(db)
+
+
+async def run_receipt_job(
+    db: Union[Session, AsyncSession],
+    job: models.ReceiptJob,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Ejecuta un trabajo de la cola (`receipt_jobs`): carga las imágenes guardadas y corre el pipeline.
+    Los errores del pipeline se convierten en ValueError para que la cola los registre en el trabajo.
+    """
+    uploads: List[Dict[str, Any]] = []
+    for f in (job.files or []):
+        uploads.append({
+            "filename": f.get("filename"),
+            "content_type": f.get("content_type"),
+            "data": Path(f["path"]).read_bytes(),
+        })
+    if not uploads:
+        raise ValueError("El trabajo no tiene imágenes para procesar")
+
+    try:
+        return await run_receipt_pipeline(
+            db,
+            uploads,
+            mode=job.mode,
+            assigned_user_id=job.assigned_user_id,
+            base_url=job.base_url or "",
+            on_progress=on_progress,
+        )
+    except ReceiptPipelineError as e:
+        raise ValueError(e.detail)
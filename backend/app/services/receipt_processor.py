@@ -1,15 +1,26 @@
+import asyncio
 import json
 import os
+import time
 from decimal import Decimal, InvalidOperation
-from typing import Optional
+from typing import Optional, Tuple
 
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
     import httpx
 except ImportError:
     OpenAI = None
+    AsyncOpenAI = None
     httpx = None
 
+try:
+    import h2  # noqa: F401  (httpx usa HTTP/2 solo si h2 está instalado)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+from app.services import extraction_cache, llm_transport, openai_governor
+
 PROMPT_ITEMS = """MODO EXTRACCIÓN FISCAL UNIVERSAL (tickets, facturas, recibos) — ITEMS.
 
 Devuelve EXCLUSIVAMENTE JSON válido (sin texto antes/después).
@@ -132,7 +143,7 @@ def _to_float(value: str) -> float:
     return _to_cents(value) / 100.0
 
 
-def _get_client_and_params(mode: str, *, for_totals: bool) -> tuple:
+def _get_params(mode: str, *, for_totals: bool) -> tuple:
     mode_norm = (mode or "precise").strip().lower()
     if mode_norm == "fast":
         model = os.getenv("RECEIPT_OPENAI_MODEL_FAST") or os.getenv("RECEIPT_OPENAI_MODEL") or "gpt-4o-mini"
@@ -150,174 +161,435 @@ def _get_client_and_params(mode: str, *, for_totals: bool) -> tuple:
         # Totales suele ser más rápido; no bloquear tanto.
         timeout_total = min(timeout_total, float(os.getenv("RECEIPT_TOTAL_TIMEOUT", "120")))
 
-    use_client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        timeout=httpx.Timeout(timeout_total, connect=10.0),
-        max_retries=0,
+    return model, image_detail, timeout_total
+
+
+# Clientes compartidos por perfil (timeout): reutilizan conexiones keep-alive en lugar de
+# abrir un pool + handshake TLS nuevo en cada llamada. Se cierran en el lifespan de la app.
+_SYNC_CLIENTS: dict = {}
+_ASYNC_CLIENTS: dict = {}
+
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=int(os.getenv("RECEIPT_OPENAI_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(os.getenv("RECEIPT_OPENAI_MAX_KEEPALIVE", "10")),
+        keepalive_expiry=float(os.getenv("RECEIPT_OPENAI_KEEPALIVE_EXPIRY", "60")),
     )
-    return use_client, model, image_detail, timeout_total
 
 
-def process_receipt_items_image(image_base64: str, image_format: str = "jpeg", mode: str = "precise") -> Optional[dict]:
-    if OpenAI is None or httpx is None:
-        raise ValueError("OpenAI client no disponible (instala openai y httpx).")
+def _use_http2() -> bool:
+    return HTTP2_AVAILABLE and str(os.getenv("RECEIPT_OPENAI_HTTP2", "1")).strip().lower() not in ("0", "false", "no")
 
-    try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI API key no configurada. Define OPENAI_API_KEY en el backend.")
 
-        use_client, model, image_detail, _timeout_total = _get_client_and_params(mode, for_totals=False)
-        image_url = {"url": f"data:image/{image_format};base64,{image_base64}"}
-        if image_detail:
-            image_url["detail"] = image_detail
-
-        request_payload = dict(
-            model=model,
-            temperature=0,
-            max_tokens=int(os.getenv("RECEIPT_MAX_TOKENS_ITEMS", "4096")),
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                PROMPT_ITEMS
-                                + "\n\n"
-                                + "CRÍTICO (anti-alucinación):\n"
-                                + "- NO INVENTES items. Si no puedes leer un renglón, usa 'no legible'.\n"
-                                + "- Si no puedes ver claramente TODO el recibo en este corte, está BIEN devolver menos items.\n"
-                                + "- NUNCA rellenes con items plausibles (ej. 'tacos', 'menú', etc.).\n"
-                            ),
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": image_url,
-                        },
-                    ],
-                }
-            ],
+def _api_key():
+    # En replay no se llama a OpenAI, pero el SDK exige una llave para construir el cliente
+    return os.getenv("OPENAI_API_KEY") or ("replay-sin-llave" if llm_transport.offline() else None)
+
+
+def _get_client(timeout_total: float):
+    key = float(timeout_total)
+    client = _SYNC_CLIENTS.get(key)
+    if client is None:
+        timeout = httpx.Timeout(timeout_total, connect=10.0)
+        client = OpenAI(
+            api_key=_api_key(),
+            timeout=timeout,
+            max_retries=0,
+            http_client=httpx.Client(timeout=timeout, limits=_http_limits(), http2=_use_http2()),
+        )
+        _SYNC_CLIENTS[key] = client
+    return client
+
+
+def _get_async_client(timeout_total: float):
+    key = float(timeout_total)
+    client = _ASYNC_CLIENTS.get(key)
+    if client is None:
+        timeout = httpx.Timeout(timeout_total, connect=10.0)
+        client = AsyncOpenAI(
+            api_key=_api_key(),
+            timeout=timeout,
+            max_retries=0,
+            http_client=httpx.AsyncClient(timeout=timeout, limits=_http_limits(), http2=_use_http2()),
         )
+        _ASYNC_CLIENTS[key] = client
+    return client
+
 
-        # Forzar JSON válido cuando el modelo lo soporta. Si falla, hacer fallback.
+async def aclose_clients() -> None:
+    """Cierra los clientes compartidos (llamar al apagar la app)."""
+    for client in list(_ASYNC_CLIENTS.values()):
         try:
-            response = use_client.chat.completions.create(
-                **request_payload,
-                response_format={"type": "json_object"},
-            )
-        except Exception:
-            response = use_client.chat.completions.create(**request_payload)
+            await client.close()
+        except Exception as e:
+            print(f"⚠️ Error cerrando cliente OpenAI: {e}")
+    _ASYNC_CLIENTS.clear()
+    for client in list(_SYNC_CLIENTS.values()):
+        try:
+            client.close()
+        except Exception as e:
+            print(f"⚠️ Error cerrando cliente OpenAI: {e}")
+    _SYNC_CLIENTS.clear()
 
-        content = response.choices[0].message.content or ""
-        data = _extract_json(content)
 
-        if "items" not in data or not isinstance(data["items"], list):
-            data["items"] = []
+def _get_client_and_params(mode: str, *, for_totals: bool) -> tuple:
+    model, image_detail, timeout_total = _get_params(mode, for_totals=for_totals)
+    return _get_client(timeout_total), model, image_detail, timeout_total
 
-        try:
-            data["_meta"] = {
-                "model": model,
-                "image_detail": image_detail,
-                "finish_reason": getattr(response.choices[0], "finish_reason", None),
+
+def _get_async_client_and_params(mode: str, *, for_totals: bool) -> tuple:
+    model, image_detail, timeout_total = _get_params(mode, for_totals=for_totals)
+    return _get_async_client(timeout_total), model, image_detail, timeout_total
+
+
+def _check_available() -> None:
+    if OpenAI is None or httpx is None:
+        raise ValueError("OpenAI client no disponible (instala openai y httpx).")
+
+
+def _check_api_key() -> None:
+    if not os.getenv("OPENAI_API_KEY") and not llm_transport.offline():
+        raise ValueError("OpenAI API key no configurada. Define OPENAI_API_KEY en el backend.")
+
+
+def _image_url(image_base64: str, image_format: str, image_detail: Optional[str]) -> dict:
+    image_url = {"url": f"data:image/{image_format};base64,{image_base64}"}
+    if image_detail:
+        image_url["detail"] = image_detail
+    return image_url
+
+
+def _response_meta(response, model: str, image_detail: Optional[str]) -> dict:
+    return {
+        "model": model,
+        "image_detail": image_detail,
+        "finish_reason": getattr(response.choices[0], "finish_reason", None),
+        "total_tokens": getattr(getattr(response, "usage", None), "total_tokens", None),
+    }
+
+
+def _cache_key(kind: str, image_base64: str, request_payload: dict, image_detail: Optional[str]) -> str:
+    prompt = request_payload["messages"][0]["content"][0]["text"]
+    return extraction_cache.make_key(
+        kind,
+        image_base64,
+        extraction_cache.prompt_version(prompt),
+        request_payload["model"],
+        image_detail,
+        request_payload.get("max_tokens") or 0,
+    )
+
+
+def _cache_store(key: str, kind: str, data: dict, started: float) -> dict:
+    """Guarda el resultado en caché salvo que venga truncado/vacío (un reintento podría mejorarlo)."""
+    meta = data.get("_meta") if isinstance(data.get("_meta"), dict) else {}
+    truncated = meta.get("finish_reason") == "length"
+    empty = kind == "transcribe" and not data.get("text")
+    if not truncated and not empty:
+        extraction_cache.put(key, kind, data, time.monotonic() - started, meta.get("total_tokens") or 0)
+    if isinstance(data.get("_meta"), dict):
+        data["_meta"]["cache"] = "miss"
+    return data
+
+
+async def _acache_lookup(
+    kind: str, image_base64: str, request_payload: dict, image_detail: Optional[str], use_cache: bool = True
+) -> Tuple[str, Optional[dict]]:
+    """(llave, resultado en caché o None) en un hilo: decodificar y hacer SHA-256 de una parte de varios MB
+    y la consulta a SQLite no deben bloquear el event loop."""
+    if not extraction_cache.CACHE_ENABLED:
+        return "", None
+
+    def _lookup() -> Tuple[str, Optional[dict]]:
+        key = _cache_key(kind, image_base64, request_payload, image_detail)
+        return key, (extraction_cache.get(key) if use_cache else None)
+
+    return await asyncio.to_thread(_lookup)
+
+
+async def _acache_store(key: str, kind: str, data: dict, started: float) -> dict:
+    """`_cache_store` en un hilo (escritura y evicción en SQLite)."""
+    if not extraction_cache.CACHE_ENABLED:
+        return _cache_store(key, kind, data, started)
+    return await asyncio.to_thread(_cache_store, key, kind, data, started)
+
+
+def _friendly_error(e: Exception, timeout_hint: str, fallback_prefix: str, *, check_not_configured: bool = False) -> ValueError:
+    msg = str(e)
+    low = msg.lower()
+
+    # Mensajes más útiles para el usuario (y evitar dumps largos).
+    if "error code: 429" in low and ("quota" in low or "billing" in low):
+        return ValueError("OpenAI: se excedió la cuota/saldo de la API. Revisa Billing o agrega créditos a tu API key.")
+    if "error code: 401" in low or "invalid api key" in low:
+        return ValueError("OpenAI: API key inválida (401). Revisa la variable OPENAI_API_KEY.")
+    if check_not_configured and "api key" in low and "not configured" in low:
+        return ValueError("OpenAI: API key no configurada. Define OPENAI_API_KEY en el backend.")
+    if "request timed out" in low or "timed out" in low:
+        return ValueError(f"OpenAI: la solicitud excedió el tiempo máximo{timeout_hint}")
+    return ValueError(f"{fallback_prefix}: {e}")
+
+
+def _estimate_tokens(request_payload: dict, image_detail: Optional[str]) -> int:
+    # Imagen: "low" cuesta fijo 85; "high" depende del tamaño (una parte típica ~1100).
+    return openai_governor.estimate_tokens(request_payload, image_tokens=85 if image_detail == "low" else 1105)
+
+
+def _create(use_client, request_payload: dict, image_detail: Optional[str], *, json_mode: bool):
+    """Llamada sync a OpenAI con turno del gobernador global (respeta RPM/TPM y prioridad)."""
+    with openai_governor.slot(_estimate_tokens(request_payload, image_detail)) as ticket:
+        if json_mode:
+            # Forzar JSON válido cuando el modelo lo soporta. Si falla, hacer fallback.
+            try:
+                response = llm_transport.create(use_client, **request_payload, response_format={"type": "json_object"})
+            except Exception:
+                response = llm_transport.create(use_client, **request_payload)
+        else:
+            response = llm_transport.create(use_client, **request_payload)
+        ticket.record(response)
+        return response
+
+
+async def _acreate(use_client, request_payload: dict, image_detail: Optional[str], *, json_mode: bool):
+    """Versión async de `_create` (espera su turno sin bloquear el event loop)."""
+    async with openai_governor.aslot(_estimate_tokens(request_payload, image_detail)) as ticket:
+        if json_mode:
+            try:
+                response = await llm_transport.acreate(use_client, **request_payload, response_format={"type": "json_object"})
+            except Exception:
+                response = await llm_transport.acreate(use_client, **request_payload)
+        else:
+            response = await llm_transport.acreate(use_client, **request_payload)
+        ticket.record(response)
+        return response
+
+
+# --- ITEMS ---
+
+def _items_request(image_base64: str, image_format: str, model: str, image_detail: Optional[str]) -> dict:
+    return dict(
+        model=model,
+        temperature=0,
+        max_tokens=int(os.getenv("RECEIPT_MAX_TOKENS_ITEMS", "4096")),
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": (
+                            PROMPT_ITEMS
+                            + "\n\n"
+                            + "CRÍTICO (anti-alucinación):\n"
+                            + "- NO INVENTES items. Si no puedes leer un renglón, usa 'no legible'.\n"
+                            + "- Si no puedes ver claramente TODO el recibo en este corte, está BIEN devolver menos items.\n"
+                            + "- NUNCA rellenes con items plausibles (ej. 'tacos', 'menú', etc.).\n"
+                        ),
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": _image_url(image_base64, image_format, image_detail),
+                    },
+                ],
             }
-        except Exception:
-            pass
-
-        # Enriquecer con validación aritmética usando enteros (centavos)
-        declared_total_cents = _to_cents(data.get("amount_raw"))
-        sum_items_cents = 0
-        for it in data["items"]:
-            sum_items_cents += _to_cents(it.get("total_raw"))
-        data["arith_total_cents"] = sum_items_cents
-        data["declared_total_cents"] = declared_total_cents
-        data["arith_diff_cents"] = declared_total_cents - sum_items_cents
-
-        return data
+        ],
+    )
+
+
+def _items_result(response, model: str, image_detail: Optional[str]) -> dict:
+    content = response.choices[0].message.content or ""
+    data = _extract_json(content)
+
+    if "items" not in data or not isinstance(data["items"], list):
+        data["items"] = []
+
+    try:
+        data["_meta"] = _response_meta(response, model, image_detail)
+    except Exception:
+        pass
+
+    # Enriquecer con validación aritmética usando enteros (centavos)
+    declared_total_cents = _to_cents(data.get("amount_raw"))
+    sum_items_cents = 0
+    for it in data["items"]:
+        sum_items_cents += _to_cents(it.get("total_raw"))
+    data["arith_total_cents"] = sum_items_cents
+    data["declared_total_cents"] = declared_total_cents
+    data["arith_diff_cents"] = declared_total_cents - sum_items_cents
+
+    return data
+
+
+_ITEMS_TIMEOUT_HINT = ". Prueba modo Rápido o usa una foto más recortada/legible."
+
+
+def process_receipt_items_image(image_base64: str, image_format: str = "jpeg", mode: str = "precise") -> Optional[dict]:
+    _check_available()
+    try:
+        _check_api_key()
+        use_client, model, image_detail, _timeout_total = _get_client_and_params(mode, for_totals=False)
+        request_payload = _items_request(image_base64, image_format, model, image_detail)
+        cache_key = _cache_key("items", image_base64, request_payload, image_detail)
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+
+        response = _create(use_client, request_payload, image_detail, json_mode=True)
+
+        return _cache_store(cache_key, "items", _items_result(response, model, image_detail), started)
     except Exception as e:
-        msg = str(e)
-        low = msg.lower()
+        raise _friendly_error(e, _ITEMS_TIMEOUT_HINT, "Error procesando el recibo", check_not_configured=True)
+
+
+async def aprocess_receipt_items_image(
+    image_base64: str,
+    image_format: str = "jpeg",
+    mode: str = "precise",
+    image_detail: Optional[str] = None,
+    use_cache: bool = True,
+) -> Optional[dict]:
+    """Versión async de `process_receipt_items_image` (cliente compartido, sin hilos del executor).
+    `image_detail` fuerza el nivel de detalle (p. ej. "high" al re-extraer una parte dudosa).
+    Con `use_cache=False` no se lee el caché (re-extracción: se quiere una lectura nueva) pero el
+    resultado nuevo sí reemplaza al guardado."""
+    _check_available()
+    try:
+        _check_api_key()
+        use_client, model, default_detail, _timeout_total = _get_async_client_and_params(mode, for_totals=False)
+        image_detail = image_detail or default_detail
+        request_payload = _items_request(image_base64, image_format, model, image_detail)
+        cache_key, cached = await _acache_lookup("items", image_base64, request_payload, image_detail, use_cache)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+
+        response = await _acreate(use_client, request_payload, image_detail, json_mode=True)
+
+        return await _acache_store(cache_key, "items", _items_result(response, model, image_detail), started)
+    except Exception as e:
+        raise _friendly_error(e, _ITEMS_TIMEOUT_HINT, "Error procesando el recibo", check_not_configured=True)
+
+
+# --- TOTALES ---
+
+def _totals_request(image_base64: str, image_format: str, model: str, image_detail: Optional[str]) -> dict:
+    return dict(
+        model=model,
+        temperature=0,
+        max_tokens=int(os.getenv("RECEIPT_MAX_TOKENS_TOTALS", "900")),
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": PROMPT_TOTALS},
+                    {"type": "image_url", "image_url": _image_url(image_base64, image_format, image_detail)},
+                ],
+            }
+        ],
+    )
 
-        # Mensajes más útiles para el usuario (y evitar dumps largos).
-        if "error code: 429" in low and ("quota" in low or "billing" in low):
-            raise ValueError("OpenAI: se excedió la cuota/saldo de la API. Revisa Billing o agrega créditos a tu API key.")
-        if "error code: 401" in low or "invalid api key" in low:
-            raise ValueError("OpenAI: API key inválida (401). Revisa la variable OPENAI_API_KEY.")
-        if "api key" in low and "not configured" in low:
-            raise ValueError("OpenAI: API key no configurada. Define OPENAI_API_KEY en el backend.")
-        if "request timed out" in low or "timed out" in low:
-            raise ValueError("OpenAI: la solicitud excedió el tiempo máximo. Prueba modo Rápido o usa una foto más recortada/legible.")
 
-        raise ValueError(f"Error procesando el recibo: {e}")
+def _totals_result(response, model: str, image_detail: Optional[str]) -> dict:
+    content = response.choices[0].message.content or ""
+    data = _extract_json(content)
 
+    # Normalizar estructura mínima
+    if "taxes" not in data or not isinstance(data.get("taxes"), list):
+        data["taxes"] = []
 
-def process_receipt_totals_image(image_base64: str, image_format: str = "jpeg", mode: str = "precise") -> Optional[dict]:
-    if OpenAI is None or httpx is None:
-        raise ValueError("OpenAI client no disponible (instala openai y httpx).")
+    declared_total_cents = _to_cents(data.get("amount_raw"))
+    data["declared_total_cents"] = declared_total_cents
 
     try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI API key no configurada. Define OPENAI_API_KEY en el backend.")
+        data["_meta"] = _response_meta(response, model, image_detail)
+    except Exception:
+        pass
+
+    return data
+
 
+_TOTALS_TIMEOUT_HINT = " al leer totales. Prueba con una foto más recortada del pie del recibo."
+
+
+def process_receipt_totals_image(image_base64: str, image_format: str = "jpeg", mode: str = "precise") -> Optional[dict]:
+    _check_available()
+    try:
+        _check_api_key()
         use_client, model, image_detail, _timeout_total = _get_client_and_params(mode, for_totals=True)
-        image_url = {"url": f"data:image/{image_format};base64,{image_base64}"}
-        if image_detail:
-            image_url["detail"] = image_detail
-
-        request_payload = dict(
-            model=model,
-            temperature=0,
-            max_tokens=int(os.getenv("RECEIPT_MAX_TOKENS_TOTALS", "900")),
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": PROMPT_TOTALS},
-                        {"type": "image_url", "image_url": image_url},
-                    ],
-                }
-            ],
-        )
+        request_payload = _totals_request(image_base64, image_format, model, image_detail)
+        cache_key = _cache_key("totals", image_base64, request_payload, image_detail)
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
 
-        try:
-            response = use_client.chat.completions.create(
-                **request_payload,
-                response_format={"type": "json_object"},
-            )
-        except Exception:
-            response = use_client.chat.completions.create(**request_payload)
+        response = _create(use_client, request_payload, image_detail, json_mode=True)
 
-        content = response.choices[0].message.content or ""
-        data = _extract_json(content)
+        return _cache_store(cache_key, "totals", _totals_result(response, model, image_detail), started)
+    except Exception as e:
+        raise _friendly_error(e, _TOTALS_TIMEOUT_HINT, "Error procesando totales del recibo")
 
-        # Normalizar estructura mínima
-        if "taxes" not in data or not isinstance(data.get("taxes"), list):
-            data["taxes"] = []
 
-        declared_total_cents = _to_cents(data.get("amount_raw"))
-        data["declared_total_cents"] = declared_total_cents
+async def aprocess_receipt_totals_image(
+    image_base64: str,
+    image_format: str = "jpeg",
+    mode: str = "precise",
+    use_cache: bool = True,
+) -> Optional[dict]:
+    """Versión async de `process_receipt_totals_image` (`use_cache` como en `aprocess_receipt_items_image`)."""
+    _check_available()
+    try:
+        _check_api_key()
+        use_client, model, image_detail, _timeout_total = _get_async_client_and_params(mode, for_totals=True)
+        request_payload = _totals_request(image_base64, image_format, model, image_detail)
+        cache_key, cached = await _acache_lookup("totals", image_base64, request_payload, image_detail, use_cache)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
 
-        try:
-            data["_meta"] = {
-                "model": model,
-                "image_detail": image_detail,
-                "finish_reason": getattr(response.choices[0], "finish_reason", None),
-            }
-        except Exception:
-            pass
+        response = await _acreate(use_client, request_payload, image_detail, json_mode=True)
 
-        return data
+        return await _acache_store(cache_key, "totals", _totals_result(response, model, image_detail), started)
     except Exception as e:
-        msg = str(e)
-        low = msg.lower()
-        if "error code: 429" in low and ("quota" in low or "billing" in low):
-            raise ValueError("OpenAI: se excedió la cuota/saldo de la API. Revisa Billing o agrega créditos a tu API key.")
-        if "error code: 401" in low or "invalid api key" in low:
-            raise ValueError("OpenAI: API key inválida (401). Revisa la variable OPENAI_API_KEY.")
-        if "request timed out" in low or "timed out" in low:
-            raise ValueError("OpenAI: la solicitud excedió el tiempo máximo al leer totales. Prueba con una foto más recortada del pie del recibo.")
-        raise ValueError(f"Error procesando totales del recibo: {e}")
+        raise _friendly_error(e, _TOTALS_TIMEOUT_HINT, "Error procesando totales del recibo")
+
+
+# --- TRANSCRIPCIÓN ---
+
+def _transcribe_request(image_base64: str, image_format: str, model: str) -> tuple:
+    # Reutilizar selección de modelo por modo, pero forzar detalle alto para OCR visual.
+    image_detail = os.getenv("RECEIPT_IMAGE_DETAIL_TRANSCRIBE") or "high"
+    model = os.getenv("RECEIPT_OPENAI_MODEL_TRANSCRIBE") or model
+    payload = dict(
+        model=model,
+        temperature=0,
+        max_tokens=int(os.getenv("RECEIPT_MAX_TOKENS_TRANSCRIBE", "4096")),
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": PROMPT_TRANSCRIBE},
+                    {"type": "image_url", "image_url": _image_url(image_base64, image_format, image_detail)},
+                ],
+            }
+        ],
+    )
+    return payload, model, image_detail
+
+
+def _transcribe_result(response, model: str, image_detail: Optional[str]) -> dict:
+    text = (response.choices[0].message.content or "").strip()
+    data = {"text": text}
+    try:
+        data["_meta"] = _response_meta(response, model, image_detail)
+    except Exception:
+        pass
+    return data
+
+
+_TRANSCRIBE_TIMEOUT_HINT = " al transcribir. Intenta con una foto más recortada/legible."
 
 
 def transcribe_receipt_image(image_base64: str, image_format: str = "jpeg", mode: str = "precise") -> Optional[dict]:
@@ -325,58 +597,37 @@ def transcribe_receipt_image(image_base64: str, image_format: str = "jpeg", mode
     Transcribe el texto del recibo como texto plano (sin JSON).
     Útil como fallback cuando el JSON estructurado falla o cuando se requiere máxima fidelidad de texto.
     """
-    if OpenAI is None or httpx is None:
-        raise ValueError("OpenAI client no disponible (instala openai y httpx).")
-
+    _check_available()
     try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI API key no configurada. Define OPENAI_API_KEY en el backend.")
-
-        # Reutilizar selección de modelo por modo, pero forzar detalle alto para OCR visual.
+        _check_api_key()
         use_client, model, _image_detail, _timeout_total = _get_client_and_params(mode, for_totals=False)
-        image_detail = os.getenv("RECEIPT_IMAGE_DETAIL_TRANSCRIBE") or "high"
-
-        image_url = {"url": f"data:image/{image_format};base64,{image_base64}"}
-        if image_detail:
-            image_url["detail"] = image_detail
-
-        response = use_client.chat.completions.create(
-            model=os.getenv("RECEIPT_OPENAI_MODEL_TRANSCRIBE") or model,
-            temperature=0,
-            max_tokens=int(os.getenv("RECEIPT_MAX_TOKENS_TRANSCRIBE", "4096")),
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": PROMPT_TRANSCRIBE},
-                        {"type": "image_url", "image_url": image_url},
-                    ],
-                }
-            ],
-        )
+        request_payload, model, image_detail = _transcribe_request(image_base64, image_format, model)
+        cache_key = _cache_key("transcribe", image_base64, request_payload, image_detail)
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+        response = _create(use_client, request_payload, image_detail, json_mode=False)
+        return _cache_store(cache_key, "transcribe", _transcribe_result(response, model, image_detail), started)
+    except Exception as e:
+        raise _friendly_error(e, _TRANSCRIBE_TIMEOUT_HINT, "Error transcribiendo el recibo")
 
-        text = (response.choices[0].message.content or "").strip()
-        data = {"text": text}
-        try:
-            data["_meta"] = {
-                "model": os.getenv("RECEIPT_OPENAI_MODEL_TRANSCRIBE") or model,
-                "image_detail": image_detail,
-                "finish_reason": getattr(response.choices[0], "finish_reason", None),
-            }
-        except Exception:
-            pass
-        return data
+
+async def atranscribe_receipt_image(image_base64: str, image_format: str = "jpeg", mode: str = "precise") -> Optional[dict]:
+    """Versión async de `transcribe_receipt_image`."""
+    _check_available()
+    try:
+        _check_api_key()
+        use_client, model, _image_detail, _timeout_total = _get_async_client_and_params(mode, for_totals=False)
+        request_payload, model, image_detail = _transcribe_request(image_base64, image_format, model)
+        cache_key, cached = await _acache_lookup("transcribe", image_base64, request_payload, image_detail)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+        response = await _acreate(use_client, request_payload, image_detail, json_mode=False)
+        return await _acache_store(cache_key, "transcribe", _transcribe_result(response, model, image_detail), started)
     except Exception as e:
-        msg = str(e)
-        low = msg.lower()
-        if "error code: 429" in low and ("quota" in low or "billing" in low):
-            raise ValueError("OpenAI: se excedió la cuota/saldo de la API. Revisa Billing o agrega créditos a tu API key.")
-        if "error code: 401" in low or "invalid api key" in low:
-            raise ValueError("OpenAI: API key inválida (401). Revisa la variable OPENAI_API_KEY.")
-        if "request timed out" in low or "timed out" in low:
-            raise ValueError("OpenAI: la solicitud excedió el tiempo máximo al transcribir. Intenta con una foto más recortada/legible.")
-        raise ValueError(f"Error transcribiendo el recibo: {e}")
+        raise _friendly_error(e, _TRANSCRIBE_TIMEOUT_HINT, "Error transcribiendo el recibo")
 
 
 # Alias anterior (para no romper imports existentes)
@@ -0,0 +1,273 @@
+"""
+Caché de respuestas de lectura por familia, validada con la versión de datos de la familia.
+
+La llave es (endpoint, familia, parámetros[, usuario], día) y cada entrada guarda la versión de
+family_data_versions con la que se armó. Al leer se consulta la versión actual (una lectura por llave
+primaria): si coincide se regresa lo guardado; si no, se arma de nuevo y se reemplaza. No hay que
+invalidar nada a mano: cualquier escritura a presupuestos, transacciones, asignaciones o categorías
+personalizadas sube la versión en su misma transacción (app/services/family_versions.py). El día entra
+en la llave porque los endpoints usan el año actual por omisión y marcan vencimientos contra hoy.
+
+Backends (RESPONSE_CACHE_BACKEND):
+- memory: LRU en memoria del proceso (RESPONSE_CACHE_MAX_ENTRIES).
+- sqlite: archivo SQLite local compartido por todos los workers del servidor (RESPONSE_CACHE_PATH),
+  con evicción LRU por tamaño (RESPONSE_CACHE_MAX_MB).
+
+Se usa como decorador debajo de @router.get; la respuesta se guarda ya convertida a JSON (con el
+response_model del endpoint si lo tiene) y es lo que se regresa, con o sin acierto.
+"""
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from pydantic import TypeAdapter
+
+from app.services import family_versions
+
+RESPONSE_CACHE_ENABLED = str(os.getenv("RESPONSE_CACHE_ENABLED", "1")).strip().lower() not in ("0", "false", "no")
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").strip().lower()
+RESPONSE_CACHE_MAX_ENTRIES = max(1, int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000")))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH") or str(Path(__file__).resolve().parents[2] / "response_cache.db")
+RESPONSE_CACHE_MAX_BYTES = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "100")) * 1024 * 1024)
+
+_ANY = TypeAdapter(Any)
+
+
+class MemoryBackend:
+    """LRU en memoria: llave -> (versión, valor)."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Tuple[int, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, version: int, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "evictions": self.evictions}
+
+
+class SQLiteBackend:
+    """Archivo SQLite compartido entre workers (WAL), evicción LRU por tamaño total."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_last_access ON responses (last_access)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[int, Any]]:
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute("SELECT version, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        return int(row[0]), json.loads(row[1])
+
+    def put(self, key: str, version: int, value: Any) -> None:
+        text = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, version, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, version, text, len(text.encode("utf-8")), time.time()),
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Al pasar el límite, borrar lo menos usado hasta quedar en ~90%."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] or 0
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        to_delete = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            if total <= target:
+                break
+            to_delete.append((key,))
+            total -= size or 0
+        conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self.evictions += len(to_delete)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._get_conn().execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self._get_conn().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"entries": entries, "size_bytes": size, "max_bytes": self.max_bytes, "path": self.path,
+                "evictions": self.evictions}
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        # Contadores del proceso por endpoint
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def _count(self, endpoint: str, field: str, amount: float = 1) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(
+                endpoint, {"hits": 0, "misses": 0, "stale": 0, "errors": 0, "build_seconds": 0.0}
+            )
+            stats[field] += amount
+
+    def get_or_build(self, endpoint: str, family_id: int, version: int, params: Dict[str, Any],
+                     build: Callable[[], Any]) -> Any:
+        """Valor guardado si se armó con `version`; si no, build() (ya en JSON) y se guarda."""
+        key = f"{endpoint}|{family_id}|{json.dumps(params, sort_keys=True, default=str)}"
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f"⚠️ Caché de respuestas no disponible (get): {e}")
+            self._count(endpoint, "errors")
+            entry = None
+        if entry is not None and entry[0] == version:
+            self._count(endpoint, "hits")
+            return entry[1]
+        self._count(endpoint, "misses")
+        if entry is not None:
+            self._count(endpoint, "stale")
+        started = time.perf_counter()
+        value = build()
+        self._count(endpoint, "build_seconds", time.perf_counter() - started)
+        try:
+            self.backend.put(key, version, value)
+        except Exception as e:
+            print(f"⚠️ Caché de respuestas no disponible (put): {e}")
+            self._count(endpoint, "errors")
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {name: dict(values) for name, values in self._stats.items()}
+        hits = misses = 0
+        for values in endpoints.values():
+            lookups = values["hits"] + values["misses"]
+            values["hit_ratio"] = round(values["hits"] / lookups, 4) if lookups else 0.0
+            values["avg_build_ms"] = round(values["build_seconds"] * 1000 / values["misses"], 2) if values["misses"] else 0.0
+            values["build_seconds"] = round(values["build_seconds"], 3)
+            hits += values["hits"]
+            misses += values["misses"]
+        out: Dict[str, Any] = {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "backend": self.backend.name,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "endpoints": endpoints,
+        }
+        try:
+            out.update(self.backend.info())
+        except Exception as e:
+            out["error"] = str(e)
+        return out
+
+
+def _make_backend():
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        return SQLiteBackend()
+    if RESPONSE_CACHE_BACKEND != "memory":
+        print(f"⚠️ RESPONSE_CACHE_BACKEND desconocido ({RESPONSE_CACHE_BACKEND}), se usa memory")
+    return MemoryBackend()
+
+
+response_cache = ResponseCache(_make_backend())
+
+
+def cached(endpoint: str, response_model: Any = None, per_user: bool = False):
+    """
+    Decorador para endpoints de lectura con `db` y `current_user` (va debajo de @router.get). Los
+    demás parámetros del endpoint entran en la llave; per_user=True para respuestas que dependen de
+    quién pregunta y no solo de su familia. Sin familia (o con la caché apagada) llama al endpoint tal cual.
+    """
+    adapter = TypeAdapter(response_model) if response_model is not None else _ANY
+
+    def encode(result: Any) -> Any:
+        if response_model is not None:
+            result = adapter.validate_python(result, from_attributes=True)
+        return adapter.dump_python(result, mode="json")
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            db = kwargs.get("db")
+            current_user = kwargs.get("current_user")
+            family_id = getattr(current_user, "family_id", None)
+            if not RESPONSE_CACHE_ENABLED or db is None or family_id is None:
+                return fn(*args, **kwargs)
+            params = {k: v for k, v in kwargs.items() if k not in ("db", "current_user")}
+            params["_day"] = date.today().isoformat()
+            if per_user:
+                params["_user"] = current_user.id
+            version = family_versions.current(db, family_id)
+            return response_cache.get_or_build(
+                endpoint, family_id, version, params, lambda: encode(fn(*args, **kwargs))
+            )
+        return wrapper
+    return decorator
+
+
+def stats() -> Dict[str, Any]:
+    return response_cache.stats()
@@ -0,0 +1,474 @@
+"""
+Agregados mensuales de transacciones (tablas monthly_spending y budget_rollups).
+
+- monthly_spending: una fila por (usuario, año, mes, categoría, subcategoría, categoría/subcategoría
+  personalizada) con la familia del usuario.
+- budget_rollups: una fila por (presupuesto familiar, usuario, año, mes) con la familia del presupuesto;
+  solo transacciones con family_budget_id.
+
+Ambas guardan totales y conteos de egresos e ingresos y se mantienen con eventos de la sesión de
+SQLAlchemy: cada alta, cambio o baja de un Transaction aplica su diferencia con un upsert atómico dentro
+de la MISMA transacción, venga de donde venga (routers, importación de Excel, recibos). En el mismo paso
+se ajusta user_budgets.spent_amount con la diferencia de egresos de su (presupuesto, usuario), así que
+ningún router lo toca a mano. Las lecturas (resumen de presupuestos, presupuestos personales, tablero,
+comandos de WhatsApp) suman unas cuantas filas por índice en lugar de recorrer transactions.
+
+Los borrados y cambios masivos (query(...).delete()/update()) no pasan por el flush: un evento
+do_orm_execute lee antes de ejecutarlos, con su mismo WHERE, las filas que tocan y aplica la diferencia
+(un borrado de toda la tabla vacía los agregados). Las filas que se quedan sin transacciones se borran,
+para no dejar agregados huérfanos que impidan borrar el presupuesto o el usuario por la llave foránea.
+rebuild() recalcula cada tabla con un solo INSERT ... SELECT agrupado (rebuild_rollups.py), p. ej. tras
+cargar o borrar transacciones con SQL directo.
+
+No importa app.models a nivel de módulo (models importa este módulo para registrar los eventos).
+"""
+import enum
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import String, case, cast, delete, event, extract, func, insert, select, update
+from sqlalchemy.orm import Session
+
+# Columnas de Transaction que cambian el agregado
+_TRACKED = (
+    "user_id", "date", "amount", "transaction_type",
+    "category", "subcategory", "custom_category_id", "custom_subcategory_id", "family_budget_id",
+)
+_KEY_COLUMNS = (
+    "user_id", "year", "month", "category", "subcategory", "custom_category_id", "custom_subcategory_id",
+)
+_BUDGET_KEY_COLUMNS = ("family_budget_id", "user_id", "year", "month")
+_TOTAL_COLUMNS = ("expense_total", "income_total", "expense_count", "income_count")
+_PENDING_KEY = "spending_rollups_pending"
+
+# (user_id, year, month, category, subcategory, custom_category_id, custom_subcategory_id)
+RollupKey = Tuple[int, int, int, str, str, int, int]
+# (family_budget_id, user_id, year, month)
+BudgetKey = Tuple[int, int, int, int]
+# Diferencias por tabla: {"monthly": {RollupKey: [...]}, "budget": {BudgetKey: [...]}}, cada una
+# [egreso, ingreso, n_egresos, n_ingresos]
+Deltas = Dict[str, Dict[tuple, List[float]]]
+
+
+def enum_name(value: Any, enum_cls) -> str:
+    """Nombre del enum tal como lo guarda SQLEnum en transactions ("" si no hay)."""
+    if value is None or value == "":
+        return ""
+    if isinstance(value, enum.Enum):
+        return value.name
+    text = str(value)
+    if text in enum_cls.__members__:
+        return text
+    for member in enum_cls:
+        if member.value == text:
+            return member.name
+    return text
+
+
+def _period(value: Any) -> Optional[Tuple[int, int]]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    return value.year, value.month
+
+
+def _is_income(transaction_type: Any) -> bool:
+    from app import models
+    return getattr(transaction_type, "value", transaction_type) == models.TransactionType.INCOME.value
+
+
+def _row_key(values: Dict[str, Any]) -> Optional[RollupKey]:
+    from app import models
+    period = _period(values.get("date"))
+    if period is None or values.get("user_id") is None:
+        return None
+    return (
+        values["user_id"], period[0], period[1],
+        enum_name(values.get("category"), models.Category),
+        enum_name(values.get("subcategory"), models.Subcategory),
+        values.get("custom_category_id") or 0,
+        values.get("custom_subcategory_id") or 0,
+    )
+
+
+def _new_deltas() -> Deltas:
+    return {"monthly": defaultdict(lambda: [0.0, 0.0, 0, 0]), "budget": defaultdict(lambda: [0.0, 0.0, 0, 0])}
+
+
+def _accumulate(deltas: Deltas, values: Dict[str, Any], sign: int) -> None:
+    key = _row_key(values)
+    if key is None:
+        return
+    amount = float(values.get("amount") or 0.0)
+    targets = [deltas["monthly"][key]]
+    if values.get("family_budget_id"):
+        targets.append(deltas["budget"][(values["family_budget_id"], key[0], key[1], key[2])])
+    income = _is_income(values.get("transaction_type"))
+    for d in targets:
+        if income:
+            d[1] += sign * amount
+            d[3] += sign
+        else:
+            d[0] += sign * amount
+            d[2] += sign
+
+
+def _tracked_changed(obj) -> bool:
+    from sqlalchemy import inspect as sa_inspect
+    state = sa_inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in _TRACKED)
+
+
+@event.listens_for(Session, "before_flush")
+def _capture_before_flush(session: Session, flush_context, instances) -> None:
+    """
+    Antes de escribir: los valores que hoy tiene la BD (cambios y bajas) se restan. Se leen de la BD y
+    no del historial del objeto porque un atributo asignado sin cargar no conserva su valor anterior.
+    """
+    from app import models
+    new = [o for o in session.new if isinstance(o, models.Transaction)]
+    dirty = [o for o in session.dirty if isinstance(o, models.Transaction) and _tracked_changed(o)]
+    deleted = [o for o in session.deleted if isinstance(o, models.Transaction)]
+    if not (new or dirty or deleted):
+        return
+
+    deltas = _new_deltas()
+    old_ids = [o.id for o in dirty + deleted if o.id is not None]
+    if old_ids:
+        table = models.Transaction.__table__
+        # Core sobre la conexión: no dispara otro autoflush
+        rows = session.connection().execute(
+            select(*[table.c[name] for name in _TRACKED]).where(table.c.id.in_(old_ids))
+        ).mappings().all()
+        for row in rows:
+            _accumulate(deltas, dict(row), -1)
+    session.info.setdefault(_PENDING_KEY, []).append((deltas, new + dirty))
+
+
+@event.listens_for(Session, "after_flush")
+def _apply_after_flush(session: Session, flush_context) -> None:
+    """Después de escribir (ids ya asignados): se suman los valores nuevos y se aplica todo en la misma transacción."""
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    deltas = _new_deltas()
+    for captured, objects in pending:
+        for kind, changes in captured.items():
+            for key, d in changes.items():
+                for i, v in enumerate(d):
+                    deltas[kind][key][i] += v
+        for obj in objects:
+            _accumulate(deltas, {name: getattr(obj, name) for name in _TRACKED}, +1)
+    apply_deltas(session.connection(), deltas)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _current_values(connection, where) -> List[Dict[str, Any]]:
+    from app import models
+    table = models.Transaction.__table__
+    query = select(*[table.c[name] for name in _TRACKED])
+    if where is not None:
+        query = query.where(where)
+    return [dict(row) for row in connection.execute(query).mappings().all()]
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _apply_on_bulk_write(orm_execute_state) -> None:
+    """query(Transaction)...delete()/update(): se restan las filas afectadas y, en un update, se suman de nuevo."""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+    from app import models
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not models.Transaction:
+        return
+    connection = orm_execute_state.session.connection()
+    where = orm_execute_state.statement.whereclause
+    if orm_execute_state.is_delete and where is None:
+        _clear(connection)
+        return
+    table = models.Transaction.__table__
+    ids = [row[0] for row in connection.execute(
+        select(table.c.id).where(where) if where is not None else select(table.c.id)
+    ).all()]
+    if not ids:
+        return
+    deltas = _new_deltas()
+    for values in _current_values(connection, table.c.id.in_(ids)):
+        _accumulate(deltas, values, -1)
+    if orm_execute_state.is_delete:
+        apply_deltas(connection, deltas)
+        return
+    result = orm_execute_state.invoke_statement()
+    for values in _current_values(connection, table.c.id.in_(ids)):
+        _accumulate(deltas, values, +1)
+    apply_deltas(connection, deltas)
+    return result
+
+
+def _changed(deltas: Dict[tuple, List[float]]) -> Dict[tuple, List[float]]:
+    return {k: d for k, d in deltas.items() if any(abs(v) > 1e-9 for v in d)}
+
+
+def _upsert(connection, table, key_columns, values: Dict[str, Any]) -> None:
+    """Inserta la fila o suma sus totales a la existente (atómico ante escrituras concurrentes)."""
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table).values(**values)
+        set_ = {name: table.c[name] + stmt.excluded[name] for name in _TOTAL_COLUMNS}
+        set_.update(family_id=stmt.excluded.family_id, updated_at=func.now())
+        connection.execute(stmt.on_conflict_do_update(index_elements=list(key_columns), set_=set_))
+        return
+    # Otros motores: UPDATE y, si no existía la fila, INSERT
+    where = [table.c[name] == values[name] for name in key_columns]
+    set_ = {name: table.c[name] + values[name] for name in _TOTAL_COLUMNS}
+    result = connection.execute(update(table).where(*where).values(family_id=values["family_id"], **set_))
+    if not result.rowcount:
+        connection.execute(insert(table).values(**values))
+
+
+def _delete_empty(connection, table, key_columns, keys) -> None:
+    """Borra las filas de esas llaves que ya no cuentan ninguna transacción."""
+    for key in keys:
+        connection.execute(delete(table).where(
+            *[table.c[name] == value for name, value in zip(key_columns, key)],
+            table.c.expense_count <= 0, table.c.income_count <= 0,
+        ))
+
+
+def _totals(d: List[float]) -> Dict[str, Any]:
+    expense, income, expense_n, income_n = d
+    return {"expense_total": expense, "income_total": income, "expense_count": int(expense_n), "income_count": int(income_n)}
+
+
+def apply_deltas(connection, deltas: Deltas) -> None:
+    """Suma las diferencias a monthly_spending y budget_rollups, y las de egresos a user_budgets.spent_amount."""
+    from app import models
+    monthly = _changed(deltas.get("monthly", {}))
+    if monthly:
+        users = models.User.__table__
+        families = dict(connection.execute(
+            select(users.c.id, users.c.family_id).where(users.c.id.in_({k[0] for k in monthly}))
+        ).all())
+        table = models.MonthlySpending.__table__
+        for key, d in monthly.items():
+            values = dict(zip(_KEY_COLUMNS, key), family_id=families.get(key[0]), **_totals(d))
+            _upsert(connection, table, _KEY_COLUMNS, values)
+        _delete_empty(connection, table, _KEY_COLUMNS, [k for k, d in monthly.items() if d[2] + d[3] < 0])
+
+    budget = _changed(deltas.get("budget", {}))
+    if not budget:
+        return
+    budgets = models.FamilyBudget.__table__
+    families = dict(connection.execute(
+        select(budgets.c.id, budgets.c.family_id).where(budgets.c.id.in_({k[0] for k in budget}))
+    ).all())
+    table = models.BudgetRollup.__table__
+    spent: Dict[Tuple[int, int], float] = defaultdict(float)
+    for key, d in budget.items():
+        values = dict(zip(_BUDGET_KEY_COLUMNS, key), family_id=families.get(key[0]), **_totals(d))
+        _upsert(connection, table, _BUDGET_KEY_COLUMNS, values)
+        spent[(key[0], key[1])] += d[0]
+    _delete_empty(connection, table, _BUDGET_KEY_COLUMNS, [k for k, d in budget.items() if d[2] + d[3] < 0])
+    user_budgets = models.UserBudget.__table__
+    for (budget_id, user_id), amount in spent.items():
+        if abs(amount) > 1e-9:
+            connection.execute(update(user_budgets).where(
+                user_budgets.c.family_budget_id == budget_id, user_budgets.c.user_id == user_id,
+            ).values(spent_amount=func.coalesce(user_budgets.c.spent_amount, 0.0) + amount))
+
+
+def _clear(connection) -> None:
+    from app import models
+    connection.execute(delete(models.MonthlySpending.__table__))
+    connection.execute(delete(models.BudgetRollup.__table__))
+    connection.execute(update(models.UserBudget.__table__).values(spent_amount=0.0))
+
+
+def clear(db: Session) -> None:
+    """Vacía los agregados y pone en cero lo gastado (sin transacciones, p. ej. tras borrarlas con SQL directo)."""
+    _clear(db.connection())
+
+
+def _grouped_totals(is_income, amount) -> list:
+    return [
+        func.sum(case((is_income, 0.0), else_=amount)),
+        func.sum(case((is_income, amount), else_=0.0)),
+        func.sum(case((is_income, 0), else_=1)),
+        func.sum(case((is_income, 1), else_=0)),
+    ]
+
+
+def _rebuild_monthly(db: Session) -> int:
+    from app import models
+    t = models.Transaction.__table__
+    u = models.User.__table__
+    table = models.MonthlySpending.__table__
+    is_income = t.c.transaction_type == models.TransactionType.INCOME.value
+    year = extract("year", t.c.date)
+    month = extract("month", t.c.date)
+    category = func.coalesce(cast(t.c.category, String), "")
+    subcategory = func.coalesce(cast(t.c.subcategory, String), "")
+    custom_category = func.coalesce(t.c.custom_category_id, 0)
+    custom_subcategory = func.coalesce(t.c.custom_subcategory_id, 0)
+    grouped = select(
+        t.c.user_id, u.c.family_id, year, month, category, subcategory, custom_category, custom_subcategory,
+        *_grouped_totals(is_income, t.c.amount),
+    ).select_from(t.join(u, u.c.id == t.c.user_id)).group_by(
+        t.c.user_id, u.c.family_id, year, month, category, subcategory, custom_category, custom_subcategory,
+    )
+    db.execute(delete(table))
+    db.execute(insert(table).from_select([
+        "user_id", "family_id", "year", "month", "category", "subcategory",
+        "custom_category_id", "custom_subcategory_id", *_TOTAL_COLUMNS,
+    ], grouped))
+    return db.query(func.count(table.c.id)).scalar() or 0
+
+
+def _rebuild_budgets(db: Session) -> int:
+    from app import models
+    t = models.Transaction.__table__
+    b = models.FamilyBudget.__table__
+    table = models.BudgetRollup.__table__
+    is_income = t.c.transaction_type == models.TransactionType.INCOME.value
+    year = extract("year", t.c.date)
+    month = extract("month", t.c.date)
+    grouped = select(
+        t.c.family_budget_id, t.c.user_id, b.c.family_id, year, month,
+        *_grouped_totals(is_income, t.c.amount),
+    ).select_from(t.join(b, b.c.id == t.c.family_budget_id)).group_by(
+        t.c.family_budget_id, t.c.user_id, b.c.family_id, year, month,
+    )
+    db.execute(delete(table))
+    db.execute(insert(table).from_select(
+        ["family_budget_id", "user_id", "family_id", "year", "month", *_TOTAL_COLUMNS], grouped,
+    ))
+    # spent_amount de cada asignación = sus egresos acumulados en el agregado
+    ub = models.UserBudget.__table__
+    db.execute(update(ub).values(spent_amount=func.coalesce(
+        select(func.sum(table.c.expense_total)).where(
+            table.c.family_budget_id == ub.c.family_budget_id, table.c.user_id == ub.c.user_id,
+        ).scalar_subquery(),
+        0.0,
+    )))
+    return db.query(func.count(table.c.id)).scalar() or 0
+
+
+def rebuild(db: Session) -> Dict[str, int]:
+    """
+    Recalcula monthly_spending y budget_rollups desde transactions (un INSERT ... SELECT agrupado por
+    tabla) y sincroniza user_budgets.spent_amount, dentro de la transacción de `db` (el llamador hace
+    commit). Regresa cuántas filas quedaron en cada tabla.
+    """
+    return {"monthly_spending": _rebuild_monthly(db), "budget_rollups": _rebuild_budgets(db)}
+
+
+# --- Lecturas ---
+
+def month_totals(db: Session, year: int, month: int, *, user_id: Optional[int] = None,
+                 family_id: Optional[int] = None) -> Dict[str, float]:
+    """Totales del mes de un usuario o de una familia (una consulta por índice)."""
+    from app import models
+    ms = models.MonthlySpending
+    q = db.query(
+        func.coalesce(func.sum(ms.expense_total), 0.0),
+        func.coalesce(func.sum(ms.income_total), 0.0),
+        func.coalesce(func.sum(ms.expense_count), 0),
+        func.coalesce(func.sum(ms.income_count), 0),
+    ).filter(ms.year == year, ms.month == month)
+    q = q.filter(ms.user_id == user_id) if user_id is not None else q.filter(ms.family_id == family_id)
+    expense, income, expense_n, income_n = q.one()
+    return {"expense": float(expense), "income": float(income), "expense_count": int(expense_n), "income_count": int(income_n)}
+
+
+def category_totals(db: Session, year: int, month: int, *, user_id: Optional[int] = None,
+                    family_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Egresos/ingresos del mes por categoría y subcategoría (de mayor a menor egreso)."""
+    from app import models
+    ms = models.MonthlySpending
+    q = db.query(
+        ms.category, ms.subcategory, ms.custom_category_id, ms.custom_subcategory_id,
+        func.sum(ms.expense_total), func.sum(ms.income_total), func.sum(ms.expense_count),
+    ).filter(ms.year == year, ms.month == month)
+    q = q.filter(ms.user_id == user_id) if user_id is not None else q.filter(ms.family_id == family_id)
+    rows = q.group_by(ms.category, ms.subcategory, ms.custom_category_id, ms.custom_subcategory_id).all()
+    out = [
+        {
+            "category": cat, "subcategory": sub,
+            "custom_category_id": ccat or None, "custom_subcategory_id": csub or None,
+            "expense": float(expense or 0.0), "income": float(income or 0.0), "count": int(count or 0),
+        }
+        for cat, sub, ccat, csub, expense, income, count in rows
+    ]
+    out.sort(key=lambda r: r["expense"], reverse=True)
+    return out
+
+
+def year_totals(db: Session, year: int, *, family_id: Optional[int] = None,
+                user_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Egresos/ingresos de un año por mes y concepto (categoría, subcategoría y personalizadas), en una
+    sola consulta que recorre solo las filas del año por el índice (family_id, year, month): el costo
+    no crece con los años de historia.
+    """
+    from app import models
+    ms = models.MonthlySpending
+    q = db.query(
+        ms.month, ms.category, ms.subcategory, ms.custom_category_id, ms.custom_subcategory_id,
+        func.sum(ms.expense_total), func.sum(ms.income_total), func.sum(ms.expense_count + ms.income_count),
+    ).filter(ms.year == year)
+    q = q.filter(ms.user_id == user_id) if user_id is not None else q.filter(ms.family_id == family_id)
+    rows = q.group_by(ms.month, ms.category, ms.subcategory, ms.custom_category_id, ms.custom_subcategory_id).all()
+    return [
+        {
+            "month": int(month), "category": cat, "subcategory": sub,
+            "custom_category_id": ccat or None, "custom_subcategory_id": csub or None,
+            "expense": float(expense or 0.0), "income": float(income or 0.0), "count": int(count or 0),
+        }
+        for month, cat, sub, ccat, csub, expense, income, count in rows
+    ]
+
+
+def budget_totals(db: Session, budget_ids, *, user_id: Optional[int] = None, by_user: bool = False,
+                  year: Optional[int] = None, month: Optional[int] = None) -> Dict[Any, Dict[str, float]]:
+    """
+    Totales por presupuesto desde budget_rollups en una sola consulta agrupada: {budget_id: {...}}, o
+    {(budget_id, user_id): {...}} con by_user. Opcionalmente solo un usuario, año o mes.
+    """
+    from app import models
+    br = models.BudgetRollup
+    budget_ids = list(budget_ids)
+    if not budget_ids:
+        return {}
+    group = [br.family_budget_id, br.user_id] if by_user else [br.family_budget_id]
+    q = db.query(
+        *group,
+        func.sum(br.expense_total), func.sum(br.income_total), func.sum(br.expense_count), func.sum(br.income_count),
+    ).filter(br.family_budget_id.in_(budget_ids))
+    if user_id is not None:
+        q = q.filter(br.user_id == user_id)
+    if year is not None:
+        q = q.filter(br.year == year)
+    if month is not None:
+        q = q.filter(br.month == month)
+    out: Dict[Any, Dict[str, float]] = {}
+    for row in q.group_by(*group).all():
+        key = (row[0], row[1]) if by_user else row[0]
+        expense, income, expense_n, income_n = row[-4:]
+        out[key] = {
+            "expense": float(expense or 0.0), "income": float(income or 0.0),
+            "expense_count": int(expense_n or 0), "income_count": int(income_n or 0),
+        }
+    return out
@@ -0,0 +1,232 @@
+"""
+Registro de cambios para la sincronización incremental (tabla sync_changes, GET /api/sync).
+
+Cada entidad sincronizable tiene a lo más una fila por familia con la secuencia en la que cambió por
+última vez y si fue borrada (tombstone). La secuencia es la versión de family_data_versions: sube en la
+misma transacción que la escritura y la fila de la familia queda bloqueada hasta el commit, así que es
+monótona por familia y un cliente que guarda la última que recibió puede pedir solo lo posterior.
+
+family_versions llama record() desde sus eventos de sesión (flush y escrituras masivas) con las
+entidades cambiadas, sus familias y la versión nueva. Las asignaciones (user_budgets) también se
+registran cuando cambia una transacción de su (presupuesto, usuario), porque spending_rollups les
+ajusta spent_amount con SQL directo. En transacciones, recibos y conceptos se acumulan los usuarios que
+han sido sus dueños (user_ids): a cada miembro solo le llega lo suyo, y lo que dejó de ser suyo como borrado.
+
+No importa app.models a nivel de módulo (models importa family_versions, que importa este módulo).
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, func, insert, null, or_, select, update
+from sqlalchemy.orm import Session
+
+# Nombre de la entidad en sync_changes / GET /api/sync -> modelo
+ENTITIES = {
+    "transactions": "Transaction",
+    "receipts": "Receipt",
+    "receipt_items": "ReceiptItem",
+    "family_budgets": "FamilyBudget",
+    "user_budgets": "UserBudget",
+    "custom_categories": "CustomCategory",
+    "custom_subcategories": "CustomSubcategory",
+}
+_ENTITY_OF = {model: entity for entity, model in ENTITIES.items()}
+# Entidades de un solo miembro (sus listados filtran por usuario): cada fila guarda sus dueños en user_ids
+USER_SCOPED = ("transactions", "receipts", "receipt_items")
+
+# (modelo, id, {tipo de referencia: {ids}}, {familias}, borrado)
+Change = Tuple[str, int, Dict[str, Set[int]], Set[int], bool]
+
+
+def derived(connection, changes: Iterable[Change]) -> List[Change]:
+    """Asignaciones cuyo spent_amount/ingresos mueve un cambio de transacción (valores actuales y anteriores)."""
+    pairs: Set[Tuple[int, int]] = set()
+    for model, _, refs, _, _ in changes:
+        if model == "Transaction":
+            pairs.update((b, u) for b in refs.get("budget", ()) for u in refs.get("user", ()))
+    if not pairs:
+        return []
+    from app import models
+    ub = models.UserBudget.__table__
+    fb = models.FamilyBudget.__table__
+    rows = connection.execute(
+        select(ub.c.id, ub.c.family_budget_id, ub.c.user_id, fb.c.family_id)
+        .select_from(ub.join(fb, fb.c.id == ub.c.family_budget_id))
+        .where(ub.c.family_budget_id.in_({b for b, _ in pairs}))
+    ).all()
+    return [
+        ("UserBudget", ub_id, {"budget": {budget_id}, "user": {user_id}}, {family_id}, False)
+        for ub_id, budget_id, user_id, family_id in rows
+        if (budget_id, user_id) in pairs and family_id is not None
+    ]
+
+
+def _encode_users(user_ids: Set[int]) -> Optional[str]:
+    return "," + ",".join(str(u) for u in sorted(user_ids)) + "," if user_ids else None
+
+
+def _decode_users(value: Optional[str]) -> Set[int]:
+    return {int(u) for u in (value or "").split(",") if u}
+
+
+def record(connection, changes: Iterable[Change], versions: Dict[int, int]) -> None:
+    """Deja cada entidad cambiada con la versión nueva de cada una de sus familias (upsert)."""
+    rows: Dict[Tuple[int, str, int], Tuple[bool, Set[int]]] = {}
+    for model, entity_id, refs, families, deleted in changes:
+        entity = _ENTITY_OF.get(model)
+        if entity is None or entity_id is None:
+            continue
+        owners = set(refs.get("user", ())) if entity in USER_SCOPED else set()
+        for family_id in families:
+            if family_id in versions:
+                previous = rows.get((family_id, entity, entity_id))
+                rows[(family_id, entity, entity_id)] = (deleted, owners | (previous[1] if previous else set()))
+    if not rows:
+        return
+    from app import models
+    table = models.SyncChange.__table__
+    # Los dueños se acumulan: quien lo tuvo antes debe enterarse si se reasigna o se borra después
+    scoped = [key for key in rows if key[1] in USER_SCOPED]
+    if scoped:
+        for entity in {e for _, e, _ in scoped}:
+            keys = [k for k in scoped if k[1] == entity]
+            existing = connection.execute(
+                select(table.c.family_id, table.c.entity_id, table.c.user_ids).where(
+                    table.c.entity == entity,
+                    table.c.family_id.in_({f for f, _, _ in keys}),
+                    table.c.entity_id.in_({i for _, _, i in keys}),
+                )
+            ).all()
+            for family_id, entity_id, user_ids in existing:
+                key = (family_id, entity, entity_id)
+                if key in rows:
+                    rows[key] = (rows[key][0], rows[key][1] | _decode_users(user_ids))
+    values = [
+        {"family_id": f, "entity": e, "entity_id": i, "seq": versions[f], "deleted": deleted,
+         "user_ids": _encode_users(owners)}
+        for (f, e, i), (deleted, owners) in sorted(rows.items())
+    ]
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table)
+        connection.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["family_id", "entity", "entity_id"],
+                set_={
+                    "seq": stmt.excluded.seq, "deleted": stmt.excluded.deleted,
+                    "user_ids": stmt.excluded.user_ids, "changed_at": func.now(),
+                },
+            ),
+            values,
+        )
+        return
+    for row in values:
+        result = connection.execute(
+            update(table)
+            .where(table.c.family_id == row["family_id"], table.c.entity == row["entity"],
+                   table.c.entity_id == row["entity_id"])
+            .values(seq=row["seq"], deleted=row["deleted"], user_ids=row["user_ids"])
+        )
+        if not result.rowcount:
+            connection.execute(insert(table).values(**row))
+
+
+def changes_since(db: Session, family_id: int, since: int, limit: int, include_deleted: bool = True,
+                  user_id: Optional[int] = None) -> Tuple[Dict[str, Dict[str, List[int]]], int, bool]:
+    """
+    Entidades de la familia que cambiaron después de `since`, en orden de secuencia:
+    ({entidad: {"upserts": [ids], "deleted": [ids]}}, cursor, hay_más). Se regresan ~`limit` filas, pero
+    nunca se corta una secuencia a la mitad (lo de un mismo commit va junto) para que el cursor sea exacto.
+    Con `user_id`, de USER_SCOPED solo lo que ese usuario tiene o tuvo (filas sin user_ids: todas).
+    """
+    from app import models
+    sc = models.SyncChange
+    base = db.query(sc).filter(sc.family_id == family_id, sc.seq > since)
+    if user_id is not None:
+        base = base.filter(or_(
+            sc.entity.not_in(USER_SCOPED), sc.user_ids.is_(None), sc.user_ids.like(f"%,{int(user_id)},%"),
+        ))
+    if not include_deleted:
+        base = base.filter(sc.deleted == False)
+    boundary = (
+        base.with_entities(sc.seq).order_by(sc.seq).offset(limit - 1).limit(1).scalar()
+    )
+    query = base.with_entities(sc.entity, sc.entity_id, sc.seq, sc.deleted)
+    if boundary is not None:
+        query = query.filter(sc.seq <= boundary)
+    out: Dict[str, Dict[str, List[int]]] = defaultdict(lambda: {"upserts": [], "deleted": []})
+    cursor = since
+    for entity, entity_id, seq, deleted in query.order_by(sc.seq, sc.entity, sc.entity_id).all():
+        out[entity]["deleted" if deleted else "upserts"].append(entity_id)
+        cursor = max(cursor, seq)
+    has_more = boundary is not None and base.filter(sc.seq > boundary).with_entities(sc.id).first() is not None
+    return dict(out), cursor, has_more
+
+
+def _sources(models) -> Dict[str, Tuple]:
+    """
+    Por entidad: (columna id, columna de la familia, columna del dueño o None, FROM) para llenar el
+    registro desde las tablas.
+    """
+    users = models.User.__table__
+    receipts = models.Receipt.__table__
+    items = models.ReceiptItem.__table__
+    fb = models.FamilyBudget.__table__
+    ub = models.UserBudget.__table__
+    cc = models.CustomCategory.__table__
+    cs = models.CustomSubcategory.__table__
+    tx = models.Transaction.__table__
+    return {
+        "transactions": (tx.c.id, users.c.family_id, tx.c.user_id, tx.join(users, users.c.id == tx.c.user_id)),
+        "receipts": (
+            receipts.c.id, users.c.family_id, receipts.c.user_id, receipts.join(users, users.c.id == receipts.c.user_id),
+        ),
+        "receipt_items": (
+            items.c.id, users.c.family_id, receipts.c.user_id,
+            items.join(receipts, receipts.c.id == items.c.receipt_id).join(users, users.c.id == receipts.c.user_id),
+        ),
+        "family_budgets": (fb.c.id, fb.c.family_id, None, fb),
+        "user_budgets": (ub.c.id, fb.c.family_id, None, ub.join(fb, fb.c.id == ub.c.family_budget_id)),
+        "custom_categories": (cc.c.id, cc.c.family_id, None, cc),
+        "custom_subcategories": (cs.c.id, cc.c.family_id, None, cs.join(cc, cc.c.id == cs.c.custom_category_id)),
+    }
+
+
+def seed(db: Session) -> Dict[str, int]:
+    """
+    Registra las entidades que todavía no tienen fila (datos anteriores a sync_changes o cargados por
+    fuera de la app) con una versión nueva de su familia, y pone el dueño actual a las filas de
+    USER_SCOPED que no lo tienen. No toca secuencias ya registradas ni los tombstones, así que los
+    cursores de los clientes siguen siendo válidos. Regresa las filas agregadas por entidad.
+    """
+    from app import models
+    from app.services import family_versions
+    sc = models.SyncChange.__table__
+    connection = db.connection()
+    missing: Dict[str, List[Tuple[int, int, Optional[int]]]] = {}
+    for entity, (id_column, family_column, owner_column, from_) in _sources(models).items():
+        registered = select(sc.c.entity_id).where(sc.c.entity == entity, sc.c.family_id == family_column)
+        owner = owner_column if owner_column is not None else null()
+        missing[entity] = connection.execute(
+            select(id_column, family_column, owner).select_from(from_)
+            .where(family_column.isnot(None), id_column.not_in(registered))
+        ).all()
+        if owner_column is not None:
+            unowned = connection.execute(
+                select(sc.c.id, owner_column).select_from(from_.join(sc, and_(
+                    sc.c.entity == entity, sc.c.entity_id == id_column, sc.c.family_id == family_column,
+                ))).where(sc.c.user_ids.is_(None))
+            ).all()
+            for row_id, user_id in unowned:
+                connection.execute(update(sc).where(sc.c.id == row_id).values(user_ids=_encode_users({user_id})))
+    families = {family_id for rows in missing.values() for _, family_id, _ in rows}
+    versions = family_versions.bump(connection, families)
+    record(connection, [
+        (ENTITIES[entity], entity_id, {"user": {user_id}} if user_id is not None else {}, {family_id}, False)
+        for entity, rows in missing.items() for entity_id, family_id, user_id in rows
+    ], versions)
+    return {entity: len(rows) for entity, rows in missing.items()}
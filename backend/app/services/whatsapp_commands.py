@@ -0,0 +1,272 @@
+"""
+Comandos de texto de WhatsApp: "saldo", "gastos mes", "presupuesto <categoría>", "últimos 5".
+
+El webhook ya resolvió al remitente (phone_numbers.PhoneSender: id y family_id); aquí solo se
+interpreta el texto y se contesta desde datos ya agregados: user_budgets.spent_amount, el agregado
+mensual monthly_spending (spending_rollups) y las últimas transacciones por el índice
+(user_id, date). Sin OpenAI ni recorridos de tablas completas: la respuesta toma milisegundos.
+"""
+import json
+import re
+import unicodedata
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app import models
+from app.services import spending_rollups
+
+MESES_ES = [
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre",
+]
+MESES_EN = [
+    "JANUARY", "FEBRUARY", "MARCH", "APRIL", "MAY", "JUNE",
+    "JULY", "AUGUST", "SEPTEMBER", "OCTOBER", "NOVEMBER", "DECEMBER",
+]
+MAX_RECENT = 20
+
+HELP_TEXT = (
+    "Envía una foto de tu recibo o transferencia para procesarla automáticamente.\n\n"
+    "Comandos disponibles:\n"
+    "• saldo - Ver tus presupuestos\n"
+    "• gastos mes - Gastos del mes (tuyos y de la familia)\n"
+    "• presupuesto <categoría> - Presupuesto vs gastado del mes\n"
+    "• últimos 5 - Tus últimos movimientos"
+)
+
+
+def _normalize(text: str) -> str:
+    """Minúsculas, sin acentos ni espacios repetidos ("Últimos  5" -> "ultimos 5")."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def parse_command(text: str) -> Tuple[Optional[str], str]:
+    """Regresa (comando, argumento); comando None si el texto no es un comando conocido."""
+    normalized = _normalize(text)
+    if not normalized:
+        return None, ""
+    head, _, rest = normalized.partition(" ")
+    if normalized in ("saldo", "balance", "saldos"):
+        return "saldo", ""
+    if head in ("gastos", "gasto", "gastado"):
+        return "gastos", rest
+    if head in ("presupuesto", "presupuestos"):
+        return "presupuesto", rest
+    if head in ("ultimos", "ultimas", "ultimo", "movimientos"):
+        return "ultimos", rest
+    if normalized in ("ayuda", "help", "menu", "comandos", "?"):
+        return "ayuda", ""
+    return None, normalized
+
+
+def reply(db: Session, sender, text: str, now: Optional[datetime] = None) -> str:
+    """Respuesta al comando de texto del remitente (`sender` = PhoneSender o User)."""
+    command, arg = parse_command(text)
+    now = now or datetime.now()
+    if command == "saldo":
+        return _saldo(db, sender, now)
+    if command == "gastos":
+        return _gastos_mes(db, sender, now)
+    if command == "presupuesto":
+        return _presupuesto(db, sender, arg, now)
+    if command == "ultimos":
+        return _ultimos(db, sender, arg)
+    return HELP_TEXT
+
+
+def _money(amount: float) -> str:
+    return f"${amount:,.2f}"
+
+
+def _enum_label(value: Any, enum_cls) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, enum_cls):
+        return value.value
+    member = enum_cls.__members__.get(str(value))
+    return member.value if member is not None else str(value)
+
+
+def _budget_labels(budget: models.FamilyBudget, custom_category: Optional[str],
+                   custom_subcategory: Optional[str]) -> Tuple[str, str]:
+    """Nombre visible de la categoría y subcategoría (nombres personalizados primero)."""
+    display = budget.display_names or {}
+    if isinstance(display, str):
+        try:
+            display = json.loads(display)
+        except ValueError:
+            display = {}
+    category = display.get("category") or custom_category or _enum_label(budget.category, models.Category) or "Sin categoría"
+    subcategory = display.get("subcategory") or custom_subcategory or _enum_label(budget.subcategory, models.Subcategory) or ""
+    return category, subcategory
+
+
+def _planned_for_month(budget: models.FamilyBudget, month: int) -> float:
+    amounts = budget.monthly_amounts
+    if isinstance(amounts, str):
+        try:
+            amounts = json.loads(amounts)
+        except ValueError:
+            amounts = None
+    if isinstance(amounts, dict) and MESES_EN[month - 1] in amounts:
+        return float(amounts.get(MESES_EN[month - 1]) or 0.0)
+    return float(budget.total_amount or 0.0) / 12.0
+
+
+# --- Comandos ---
+
+def _saldo(db: Session, sender, now: datetime) -> str:
+    # Una sola consulta (antes: una carga perezosa de family_budget por presupuesto)
+    rows = db.query(models.UserBudget, models.FamilyBudget, models.CustomCategory.name, models.CustomSubcategory.name).join(
+        models.FamilyBudget, models.FamilyBudget.id == models.UserBudget.family_budget_id
+    ).outerjoin(
+        models.CustomCategory, models.CustomCategory.id == models.FamilyBudget.custom_category_id
+    ).outerjoin(
+        models.CustomSubcategory, models.CustomSubcategory.id == models.FamilyBudget.custom_subcategory_id
+    ).filter(
+        models.UserBudget.user_id == sender.id,
+        models.FamilyBudget.year == now.year,
+    ).order_by(models.FamilyBudget.id).all()
+    if not rows:
+        return "No tienes presupuestos asignados."
+
+    reply_text = "📊 Tus Presupuestos:\n\n"
+    for user_budget, family_budget, custom_category, custom_subcategory in rows:
+        category, subcategory = _budget_labels(family_budget, custom_category, custom_subcategory)
+        spent = user_budget.spent_amount or 0.0
+        available = (user_budget.allocated_amount or 0.0) - spent
+        reply_text += f"• {category}" + (f" - {subcategory}" if subcategory else "") + "\n"
+        reply_text += f"  Asignado: {_money(user_budget.allocated_amount or 0.0)}\n"
+        reply_text += f"  Gastado: {_money(spent)}\n"
+        reply_text += f"  Disponible: {_money(available)}\n\n"
+    return reply_text.rstrip() + "\n"
+
+
+def _category_names(db: Session, rows: List[Dict[str, Any]]) -> Dict[int, str]:
+    ids = {r["custom_category_id"] for r in rows if r["custom_category_id"]}
+    if not ids:
+        return {}
+    return dict(db.query(models.CustomCategory.id, models.CustomCategory.name).filter(models.CustomCategory.id.in_(ids)).all())
+
+
+def _gastos_mes(db: Session, sender, now: datetime) -> str:
+    mine = spending_rollups.month_totals(db, now.year, now.month, user_id=sender.id)
+    title = f"📅 Gastos de {MESES_ES[now.month - 1]} {now.year}\n\n"
+    text = title + f"👤 Tú: {_money(mine['expense'])} en {mine['expense_count']} movimiento(s)\n"
+    if mine["income"]:
+        text += f"   Ingresos: {_money(mine['income'])}\n"
+
+    if sender.family_id:
+        family = spending_rollups.month_totals(db, now.year, now.month, family_id=sender.family_id)
+        text += f"👨‍👩‍👧 Familia: {_money(family['expense'])} en {family['expense_count']} movimiento(s)\n"
+        rows = spending_rollups.category_totals(db, now.year, now.month, family_id=sender.family_id)
+    else:
+        rows = spending_rollups.category_totals(db, now.year, now.month, user_id=sender.id)
+
+    # Por categoría (sumando subcategorías), de mayor a menor
+    custom_names = _category_names(db, rows)
+    by_category: Dict[str, float] = {}
+    for r in rows:
+        if r["expense"] <= 0:
+            continue
+        label = custom_names.get(r["custom_category_id"]) or _enum_label(r["category"], models.Category) or "Sin categoría"
+        by_category[label] = by_category.get(label, 0.0) + r["expense"]
+    if by_category:
+        text += "\nPrincipales categorías:\n"
+        for label, amount in sorted(by_category.items(), key=lambda kv: kv[1], reverse=True)[:5]:
+            text += f"• {label}: {_money(amount)}\n"
+    return text
+
+
+def _presupuesto(db: Session, sender, arg: str, now: datetime) -> str:
+    if not sender.family_id:
+        return "No perteneces a una familia con presupuestos."
+    budgets = db.query(models.FamilyBudget, models.CustomCategory.name, models.CustomSubcategory.name).outerjoin(
+        models.CustomCategory, models.CustomCategory.id == models.FamilyBudget.custom_category_id
+    ).outerjoin(
+        models.CustomSubcategory, models.CustomSubcategory.id == models.FamilyBudget.custom_subcategory_id
+    ).filter(
+        models.FamilyBudget.family_id == sender.family_id,
+        models.FamilyBudget.year == now.year,
+    ).all()
+    if not budgets:
+        return f"Tu familia no tiene presupuestos para {now.year}."
+
+    labeled = [(b, *_budget_labels(b, cc, cs)) for b, cc, cs in budgets]
+    if not arg:
+        categories = sorted({category for _b, category, _s in labeled})
+        return "Escribe: presupuesto <categoría>\n\nCategorías:\n" + "\n".join(f"• {c}" for c in categories)
+
+    needle = _normalize(arg)
+    by_category = [x for x in labeled if needle in _normalize(x[1])]
+    by_subcategory = [x for x in labeled if needle in _normalize(x[2])]
+    if not by_category and not by_subcategory:
+        return f"No encontré la categoría \"{arg}\". Escribe \"presupuesto\" para ver la lista."
+
+    # Gastado del mes por (categoría, subcategoría) de la familia, desde el agregado
+    actual = spending_rollups.category_totals(db, now.year, now.month, family_id=sender.family_id)
+
+    def _spent(budget: models.FamilyBudget, level: str) -> float:
+        total = 0.0
+        for r in actual:
+            if budget.custom_category_id:
+                if r["custom_category_id"] != budget.custom_category_id:
+                    continue
+                if level == "sub" and r["custom_subcategory_id"] != budget.custom_subcategory_id:
+                    continue
+            else:
+                if r["category"] != spending_rollups.enum_name(budget.category, models.Category):
+                    continue
+                if level == "sub" and r["subcategory"] != spending_rollups.enum_name(budget.subcategory, models.Subcategory):
+                    continue
+            total += r["expense"]
+        return total
+
+    lines = []
+    if by_category:
+        # Agrupado por categoría: presupuesto de todas sus subcategorías vs gastado de la categoría
+        groups: Dict[str, List[models.FamilyBudget]] = {}
+        for budget, category, _sub in by_category:
+            groups.setdefault(category, []).append(budget)
+        for category, group in list(groups.items())[:5]:
+            planned = sum(_planned_for_month(b, now.month) for b in group)
+            lines.append((category, planned, _spent(group[0], "cat")))
+    else:
+        for budget, category, subcategory in by_subcategory[:5]:
+            lines.append((f"{category} - {subcategory}", _planned_for_month(budget, now.month), _spent(budget, "sub")))
+
+    text = f"📊 Presupuesto de {MESES_ES[now.month - 1]} {now.year}\n\n"
+    for label, planned, spent in lines:
+        available = planned - spent
+        percent = f" ({spent / planned * 100:.0f}%)" if planned > 0 else ""
+        text += f"• {label}\n"
+        text += f"  Presupuesto: {_money(planned)}\n"
+        text += f"  Gastado: {_money(spent)}{percent}\n"
+        text += f"  {'Disponible' if available >= 0 else 'Excedido'}: {_money(abs(available))}\n\n"
+    return text.rstrip() + "\n"
+
+
+def _ultimos(db: Session, sender, arg: str) -> str:
+    match = re.search(r"\d+", arg or "")
+    limit = max(1, min(MAX_RECENT, int(match.group()) if match else 5))
+    # Índice (user_id, date): lee solo las `limit` filas
+    rows = db.query(
+        models.Transaction.date, models.Transaction.amount, models.Transaction.transaction_type,
+        models.Transaction.merchant_or_beneficiary, models.Transaction.concept, models.Transaction.category,
+    ).filter(
+        models.Transaction.user_id == sender.id
+    ).order_by(models.Transaction.date.desc(), models.Transaction.id.desc()).limit(limit).all()
+    if not rows:
+        return "Aún no tienes movimientos registrados."
+
+    text = f"🧾 Tus últimos {len(rows)} movimientos:\n\n"
+    for date, amount, transaction_type, merchant, concept, category in rows:
+        sign = "+" if transaction_type == models.TransactionType.INCOME.value else "-"
+        label = merchant or concept or _enum_label(category, models.Category) or "Movimiento"
+        when = date.strftime("%d/%m") if hasattr(date, "strftime") else str(date)[:10]
+        text += f"• {when} {label}: {sign}{_money(amount or 0.0)}\n"
+    return text
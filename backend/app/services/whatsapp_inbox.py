@@ -0,0 +1,504 @@
+"""
+Bandeja de mensajes entrantes de WhatsApp (Twilio).
+
+El webhook solo guarda el mensaje en `whatsapp_messages` y responde TwiML vacío en milisegundos:
+si tarda más que el timeout del webhook, Twilio reintenta y el recibo se procesaba dos veces
+(ver CORRECCION_DUPLICADOS_WHATSAPP.md). Un pool de workers (tareas asyncio del mismo proceso)
+descarga las imágenes (cliente HTTP compartido, con tope de tamaño), las procesa con el mismo pipeline que la web (receipt_pipeline) y contesta
+al usuario dejando la respuesta en la bandeja de salida (whatsapp_outbox), que la envía.
+Cada WHATSAPP_RESCAN_SECONDS se renueva el latido de los mensajes en proceso y se reencolan los pendientes
+(de un arranque anterior o de un proceso caído).
+
+Cada MessageSid se registra una sola vez (índice único): los reintentos de Twilio, incluso en paralelo
+o en otro proceso, encuentran el registro existente y nunca disparan una segunda extracción. Los
+comandos de texto también se registran (status done + respuesta) para repetir la misma respuesta si
+Twilio reintenta. Los mensajes terminados se borran en lotes al pasar WHATSAPP_MESSAGE_TTL_HOURS.
+"""
+import asyncio
+import base64
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app import models, schemas
+from app.database import AsyncSessionLocal, SessionLocal
+from app.services import openai_governor, receipt_pipeline, whatsapp_outbox
+
+WHATSAPP_WORKERS = max(1, int(os.getenv("WHATSAPP_WORKERS", "2")))
+# Cada cuánto se revisa la tabla: latido de los mensajes en proceso y reencolado de los pendientes.
+WHATSAPP_RESCAN_SECONDS = max(1.0, float(os.getenv("WHATSAPP_RESCAN_SECONDS", "30")))
+# Mensajes en "processing" sin latido por más de este tiempo se consideran abandonados (proceso caído).
+WHATSAPP_STALE_SECONDS = max(WHATSAPP_RESCAN_SECONDS * 3, float(os.getenv("WHATSAPP_STALE_SECONDS", "180")))
+WHATSAPP_MEDIA_TIMEOUT = float(os.getenv("WHATSAPP_MEDIA_TIMEOUT", "30"))
+# Tope de tamaño por imagen: se corta la descarga en cuanto lo rebasa (WhatsApp permite hasta 16 MB).
+WHATSAPP_MEDIA_MAX_BYTES = int(float(os.getenv("WHATSAPP_MEDIA_MAX_MB", "20")) * 1024 * 1024)
+WHATSAPP_MEDIA_CONNECTIONS = max(1, int(os.getenv("WHATSAPP_MEDIA_CONNECTIONS", "8")))
+WHATSAPP_RECEIPT_MODE = os.getenv("WHATSAPP_RECEIPT_MODE", "precise")
+# Base pública del backend para la URL de la imagen guardada (el webhook no tiene la URL de la petición web).
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "")
+# Los mensajes terminados se conservan este tiempo (bloquean reintentos y sirven de bitácora) y se borran en lotes.
+WHATSAPP_MESSAGE_TTL_HOURS = float(os.getenv("WHATSAPP_MESSAGE_TTL_HOURS", "168"))
+WHATSAPP_PURGE_BATCH = max(1, int(os.getenv("WHATSAPP_PURGE_BATCH", "500")))
+WHATSAPP_PURGE_INTERVAL = float(os.getenv("WHATSAPP_PURGE_INTERVAL", "3600"))
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# --- Descarga de las imágenes ---
+
+def _twilio_auth_header() -> Dict[str, str]:
+    """Twilio puede requerir autenticación básica para descargar la media."""
+    account_sid = os.getenv("TWILIO_ACCOUNT_SID")
+    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+    if not (account_sid and auth_token):
+        return {}
+    credentials = base64.b64encode(f"{account_sid}:{auth_token}".encode()).decode()
+    return {"Authorization": f"Basic {credentials}"}
+
+
+# Un solo cliente para todas las descargas: reutiliza conexiones TLS a Twilio/CDN en lugar de abrir
+# una por imagen. Se crea al primer uso (dentro del event loop) y se cierra en stop().
+_http: Optional[httpx.AsyncClient] = None
+
+
+def _get_http() -> httpx.AsyncClient:
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=WHATSAPP_MEDIA_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=WHATSAPP_MEDIA_CONNECTIONS,
+                max_keepalive_connections=WHATSAPP_MEDIA_CONNECTIONS,
+            ),
+        )
+    return _http
+
+
+async def _close_http() -> None:
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+def _too_large() -> ValueError:
+    return ValueError(f"La imagen es demasiado grande (máximo {WHATSAPP_MEDIA_MAX_BYTES // (1024 * 1024)} MB)")
+
+
+async def _download_media(media_url: str) -> Tuple[bytes, str]:
+    """
+    Descarga la imagen en streaming (Twilio puede responder 307 a su CDN). Regresa (bytes, content-type).
+    Rechaza por Content-Length y corta a medio camino si rebasa WHATSAPP_MEDIA_MAX_BYTES.
+    """
+    async with _get_http().stream("GET", media_url, headers=_twilio_auth_header()) as media_response:
+        if media_response.status_code == 404:
+            raise ValueError("La imagen ya no está disponible en Twilio. Por favor, envía la foto nuevamente.")
+        media_response.raise_for_status()
+        content_type = media_response.headers.get("content-type", "").lower()
+        declared = media_response.headers.get("content-length")
+        if declared and declared.isdigit() and int(declared) > WHATSAPP_MEDIA_MAX_BYTES:
+            raise _too_large()
+        data = bytearray()
+        async for chunk in media_response.aiter_bytes():
+            data += chunk
+            if len(data) > WHATSAPP_MEDIA_MAX_BYTES:
+                raise _too_large()
+    print(f"📥 Imagen descargada: {len(data)} bytes ({content_type or 'sin content-type'})")
+    return bytes(data), content_type
+
+
+# --- Procesamiento ---
+
+def _confirmation(receipt: schemas.ReceiptResponse, items_count: int) -> str:
+    msg = "✅ Recibo procesado exitosamente!\n\n"
+    msg += f"💰 Monto: ${receipt.amount:,.2f} {receipt.currency}\n"
+    if receipt.merchant_or_beneficiary:
+        msg += f"🏪 Comercio: {receipt.merchant_or_beneficiary}\n"
+    if receipt.date:
+        msg += f"📅 Fecha: {receipt.date}\n"
+    msg += f"🧾 Conceptos: {items_count}\n\n"
+    msg += "Asígnalo a un presupuesto desde la sección Recibos de DOMUS+."
+    return msg
+
+
+def _error_reply(error: Exception) -> str:
+    error_str = str(error).lower()
+    if "404" in error_str or "not found" in error_str or "ya no está disponible" in error_str:
+        return "❌ La imagen ya no está disponible. Por favor, envía la foto nuevamente."
+    if "demasiado grande" in error_str:
+        return "❌ La imagen es demasiado grande. Por favor, envía una foto de menor tamaño."
+    if "timeout" in error_str or "timed out" in error_str or "connection" in error_str:
+        return "❌ Error de conexión al procesar la imagen. Por favor, intenta de nuevo."
+    return "❌ No pude procesar el recibo. Por favor, intenta con una imagen más clara."
+
+
+async def _process_message(db: AsyncSession, msg: models.WhatsAppMessage) -> Tuple[str, Optional[int]]:
+    """
+    Descarga todas las imágenes del mensaje (MediaUrl0..3) a la vez y las procesa como un solo recibo
+    de varias imágenes con el mismo pipeline que la web. Regresa (respuesta para el usuario, receipt_id).
+    """
+    media: List[Dict[str, Any]] = list(msg.media or [])
+    if not media:
+        raise ValueError("El mensaje no tiene imágenes")
+    print(f"🖼️ Procesando recibo de WhatsApp {msg.message_sid}: {len(media)} imagen(es)")
+
+    downloads = await asyncio.gather(*[_download_media(m["url"]) for m in media])
+    uploads = [
+        {
+            "filename": f"whatsapp_{msg.message_sid}_{index}",
+            "content_type": content_type or m.get("content_type"),
+            "data": data,
+        }
+        for index, (m, (data, content_type)) in enumerate(zip(media, downloads))
+    ]
+
+    # Carril "whatsapp" del gobernador de OpenAI (después de las subidas web); las tareas del pipeline lo heredan.
+    with openai_governor.lane(openai_governor.LANE_WHATSAPP):
+        result = await receipt_pipeline.run_receipt_pipeline(
+            db,
+            uploads,
+            mode=WHATSAPP_RECEIPT_MODE,
+            assigned_user_id=msg.user_id,
+            base_url=PUBLIC_BASE_URL,
+            receipt_fields={"whatsapp_message_id": msg.message_sid, "whatsapp_phone": msg.phone},
+        )
+
+    receipt = result["receipt"]
+    print(f"✅ Recibo {receipt.id} creado desde WhatsApp para usuario {msg.user_id}: ${receipt.amount} {receipt.currency}")
+    return _confirmation(receipt, len(receipt.items)), receipt.id
+
+
+# --- Idempotencia por MessageSid ---
+
+def find(db: Session, message_sid: str) -> Optional[models.WhatsAppMessage]:
+    """Mensaje ya registrado con ese MessageSid (consulta por el índice único)."""
+    return db.query(models.WhatsAppMessage).filter(models.WhatsAppMessage.message_sid == message_sid).first()
+
+
+def finish_inline(db: Session, msg: models.WhatsAppMessage, reply: str) -> None:
+    """Marca como terminado un mensaje contestado directo en el TwiML (comandos de texto)."""
+    msg.status = models.WhatsAppMessageStatus.DONE.value
+    msg.reply = reply
+    msg.reply_sent = True
+    msg.finished_at = _now()
+    db.commit()
+
+
+def duplicate_reply(msg: models.WhatsAppMessage) -> Optional[str]:
+    """
+    Qué contestar a un reintento de Twilio. Twilio solo reintenta si no recibió nuestra respuesta, así que
+    un comando de texto ya contestado se repite; lo demás (imágenes en proceso o ya contestadas por la API,
+    o un comando que aún se está respondiendo) recibe TwiML vacío.
+    """
+    if not msg.media and msg.status == models.WhatsAppMessageStatus.DONE.value and msg.reply:
+        return msg.reply
+    return None
+
+
+def purge_expired(
+    ttl_hours: Optional[float] = None,
+    batch_size: Optional[int] = None,
+) -> int:
+    """
+    Borra en lotes los mensajes terminados (done/failed) con más de `ttl_hours`. Los pendientes nunca se borran:
+    su MessageSid debe seguir bloqueando reintentos. Regresa cuántos se borraron.
+    """
+    ttl_hours = WHATSAPP_MESSAGE_TTL_HOURS if ttl_hours is None else ttl_hours
+    batch_size = WHATSAPP_PURGE_BATCH if batch_size is None else batch_size
+    cutoff = _now() - timedelta(hours=ttl_hours)
+    terminal = (models.WhatsAppMessageStatus.DONE.value, models.WhatsAppMessageStatus.FAILED.value)
+    deleted = 0
+    db = SessionLocal()
+    try:
+        while True:
+            ids = [row_id for (row_id,) in db.query(models.WhatsAppMessage.id).filter(
+                models.WhatsAppMessage.status.in_(terminal),
+                models.WhatsAppMessage.created_at < cutoff,
+            ).order_by(models.WhatsAppMessage.id).limit(batch_size).all()]
+            if not ids:
+                break
+            db.query(models.WhatsAppMessage).filter(
+                models.WhatsAppMessage.id.in_(ids)
+            ).delete(synchronize_session=False)
+            db.commit()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return deleted
+
+
+class WhatsAppInbox:
+    def __init__(self, workers: int = WHATSAPP_WORKERS):
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._queued: set = set()
+        self._in_flight: set = set()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks) and not all(t.done() for t in self._tasks)
+
+    async def start(self) -> None:
+        if self.started:
+            return
+        # Las respuestas salen por la bandeja de salida
+        await whatsapp_outbox.start()
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(1, self.workers + 1)]
+        self._tasks.append(asyncio.create_task(self._maintenance_loop()))
+        print(f"📨 Bandeja de WhatsApp iniciada ({self.workers} workers)")
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued = set()
+        await _close_http()
+
+    def record(
+        self,
+        db: Session,
+        *,
+        message_sid: str,
+        phone: str,
+        from_number: str,
+        user_id: Optional[int],
+        body: Optional[str],
+        media: Optional[List[Dict[str, Any]]],
+        status: str,
+    ) -> Tuple[models.WhatsAppMessage, bool]:
+        """
+        Registra el MessageSid una sola vez. Regresa (mensaje, creado); si otro intento de Twilio
+        ya lo registró (aunque sea en paralelo), el índice único lo rechaza y se regresa ese mensaje.
+        """
+        msg = models.WhatsAppMessage(
+            message_sid=message_sid,
+            phone=phone,
+            from_number=from_number,
+            user_id=user_id,
+            body=body,
+            media=media,
+            status=status,
+            attempts=0,
+        )
+        db.add(msg)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            existing = find(db, message_sid)
+            if existing is None:
+                raise
+            return existing, False
+        db.refresh(msg)
+        return msg, True
+
+    async def accept(self, db: AsyncSession, **fields) -> Tuple[models.WhatsAppMessage, bool]:
+        """
+        Guarda el mensaje con imágenes y lo encola (solo si es nuevo); no espera a que se procese.
+        Recibe la sesión async del webhook: el insert espera al driver sin bloquear el event loop.
+        """
+        await self.start()
+        msg, created = await db.run_sync(self.record, status=models.WhatsAppMessageStatus.RECEIVED.value, **fields)
+        if created:
+            self._enqueue(msg.id)
+        return msg, created
+
+    def _enqueue(self, message_id: int) -> bool:
+        if message_id in self._queued or message_id in self._in_flight:
+            return False
+        self._queue.put_nowait(message_id)
+        self._queued.add(message_id)
+        return True
+
+    async def _recover(self) -> None:
+        """
+        Renueva el latido (updated_at) de los mensajes que se procesan aquí, regresa a "received" los de
+        procesos caídos y encola los que esperan en la BD.
+        """
+        try:
+            async with AsyncSessionLocal() as db:
+                if self._in_flight:
+                    await db.execute(
+                        update(models.WhatsAppMessage)
+                        .where(models.WhatsAppMessage.id.in_(list(self._in_flight)))
+                        .values(updated_at=func.now())
+                        .execution_options(synchronize_session=False)
+                    )
+                stale_before = _now() - timedelta(seconds=WHATSAPP_STALE_SECONDS)
+                stale = [
+                    models.WhatsAppMessage.status == models.WhatsAppMessageStatus.PROCESSING.value,
+                    or_(
+                        models.WhatsAppMessage.updated_at < stale_before,
+                        and_(models.WhatsAppMessage.updated_at.is_(None), models.WhatsAppMessage.started_at < stale_before),
+                    ),
+                ]
+                if self._in_flight:
+                    stale.append(models.WhatsAppMessage.id.not_in(list(self._in_flight)))
+                reclaimed = (await db.execute(
+                    update(models.WhatsAppMessage).where(*stale)
+                    .values(status=models.WhatsAppMessageStatus.RECEIVED.value)
+                    .execution_options(synchronize_session=False)
+                )).rowcount
+                await db.commit()
+                if reclaimed:
+                    print(f"🔁 {reclaimed} mensajes de WhatsApp abandonados regresaron a la cola")
+
+                rows = (await db.execute(
+                    select(models.WhatsAppMessage.id)
+                    .where(models.WhatsAppMessage.status == models.WhatsAppMessageStatus.RECEIVED.value)
+                    .order_by(models.WhatsAppMessage.id)
+                )).scalars().all()
+            enqueued = sum(1 for message_id in rows if self._enqueue(message_id))
+            if enqueued:
+                print(f"🔁 {enqueued} mensajes de WhatsApp reencolados")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ No se pudieron recuperar mensajes de WhatsApp: {e}")
+
+    async def _maintenance_loop(self) -> None:
+        """Revisa pendientes/abandonados cada WHATSAPP_RESCAN_SECONDS y borra los terminados expirados cada WHATSAPP_PURGE_INTERVAL."""
+        next_purge = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._recover()
+            if loop.time() >= next_purge:
+                next_purge = loop.time() + WHATSAPP_PURGE_INTERVAL
+                try:
+                    deleted = await asyncio.to_thread(purge_expired)
+                    if deleted:
+                        print(f"🧹 {deleted} mensajes de WhatsApp expirados borrados")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ No se pudieron borrar mensajes de WhatsApp expirados: {e}")
+            await asyncio.sleep(WHATSAPP_RESCAN_SECONDS)
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            message_id = await self._queue.get()
+            # En vuelo antes de salir de _queued: una revisión en medio no lo vuelve a encolar
+            self._in_flight.add(message_id)
+            self._queued.discard(message_id)
+            try:
+                await self._run_message(message_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                import traceback
+                print(f"❌ Worker WhatsApp {n}: error inesperado en mensaje {message_id}: {e}")
+                print(traceback.format_exc())
+            finally:
+                self._in_flight.discard(message_id)
+                self._queue.task_done()
+
+    async def _run_message(self, message_id: int) -> None:
+        # Sesión async, como el webhook: el reclamo, los commits y el guardado del recibo no bloquean el event loop.
+        async with AsyncSessionLocal() as db:
+            # Reclamar el mensaje de forma atómica (otro proceso pudo haberlo tomado).
+            claimed = (await db.execute(
+                update(models.WhatsAppMessage)
+                .where(
+                    models.WhatsAppMessage.id == message_id,
+                    models.WhatsAppMessage.status == models.WhatsAppMessageStatus.RECEIVED.value,
+                )
+                .values(
+                    status=models.WhatsAppMessageStatus.PROCESSING.value,
+                    started_at=_now(),
+                    attempts=models.WhatsAppMessage.attempts + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            await db.commit()
+            if not claimed:
+                return
+
+            msg = await db.get(models.WhatsAppMessage, message_id)
+            message_sid, phone, to = msg.message_sid, msg.phone, msg.from_number or msg.phone
+            values: Dict[str, Any]
+            if not msg.media:
+                # Comando de texto que quedó a medias (se contesta en línea en el webhook): no hay nada que procesar.
+                msg.status = models.WhatsAppMessageStatus.FAILED.value
+                msg.error = "Mensaje sin imágenes interrumpido antes de responder"
+                msg.finished_at = _now()
+                await db.commit()
+                return
+            try:
+                reply, receipt_id = await _process_message(db, msg)
+                values = {"status": models.WhatsAppMessageStatus.DONE.value, "receipt_id": receipt_id}
+            except asyncio.CancelledError:
+                # Apagado del servidor: dejarlo pendiente para el siguiente arranque.
+                await db.rollback()
+                await db.execute(
+                    update(models.WhatsAppMessage).where(models.WhatsAppMessage.id == message_id)
+                    .values(status=models.WhatsAppMessageStatus.RECEIVED.value)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                raise
+            except Exception as e:
+                import traceback
+                await db.rollback()
+                error = str(e)[:2000]
+                values = {"status": models.WhatsAppMessageStatus.FAILED.value, "error": error}
+                reply = _error_reply(e)
+                print(f"❌ Mensaje de WhatsApp {message_sid} falló: {error[:240]}")
+                print(traceback.format_exc())
+
+            await db.execute(
+                update(models.WhatsAppMessage).where(models.WhatsAppMessage.id == message_id)
+                .values(reply=reply, finished_at=_now(), **values)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+            # Solo se encola: whatsapp_outbox la envía (ritmo de Twilio, reintentos) y marca reply_sent.
+            # La llave evita una segunda respuesta si el mensaje se reprocesa tras un reinicio.
+            await db.run_sync(
+                whatsapp_outbox.enqueue,
+                to,
+                reply,
+                kind="receipt_reply",
+                message_sid=message_sid,
+                dedup_key=f"reply:{message_sid}",
+            )
+            print(f"📤 Respuesta de WhatsApp encolada para {phone} ({message_sid})")
+
+
+whatsapp_inbox = WhatsAppInbox()
+
+
+async def start() -> None:
+    await whatsapp_inbox.start()
+
+
+async def stop() -> None:
+    await whatsapp_inbox.stop()
+
+
+async def accept(db: AsyncSession, **kwargs) -> Tuple[models.WhatsAppMessage, bool]:
+    return await whatsapp_inbox.accept(db, **kwargs)
+
+
+def record(db: Session, **kwargs) -> Tuple[models.WhatsAppMessage, bool]:
+    return whatsapp_inbox.record(db, **kwargs)
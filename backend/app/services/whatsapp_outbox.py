@@ -0,0 +1,434 @@
+"""
+Bandeja de salida de WhatsApp (Twilio).
+
+`client.messages.create` es síncrono; antes se llamaba directo desde quien necesitaba avisar, sin
+límite de ritmo ni reintentos. Ahora quien avisa (respuestas a recibos, alertas, resúmenes) solo
+inserta una fila en `whatsapp_outbox` con enqueue() y sigue. Un despachador (tarea asyncio del mismo
+proceso) reclama en lotes los mensajes vencidos, los envía en paralelo (WHATSAPP_SEND_CONCURRENCY
+hilos) a no más de WHATSAPP_SEND_RATE mensajes por segundo por número remitente, reintenta los errores
+transitorios (429, 5xx, red) con backoff exponencial y guarda el SID de Twilio. El status callback
+(/api/whatsapp/status) completa el estado de entrega (delivered, read, undelivered).
+Los mensajes pendientes de un arranque anterior siguen en la tabla y se envían al iniciar.
+"""
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import SessionLocal
+from app.services import whatsapp_service
+
+WHATSAPP_SEND_CONCURRENCY = max(1, int(os.getenv("WHATSAPP_SEND_CONCURRENCY", "4")))
+# Mensajes por segundo por número remitente (lo que rebase el límite de Twilio regresa 429/63018).
+WHATSAPP_SEND_RATE = max(0.1, float(os.getenv("WHATSAPP_SEND_RATE", "10")))
+WHATSAPP_SEND_BATCH = max(1, int(os.getenv("WHATSAPP_SEND_BATCH", "20")))
+WHATSAPP_SEND_MAX_ATTEMPTS = max(1, int(os.getenv("WHATSAPP_SEND_MAX_ATTEMPTS", "5")))
+# Espera antes del reintento: BACKOFF * 2^(intento-1) segundos (±20%), hasta BACKOFF_MAX.
+WHATSAPP_SEND_BACKOFF = float(os.getenv("WHATSAPP_SEND_BACKOFF", "2"))
+WHATSAPP_SEND_BACKOFF_MAX = float(os.getenv("WHATSAPP_SEND_BACKOFF_MAX", "300"))
+# Sin avisos nuevos, el despachador revisa la tabla cada tanto (mensajes encolados por otro proceso).
+WHATSAPP_SEND_POLL = float(os.getenv("WHATSAPP_SEND_POLL", "5"))
+# Mensajes en "sending" sin actividad por más de este tiempo se consideran abandonados (proceso reiniciado).
+WHATSAPP_SEND_STALE_SECONDS = float(os.getenv("WHATSAPP_SEND_STALE_SECONDS", "300"))
+WHATSAPP_OUTBOX_TTL_HOURS = float(os.getenv("WHATSAPP_OUTBOX_TTL_HOURS", "168"))
+WHATSAPP_PURGE_BATCH = max(1, int(os.getenv("WHATSAPP_PURGE_BATCH", "500")))
+WHATSAPP_PURGE_INTERVAL = float(os.getenv("WHATSAPP_PURGE_INTERVAL", "3600"))
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "")
+
+# Orden de los estados que reporta Twilio: un callback atrasado no regresa el estado hacia atrás.
+_DELIVERY_RANK = {"accepted": 0, "queued": 1, "sending": 2, "sent": 3, "delivered": 4, "read": 5}
+_DELIVERY_FAILED = {"failed", "undelivered"}
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _status_callback_url() -> Optional[str]:
+    if not PUBLIC_BASE_URL:
+        return None
+    return f"{PUBLIC_BASE_URL.rstrip('/')}/api/whatsapp/status"
+
+
+def _backoff(attempts: int) -> float:
+    delay = min(WHATSAPP_SEND_BACKOFF_MAX, WHATSAPP_SEND_BACKOFF * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class _RateLimiter:
+    """Espacia los envíos de un número: a lo más `rate` por segundo entre todos los envíos en curso."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def record_delivery(db: Session, twilio_sid: str, status: Optional[str], error_code: Optional[str] = None) -> bool:
+    """Guarda el estado de entrega del status callback de Twilio. Regresa False si el SID no es nuestro."""
+    row = db.query(models.WhatsAppOutbound).filter(models.WhatsAppOutbound.twilio_sid == twilio_sid).first()
+    if row is None or not status:
+        return False
+    status = status.lower()
+    current = row.delivery_status
+    if current in _DELIVERY_FAILED:
+        return True
+    if status not in _DELIVERY_FAILED and _DELIVERY_RANK.get(status, 0) < _DELIVERY_RANK.get(current, -1):
+        return True
+    row.delivery_status = status
+    if status in _DELIVERY_FAILED:
+        row.error = f"Twilio reportó {status}" + (f" (ErrorCode {error_code})" if error_code else "")
+        print(f"⚠️ Mensaje de WhatsApp {twilio_sid} a {row.to_number} no entregado: {row.error}")
+    db.commit()
+    return True
+
+
+def purge_expired(ttl_hours: Optional[float] = None, batch_size: Optional[int] = None) -> int:
+    """Borra en lotes los mensajes enviados o fallidos más viejos que el TTL. Regresa cuántos borró."""
+    ttl_hours = WHATSAPP_OUTBOX_TTL_HOURS if ttl_hours is None else ttl_hours
+    batch_size = batch_size or WHATSAPP_PURGE_BATCH
+    cutoff = _now() - timedelta(hours=ttl_hours)
+    deleted = 0
+    db = SessionLocal()
+    try:
+        while True:
+            ids = [row_id for (row_id,) in db.query(models.WhatsAppOutbound.id).filter(
+                models.WhatsAppOutbound.status.in_((
+                    models.WhatsAppOutboundStatus.SENT.value,
+                    models.WhatsAppOutboundStatus.FAILED.value,
+                )),
+                models.WhatsAppOutbound.created_at < cutoff,
+            ).order_by(models.WhatsAppOutbound.id).limit(batch_size).all()]
+            if not ids:
+                break
+            db.query(models.WhatsAppOutbound).filter(
+                models.WhatsAppOutbound.id.in_(ids)
+            ).delete(synchronize_session=False)
+            db.commit()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return deleted
+
+
+class _Outgoing(NamedTuple):
+    """Lo que _send necesita de la fila (la sesión se cierra en el hilo que la leyó)."""
+    to_number: str
+    body: str
+    kind: Optional[str]
+    message_sid: Optional[str]
+    attempts: int
+
+
+class WhatsAppOutbox:
+    def __init__(self, concurrency: int = WHATSAPP_SEND_CONCURRENCY, rate: float = WHATSAPP_SEND_RATE):
+        self.concurrency = concurrency
+        self.rate = rate
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._limiters: Dict[str, _RateLimiter] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks) and not all(t.done() for t in self._tasks)
+
+    async def start(self) -> None:
+        if self.started:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._limiters = {}
+        await asyncio.to_thread(self._recover)
+        self._tasks = [asyncio.create_task(self._dispatch()), asyncio.create_task(self._purge_loop())]
+        print(f"📤 Bandeja de salida de WhatsApp iniciada ({self.concurrency} envíos en paralelo, {self.rate:g}/s por número)")
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._loop = None
+
+    def enqueue(
+        self,
+        db: Session,
+        to: str,
+        body: str,
+        *,
+        kind: str = "reply",
+        message_sid: Optional[str] = None,
+        dedup_key: Optional[str] = None,
+    ) -> Tuple[models.WhatsAppOutbound, bool]:
+        """
+        Deja el mensaje en la bandeja de salida (confirma la sesión) y despierta al despachador; no envía.
+        Con `dedup_key`, un segundo aviso con la misma llave regresa el existente. Regresa (mensaje, creado).
+        Se puede llamar desde el event loop o desde un hilo (rutas síncronas).
+        """
+        row = models.WhatsAppOutbound(
+            to_number=to,
+            body=body,
+            kind=kind,
+            message_sid=message_sid,
+            dedup_key=dedup_key,
+            status=models.WhatsAppOutboundStatus.QUEUED.value,
+            attempts=0,
+        )
+        db.add(row)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            existing = None
+            if dedup_key:
+                existing = db.query(models.WhatsAppOutbound).filter(
+                    models.WhatsAppOutbound.dedup_key == dedup_key
+                ).first()
+            if existing is None:
+                raise
+            return existing, False
+        db.refresh(row)
+        self.wake()
+        return row, True
+
+    def wake(self) -> None:
+        loop = self._loop
+        if loop is None or loop.is_closed() or self._wake is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wake.set()
+        else:
+            loop.call_soon_threadsafe(self._wake.set)
+
+    def stats(self) -> Dict[str, int]:
+        return {"sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+    def _recover(self) -> None:
+        """Regresa a la cola los envíos que quedaron a medias en un arranque anterior."""
+        db = SessionLocal()
+        try:
+            stale_before = _now() - timedelta(seconds=WHATSAPP_SEND_STALE_SECONDS)
+            recovered = db.query(models.WhatsAppOutbound).filter(
+                models.WhatsAppOutbound.status == models.WhatsAppOutboundStatus.SENDING.value,
+                or_(models.WhatsAppOutbound.updated_at.is_(None), models.WhatsAppOutbound.updated_at < stale_before),
+            ).update({models.WhatsAppOutbound.status: models.WhatsAppOutboundStatus.QUEUED.value}, synchronize_session=False)
+            db.commit()
+            if recovered:
+                print(f"🔁 {recovered} mensajes de salida de WhatsApp reencolados")
+        except Exception as e:
+            db.rollback()
+            print(f"⚠️ No se pudieron recuperar mensajes de salida de WhatsApp: {e}")
+        finally:
+            db.close()
+
+    def _claim_batch(self) -> Tuple[List[int], float]:
+        """
+        Reclama (queued -> sending, atómico por fila) hasta WHATSAPP_SEND_BATCH mensajes vencidos.
+        Regresa (ids, segundos hasta el siguiente reintento programado).
+        """
+        db = SessionLocal()
+        try:
+            now = _now()
+            due = or_(models.WhatsAppOutbound.next_attempt_at.is_(None), models.WhatsAppOutbound.next_attempt_at <= now)
+            ids = [row_id for (row_id,) in db.query(models.WhatsAppOutbound.id).filter(
+                models.WhatsAppOutbound.status == models.WhatsAppOutboundStatus.QUEUED.value, due,
+            ).order_by(models.WhatsAppOutbound.id).limit(WHATSAPP_SEND_BATCH).all()]
+            claimed = []
+            for row_id in ids:
+                # Otro proceso pudo haberlo tomado
+                if db.query(models.WhatsAppOutbound).filter(
+                    models.WhatsAppOutbound.id == row_id,
+                    models.WhatsAppOutbound.status == models.WhatsAppOutboundStatus.QUEUED.value,
+                ).update({
+                    models.WhatsAppOutbound.status: models.WhatsAppOutboundStatus.SENDING.value,
+                    models.WhatsAppOutbound.attempts: models.WhatsAppOutbound.attempts + 1,
+                }, synchronize_session=False):
+                    claimed.append(row_id)
+            db.commit()
+
+            wait = WHATSAPP_SEND_POLL
+            if not claimed:
+                next_at = db.query(func.min(models.WhatsAppOutbound.next_attempt_at)).filter(
+                    models.WhatsAppOutbound.status == models.WhatsAppOutboundStatus.QUEUED.value,
+                ).scalar()
+                if next_at is not None:
+                    if next_at.tzinfo is None:
+                        next_at = next_at.replace(tzinfo=timezone.utc)
+                    wait = max(0.05, min(wait, (next_at - now).total_seconds()))
+            return claimed, wait
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                ids, wait = await asyncio.to_thread(self._claim_batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Bandeja de salida de WhatsApp: no se pudieron reclamar mensajes: {e}")
+                ids, wait = [], WHATSAPP_SEND_POLL
+            if ids:
+                await asyncio.gather(*[self._send(row_id) for row_id in ids])
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _load(self, row_id: int) -> Optional[_Outgoing]:
+        db = SessionLocal()
+        try:
+            row = db.query(models.WhatsAppOutbound).filter(models.WhatsAppOutbound.id == row_id).first()
+            if row is None:
+                return None
+            return _Outgoing(row.to_number, row.body, row.kind, row.message_sid, row.attempts or 0)
+        finally:
+            db.close()
+
+    def _mark_sent(self, row_id: int, twilio_sid: Optional[str], message_sid: Optional[str]) -> None:
+        db = SessionLocal()
+        try:
+            db.query(models.WhatsAppOutbound).filter(models.WhatsAppOutbound.id == row_id).update({
+                models.WhatsAppOutbound.status: models.WhatsAppOutboundStatus.SENT.value,
+                models.WhatsAppOutbound.twilio_sid: twilio_sid,
+                models.WhatsAppOutbound.sent_at: _now(),
+                models.WhatsAppOutbound.error: None,
+            }, synchronize_session=False)
+            if message_sid:
+                db.query(models.WhatsAppMessage).filter(
+                    models.WhatsAppMessage.message_sid == message_sid
+                ).update({models.WhatsAppMessage.reply_sent: True}, synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _mark_error(self, row_id: int, error: str, retry_in: Optional[float]) -> None:
+        """Con `retry_in` regresa a la cola para reintentar en ese tiempo; sin él, queda fallido."""
+        values = {models.WhatsAppOutbound.error: error}
+        if retry_in is not None:
+            values[models.WhatsAppOutbound.status] = models.WhatsAppOutboundStatus.QUEUED.value
+            values[models.WhatsAppOutbound.next_attempt_at] = _now() + timedelta(seconds=retry_in)
+        else:
+            values[models.WhatsAppOutbound.status] = models.WhatsAppOutboundStatus.FAILED.value
+        db = SessionLocal()
+        try:
+            db.query(models.WhatsAppOutbound).filter(models.WhatsAppOutbound.id == row_id).update(
+                values, synchronize_session=False
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _send(self, row_id: int) -> None:
+        # Lectura y cambios de estado en hilos (como _claim_batch): el event loop solo espera
+        async with self._slots:
+            try:
+                row = await asyncio.to_thread(self._load, row_id)
+                if row is None:
+                    return
+                sender = whatsapp_service.whatsapp_number or ""
+                limiter = self._limiters.get(sender)
+                if limiter is None:
+                    limiter = self._limiters[sender] = _RateLimiter(self.rate)
+                await limiter.acquire()
+                try:
+                    # El cliente de Twilio es síncrono: en un hilo para no bloquear el event loop
+                    twilio_sid = await asyncio.to_thread(
+                        whatsapp_service.deliver_whatsapp_message, row.to_number, row.body, _status_callback_url()
+                    )
+                except whatsapp_service.WhatsAppSendError as e:
+                    error = str(e)[:2000]
+                    if e.retryable and row.attempts < WHATSAPP_SEND_MAX_ATTEMPTS:
+                        delay = _backoff(row.attempts)
+                        await asyncio.to_thread(self._mark_error, row_id, error, delay)
+                        self.retried += 1
+                        print(f"🔁 Envío de WhatsApp a {row.to_number} reintenta en {delay:.1f}s (intento {row.attempts}): {error[:160]}")
+                    else:
+                        await asyncio.to_thread(self._mark_error, row_id, error, None)
+                        self.failed += 1
+                        print(f"❌ Envío de WhatsApp a {row.to_number} falló tras {row.attempts} intento(s): {error[:240]}")
+                    return
+
+                await asyncio.to_thread(self._mark_sent, row_id, twilio_sid, row.message_sid)
+                self.sent += 1
+                print(f"📤 Mensaje de WhatsApp ({row.kind}) enviado a {row.to_number} ({twilio_sid})")
+            except asyncio.CancelledError:
+                # Apagado del servidor: el mensaje queda en "sending" y _recover lo reencola al arrancar.
+                raise
+            except Exception as e:
+                import traceback
+                print(f"❌ Bandeja de salida de WhatsApp: error inesperado en mensaje {row_id}: {e}")
+                print(traceback.format_exc())
+
+    async def _purge_loop(self) -> None:
+        """Borra periódicamente los mensajes enviados o fallidos más viejos que el TTL."""
+        while True:
+            try:
+                deleted = await asyncio.to_thread(purge_expired)
+                if deleted:
+                    print(f"🧹 {deleted} mensajes de salida de WhatsApp expirados borrados")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ No se pudieron borrar mensajes de salida de WhatsApp expirados: {e}")
+            await asyncio.sleep(WHATSAPP_PURGE_INTERVAL)
+
+
+whatsapp_outbox = WhatsAppOutbox()
+
+
+async def start() -> None:
+    await whatsapp_outbox.start()
+
+
+async def stop() -> None:
+    await whatsapp_outbox.stop()
+
+
+def enqueue(db: Session, to: str, body: str, **kwargs) -> Tuple[models.WhatsAppOutbound, bool]:
+    return whatsapp_outbox.enqueue(db, to, body, **kwargs)
+
+
+def stats() -> Dict[str, int]:
+    return whatsapp_outbox.stats()
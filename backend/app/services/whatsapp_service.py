@@ -4,11 +4,13 @@ from typing import Optional
 try:
     from twilio.rest import Client
     from twilio.twiml.messaging_response import MessagingResponse
+    from twilio.base.exceptions import TwilioRestException
     TWILIO_AVAILABLE = True
 except ImportError:
     TWILIO_AVAILABLE = False
     Client = None
     MessagingResponse = None
+    TwilioRestException = None
 
 account_sid = os.getenv("TWILIO_ACCOUNT_SID")
 auth_token = os.getenv("TWILIO_AUTH_TOKEN")
@@ -16,23 +18,49 @@ whatsapp_number = os.getenv("TWILIO_WHATSAPP_NUMBER")
 
 client = Client(account_sid, auth_token) if (TWILIO_AVAILABLE and account_sid and auth_token) else None
 
-def send_whatsapp_message(to: str, message: str) -> bool:
+# Códigos de Twilio que indican saturación temporal (se reintenta): demasiadas peticiones / límite de WhatsApp.
+RETRYABLE_TWILIO_CODES = {20429, 63018}
+
+
+class WhatsAppSendError(Exception):
+    """Error al enviar; `retryable` indica si vale la pena reintentar (429, 5xx, red)."""
+
+    def __init__(self, message: str, retryable: bool):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def deliver_whatsapp_message(to: str, message: str, status_callback: Optional[str] = None) -> str:
     """
-    Envía un mensaje de WhatsApp usando Twilio.
+    Envía un mensaje de WhatsApp con Twilio (llamada bloqueante) y regresa el SID del mensaje.
+    Lanza WhatsAppSendError. Lo usa el worker de whatsapp_outbox; los demás solo encolan.
     """
     if not client:
-        print("Twilio no configurado")
-        return False
-    
+        raise WhatsAppSendError("Twilio no configurado", retryable=False)
+    to_number = to if to.startswith("whatsapp:") else f"whatsapp:{to}"
+    kwargs = {"status_callback": status_callback} if status_callback else {}
     try:
-        message = client.messages.create(
-            body=message,
-            from_=whatsapp_number,
-            to=f"whatsapp:{to}"
-        )
-        return True
+        sent = client.messages.create(body=message, from_=whatsapp_number, to=to_number, **kwargs)
     except Exception as e:
-        print(f"Error enviando mensaje WhatsApp: {str(e)}")
+        if TwilioRestException is not None and isinstance(e, TwilioRestException):
+            status = getattr(e, "status", None) or 0
+            retryable = status == 429 or status >= 500 or getattr(e, "code", None) in RETRYABLE_TWILIO_CODES
+            raise WhatsAppSendError(f"Twilio {status} ({getattr(e, 'code', None)}): {getattr(e, 'msg', e)}", retryable) from e
+        # Red / timeout: transitorio
+        raise WhatsAppSendError(f"Error enviando mensaje WhatsApp: {e}", retryable=True) from e
+    return sent.sid
+
+
+def send_whatsapp_message(to: str, message: str) -> bool:
+    """
+    Envía un mensaje de WhatsApp usando Twilio (bloqueante, sin reintentos).
+    Para avisos desde la app usar whatsapp_outbox.enqueue.
+    """
+    try:
+        deliver_whatsapp_message(to, message)
+        return True
+    except WhatsAppSendError as e:
+        print(str(e))
         return False
 
 def process_incoming_message(phone: str, message_body: str, media_url: Optional[str] = None) -> dict:
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Exactitud y micro-benchmark de la combinación de renglones entre partes de un recibo.
+
+Genera recibos sintéticos de varias partes (con productos repetidos, p. ej. 3 x "LECHE 1L"),
+los corta como lo hace receipt_images (cortes fijos con 260 px de solape o cortes en huecos),
+simula lo que lee el modelo en cada parte (variaciones OCR y renglones reordenados en el solape)
+y compara el esquema anterior (comparación por pares en la ventana de borde) contra la
+alineación por texto + monto con offsets en pixeles.
+
+Reporta por esquema: recibos combinados exactos, renglones perdidos, renglones duplicados
+y tiempo por combinación. Con --min-exactitud sale con código 1 si la alineación queda debajo.
+
+Uso:
+    python benchmark_combinacion_recibos.py [--recibos 300] [--semilla 7] [--min-exactitud 0.95]
+"""
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+
+from app.services import receipt_pipeline as receipts
+from app.services import receipt_images
+
+ROW_PX = 34  # alto de un renglón impreso en la imagen redimensionada
+HEADER_PX = 260
+FOOTER_PX = 420
+
+PRODUCTOS = [
+    ("LECHE LALA 1L", "25.50"), ("HUEVO BLANCO 12PZ", "48.90"), ("PAN BIMBO GDE", "52.00"),
+    ("TORTILLA MAIZ 1KG", "22.00"), ("JITOMATE SALADET KG", "31.80"), ("AGUA CIEL 1.5L", "14.50"),
+    ("COCA COLA 600ML", "18.00"), ("JAMON FUD 250G", "45.00"), ("QUESO OAXACA 400G", "89.00"),
+    ("PAPEL HIGIENICO 4R", "39.90"), ("DETERGENTE ARIEL 1KG", "64.50"), ("ARROZ SOS 1KG", "33.00"),
+    ("FRIJOL NEGRO 1KG", "41.00"), ("ATUN DOLORES 140G", "21.50"), ("PLATANO KG", "19.90"),
+    ("MANZANA ROJA KG", "49.00"), ("YOGURT DANONE 1L", "38.50"), ("CAFE NESCAFE 120G", "97.00"),
+    ("AZUCAR ESTANDAR 2KG", "58.00"), ("ACEITE 123 1L", "42.90"),
+]
+OCR_CAMBIOS = {"O": "0", "0": "O", "I": "1", "1": "I", "S": "5", "B": "8", "E": "F", "A": "4"}
+
+
+def generar_recibo(rng: random.Random, renglones: int):
+    """Lista de renglones (con productos repetidos consecutivos) y alto total de la imagen."""
+    items = []
+    while len(items) < renglones:
+        nombre, precio = rng.choice(PRODUCTOS)
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):  # a veces el mismo producto 2-3 veces seguidas
+            items.append({
+                "raw_line": f"{nombre} {precio}", "quantity_raw": "1", "unit_price_raw": precio, "total_raw": precio,
+                "_renglon": len(items),  # identidad del renglón impreso (solo para evaluar)
+            })
+    items = items[:renglones]
+    return items, HEADER_PX + len(items) * ROW_PX + FOOTER_PX
+
+
+def ruido_ocr(rng: random.Random, item):
+    """Variación OCR leve en el texto (el monto casi siempre se lee igual)."""
+    line = list(item["raw_line"])
+    for _ in range(rng.choice((1, 1, 2))):
+        pos = rng.randrange(len(line))
+        line[pos] = OCR_CAMBIOS.get(line[pos], line[pos])
+    out = dict(item, raw_line="".join(line))
+    if rng.random() < 0.05:
+        out["total_raw"] = "no legible"
+    return out
+
+
+def leer_partes(rng: random.Random, items, height: int, estrategia: str, ruido: float, reorden: float):
+    """Simula la lectura del modelo por parte: renglones completos dentro de la parte, con ruido en el solape."""
+    num_parts = max(2, min(8, height // 1100))
+    if estrategia == "gaps":
+        # Cortes entre renglones (como _gap_tiles): solape de a lo más 8 px de blanco
+        paso = len(items) / num_parts
+        cortes = [HEADER_PX + int(round(paso * i)) * ROW_PX for i in range(1, num_parts)]
+        bordes = [0] + cortes + [height]
+        tiles = [(max(0, bordes[i] - 8), min(height, bordes[i + 1] + 8)) for i in range(num_parts)]
+    else:
+        tiles = receipt_images._fixed_tiles(height, num_parts)
+
+    partes, offsets = [], []
+    anterior_bottom = None
+    for top, bottom in tiles:
+        parte = []
+        for idx, item in enumerate(items):
+            y0 = HEADER_PX + idx * ROW_PX
+            y1 = y0 + ROW_PX
+            if y0 >= top and y1 <= bottom:
+                en_solape = anterior_bottom is not None and y0 < anterior_bottom
+                parte.append(ruido_ocr(rng, item) if en_solape and rng.random() < ruido else dict(item))
+        # A veces el modelo reordena dos renglones del inicio de la parte
+        if len(parte) > 3 and rng.random() < reorden:
+            i = rng.randrange(0, min(4, len(parte) - 1))
+            parte[i], parte[i + 1] = parte[i + 1], parte[i]
+        partes.append(parte)
+        offsets.append((1, top, bottom))
+        anterior_bottom = bottom
+    return partes, offsets
+
+
+def _es_duplicado_anterior(item, tail_item) -> bool:
+    """Criterio por pares del esquema anterior: monto dentro de tolerancia y texto >= 0.90 parecido."""
+    a_line = receipts._normalize_for_match(str(item.get("raw_line") or ""))
+    b_line = receipts._normalize_for_match(str(tail_item.get("raw_line") or ""))
+    if not a_line or not b_line:
+        return False
+    a_total = receipts._parse_float_safe(item.get("total_raw"))
+    b_total = receipts._parse_float_safe(tail_item.get("total_raw"))
+    if a_total > 0 and b_total > 0 and abs(a_total - b_total) > max(1.0, max(a_total, b_total) * 0.03):
+        return False
+    if a_line.replace(" ", "") == b_line.replace(" ", ""):
+        return True
+    return receipts._similarity(a_line, b_line) >= 0.90
+
+
+def combinar_anterior(parts_items, tail_window: int = 60, boundary_window: int = 45):
+    """Esquema anterior: cada renglón de la ventana de borde contra toda la cola (por pares)."""
+    merged, removed = [], 0
+    for part_items in parts_items:
+        if not part_items:
+            continue
+        if not merged:
+            merged.extend(part_items)
+            continue
+        tail = merged[-tail_window:] if len(merged) > tail_window else merged
+        for idx_item, it in enumerate(part_items):
+            if idx_item < boundary_window and any(_es_duplicado_anterior(it, t) for t in tail):
+                removed += 1
+                continue
+            merged.append(it)
+    return merged, removed
+
+
+def evaluar(esperado, obtenido):
+    """(exacto, perdidos, duplicados) comparando qué renglones impresos quedaron y cuántas veces."""
+    e = Counter(it["_renglon"] for it in esperado)
+    o = Counter(it["_renglon"] for it in obtenido)
+    perdidos = sum((e - o).values())
+    duplicados = sum((o - e).values())
+    return perdidos == 0 and duplicados == 0, perdidos, duplicados
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Exactitud y micro-benchmark de la combinación de partes")
+    parser.add_argument("--recibos", type=int, default=300)
+    parser.add_argument("--semilla", type=int, default=7)
+    parser.add_argument("--ruido", type=float, default=0.3, help="Probabilidad de variación OCR en renglones del solape")
+    parser.add_argument("--reorden", type=float, default=0.2, help="Probabilidad de reordenar el inicio de una parte")
+    parser.add_argument("--min-exactitud", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.semilla)
+    casos = []
+    for _ in range(args.recibos):
+        items, height = generar_recibo(rng, rng.randint(20, 220))
+        estrategia = rng.choice(("fixed", "gaps"))
+        partes, offsets = leer_partes(rng, items, height, estrategia, args.ruido, args.reorden)
+        casos.append((estrategia, items, partes, offsets))
+
+    esquemas = {
+        "anterior (por pares)": lambda partes, offsets: combinar_anterior(partes),
+        "alineación sin offsets": lambda partes, offsets: receipts._merge_items_with_overlap_dedup(partes),
+        "alineación + offsets": lambda partes, offsets: receipts._merge_items_with_overlap_dedup(partes, offsets=offsets),
+    }
+
+    print(f"🧾 Combinación de partes: {len(casos)} recibos sintéticos (ruido OCR {args.ruido:.0%}, reorden {args.reorden:.0%})\n")
+    print(f"{'esquema':<26}{'estrategia':>10}{'exactos':>10}{'perdidos':>10}{'duplicados':>12}{'ms/recibo':>11}")
+    exactitud_final = None
+    for nombre, fn in esquemas.items():
+        for estrategia in ("fixed", "gaps", "todas"):
+            sub = [c for c in casos if estrategia == "todas" or c[0] == estrategia]
+            exactos = perdidos = duplicados = 0
+            t0 = time.perf_counter()
+            for _est, items, partes, offsets in sub:
+                merged, _removed = fn(partes, offsets)
+                ok, p, d = evaluar(items, merged)
+                exactos += int(ok)
+                perdidos += p
+                duplicados += d
+            ms = (time.perf_counter() - t0) * 1000.0 / max(1, len(sub))
+            exactitud = exactos / max(1, len(sub))
+            print(f"{nombre:<26}{estrategia:>10}{exactitud * 100:>9.1f}%{perdidos:>10}{duplicados:>12}{ms:>11.3f}")
+            if nombre == "alineación + offsets" and estrategia == "todas":
+                exactitud_final = exactitud
+        print()
+
+    # Micro-benchmark: costo por frontera según el tamaño de la ventana de solape
+    print("⏱️  Costo de una frontera (cola vs cabeza de N renglones, sin solape que encontrar)")
+    for n in (10, 45, 200, 500):
+        tail = [{"raw_line": f"PRODUCTO A{i} 10.00", "total_raw": f"{10 + i}.00"} for i in range(n)]
+        head = [{"raw_line": f"PRODUCTO B{i} 10.00", "total_raw": f"{5000 + i}.00"} for i in range(n)]
+        repeticiones = max(1, 400 // n)
+        tiempos = {}
+        for nombre, fn in (
+            ("anterior", lambda: combinar_anterior([tail, head], tail_window=n, boundary_window=n)),
+            ("alineación", lambda: receipts._merge_items_with_overlap_dedup([tail, head], tail_window=n, boundary_window=n)),
+        ):
+            t0 = time.perf_counter()
+            for _ in range(repeticiones):
+                fn()
+            tiempos[nombre] = (time.perf_counter() - t0) * 1000.0 / repeticiones
+        print(f"  N={n:<5} anterior={tiempos['anterior']:>9.3f} ms   alineación={tiempos['alineación']:>8.3f} ms")
+
+    if args.min_exactitud is not None and exactitud_final is not None and exactitud_final < args.min_exactitud:
+        print(f"\n❌ Exactitud {exactitud_final:.3f} < {args.min_exactitud}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
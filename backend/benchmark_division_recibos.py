@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark de división de recibos en partes: cortes fijos vs cortes en renglones en blanco.
+
+Para cada imagen de muestra (uploads/receipts/*.jpg|png, sin duplicados) compara:
+  - número de partes y pixeles enviados al modelo,
+  - tokens de visión estimados (fórmula de detalle "high" de OpenAI),
+  - cortes que atraviesan un renglón impreso (tinta en el renglón del corte),
+  - pixeles duplicados por solapamiento y tiempo de división.
+
+Uso:
+    python benchmark_division_recibos.py [--fast] [rutas...]
+"""
+import hashlib
+import io
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from app.services import receipt_images
+
+
+def medir(img, image_bytes: bytes, aggressive: bool, strategy: str) -> dict:
+    t0 = time.perf_counter()
+    parts, info = receipt_images.split_image_parts(img, image_bytes, aggressive=aggressive, strategy=strategy)
+    elapsed_ms = (time.perf_counter() - t0) * 1000.0
+
+    tiles = info["tiles"]
+    width = info["width"]
+    tokens = sum(receipt_images.vision_tokens(width, bottom - top) for top, bottom in tiles)
+    pixels = sum(width * (bottom - top) for top, bottom in tiles)
+    overlap_px = sum(max(0, tiles[i][1] - tiles[i + 1][0]) for i in range(len(tiles) - 1)) * width
+
+    # ¿Cuántos bordes de parte caen sobre tinta? (bordes internos; el perfil es de la imagen redimensionada)
+    cortes_en_tinta = 0
+    if len(tiles) > 1:
+        resized = receipt_images._resize_max_width(img, receipt_images._num_parts(img.size[1], aggressive)[1])
+        profile = receipt_images.ink_profile(resized)
+        nivel = receipt_images.blank_level(profile)
+        for i in range(len(tiles) - 1):
+            for y in (tiles[i][1] - 1, tiles[i + 1][0]):
+                if 0 <= y < len(profile) and profile[y] > nivel:
+                    cortes_en_tinta += 1
+
+    return {
+        "partes": len(parts),
+        "estrategia": info["strategy"],
+        "tokens": tokens,
+        "pixeles": pixels,
+        "solape_px": overlap_px,
+        "cortes_en_tinta": cortes_en_tinta,
+        "bytes": sum(len(p) for p in parts),
+        "ms": elapsed_ms,
+    }
+
+
+def main(args):
+    aggressive = "--fast" not in args
+    rutas = [Path(a) for a in args if not a.startswith("--")]
+    if not rutas:
+        carpeta = Path(__file__).resolve().parent / "uploads" / "receipts"
+        rutas = sorted(list(carpeta.glob("*.jpg")) + list(carpeta.glob("*.png")))
+
+    vistos = set()
+    totales = {"fixed": {}, "gaps": {}}
+    print(f"🧾 Benchmark de división ({'preciso' if aggressive else 'rápido'})\n")
+    print(f"{'imagen':<22}{'tamaño':>12} | {'fijo: partes/tokens/tinta/ms':>30} | {'huecos: partes/tokens/tinta/ms':>32} | estrategia")
+    for ruta in rutas:
+        data = ruta.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in vistos:
+            continue
+        vistos.add(digest)
+
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        fila = {}
+        for strategy in ("fixed", "gaps"):
+            r = medir(img, data, aggressive, strategy)
+            fila[strategy] = r
+            acc = totales[strategy]
+            for k in ("partes", "tokens", "pixeles", "solape_px", "cortes_en_tinta", "bytes", "ms"):
+                acc[k] = acc.get(k, 0) + r[k]
+
+        f, g = fila["fixed"], fila["gaps"]
+        print(
+            f"{ruta.name:<22}{img.size[0]:>5}x{img.size[1]:<6} | "
+            f"{f['partes']:>6}/{f['tokens']:>6}/{f['cortes_en_tinta']:>3}/{f['ms']:>7.1f}   | "
+            f"{g['partes']:>6}/{g['tokens']:>6}/{g['cortes_en_tinta']:>3}/{g['ms']:>7.1f}     | {g['estrategia']}"
+        )
+
+    if not vistos:
+        print("⚠️  No se encontraron imágenes.")
+        return
+
+    f, g = totales["fixed"], totales["gaps"]
+    print(f"\n📊 {len(vistos)} imágenes únicas")
+    for k, etiqueta in (
+        ("tokens", "Tokens de visión"),
+        ("pixeles", "Pixeles enviados"),
+        ("solape_px", "Pixeles duplicados (solape)"),
+        ("cortes_en_tinta", "Bordes sobre un renglón"),
+        ("bytes", "Bytes JPEG"),
+        ("ms", "Tiempo de división (ms)"),
+    ):
+        ahorro = (1 - g[k] / f[k]) * 100 if f[k] else 0.0
+        print(f"  {etiqueta:<30} fijo={f[k]:>12.0f}  huecos={g[k]:>12.0f}  ({ahorro:+.1f}% ahorro)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Benchmark de punta a punta del pipeline de recibos (división, llamadas al LLM, combinación y guardado).
+
+Corre el mismo pipeline que POST /api/receipts/process sobre un corpus de imágenes y reporta:
+  - tiempo de pared por recibo (p50 / p95) y total,
+  - llamadas al LLM, bytes enviados y tokens por recibo,
+  - exactitud de la combinación: recibos que cuadran con su total declarado y, si hay
+    resultados esperados (benchmark_recibos_esperados.json), acierto del total y F1 por renglón.
+
+Pensado para correr SIN red ni costo con el transporte de replay (app/services/llm_transport.py):
+    # 1) Grabar una vez (requiere OPENAI_API_KEY):
+    LLM_TRANSPORT=record python benchmark_pipeline_recibos.py
+    # 2) Repetir cuantas veces se quiera, offline, con latencia y errores simulados:
+    LLM_TRANSPORT=replay python benchmark_pipeline_recibos.py --latencia 400-1500 --errores 0.05
+
+Corpus: las rutas indicadas o uploads/receipts/*.jpg|png (sin duplicados), más los recibos con imagen local
+que aparezcan en las exportaciones domus_plus_recibos_*.json (su "monto" se usa como total esperado).
+La base de datos y los archivos subidos van a una carpeta temporal; no toca la BD ni uploads/ reales.
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent
+ESPERADOS_PATH = BACKEND_DIR / "benchmark_recibos_esperados.json"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark de punta a punta del pipeline de recibos")
+    parser.add_argument("rutas", nargs="*", help="Imágenes a procesar (default: uploads/receipts)")
+    parser.add_argument("--fast", action="store_true", help="Modo rápido (default: preciso)")
+    parser.add_argument("--concurrencia", type=int, default=1, help="Recibos procesados a la vez")
+    parser.add_argument("--repeticiones", type=int, default=1, help="Veces que se procesa el corpus")
+    parser.add_argument("--limite", type=int, default=0, help="Máximo de imágenes del corpus (0 = todas)")
+    parser.add_argument("--latencia", default=None, help="Replay: latencia simulada en ms ('800' o '400-1500')")
+    parser.add_argument("--errores", type=float, default=None, help="Replay: fracción de llamadas con error inyectado")
+    parser.add_argument("--tipo-error", default=None, help="Replay: timeout | rate_limit | server | mixed")
+    parser.add_argument("--semilla", type=int, default=7, help="Semilla de latencia/errores (reproducible)")
+    parser.add_argument("--cassettes", default=None, help="Carpeta de grabaciones (default: LLM_CASSETTE_DIR o backend/llm_cassettes)")
+    parser.add_argument("--cache", action="store_true", help="Usar la caché de extracciones (por defecto se desactiva)")
+    parser.add_argument("--guardar-esperados", action="store_true", help="Guardar los resultados como esperados (revisarlos antes)")
+    parser.add_argument("--json", dest="json_out", default=None, help="Escribir el reporte completo en este archivo JSON")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar la salida del pipeline")
+    return parser.parse_args(argv)
+
+
+def preparar_entorno(args) -> Path:
+    """BD y uploads temporales; debe correr ANTES de importar app.*"""
+    tmp = Path(tempfile.mkdtemp(prefix="bench_recibos_"))
+    os.environ["DATABASE_URL"] = f"sqlite:///{tmp / 'bench.db'}"
+    os.environ["UPLOADS_DIR"] = str(tmp / "uploads")
+    if not args.cache:
+        os.environ["RECEIPT_CACHE_ENABLED"] = "0"
+    return tmp
+
+
+def cargar_corpus(args):
+    """Lista de {"nombre", "ruta", "sha256", "esperado_total"} sin imágenes duplicadas."""
+    rutas = [Path(r) for r in args.rutas]
+    if not rutas:
+        carpeta = BACKEND_DIR / "uploads" / "receipts"
+        rutas = sorted(list(carpeta.glob("*.jpg")) + list(carpeta.glob("*.png")))
+
+    totales_exportados = {}
+    exportaciones = sorted(BACKEND_DIR.glob("domus_plus_recibos_*.json"))
+    for export in exportaciones:
+        try:
+            data = json.loads(export.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"⚠️ No se pudo leer {export.name}: {e}")
+            continue
+        for registro in (data.get("recibos") or []) + (data.get("todas_las_transacciones") or []):
+            url = registro.get("receipt_image_url")
+            if not url or registro.get("monto") is None:
+                continue
+            local = BACKEND_DIR / "uploads" / "receipts" / Path(str(url)).name
+            if local.exists():
+                totales_exportados[str(local.resolve())] = float(registro["monto"])
+                if local not in rutas and not args.rutas:
+                    rutas.append(local)
+
+    corpus = []
+    vistos = set()
+    for ruta in rutas:
+        data = ruta.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in vistos:
+            continue
+        vistos.add(digest)
+        corpus.append({
+            "nombre": ruta.name,
+            "ruta": ruta,
+            "sha256": digest,
+            "esperado_total": totales_exportados.get(str(ruta.resolve())),
+        })
+    if args.limite:
+        corpus = corpus[: args.limite]
+    return corpus, len(exportaciones), len(totales_exportados)
+
+
+def percentil(valores, p: float) -> float:
+    if not valores:
+        return 0.0
+    orden = sorted(valores)
+    idx = min(len(orden) - 1, max(0, math.ceil(p / 100.0 * len(orden)) - 1))  # rango más cercano
+    return orden[idx]
+
+
+def _norm(texto: str) -> str:
+    return re.sub(r"[^A-Z0-9]", "", str(texto or "").upper())
+
+
+def renglones(items) -> Counter:
+    """Multiconjunto (descripción normalizada, centavos) sin placeholders ni ajustes del sistema."""
+    out = Counter()
+    for item in items:
+        if item.get("is_adjustment") or item.get("is_placeholder"):
+            continue
+        out[(_norm(item["description"]), round(float(item["amount"] or 0) * 100))] += 1
+    return out
+
+
+def f1(predichos: Counter, esperados: Counter) -> float:
+    if not predichos and not esperados:
+        return 1.0
+    tp = sum((predichos & esperados).values())
+    if tp == 0:
+        return 0.0
+    precision = tp / sum(predichos.values())
+    recall = tp / sum(esperados.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+async def procesar_recibo(entrada, mode, user_id, sem):
+    from app.database import SessionLocal
+    from app.services import llm_transport, receipt_pipeline
+    from app import models
+
+    data = entrada["ruta"].read_bytes()
+    uploads = [{
+        "filename": entrada["nombre"],
+        "content_type": "image/png" if entrada["nombre"].lower().endswith(".png") else "image/jpeg",
+        "data": data,
+    }]
+    async with sem:
+        db = SessionLocal()
+        fila = {"nombre": entrada["nombre"], "sha256": entrada["sha256"], "ok": False}
+        try:
+            with llm_transport.track() as contadores:
+                t0 = time.perf_counter()
+                try:
+                    result = await receipt_pipeline.run_receipt_pipeline(db, uploads, mode, user_id, "http://benchmark")
+                    fila["ok"] = True
+                except receipt_pipeline.ReceiptPipelineError as e:
+                    fila["error"] = str(e.detail)[:200]
+                    result = None
+                except Exception as e:
+                    fila["error"] = f"{type(e).__name__}: {e}"[:200]
+                    result = None
+                fila["segundos"] = time.perf_counter() - t0
+            fila.update(
+                llamadas=contadores["calls"],
+                errores_llm=contadores["errors"],
+                bytes_enviados=contadores["bytes_sent"],
+                tokens=contadores["tokens"],
+            )
+            if result:
+                receipt = db.query(models.Receipt).filter(models.Receipt.id == result["receipt_id"]).first()
+                notes = json.loads(receipt.notes or "{}")
+                arith = notes.get("arith") or {}
+                items = []
+                for item in db.query(models.ReceiptItem).filter(models.ReceiptItem.receipt_id == receipt.id).all():
+                    item_notes = json.loads(item.notes or "{}")
+                    items.append({
+                        "description": item.description,
+                        "amount": item.amount,
+                        "is_adjustment": bool(item_notes.get("is_adjustment")),
+                        "is_placeholder": bool(item_notes.get("is_placeholder")),
+                    })
+                diff = arith.get("diff_total_minus_items")
+                fila.update(
+                    total=receipt.amount,
+                    total_declarado=arith.get("declared_total"),
+                    diferencia=diff,
+                    cuadra=bool(arith.get("declared_total")) and diff is not None and abs(diff) < 0.5,
+                    renglones=len([i for i in items if not i["is_adjustment"] and not i["is_placeholder"]]),
+                    placeholders=sum(1 for i in items if i["is_placeholder"]),
+                    items=items,
+                    partes_fallidas=sum(1 for p in notes.get("parts_status") or [] if not p.get("ok") and not p.get("skipped")),
+                    reextracciones=len(notes.get("reextract") or []),
+                )
+        finally:
+            db.close()
+    return fila
+
+
+def evaluar(fila, entrada, esperados):
+    """Compara contra el resultado esperado (archivo de esperados o total de la exportación)."""
+    esperado = esperados.get(entrada["sha256"]) or {}
+    total_esperado = esperado.get("total", entrada.get("esperado_total"))
+    if total_esperado is not None and fila.get("ok"):
+        fila["total_correcto"] = abs(float(fila.get("total") or 0) - float(total_esperado)) <= 0.01
+    if esperado.get("items") is not None and fila.get("ok"):
+        fila["f1_renglones"] = f1(renglones(fila["items"]), renglones(esperado["items"]))
+
+
+async def correr(args, corpus):
+    from app.database import Base, SessionLocal, engine
+    from app import models
+    from app.services import llm_transport, receipt_images
+
+    llm_transport.configure(
+        cassette_dir=args.cassettes,
+        latency_ms=args.latencia,
+        error_rate=args.errores,
+        error_kind=args.tipo_error,
+        seed=args.semilla,
+    )
+    llm_transport.reset_stats()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    user = models.User(email="benchmark@example.com", phone="+520000000000", name="Benchmark", hashed_password="x")
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    db.close()
+
+    mode = "fast" if args.fast else "precise"
+    sem = asyncio.Semaphore(max(1, args.concurrencia))
+    receipt_images.warmup()
+
+    salida = io.StringIO()
+    t0 = time.perf_counter()
+    with (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(salida)):
+        filas = []
+        for _ in range(max(1, args.repeticiones)):
+            filas += await asyncio.gather(*[procesar_recibo(e, mode, user_id, sem) for e in corpus])
+    pared = time.perf_counter() - t0
+    receipt_images.shutdown()
+    return filas, pared, llm_transport.stats()
+
+
+def reporte(args, corpus, filas, pared, stats_llm, exportaciones, con_total):
+    esperados = {}
+    if ESPERADOS_PATH.exists():
+        esperados = json.loads(ESPERADOS_PATH.read_text(encoding="utf-8"))
+    por_sha = {e["sha256"]: e for e in corpus}
+    for fila in filas:
+        evaluar(fila, por_sha[fila["sha256"]], esperados)
+
+    ok = [f for f in filas if f.get("ok")]
+    fallidos = Counter(f.get("error") or "error desconocido" for f in filas if not f.get("ok"))
+    tiempos = [f["segundos"] for f in filas]
+    n = len(filas) or 1
+
+    print(f"🧾 Benchmark del pipeline de recibos ({'rápido' if args.fast else 'preciso'}, transporte {stats_llm['mode']})")
+    print(f"   Corpus: {len(corpus)} imágenes × {max(1, args.repeticiones)} · concurrencia {args.concurrencia}"
+          f" · exportaciones leídas: {exportaciones} (recibos con imagen local: {con_total})\n")
+    print(f"{'imagen':<22}{'seg':>7}{'llam':>6}{'KB env':>9}{'renglones':>10}{'cuadra':>8}{'total ok':>9}{'F1':>6}")
+    for f in filas:
+        total_ok = f.get("total_correcto")
+        print(
+            f"{f['nombre']:<22}{f['segundos']:>7.2f}{f.get('llamadas', 0):>6}{f.get('bytes_enviados', 0) / 1024:>9.0f}"
+            f"{f.get('renglones', 0):>10}{('sí' if f.get('cuadra') else 'no') if f.get('ok') else 'ERR':>8}"
+            f"{('-' if total_ok is None else ('sí' if total_ok else 'no')):>9}"
+            f"{('-' if f.get('f1_renglones') is None else format(f['f1_renglones'], '.2f')):>6}"
+        )
+
+    con_total_esperado = [f for f in ok if f.get("total_correcto") is not None]
+    con_f1 = [f["f1_renglones"] for f in ok if f.get("f1_renglones") is not None]
+    resumen = {
+        "recibos": len(filas),
+        "ok": len(ok),
+        "fallidos": len(filas) - len(ok),
+        "errores_pipeline": dict(fallidos),
+        "pared_total_s": round(pared, 2),
+        "p50_s": round(percentil(tiempos, 50), 3),
+        "p95_s": round(percentil(tiempos, 95), 3),
+        "llamadas_por_recibo": round(sum(f.get("llamadas", 0) for f in filas) / n, 2),
+        "bytes_enviados_por_recibo": int(sum(f.get("bytes_enviados", 0) for f in filas) / n),
+        "tokens_por_recibo": int(sum(f.get("tokens", 0) for f in filas) / n),
+        "cuadran_con_total": round(sum(1 for f in ok if f.get("cuadra")) / len(ok), 4) if ok else 0.0,
+        "total_correcto": round(sum(1 for f in con_total_esperado if f["total_correcto"]) / len(con_total_esperado), 4) if con_total_esperado else None,
+        "f1_renglones": round(sum(con_f1) / len(con_f1), 4) if con_f1 else None,
+        "llm": stats_llm,
+    }
+    print(f"\n📊 {resumen['ok']}/{resumen['recibos']} recibos guardados en {resumen['pared_total_s']} s")
+    print(f"  Tiempo por recibo           p50={resumen['p50_s']:.2f}s  p95={resumen['p95_s']:.2f}s")
+    print(f"  Llamadas al LLM por recibo  {resumen['llamadas_por_recibo']}")
+    print(f"  Bytes enviados por recibo   {resumen['bytes_enviados_por_recibo'] / 1024:.0f} KB")
+    print(f"  Tokens por recibo           {resumen['tokens_por_recibo']}")
+    print(f"  Cuadran con su total        {resumen['cuadran_con_total'] * 100:.1f}%")
+    if resumen["total_correcto"] is not None:
+        print(f"  Total = esperado            {resumen['total_correcto'] * 100:.1f}% ({len(con_total_esperado)} con esperado)")
+    if resumen["f1_renglones"] is not None:
+        print(f"  F1 de renglones             {resumen['f1_renglones']:.3f} ({len(con_f1)} con esperado)")
+    print(
+        f"  LLM: {stats_llm['calls']} llamadas, {stats_llm['errors']} errores"
+        f" ({stats_llm['injected_errors']} inyectados, {stats_llm['replay_misses']} sin grabación),"
+        f" {stats_llm['recorded']} grabadas"
+    )
+    if fallidos:
+        print(f"❌ {resumen['fallidos']} recibos fallaron en el pipeline:")
+        for error, veces in fallidos.most_common(5):
+            print(f"     {veces}× {error}")
+    if stats_llm["mode"] == "replay" and stats_llm["replay_misses"]:
+        print("⚠️  Hay llamadas sin grabación: graba el corpus con LLM_TRANSPORT=record o revisa que el modo/prompt no haya cambiado.")
+
+    if args.guardar_esperados:
+        for f in ok:
+            esperados[f["sha256"]] = {
+                "nombre": f["nombre"],
+                "total": f.get("total"),
+                "items": [i for i in f.get("items") or [] if not i["is_adjustment"] and not i["is_placeholder"]],
+            }
+        ESPERADOS_PATH.write_text(json.dumps(esperados, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 Esperados guardados en {ESPERADOS_PATH.name} ({len(ok)} recibos)")
+
+    if args.json_out:
+        detalle = [{k: v for k, v in f.items() if k != "items"} for f in filas]
+        Path(args.json_out).write_text(json.dumps({"resumen": resumen, "recibos": detalle}, ensure_ascii=False, indent=2), encoding="utf-8")
+    return resumen
+
+
+def main(argv):
+    args = parse_args(argv)
+    tmp = preparar_entorno(args)
+    sys.path.insert(0, str(BACKEND_DIR))
+    try:
+        corpus, exportaciones, con_total = cargar_corpus(args)
+        if not corpus:
+            print("⚠️  No se encontraron imágenes.")
+            return
+        filas, pared, stats_llm = asyncio.run(correr(args, corpus))
+        reporte(args, corpus, filas, pared, stats_llm, exportaciones, con_total)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,54 @@
+"""
+Script de migración para crear budget_rollups (agregado mensual por presupuesto familiar y usuario que
+usan el resumen de presupuestos, los presupuestos personales y el tablero) y llenarlo desde las
+transacciones existentes. También deja user_budgets.spent_amount igual a los egresos registrados.
+Se puede correr de nuevo sin problema: recalcula los agregados completos.
+"""
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./domus_plus.db")
+
+
+def run_migration():
+    # Importar después de load_dotenv (app.database lee DATABASE_URL al importarse)
+    from app import models
+    from app.services import spending_rollups
+
+    engine = create_engine(DATABASE_URL)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    print("🚀 Iniciando migración: crear budget_rollups y llenarlo")
+
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    if 'transactions' not in tables:
+        print("⚠️ Tabla transactions no encontrada. Se creará automáticamente al iniciar el servidor.")
+        return
+
+    for model in (models.MonthlySpending, models.BudgetRollup):
+        if model.__tablename__ not in tables:
+            print(f"🔄 Creando tabla {model.__tablename__}...")
+            model.__table__.create(engine)
+        else:
+            print(f"ℹ️ Tabla {model.__tablename__} ya existe.")
+
+    with SessionLocal() as db:
+        try:
+            rows = spending_rollups.rebuild(db)
+            db.commit()
+            print(f"✅ budget_rollups recalculado: {rows['budget_rollups']} filas "
+                  f"(monthly_spending: {rows['monthly_spending']})")
+        except Exception:
+            db.rollback()
+            raise
+
+    print("✅ Migración completada")
+
+
+if __name__ == "__main__":
+    run_migration()
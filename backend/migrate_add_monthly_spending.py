@@ -0,0 +1,56 @@
+"""
+Script de migración para crear monthly_spending (agregado mensual de transacciones que usan los
+comandos de texto de WhatsApp) y el índice transactions(user_id, date), y llenarlo desde las
+transacciones existentes con un solo INSERT ... SELECT agrupado.
+Se puede correr de nuevo sin problema: recalcula el agregado completo.
+"""
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./domus_plus.db")
+
+
+def run_migration():
+    # Importar después de load_dotenv (app.database lee DATABASE_URL al importarse)
+    from app import models
+    from app.services import spending_rollups
+
+    engine = create_engine(DATABASE_URL)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    print("🚀 Iniciando migración: crear monthly_spending y llenarlo")
+
+    inspector = inspect(engine)
+    if 'transactions' not in inspector.get_table_names():
+        print("⚠️ Tabla transactions no encontrada. Se creará automáticamente al iniciar el servidor.")
+        return
+
+    if 'monthly_spending' not in inspector.get_table_names():
+        print("🔄 Creando tabla monthly_spending...")
+        models.MonthlySpending.__table__.create(engine)
+    else:
+        print("ℹ️ Tabla monthly_spending ya existe.")
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_transactions_user_date ON transactions (user_id, date)"
+        ))
+
+    with SessionLocal() as db:
+        try:
+            rows = spending_rollups.rebuild(db)
+            db.commit()
+            print(f"✅ monthly_spending recalculado: {rows['monthly_spending']} filas")
+        except Exception:
+            db.rollback()
+            raise
+
+    print("✅ Migración completada")
+
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,70 @@
+"""
+Script de migración para agregar users.phone_e164 y users.phone_last10 (con índice) y rellenarlos
+a partir de users.phone. El webhook de WhatsApp busca al remitente por estas columnas.
+Se puede correr de nuevo sin problema: solo recalcula las filas cuyo valor cambió.
+"""
+from sqlalchemy import create_engine, inspect, text
+import os
+from dotenv import load_dotenv
+
+from app.services.phone_numbers import normalize_phone, phone_last10
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./domus_plus.db")
+
+COLUMNS = (
+    ("phone_e164", "VARCHAR", "ix_users_phone_e164"),
+    ("phone_last10", "VARCHAR(10)", "ix_users_phone_last10"),
+)
+
+
+def run_migration():
+    engine = create_engine(DATABASE_URL)
+
+    print("🚀 Iniciando migración: agregar phone_e164 / phone_last10 a users")
+
+    inspector = inspect(engine)
+    if 'users' not in inspector.get_table_names():
+        print("⚠️ Tabla users no encontrada. Se creará automáticamente al iniciar el servidor.")
+        return
+
+    existing = {col['name'] for col in inspector.get_columns('users')}
+    with engine.begin() as connection:
+        for column, sql_type, index_name in COLUMNS:
+            if column not in existing:
+                print(f"🔄 Agregando columna {column}...")
+                connection.execute(text(f"ALTER TABLE users ADD COLUMN {column} {sql_type}"))
+            else:
+                print(f"ℹ️ Columna {column} ya existe. Saltando.")
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON users ({column})"))
+
+    # Rellenar con el mismo normalizador que usa la app (registro y webhook)
+    updated = 0
+    with engine.begin() as connection:
+        rows = connection.execute(text("SELECT id, phone, phone_e164, phone_last10 FROM users")).fetchall()
+        for user_id, phone, current_e164, current_last10 in rows:
+            e164 = normalize_phone(phone)
+            last10 = phone_last10(phone)
+            if e164 == current_e164 and last10 == current_last10:
+                continue
+            connection.execute(
+                text("UPDATE users SET phone_e164 = :e164, phone_last10 = :last10 WHERE id = :id"),
+                {"e164": e164, "last10": last10, "id": user_id},
+            )
+            updated += 1
+        print(f"✅ {updated} de {len(rows)} usuarios actualizados")
+
+        # Avisar de números que ahora coinciden (mismo número escrito en formatos distintos)
+        duplicates = connection.execute(text(
+            "SELECT phone_e164, COUNT(*) FROM users WHERE phone_e164 IS NOT NULL "
+            "GROUP BY phone_e164 HAVING COUNT(*) > 1"
+        )).fetchall()
+        for e164, count in duplicates:
+            print(f"⚠️ {count} usuarios comparten el número {e164}; WhatsApp usará el de menor id")
+
+    print("✅ Migración completada")
+
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,62 @@
+"""
+Script de migración para crear sync_changes (registro de cambios de GET /api/sync) y registrar las
+transacciones, recibos, conceptos, presupuestos, asignaciones y categorías personalizadas que ya existen,
+para que la primera sincronización de cada cliente las incluya.
+Se puede correr de nuevo sin problema: solo agrega las entidades que todavía no tienen fila (y la
+columna user_ids con los dueños actuales si la tabla es de antes).
+"""
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./domus_plus.db")
+
+
+def run_migration():
+    # Importar después de load_dotenv (app.database lee DATABASE_URL al importarse)
+    from app import models
+    from app.services import sync_log
+
+    engine = create_engine(DATABASE_URL)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    print("🚀 Iniciando migración: crear sync_changes y registrar lo existente")
+
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    if 'transactions' not in tables:
+        print("⚠️ Tabla transactions no encontrada. Se creará automáticamente al iniciar el servidor.")
+        return
+
+    for model in (models.FamilyDataVersion, models.SyncChange):
+        if model.__tablename__ not in tables:
+            print(f"🔄 Creando tabla {model.__tablename__}...")
+            model.__table__.create(engine)
+        else:
+            print(f"ℹ️ Tabla {model.__tablename__} ya existe.")
+
+    # Dueños de transacciones, recibos y conceptos (tablas creadas antes de user_ids); seed() los llena
+    existing = {col['name'] for col in inspect(engine).get_columns('sync_changes')}
+    if 'user_ids' not in existing:
+        print("🔄 Agregando columna user_ids a sync_changes...")
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE sync_changes ADD COLUMN user_ids VARCHAR"))
+
+    with SessionLocal() as db:
+        try:
+            rows = sync_log.seed(db)
+            db.commit()
+            for entity, count in rows.items():
+                print(f"✅ {entity}: {count} filas registradas")
+        except Exception:
+            db.rollback()
+            raise
+
+    print("✅ Migración completada")
+
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,51 @@
+"""
+Script de migración para hacer único whatsapp_messages.message_sid (idempotencia de reintentos de Twilio).
+Si ya hay MessageSid repetidos se conserva el registro más antiguo de cada uno.
+En bases nuevas la tabla ya se crea con el índice único al iniciar el servidor.
+"""
+from sqlalchemy import create_engine, inspect, text
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./domus_plus.db")
+INDEX_NAME = "ix_whatsapp_messages_message_sid"
+
+
+def run_migration():
+    engine = create_engine(DATABASE_URL)
+
+    print("🚀 Iniciando migración: índice único en whatsapp_messages.message_sid")
+
+    inspector = inspect(engine)
+    if 'whatsapp_messages' not in inspector.get_table_names():
+        print("⚠️ Tabla whatsapp_messages no encontrada. Se creará automáticamente al iniciar el servidor.")
+        return
+
+    indexes = {ix['name']: ix for ix in inspector.get_indexes('whatsapp_messages')}
+    if indexes.get(INDEX_NAME, {}).get('unique'):
+        print("ℹ️ El índice único ya existe. Saltando.")
+        return
+
+    with engine.begin() as connection:
+        duplicates = connection.execute(text(
+            "SELECT message_sid, COUNT(*) FROM whatsapp_messages GROUP BY message_sid HAVING COUNT(*) > 1"
+        )).fetchall()
+        if duplicates:
+            print(f"🔄 Eliminando registros repetidos de {len(duplicates)} MessageSid (se conserva el más antiguo)...")
+            connection.execute(text(
+                "DELETE FROM whatsapp_messages WHERE id NOT IN ("
+                "SELECT MIN(id) FROM whatsapp_messages GROUP BY message_sid)"
+            ))
+
+        if INDEX_NAME in indexes:
+            connection.execute(text(f"DROP INDEX {INDEX_NAME}"))
+        print("🔄 Creando índice único...")
+        connection.execute(text(f"CREATE UNIQUE INDEX {INDEX_NAME} ON whatsapp_messages (message_sid)"))
+
+    print("✅ Migración completada")
+
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Recalcula los agregados de transacciones (monthly_spending y budget_rollups) y user_budgets.spent_amount
+desde cero, con un INSERT ... SELECT agrupado por tabla en una sola transacción.
+Útil después de cargar o borrar transacciones por fuera de la app (SQL directo, restauraciones).
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.database import SessionLocal
+from app.services import spending_rollups
+
+
+def rebuild_rollups():
+    db = SessionLocal()
+    try:
+        rows = spending_rollups.rebuild(db)
+        db.commit()
+        for table, count in rows.items():
+            print(f"✅ {table}: {count} filas")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Error: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    rebuild_rollups()